@@ -0,0 +1,179 @@
+"""
+Бенчмарк рассылки: BroadcastEngine против прежнего /broadcast (все user_id в память, затем
+по одному сообщению с паузой 0.1 с и строкой лога на каждое).
+
+Вместо Bot API используется сессия aiogram, которая отвечает на каждый вызов через --latency
+секунд, может отвечать TelegramForbiddenError (каждый --blocked-every пользователь) и один
+раз TelegramRetryAfter. Каждый сценарий получает свой временный SQLite-файл с --users
+пользователями. Печатает:
+- скорость прежнего обработчика (на --old-users пользователях, он медленный);
+- скорость движка при лимите --rate сообщений в секунду и без лимита;
+- число помеченных is_blocked при заблокированных пользователях и RetryAfter;
+- число повторных доставок после остановки посреди задания и продолжения новым движком.
+
+Запуск:
+    python bench_broadcast.py [--users 1000] [--old-users 200] [--rate 25] [--latency 0.03]
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.WARNING)
+
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+
+import main  # noqa: E402
+
+ADMIN_ID = 999_999
+BATCH_SIZE = 200
+CONCURRENCY = 10
+
+logger = logging.getLogger("bench")
+
+
+class MockSession(BaseSession):
+    """Сессия aiogram без сети: задержка на вызов, заблокированные чаты и RetryAfter на заданных вызовах."""
+
+    def __init__(self, latency: float, blocked: set[int] = frozenset(), retry_after_at: set[int] = frozenset()):
+        super().__init__()
+        self.latency = latency
+        self.blocked = blocked
+        self.retry_after_at = retry_after_at
+        self.sent = collections.Counter()
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if not isinstance(method, SendMessage):
+            return True
+        if self.calls in self.retry_after_at:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests: retry after 1", retry_after=1)
+        if method.chat_id in self.blocked:
+            raise TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")
+        self.sent[method.chat_id] += 1
+        return types.Message(message_id=1, date=0, chat=types.Chat(id=method.chat_id, type="private"), text=method.text)
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+async def open_db(tmp: str, name: str, users: int) -> main.SQLiteBackend:
+    db = await main.init_sqlite_db(f"sqlite:///{tmp}/{name}.db", main.settings.SQLITE_POOL_SIZE)
+    await db.run(lambda conn: conn.executemany(
+        "INSERT INTO users (user_id, first_name) VALUES (?, 'bench')", [(i,) for i in range(1, users + 1)]
+    ))
+    return db
+
+
+async def legacy_broadcast(bot: Bot, db: main.SQLiteBackend, text: str) -> int:
+    """Прежний обработчик /broadcast без ответа администратору."""
+    user_ids = await db.run(lambda conn: [r[0] for r in conn.execute("SELECT user_id FROM users").fetchall()])
+    sent = 0
+    for uid in user_ids:
+        try:
+            await bot.send_message(uid, text)
+            sent += 1
+            logger.info(f"Broadcast to {uid} succeeded")
+        except Exception as e:
+            logger.warning(f"Broadcast to {uid} failed: {e}")
+        await asyncio.sleep(0.1)
+    return sent
+
+
+async def wait_idle(engine: main.BroadcastEngine):
+    while engine._tasks:
+        await asyncio.sleep(0.02)
+
+
+async def count_blocked(db: main.SQLiteBackend) -> int:
+    return await db.run(lambda conn: conn.execute("SELECT COUNT(*) FROM users WHERE is_blocked").fetchone()[0])
+
+
+def report(name: str, users: int, elapsed: float, extra: str = ""):
+    rate = users / elapsed
+    print(f"  {name:<28} {users} за {elapsed:6.1f} с: {rate:6.1f} msg/s, 50k за {50_000 / rate / 60:5.0f} мин{extra}")
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(prefix="bench-broadcast-") as tmp:
+        db = await open_db(tmp, "legacy", args.old_users)
+        session = MockSession(args.latency)
+        started = time.perf_counter()
+        sent = await legacy_broadcast(Bot(main.settings.TELEGRAM_BOT_TOKEN, session=session), db, "bench")
+        report("прежний обработчик", args.old_users, time.perf_counter() - started)
+        assert sent == args.old_users
+        await db.close()
+
+        for name, rate in ((f"BroadcastEngine, {args.rate:g}/с", args.rate), ("BroadcastEngine, без лимита", 1e6)):
+            db = await open_db(tmp, f"engine-{rate:g}", args.users)
+            session = MockSession(args.latency)
+            engine = main.BroadcastEngine(Bot(main.settings.TELEGRAM_BOT_TOKEN, session=session), db, rate, CONCURRENCY, BATCH_SIZE)
+            started = time.perf_counter()
+            await engine.start("bench", ADMIN_ID)
+            await wait_idle(engine)
+            report(name, args.users, time.perf_counter() - started)
+            assert len(session.sent) == args.users + 1  # и уведомление администратору
+            await db.close()
+
+        db = await open_db(tmp, "blocked", args.users)
+        blocked = set(range(7, args.users + 1, args.blocked_every))
+        session = MockSession(args.latency, blocked=blocked, retry_after_at={args.users // 6})
+        engine = main.BroadcastEngine(Bot(main.settings.TELEGRAM_BOT_TOKEN, session=session), db, 1e6, CONCURRENCY, BATCH_SIZE)
+        job = await engine.start("bench", ADMIN_ID)
+        await wait_idle(engine)
+        job = await main.get_broadcast_job(db, job['id'])
+        marked = await count_blocked(db)
+        missed = args.users - len(blocked) - (len(session.sent) - 1)
+        print(f"  {'заблокированные + RetryAfter':<28} заблокировано {len(blocked)}, помечено {marked}, "
+              f"отправлено {job['sent']}, пропущено {missed}")
+        assert marked == len(blocked) == job['blocked'] and missed == 0
+        await db.close()
+
+        db = await open_db(tmp, "resume", args.users)
+        session = MockSession(args.latency)
+        bot = Bot(main.settings.TELEGRAM_BOT_TOKEN, session=session)
+        engine = main.BroadcastEngine(bot, db, 1e6, CONCURRENCY, BATCH_SIZE)
+        job = await engine.start("bench", ADMIN_ID)
+        await asyncio.sleep(args.stop_after)
+        await engine.stop()
+        engine = main.BroadcastEngine(bot, db, 1e6, CONCURRENCY, BATCH_SIZE)
+        resumed = await engine.resume()
+        await wait_idle(engine)
+        job = await main.get_broadcast_job(db, job['id'])
+        duplicates = sum(1 for count in session.sent.values() if count > 1)
+        print(f"  {'остановка и продолжение':<28} продолжено заданий {resumed}, статус {job['status']}, "
+              f"отправлено {job['sent']}/{job['total']}, повторных доставок {duplicates} (пачка {BATCH_SIZE})")
+        assert job['status'] == 'done' and job['sent'] == args.users and duplicates < BATCH_SIZE
+        await db.close()
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--old-users", type=int, default=200, help="пользователей для прежнего обработчика")
+    ap.add_argument("--rate", type=float, default=25.0, help="BROADCAST_RATE, сообщений в секунду")
+    ap.add_argument("--latency", type=float, default=0.03, help="задержка ответа Bot API, секунды")
+    ap.add_argument("--blocked-every", type=int, default=50, help="каждый N-й пользователь заблокировал бота")
+    ap.add_argument("--stop-after", type=float, default=1.0, help="остановка задания через столько секунд")
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
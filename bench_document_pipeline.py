@@ -0,0 +1,216 @@
+"""
+Бенчмарк обработки документов: извлечение текста PDF, деление на части и пересказ по частям.
+
+Для каждого PDF печатает скорость извлечения текста (страниц в секунду) прямо в цикле
+событий и через DocumentExtractor (поток и пул процессов), максимальную задержку цикла
+событий, число частей после chunk_document и время пересказа summarize_document при
+последовательных и параллельных запросах к модели. Модель заменяет локальный SSE-сервер
+в формате chat/completions с задержкой ответа --model-latency.
+
+Запуск:
+    python bench_document_pipeline.py [doc.pdf ...] [--workers 2] [--concurrency 4] [--model-latency 1.0]
+
+Без файлов создаются PDF на 50, 200 и 500 страниц.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.INFO)
+
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+
+SYNTHETIC_PAGES = [50, 200, 500]
+WORDS = ("patient", "blood", "pressure", "glucose", "mmol/L", "HbA1c", "dose", "mg", "daily", "therapy",
+         "diagnosis", "hypertension", "follow-up", "ECG", "normal", "elevated", "recommended", "120/80",
+         "creatinine", "clinical", "trial", "results", "table", "figure", "the", "of", "and", "with")
+
+
+def synthesize_pdf(pages: int, lines_per_page: int = 45, seed: int = 1) -> bytes:
+    """PDF с текстовым слоем (Helvetica), как у выписки или статьи: ~45 строк на странице."""
+    rnd = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for number in range(1, pages + 1):
+        lines = [f"Page {number}. Clinical report section {number}"] + [
+            " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 14))) for _ in range(lines_per_page)
+        ]
+        text = "".join(f"({line}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 800 Td {text}ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects)))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{k} 0 R" for k in kids).encode(), pages)
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+class FakeModel:
+    """SSE-сервер chat/completions: после latency секунд отдаёт короткий пересказ."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await request.read()
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            await asyncio.sleep(self.latency)
+            for word in ("Summary: glucose elevated, HbA1c 7.1%, therapy adjusted; follow-up in 3 months. " * 8).split(" "):
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                await resp.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            await resp.write(b"data: [DONE]\n\n")
+            return resp
+        finally:
+            self.active -= 1
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+
+async def with_loop_lag(coro, tick: float = 0.005):
+    """Результат coro, время выполнения и максимальная задержка тика цикла событий."""
+    lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal lag
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(tick)
+            lag = max(lag, time.perf_counter() - t0 - tick)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(tick * 2)
+    started = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - started
+    running = False
+    await ticker_task
+    return result, elapsed, lag
+
+
+async def bench_extract(path: str, max_pages: int, workers: int) -> list[str]:
+    async def inline():
+        # Без пула: PyPDF2 прямо в обработчике
+        count = min(main.count_pdf_pages(path), max_pages)
+        return main.extract_pdf_pages(path, 0, count), count
+
+    pages, elapsed, lag = await with_loop_lag(inline())
+    print(f"  {'в цикле событий':<22} {len(pages[0]) / elapsed:7.0f} стр./с  задержка цикла макс. {lag * 1000:7.1f} мс")
+    for name, count in (("поток", 0), (f"пул процессов ({workers})", workers)):
+        extractor = main.DocumentExtractor(count)
+        progress = []
+        try:
+            await asyncio.to_thread(extractor.start)  # процессы пула запускаются до замера, как в main()
+            (pages, _total), elapsed, lag = await with_loop_lag(
+                extractor.extract(path, "pdf", max_pages, on_progress=lambda done, total: progress.append(done))
+            )
+        finally:
+            extractor.close()
+        print(f"  {name:<22} {len(pages) / elapsed:7.0f} стр./с  задержка цикла макс. {lag * 1000:7.1f} мс"
+              f"  (обновлений прогресса: {len(progress)}, всего {elapsed:.2f} с)")
+    return pages
+
+
+async def bench_summarize(pages: list[str], chunk_tokens: int, concurrency: int, latency: float):
+    extractor = main.DocumentExtractor(1)
+    try:
+        await asyncio.to_thread(extractor.start)
+        chunks, elapsed, lag = await with_loop_lag(extractor.chunk(pages, chunk_tokens))
+    finally:
+        extractor.close()
+    t0 = time.perf_counter()
+    assert main.chunk_document(pages, chunk_tokens) == chunks
+    inline_ms = (time.perf_counter() - t0) * 1000
+    tokens = sum(main.count_tokens(chunk) for chunk in chunks)
+    print(f"  chunk_document: {len(chunks)} частей по ≤{chunk_tokens} ток. (~{tokens} ток. всего),"
+          f" в цикле событий {inline_ms:.0f} мс, в пуле {elapsed * 1000:.0f} мс (задержка цикла {lag * 1000:.1f} мс)")
+    model = FakeModel(latency)
+    base_url = await model.start()
+    client = main.XAIClient("bench", base_url=base_url)
+    try:
+        for parallel in sorted({1, concurrency}):
+            model.requests = model.max_active = 0
+            t0 = time.perf_counter()
+            answer = [piece async for piece in main.summarize_document(
+                client, chunks, main.DOCUMENT_DEFAULT_PROMPT, "bench.pdf", parallel, chunk_tokens
+            )]
+            elapsed = time.perf_counter() - t0
+            assert answer, "пустой ответ"
+            print(f"  пересказ, {parallel} одновременно: {elapsed:6.1f} с, запросов к модели {model.requests}"
+                  f" (одновременно до {model.max_active}), {len(pages) / elapsed:5.1f} стр./с")
+    finally:
+        await client.close()
+        await model.runner.cleanup()
+
+
+async def run(args):
+    files = [(path, path) for path in args.documents]
+    tmp_paths = []
+    if not files:
+        for pages in SYNTHETIC_PAGES:
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(synthesize_pdf(pages))
+            tmp_paths.append(path)
+            files.append((f"синтетический PDF, {pages} стр.", path))
+    try:
+        for name, path in files:
+            print(f"{name}: {os.path.getsize(path) / 1024:.0f} КиБ")
+            pages = await bench_extract(path, args.max_pages, args.workers)
+            await bench_summarize(pages, args.chunk_tokens, args.concurrency, args.model_latency)
+    finally:
+        for path in tmp_paths:
+            os.unlink(path)
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("documents", nargs="*", help="PDF-файлы")
+    ap.add_argument("--workers", type=int, default=main.settings.DOCUMENT_WORKERS)
+    ap.add_argument("--max-pages", type=int, default=main.settings.DOCUMENT_MAX_PAGES)
+    ap.add_argument("--chunk-tokens", type=int, default=main.settings.DOCUMENT_CHUNK_TOKENS)
+    ap.add_argument("--concurrency", type=int, default=main.settings.DOCUMENT_SUMMARY_CONCURRENCY)
+    ap.add_argument("--model-latency", type=float, default=1.0, help="задержка ответа модели, секунды")
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,363 @@
+"""
+Нагрузочный тест текстовых ответов: заглушки Bot API и xAI, N одновременных пользователей.
+
+Поднимает локальный сервер Bot API, который записывает sendMessage/editMessageText и
+может отвечать на каждую --retry-after-every правку чата ошибкой 429 RetryAfter. Второй
+сервер — SSE chat/completions с задержкой первого токена и заданной скоростью токенов.
+Бот направляется на них через TELEGRAM_API_URL и XAI_BASE_URL. Синтетические пользователи
+(подписчики) задают вопросы через dp.feed_update, как в режиме webhook, и попадают в
+message_handler.
+
+Для каждой базы печатает:
+- p50/p95/p99 времени до первой правки и до полного ответа;
+- число правок в секунду;
+- число обращений к БД на сообщение (SQLiteBackend.run или выдача соединения из пула
+  asyncpg) с разбивкой по функциям из метрик bot_db_query_seconds;
+- ожидание в очереди генераций и задержку цикла событий.
+
+Запуск:
+    python bench_load.py [--users 50] [--messages 3] [--think-time 2]
+                         [--db sqlite:///./bench_load.db] [--db postgresql://user@host/db]
+                         [--first-token-latency 0.5] [--tokens-per-sec 60] [--answer-tokens 300]
+                         [--retry-after-every 0] [--api-latency 0.02] [--max-concurrent 8]
+
+Каждая база проверяется в отдельном процессе, потому что main.py читает настройки при
+импорте. Пользователи нагрузочного теста (id от 900000000) получают подписку. Перед
+тестом их история очищается командой /clear.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+# main.py читает настройки при импорте. Заглушки API должны подменять настоящие всегда,
+# поэтому их адреса задаются напрямую, а не через setdefault.
+FAKE_TELEGRAM_PORT = 18081
+FAKE_XAI_PORT = 18082
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench_load.db")
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{FAKE_TELEGRAM_PORT}"
+os.environ["XAI_BASE_URL"] = f"http://127.0.0.1:{FAKE_XAI_PORT}/v1"
+logging.disable(logging.WARNING)
+
+import asyncpg  # noqa: E402
+from aiogram import types  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+
+USER_ID_BASE = 900_000_000
+QUESTIONS = (
+    "Какая норма глюкозы натощак?",
+    "Как интерпретировать HbA1c 6.4%?",
+    "Стартовая доза метформина?",
+    "Когда назначать статины при СД 2 типа?",
+    "Целевое давление у пациента с ХБП?",
+)
+ANSWER_WORDS = ("глюкоза", "натощак", "ммоль/л", "**HbA1c**", "норма", "контроль", "дозировка", "мг", "пациент",
+                "*рекомендуется*", "терапия", "`3.3–5.5`", "наблюдение", "через", "месяца", "анализ")
+
+
+class FakeBotAPI:
+    """Bot API: записывает отправку и правки сообщений по чатам, по желанию отвечает RetryAfter."""
+
+    def __init__(self, latency: float = 0.0, retry_after_every: int = 0, retry_after: int = 1):
+        self.latency = latency
+        self.retry_after_every = retry_after_every
+        self.retry_after = retry_after
+        self.events: dict[int, list[tuple[float, str, str]]] = collections.defaultdict(list)  # чат -> (время, метод, текст)
+        self.calls = collections.Counter()
+        self.retry_after_sent = 0
+        self._edits_by_chat = collections.Counter()
+        self._message_id = 0
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(data.get("chat_id") or 0)
+        if method == "editMessageText" and self.retry_after_every:
+            self._edits_by_chat[chat_id] += 1
+            if self._edits_by_chat[chat_id] % self.retry_after_every == 0:
+                self.retry_after_sent += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+        if method in ("sendMessage", "editMessageText"):
+            text = data.get("text", "")
+            self.events[chat_id].append((time.perf_counter(), method, text))
+            if method == "sendMessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(data.get("message_id") or 0)
+            return web.json_response({"ok": True, "result": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text,
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", FAKE_TELEGRAM_PORT).start()
+        return runner
+
+
+class FakeLLM:
+    """SSE chat/completions: первый токен через first_token_latency, далее tokens_per_sec токенов в секунду."""
+
+    TICK = 0.05  # интервал между SSE-событиями, секунды
+
+    def __init__(self, first_token_latency: float, tokens_per_sec: float, answer_tokens: int):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens = answer_tokens
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    def answer(self) -> list[str]:
+        """Ответ с абзацами и разметкой, как у модели: рендерер Markdown работает по-настоящему."""
+        rnd = random.Random(self.requests)
+        words = []
+        for i in range(self.answer_tokens):
+            words.append(rnd.choice(ANSWER_WORDS))
+            if i % 40 == 39:
+                words.append("\n\n- ")
+        return [word + " " for word in words]
+
+    async def handle(self, request):
+        await request.read()
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            await asyncio.sleep(self.first_token_latency)
+            words = self.answer()
+            per_tick = max(1, round(self.tokens_per_sec * self.TICK))
+            for i in range(0, len(words), per_tick):
+                chunk = {"choices": [{"delta": {"content": "".join(words[i:i + per_tick])}}]}
+                await resp.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+                await asyncio.sleep(per_tick / self.tokens_per_sec)
+            await resp.write(b'data: {"choices": [{"delta": {}, "finish_reason": "stop"}]}\n\ndata: [DONE]\n\n')
+            return resp
+        finally:
+            self.active -= 1
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", FAKE_XAI_PORT).start()
+        return runner
+
+
+class CountingDB:
+    """SQLiteBackend или пул asyncpg, считающий обращения к БД: вызовы run() и выдачи соединений."""
+
+    def __init__(self, db):
+        self._db = db
+        self.ops = 0
+
+    def run(self, func, *args):
+        self.ops += 1
+        return self._db.run(func, *args)
+
+    def acquire(self, *args, **kwargs):
+        self.ops += 1
+        return self._db.acquire(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> types.Update:
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+    return types.Update(**{"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"load{user_id - USER_ID_BASE}"},
+        "text": text, "entities": entities,
+    }})
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "нет данных"
+    values = sorted(values)
+    def _pct(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return f"p50 {_pct(0.5):6.2f} с   p95 {_pct(0.95):6.2f} с   p99 {_pct(0.99):6.2f} с"
+
+
+async def open_db(settings: main.Settings):
+    if settings.USE_SQLITE:
+        return await main.init_sqlite_db(settings.DATABASE_URL, settings.SQLITE_POOL_SIZE)
+    pool = await asyncpg.create_pool(dsn=settings.DATABASE_URL, min_size=1, max_size=10)
+    await main.init_db_postgres(pool)
+    return pool
+
+
+async def run(args):
+    settings = main.settings
+    telegram = FakeBotAPI(args.api_latency, args.retry_after_every, args.retry_after)
+    llm = FakeLLM(args.first_token_latency, args.tokens_per_sec, args.answer_tokens)
+    runners = [await telegram.start(), await llm.start()]
+    raw_db = await open_db(settings)
+    db = CountingDB(raw_db)
+    # Те же зависимости текстового пути, что создаёт main()
+    scheduler = main.GenerationScheduler(
+        args.max_concurrent or settings.GENERATION_MAX_CONCURRENT,
+        aging_seconds=settings.GENERATION_PRIORITY_AGING
+    )
+    xai_client = main.XAIClient(
+        settings.XAI_API_KEY,
+        base_url=settings.XAI_BASE_URL,
+        pool_limit=settings.XAI_POOL_LIMIT,
+        retry_attempts=settings.XAI_RETRY_ATTEMPTS,
+        stream_idle_timeout=settings.XAI_STREAM_IDLE_TIMEOUT
+    )
+    last_active_writer = main.LastActiveWriter(db, settings.LAST_ACTIVE_FLUSH_INTERVAL)
+    last_active_writer.start()
+    main.dp.workflow_data.update(
+        db=db,
+        settings=settings,
+        generation_scheduler=scheduler,
+        edit_throttler=main.EditThrottler(
+            main.bot,
+            min_interval=settings.EDIT_MIN_INTERVAL,
+            max_interval=settings.EDIT_MAX_INTERVAL,
+            global_rate=settings.EDIT_GLOBAL_RATE
+        ),
+        state_backend=main.LocalStateBackend(),
+        xai_client=xai_client,
+        last_active_writer=last_active_writer,
+    )
+    update_ids = iter(range(1, 10 ** 9))
+    user_ids = [USER_ID_BASE + i for i in range(args.users)]
+    try:
+        for user_id in user_ids:
+            await main.get_or_create_user(db, user_id, None, f"load{user_id - USER_ID_BASE}", None)
+            await main.update_user_subscription(db, user_id, 30)
+            await main.dp.feed_update(main.bot, make_update(next(update_ids), user_id, "/clear"))
+
+        results = []
+        lag = 0.0
+        running = True
+
+        async def ticker(tick: float = 0.01):
+            nonlocal lag
+            while running:
+                t0 = time.perf_counter()
+                await asyncio.sleep(tick)
+                lag = max(lag, time.perf_counter() - t0 - tick)
+
+        async def user_session(user_id: int):
+            rnd = random.Random(user_id)
+            await asyncio.sleep(rnd.uniform(0, args.ramp))
+            for n in range(args.messages):
+                question = QUESTIONS[(user_id + n) % len(QUESTIONS)]
+                mark = len(telegram.events[user_id])
+                started = time.perf_counter()
+                await main.dp.feed_update(main.bot, make_update(next(update_ids), user_id, question))
+                events = telegram.events[user_id][mark:]
+                edits = [(at, text) for at, method, text in events if method == "editMessageText"]
+                # Первая правка с текстом ответа (не позиция в очереди) и последняя — итоговый ответ
+                streamed = [at for at, text in edits if not text.startswith("⏳")]
+                failed = not edits or "ошибка" in edits[-1][1].lower() or "недоступен" in edits[-1][1]
+                results.append({
+                    "first_edit": streamed[0] - started if streamed else None,
+                    "full": edits[-1][0] - started if edits else time.perf_counter() - started,
+                    "failed": failed,
+                    # Итоговая правка не дошла: в чате остался промежуточный текст с «...»
+                    "unfinished": not failed and edits[-1][1].endswith("..."),
+                })
+                await asyncio.sleep(rnd.uniform(0, 2 * args.think_time))
+
+        queries_before = {key: state[2] for key, state in main.db_query_seconds._values.items()}
+        edits_before = telegram.calls["editMessageText"]
+        db.ops = 0
+        ticker_task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        await asyncio.gather(*(user_session(user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - started
+        running = False
+        await ticker_task
+        ops = db.ops
+        edits = telegram.calls["editMessageText"] - edits_before
+
+        backend = "SQLite" if settings.USE_SQLITE else "PostgreSQL"
+        messages = len(results)
+        print(f"{backend}: {args.users} пользователей × {args.messages} сообщений, "
+              f"генераций одновременно до {scheduler.max_concurrent}")
+        print(f"  сообщений: {messages}, ошибок: {sum(r['failed'] for r in results)}, "
+              f"без итоговой правки: {sum(r['unfinished'] for r in results)}, за {elapsed:.1f} с "
+              f"(запросов к модели {llm.requests}, одновременно до {llm.max_active})")
+        print(f"  до первой правки:  {percentiles([r['first_edit'] for r in results if r['first_edit'] is not None])}")
+        print(f"  до полного ответа: {percentiles([r['full'] for r in results])}")
+        print(f"  правок: {edits} ({edits / elapsed:.1f} в секунду), RetryAfter: {telegram.retry_after_sent}, "
+              f"sendMessage: {telegram.calls['sendMessage']}")
+        per_query = ", ".join(
+            f"{key[0]} {(state[2] - queries_before.get(key, 0)) / messages:.2f}"
+            for key, state in sorted(main.db_query_seconds._values.items())
+            if state[2] > queries_before.get(key, 0)
+        )
+        print(f"  обращений к БД на сообщение: {ops / messages:.2f} ({per_query})")
+        queue = scheduler.stats()
+        print(f"  очередь генераций: ожидание p50 {queue['wait_p50']:.2f} с, p95 {queue['wait_p95']:.2f} с, "
+              f"максимум в очереди {queue['max_depth']}; задержка цикла событий макс. {lag * 1000:.0f} мс")
+    finally:
+        await last_active_writer.stop()
+        await xai_client.close()
+        await main.bot.session.close()
+        await raw_db.close()
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", action="append", help="DATABASE_URL (можно несколько); по умолчанию из окружения")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=3, help="вопросов от каждого пользователя")
+    ap.add_argument("--think-time", type=float, default=2.0, help="средняя пауза между вопросами, секунды")
+    ap.add_argument("--ramp", type=float, default=5.0, help="пользователи начинают в течение стольких секунд")
+    ap.add_argument("--first-token-latency", type=float, default=0.5)
+    ap.add_argument("--tokens-per-sec", type=float, default=60.0)
+    ap.add_argument("--answer-tokens", type=int, default=300)
+    ap.add_argument("--api-latency", type=float, default=0.02, help="задержка ответа Bot API, секунды")
+    ap.add_argument("--retry-after-every", type=int, default=0, help="каждая N-я правка чата получает 429 (0 — никогда)")
+    ap.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, секунды")
+    ap.add_argument("--max-concurrent", type=int, default=0, help="GENERATION_MAX_CONCURRENT (0 — из настроек)")
+    args = ap.parse_args()
+
+    if os.environ.get("BENCH_LOAD_CHILD"):
+        asyncio.run(run(args))
+        return 0
+    # Каждая база — в своём процессе: main.py выбирает SQLite или PostgreSQL при импорте
+    failed = 0
+    for database_url in args.db or [os.environ["DATABASE_URL"]]:
+        env = dict(os.environ, DATABASE_URL=database_url, BENCH_LOAD_CHILD="1")
+        failed |= subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:]], env=env).returncode
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
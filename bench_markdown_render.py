@@ -0,0 +1,109 @@
+"""
+Микробенчмарк рендера Markdown при стриминге: StreamingMarkdownRenderer против полного
+пересчёта markdown_to_telegram_html на каждом чанке (как message_handler делал раньше).
+
+Ответ подаётся кусками по --chunk символов; на каждом куске, как при стриминге, берётся
+HTML всего текста (для проверки длины и промежуточной правки). Печатает суммарное время
+на ответ и на один чанк. Проверяет, что после каждого чанка результаты совпадают.
+
+Запуск:
+    python bench_markdown_render.py [answer.md ...] [--chunk 20] [--repeat 5]
+
+Без файлов используются два синтетических ответа около 12 000 символов: заголовки, абзацы
+с жирным, курсивом, кодом и ссылками, списки через «-»; то же со списками через «*» и
+с «5 * 3» и dose_table.csv в начале — одиночными маркерами, которым не найдётся пары.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.INFO)
+
+import main  # noqa: E402
+
+
+def synthesize_answer(size: int = 12000, seed: int = 1) -> str:
+    rnd = random.Random(seed)
+    paragraph = ("Here is **bold** text with *italic* and `code` and [link](http://x.y/z). "
+                 "Some more words follow here.\n")
+    text = ""
+    while len(text) < size:
+        text += "## Section\n\n" + paragraph * rnd.randint(1, 4) + "\n- item *one*\n- item two\n\n"
+    return text
+
+
+def synthesize_bullet_answer(size: int = 12000, seed: int = 1) -> str:
+    rnd = random.Random(seed)
+    paragraph = ("Here is **bold** text with *italic* and `code` and [link](http://x.y/z). "
+                 "Some more words follow here.\n")
+    text = "Расчёт: 5 * 3 = 15 мг в сутки, см. файл dose_table.csv.\n\n"
+    while len(text) < size:
+        text += "## Section\n\n" + paragraph * rnd.randint(1, 4) + "\n* пункт один\n* пункт два\n\n"
+    return text
+
+
+def full_rerender(chunks: list[str]) -> int:
+    accumulated = ""
+    total = 0
+    for chunk in chunks:
+        accumulated += chunk
+        total += len(main.markdown_to_telegram_html(accumulated))
+    return total
+
+
+def incremental(chunks: list[str]) -> int:
+    renderer = main.StreamingMarkdownRenderer()
+    total = 0
+    for chunk in chunks:
+        renderer.feed(chunk)
+        total += len(renderer.html())
+    return total
+
+
+def check_equivalence(chunks: list[str]):
+    renderer = main.StreamingMarkdownRenderer()
+    accumulated = ""
+    for chunk in chunks:
+        accumulated += chunk
+        renderer.feed(chunk)
+        assert renderer.html() == main.markdown_to_telegram_html(accumulated), "рендер по чанкам не совпал с полным"
+
+
+def bench(name: str, fn, chunks: list[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - t0)
+    print(f"  {name:<28} {best * 1000:9.1f} мс на ответ  {best / len(chunks) * 1e6:8.1f} мкс на чанк")
+    return best
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("answers", nargs="*", help="файлы с Markdown-ответом модели")
+    ap.add_argument("--chunk", type=int, default=20, help="размер чанка, символов")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    answers = [(path, open(path, encoding="utf-8").read()) for path in args.answers] or [
+        ("synthetic", synthesize_answer()), ("synthetic, списки через *", synthesize_bullet_answer())
+    ]
+    for name, text in answers:
+        chunks = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+        check_equivalence(chunks)
+        print(f"{name}: {len(text)} символов, {len(chunks)} чанков по {args.chunk}")
+        base = bench("полный пересчёт", full_rerender, chunks, args.repeat)
+        best = bench("StreamingMarkdownRenderer", incremental, chunks, args.repeat)
+        print(f"  {'':<28} x{base / best:.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,102 @@
+"""
+Бенчмарк SQLite-бэкенда: SQLiteBackend (постоянные соединения в пуле потоков, WAL)
+против прежней схемы — sqlite3.connect() в asyncio.to_thread на каждый запрос.
+
+Оба варианта выполняют одни и те же функции бота на сообщение пользователя:
+get_or_create_user, add_message_to_db, get_context_messages, check_and_consume_limit.
+Кэш пользователей сбрасывается перед каждым сообщением, чтобы get_or_create_user
+тоже обращался к базе. Печатает среднее время на сообщение.
+
+Запуск:
+    python bench_sqlite_backend.py [--messages 300] [--pool-size 4]
+
+Базы создаются во временном каталоге; прежняя схема работает с журналом DELETE
+(WAL тогда не включался).
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+# Бенчмарк только для SQLite: база задаётся явно, настройки main.py читаются при импорте
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ["DATABASE_URL"] = "sqlite:///./bench.db"
+logging.disable(logging.INFO)
+
+import main  # noqa: E402
+
+USER_ID = 1
+
+
+class ConnectPerCallDB:
+    """Прежняя схема за интерфейсом SQLiteBackend.run: новое соединение на каждый вызов."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def _call(self, func, args):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    async def run(self, func, *args):
+        return await asyncio.to_thread(self._call, func, args)
+
+    async def close(self):
+        pass
+
+
+async def per_message(db, messages: int) -> float:
+    await main.get_or_create_user(db, USER_ID, "bench", "Bench", None)
+    await main.update_user_subscription(db, USER_ID, 30)  # лимит не должен закончиться
+    started = time.perf_counter()
+    for i in range(messages):
+        main.user_cache.invalidate(USER_ID)
+        await main.get_or_create_user(db, USER_ID, "bench", "Bench", None)
+        await main.add_message_to_db(db, USER_ID, "user", f"Вопрос {i}")
+        await main.get_context_messages(db, USER_ID)
+        await main.check_and_consume_limit(db, main.settings, USER_ID)
+    return (time.perf_counter() - started) / messages
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        backend = await main.init_sqlite_db(legacy_path, 1)
+        await backend.close()
+        with sqlite3.connect(legacy_path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        legacy = await per_message(ConnectPerCallDB(legacy_path), args.messages)
+
+        backend = await main.init_sqlite_db(os.path.join(tmp, "pooled.db"), args.pool_size)
+        try:
+            pooled = await per_message(backend, args.messages)
+        finally:
+            await backend.close()
+
+    print(f"{args.messages} сообщений, на сообщение: get_or_create_user + add_message_to_db "
+          f"+ get_context_messages + check_and_consume_limit")
+    print(f"  {'sqlite3.connect() на запрос':<30} {legacy * 1000:7.2f} мс")
+    print(f"  {f'SQLiteBackend (пул {args.pool_size})':<30} {pooled * 1000:7.2f} мс   x{legacy / pooled:.1f}")
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--messages", type=int, default=300)
+    ap.add_argument("--pool-size", type=int, default=4)
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
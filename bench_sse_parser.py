@@ -0,0 +1,152 @@
+"""
+Микробенчмарк разбора потока ответа xAI: SSEDeltaParser против прежнего построчного цикла.
+
+Проигрывает записанные потоки (сырое тело ответа chat/completions со stream=true) и печатает
+пропускную способность разбора в токенах (фрагментах delta.content) в секунду. Проверяет,
+что при любой нарезке потока на куски результат совпадает с прежним разбором.
+
+Записать поток:
+    curl -sN https://api.x.ai/v1/chat/completions -H "Authorization: Bearer $XAI_API_KEY" \\
+         -H "Content-Type: application/json" \\
+         -d '{"model": "grok-3-mini-beta", "stream": true, "messages": [{"role": "user", "content": "..."}]}' > stream.sse
+
+Запуск:
+    python bench_sse_parser.py [stream.sse ...] [--chunk 1024] [--repeat 20]
+
+Без файлов используется синтетический поток в формате xAI (reasoning_content, затем content).
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.INFO)
+
+import main  # noqa: E402
+
+logger = logging.getLogger("bench")
+
+
+def synthesize_stream(reasoning_tokens: int = 600, content_tokens: int = 800, seed: int = 1) -> bytes:
+    """Поток как у grok-3-mini: роль, рассуждение, ответ, finish_reason с usage и [DONE]."""
+    rnd = random.Random(seed)
+    words = ["Пациенту", " рекомендуется", " контроль", " давления", ",", " **важно**", " 120/80", " мм", " рт.", " ст.",
+             "\n\n", "- ", " дозировка", " препарата", " ✅", " HbA1c", " <", " 7%", " `code`", " ответ"]
+    base = {"id": "3f0c9a1e-bench", "object": "chat.completion.chunk", "created": 1760000000, "model": "grok-3-mini-beta",
+            "system_fingerprint": "fp_bench"}
+    events = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}])]
+    for _ in range(reasoning_tokens):
+        events.append(dict(base, choices=[{"index": 0, "delta": {"reasoning_content": rnd.choice(words)}, "finish_reason": None}]))
+    for _ in range(content_tokens):
+        events.append(dict(base, choices=[{"index": 0, "delta": {"content": rnd.choice(words)}, "finish_reason": None}]))
+    events.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                       usage={"prompt_tokens": 812, "completion_tokens": reasoning_tokens + content_tokens}))
+    body = b"".join(b"data: " + json.dumps(e, ensure_ascii=False).encode() + b"\n\n" for e in events)
+    return body + b"data: [DONE]\n\n"
+
+
+def legacy_parse(body: bytes) -> list[str]:
+    """Прежний разбор из stream_xai_response: decode+strip и json.loads на каждую строку."""
+    out = []
+    for line_bytes in body.splitlines(keepends=True):  # aiohttp отдаёт строки вместе с \n
+        line = line_bytes.decode('utf-8').strip()
+        logger.debug(f"Received line: {line!r}")
+        if not line:
+            continue
+        if line.startswith("data: "):
+            buffer = line[len("data: "):]
+            if buffer == "[DONE]":
+                return out
+            chunk = json.loads(buffer)
+            choices = chunk.get('choices') or []
+            if choices:
+                delta = choices[0].get('delta') or {}
+                text = delta.get('content')
+                if text:
+                    out.append(text)
+    return out
+
+
+def parser_parse(body: bytes, chunk_size: int) -> list[str]:
+    parser = main.SSEDeltaParser()
+    out = []
+    for i in range(0, len(body), chunk_size):
+        out.extend(parser.feed(body[i:i + chunk_size]))
+        if parser.done:
+            return out
+    out.extend(parser.close())
+    return out
+
+
+def check_partial_reads(body: bytes, expected: list[str], rounds: int = 20):
+    """Случайная нарезка (в том числе посреди строки и UTF-8 символа) даёт тот же текст."""
+    rnd = random.Random(7)
+    for _ in range(rounds):
+        parser = main.SSEDeltaParser()
+        out, pos = [], 0
+        while pos < len(body):
+            step = rnd.randint(1, 97)
+            out.extend(parser.feed(body[pos:pos + step]))
+            pos += step
+        out.extend(parser.close())
+        assert "".join(out) == "".join(expected), "нарезка потока изменила результат"
+
+
+def check_sse_edge_cases():
+    """Многострочные data:, CRLF, комментарии и событие без завершающей пустой строки."""
+    parser = main.SSEDeltaParser()
+    stream = (b": keep-alive\r\n\r\n"
+              b'data: {"choices": [{"delta":\r\n'
+              b'data:  {"content": "a\\nb"}}]}\r\n\r\n'
+              b'event: message\nid: 1\ndata:{"choices":[{"delta":{"content":"c"},"finish_reason":"stop"}]}')
+    out = parser.feed(stream) + parser.close()
+    assert out == ["a\nb", "c"], out
+    assert parser.finish_reason == "stop"
+
+
+def bench(name: str, fn, body: bytes, tokens: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(body)
+        best = min(best, time.perf_counter() - t0)
+    rate = tokens / best
+    print(f"  {name:<28} {best * 1000:8.2f} ms  {rate / 1000:9.1f}k tokens/s  {len(body) / best / 1e6:7.1f} MB/s")
+    return rate
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("streams", nargs="*", help="файлы с записанным телом SSE-ответа")
+    ap.add_argument("--chunk", type=int, default=1024, help="размер куска при проигрывании, байт")
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    streams = [(path, open(path, "rb").read()) for path in args.streams] or [("synthetic", synthesize_stream())]
+    check_sse_edge_cases()
+    json_loads = main._json_loads
+    for name, body in streams:
+        expected = legacy_parse(body)
+        assert parser_parse(body, args.chunk) == expected, "результат разбора не совпал с прежним"
+        check_partial_reads(body, expected)
+        print(f"{name}: {len(body)} байт, {len(expected)} токенов content")
+        base = bench("прежний цикл", legacy_parse, body, len(expected), args.repeat)
+        main._json_loads = json.loads
+        rate = bench("SSEDeltaParser + json", lambda b: parser_parse(b, args.chunk), body, len(expected), args.repeat)
+        print(f"  {'':<28} x{rate / base:.1f}")
+        if main.orjson:
+            main._json_loads = main.orjson.loads
+            rate = bench("SSEDeltaParser + orjson", lambda b: parser_parse(b, args.chunk), body, len(expected), args.repeat)
+            print(f"  {'':<28} x{rate / base:.1f}")
+        main._json_loads = json_loads
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
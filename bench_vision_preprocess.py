@@ -0,0 +1,151 @@
+"""
+Бенчмарк подготовки фото для vision-модели: prepare_image и ImagePreprocessor.
+
+Для типичных размеров фото (сжатые Telegram и оригиналы с камеры телефона) печатает
+время подготовки, размер файла и base64-тела запроса до и после. Проверяет, что EXIF
+удалён, а ориентация применена к пикселям. Отдельно измеряет, на сколько задерживается
+цикл событий, когда фото готовятся прямо в нём и в пуле процессов.
+
+Запуск:
+    python bench_vision_preprocess.py [photo.jpg ...] [--max-side 1536] [--quality 85] [--repeat 5]
+
+Без файлов используются синтетические фото с EXIF (ориентация, камера, геометка).
+"""
+import argparse
+import asyncio
+import base64
+import io
+import logging
+import os
+import sys
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.INFO)
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+import main  # noqa: E402
+
+# Сжатое фото Telegram (стандарт и максимум) и оригиналы с камеры телефона
+SYNTHETIC_SIZES = [
+    ("Telegram 1280x960", (1280, 960)),
+    ("Telegram 2560x1920", (2560, 1920)),
+    ("телефон 12 Мп", (4032, 3024)),
+    ("телефон 50 Мп", (8160, 6120)),
+]
+
+
+def synthesize_photo(size: tuple[int, int], quality: int = 92) -> bytes:
+    """JPEG, похожий на снимок камеры: плавный фон, шум сенсора, объекты, EXIF с поворотом."""
+    w, h = size
+    base = Image.merge("RGB", [
+        Image.linear_gradient("L").resize((w, h)),
+        Image.radial_gradient("L").resize((w, h)),
+        Image.linear_gradient("L").rotate(90).resize((w, h)),
+    ])
+    draw = ImageDraw.Draw(base)
+    for i in range(40):
+        x, y = (i * 7919) % w, (i * 104729) % h
+        draw.rectangle((x, y, x + w // 10, y + h // 14), fill=((i * 53) % 256, (i * 97) % 256, (i * 31) % 256))
+        draw.text((x + 10, y + 10), "HbA1c 6.1% 120/80", fill=(0, 0, 0))
+    noise = Image.effect_noise((w, h), 40).convert("RGB")
+    img = Image.blend(base.filter(ImageFilter.GaussianBlur(1)), noise, 0.12)
+    exif = Image.Exif()
+    exif[0x0112] = 6                       # Orientation: повернуть на 90° по часовой
+    exif[0x010F] = "BenchPhone"            # Make
+    exif[0x0110] = "Model X"               # Model
+    exif[0x8825] = {1: "N", 2: (55.0, 45.0, 0.0), 3: "E", 4: (37.0, 37.0, 0.0)}  # GPS
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality, exif=exif)
+    return out.getvalue()
+
+
+def check_output(source: bytes, prepared: bytes, max_side: int):
+    """Результат — JPEG без EXIF, не больше max_side, с учётом поворота из EXIF."""
+    with Image.open(io.BytesIO(source)) as src, Image.open(io.BytesIO(prepared)) as out:
+        assert out.format == "JPEG"
+        assert not out.getexif(), "EXIF не удалён"
+        assert "icc_profile" not in out.info
+        assert max(out.size) <= max_side
+        rotated = src.getexif().get(0x0112) in (5, 6, 7, 8)
+        src_w, src_h = src.size[::-1] if rotated else src.size
+        assert (out.width >= out.height) == (src_w >= src_h), "ориентация не применена"
+
+
+def bench_prepare(name: str, data: bytes, max_side: int, quality: int, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        prepared, size = main.prepare_image(data, max_side, quality)
+        best = min(best, time.perf_counter() - t0)
+    check_output(data, prepared, max_side)
+    raw_b64, out_b64 = len(base64.b64encode(data)), len(base64.b64encode(prepared))
+    print(f"  {name:<20} {len(data) / 1024:8.0f} КиБ -> {len(prepared) / 1024:6.0f} КиБ  {size[0]}x{size[1]:<5}"
+          f" {best * 1000:7.1f} мс   base64 {raw_b64 / 1024:8.0f} -> {out_b64 / 1024:6.0f} КиБ"
+          f" (-{1 - out_b64 / raw_b64:.0%})")
+
+
+async def measure_loop_lag(prepare, photos: list[bytes], tick: float = 0.005) -> tuple[float, float]:
+    """Максимальная задержка тика цикла событий, пока готовятся все фото, и общее время."""
+    lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal lag
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(tick)
+            lag = max(lag, time.perf_counter() - t0 - tick)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(tick * 2)
+    started = time.perf_counter()
+    await asyncio.gather(*(prepare(data) for data in photos))
+    elapsed = time.perf_counter() - started
+    running = False
+    await ticker_task
+    return lag, elapsed
+
+
+async def bench_loop(photos: list[bytes], max_side: int, quality: int):
+    async def inline(data: bytes):
+        # Как было бы без пула: Pillow прямо в обработчике
+        return main.prepare_image(data, max_side, quality)
+
+    preprocessor = main.ImagePreprocessor(2, max_side, quality)
+    await asyncio.to_thread(preprocessor.start)  # процессы пула запускаются до замера, как в main()
+    try:
+        for name, prepare in (("в цикле событий", inline), ("пул процессов (2)", preprocessor.prepare)):
+            lag, elapsed = await measure_loop_lag(prepare, photos)
+            print(f"  {name:<20} задержка цикла макс. {lag * 1000:7.1f} мс, всего {elapsed * 1000:7.0f} мс")
+    finally:
+        preprocessor.close()
+    stats = preprocessor.stats()
+    print(f"  ImagePreprocessor: {stats['processed']} фото, {stats['saved_ratio']:.0%} байт сэкономлено, "
+          f"в среднем {stats['avg_ms']:.0f} мс")
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("photos", nargs="*", help="файлы изображений")
+    ap.add_argument("--max-side", type=int, default=main.settings.VISION_MAX_SIDE)
+    ap.add_argument("--quality", type=int, default=main.settings.VISION_JPEG_QUALITY)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    photos = [(path, open(path, "rb").read()) for path in args.photos] or [
+        (name, synthesize_photo(size)) for name, size in SYNTHETIC_SIZES
+    ]
+    print(f"prepare_image (max_side={args.max_side}, quality={args.quality}), лучшее из {args.repeat}:")
+    for name, data in photos:
+        bench_prepare(name, data, args.max_side, args.quality, args.repeat)
+    print("Цикл событий при подготовке всех фото сразу:")
+    asyncio.run(bench_loop([data for _, data in photos], args.max_side, args.quality))
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,216 @@
+"""
+Бенчмарк приёма обновлений: long polling против webhook и остановка webhook-сервера.
+
+Поднимает локальную заглушку Bot API (getUpdates с очередью обновлений, sendMessage и
+прочие методы отвечают успехом). Сессия бота направляется на неё, и бот запускается
+целиком через main.main(). Проверяется:
+- polling: --updates записанных /start отдаются через getUpdates;
+- webhook: те же обновления отправляются POST-запросами на WEBHOOK_PATH (--concurrency
+  одновременно), запрос с неверным секретом должен получить 401;
+- остановка: --drain обновлений ждут ответа Bot API (--drain-latency секунд на sendMessage),
+  процесс получает SIGTERM, и все они должны завершиться до закрытия БД.
+
+Печатает число обновлений в секунду для обоих режимов. Клиент и сервер работают на одном
+ядре, поэтому webhook дополнительно платит за HTTP-клиент бенчмарка.
+
+Запуск:
+    python bench_webhook.py [--updates 2000] [--concurrency 40] [--drain 10] [--drain-latency 1.5]
+
+Каждый режим проверяется в отдельном процессе со своим временным SQLite-файлом, потому что
+main.py читает настройки при импорте, а main.main() рассчитана на один запуск.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+FAKE_TELEGRAM_PORT = 18083
+WEBHOOK_PORT = 18084
+WEBHOOK_SECRET = "bench-secret"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+os.environ["METRICS_PORT"] = "0"
+if os.environ.get("BENCH_WEBHOOK_MODE") in ("webhook", "drain"):
+    os.environ.update(USE_WEBHOOK="true", WEBHOOK_BASE_URL="https://bench.example.org",
+                      WEBHOOK_SECRET=WEBHOOK_SECRET, WEBAPP_HOST="127.0.0.1", PORT=str(WEBHOOK_PORT))
+
+import logging  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+import aiohttp  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+
+USER_ID_BASE = 920_000_000
+
+
+class FakeBotAPI:
+    """Bot API: очередь для getUpdates с учётом offset, остальные методы отвечают успехом."""
+
+    def __init__(self, send_latency: float = 0.0):
+        self.send_latency = send_latency
+        self.calls = collections.Counter()
+        self.updates: list[dict] = []
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if method == "getUpdates":
+            offset = int(data.get("offset") or 0)
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates:
+                self._new_updates.clear()
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), float(data.get("timeout") or 1))
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({"ok": True, "result": self.updates[:100]})
+        if method == "sendMessage":
+            if self.send_latency:
+                await asyncio.sleep(self.send_latency)
+            self._message_id += 1
+            chat_id = int(data.get("chat_id") or 0)
+            return web.json_response({"ok": True, "result": {
+                "message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+            }})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    def push(self, updates: list[dict]):
+        self.updates.extend(updates)
+        self._new_updates.set()
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", FAKE_TELEGRAM_PORT).start()
+        return runner
+
+
+def make_update(update_id: int) -> dict:
+    user_id = USER_ID_BASE + update_id
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"bench{update_id}"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": len("/start")}],
+    }}
+
+
+async def wait_started(fake: FakeBotAPI, method: str) -> main.InFlightUpdates:
+    """Ждёт, пока main.main() дойдёт до приёма обновлений (deleteWebhook или setWebhook)."""
+    while not fake.calls[method]:
+        await asyncio.sleep(0.02)
+    return next(m for m in main.dp.update.outer_middleware if isinstance(m, main.InFlightUpdates))
+
+
+async def wait_processed(in_flight: main.InFlightUpdates, total: int):
+    while in_flight.processed_total < total:
+        await asyncio.sleep(0.005)
+
+
+async def run_polling(args, fake: FakeBotAPI, bot_task: asyncio.Task):
+    in_flight = await wait_started(fake, "deleteWebhook")
+    started = time.perf_counter()
+    fake.push([make_update(i) for i in range(1, args.updates + 1)])
+    await wait_processed(in_flight, args.updates)
+    elapsed = time.perf_counter() - started
+    print(f"  {'polling':<28} {args.updates} обновлений за {elapsed:5.2f} с: {args.updates / elapsed:6.0f} upd/s")
+    await main.dp.stop_polling()
+    await asyncio.wait_for(bot_task, 30)
+
+
+async def run_webhook(args, fake: FakeBotAPI, bot_task: asyncio.Task):
+    in_flight = await wait_started(fake, "setWebhook")
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{main.settings.WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=make_update(1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as resp:
+            assert resp.status == 401, f"неверный секрет: ожидался 401, получен {resp.status}"
+        print(f"  {'неверный секрет':<28} {resp.status}")
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def post(update: dict):
+            async with semaphore:
+                async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}) as resp:
+                    assert resp.status == 200, resp.status
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(make_update(i)) for i in range(1, args.updates + 1)))
+        await wait_processed(in_flight, args.updates)
+        elapsed = time.perf_counter() - started
+    print(f"  {'webhook':<28} {args.updates} обновлений за {elapsed:5.2f} с: {args.updates / elapsed:6.0f} upd/s")
+    os.kill(os.getpid(), signal.SIGTERM)
+    await asyncio.wait_for(bot_task, 30)
+
+
+async def run_drain(args, fake: FakeBotAPI, bot_task: asyncio.Task):
+    in_flight = await wait_started(fake, "setWebhook")
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{main.settings.WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as session:
+        for i in range(1, args.drain + 1):
+            async with session.post(url, json=make_update(i), headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}) as resp:
+                assert resp.status == 200, resp.status
+    await asyncio.sleep(0.1)
+    pending = len(in_flight)
+    os.kill(os.getpid(), signal.SIGTERM)
+    await asyncio.wait_for(bot_task, 30)
+    print(f"  {'остановка по SIGTERM':<28} в обработке {pending}, завершено {in_flight.processed_total}, "
+          f"sendMessage {fake.calls['sendMessage']}")
+    assert in_flight.processed_total == args.drain, "не все принятые обновления завершились до остановки"
+
+
+async def run(args, mode: str):
+    fake = FakeBotAPI(send_latency=args.drain_latency if mode == "drain" else 0.0)
+    fake_runner = await fake.start()
+    main.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{FAKE_TELEGRAM_PORT}")
+    bot_task = asyncio.create_task(main.main())
+    try:
+        await {"polling": run_polling, "webhook": run_webhook, "drain": run_drain}[mode](args, fake, bot_task)
+    finally:
+        await fake_runner.cleanup()
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--updates", type=int, default=2000, help="обновлений /start для polling и webhook")
+    ap.add_argument("--concurrency", type=int, default=40, help="одновременных POST на webhook")
+    ap.add_argument("--drain", type=int, default=10, help="обновлений в обработке в момент SIGTERM")
+    ap.add_argument("--drain-latency", type=float, default=1.5, help="задержка sendMessage при проверке остановки, секунды")
+    args = ap.parse_args()
+
+    mode = os.environ.get("BENCH_WEBHOOK_MODE")
+    if mode:
+        asyncio.run(run(args, mode))
+        return 0
+    # Каждый режим — в своём процессе и со своей базой: main.py читает настройки при импорте
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="bench-webhook-") as tmp:
+        for mode in ("polling", "webhook", "drain"):
+            env = dict(os.environ, BENCH_WEBHOOK_MODE=mode, DATABASE_URL=f"sqlite:///{tmp}/{mode}.db")
+            failed |= subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:]], env=env).returncode
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
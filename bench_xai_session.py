@@ -0,0 +1,97 @@
+"""
+Бенчмарк HTTP-клиента xAI: общая сессия XAIClient с пулом соединений против новой
+aiohttp-сессии на каждый ответ (как stream_xai_response работал раньше).
+
+Локальная SSE-заглушка chat/completions по HTTP отвечает --deltas фрагментами без задержки,
+поэтому видна только стоимость клиента: создание сессии, соединение, разбор потока.
+Печатает время на запрос при последовательных и одновременных (--concurrency) запросах.
+С api.x.ai новая сессия дополнительно платит за DNS и TLS-рукопожатие.
+
+Запуск:
+    python bench_xai_session.py [--requests 1000] [--concurrency 50] [--deltas 5]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+# main.py читает настройки при импорте: для бенчмарка достаточно заглушек
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("XAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+logging.disable(logging.WARNING)
+
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+
+HISTORY = [{"role": "user", "content": "Норма глюкозы натощак?"}]
+
+
+def sse_handler(deltas: int):
+    async def handle(request):
+        await request.read()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(deltas):
+            chunk = {"choices": [{"delta": {"content": f"фрагмент {i} "}}]}
+            await response.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+        return response
+    return handle
+
+
+async def answer(client: main.XAIClient) -> str:
+    return "".join([text async for text in main.stream_xai_response(client, "system", HISTORY)])
+
+
+async def run(args):
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", sse_handler(args.deltas))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}/v1"
+    shared = main.XAIClient("bench", base_url=base_url, pool_limit=max(args.concurrency, 1))
+
+    async def fresh_session():
+        client = main.XAIClient("bench", base_url=base_url)
+        try:
+            return await answer(client)
+        finally:
+            await client.close()
+
+    async def shared_session():
+        return await answer(shared)
+
+    try:
+        expected = await shared_session()
+        print(f"{args.requests} запросов по {args.deltas} фрагментов")
+        for name, fn in (("новая сессия на запрос", fresh_session), ("общая сессия XAIClient", shared_session)):
+            for concurrency in (1, args.concurrency):
+                started = time.perf_counter()
+                for _ in range(args.requests // concurrency):
+                    results = await asyncio.gather(*(fn() for _ in range(concurrency)))
+                    assert all(result == expected for result in results)
+                elapsed = time.perf_counter() - started
+                print(f"  {name:<26} одновременно {concurrency:>3}: {elapsed / args.requests * 1000:6.2f} мс на запрос")
+    finally:
+        await shared.close()
+        await runner.cleanup()
+
+
+def main_bench():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--requests", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--deltas", type=int, default=5, help="фрагментов content в ответе")
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
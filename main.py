@@ -1,4 +1,5 @@
 import asyncio
+import bisect
 import logging
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandObject, StateFilter, BaseFilter
@@ -14,6 +15,10 @@ import traceback
 import socket
 import os
 import sqlite3
+import threading
+import concurrent.futures
+import multiprocessing
+import tempfile
 import json
 import re
 import base64
@@ -21,13 +26,32 @@ import io
 import typing
 import time
 import html
+import hashlib
+import random
+import unicodedata
+import collections
+import contextlib
 import datetime
-from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+import functools
+import secrets
+import signal
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from openai import OpenAI, AsyncOpenAI  # клиенты xAI для текстовых и vision-моделей
-from openai import APIStatusError  # ошибки при работе с визуальной моделью
-from PIL import Image  # для конвертации любых форматов изображений
+from openai import APIStatusError, APIConnectionError  # ошибки при работе с визуальной моделью
+from workers import (  # функции пулов процессов (см. workers.py)
+    count_tokens, prepare_image,
+    DocumentError, count_pdf_pages, extract_pdf_pages, file_sha256, extract_docx_text, chunk_document
+)
+try:
+    import orjson  # необязательно: быстрее json и разбирает bytes без декодирования
+except ImportError:
+    orjson = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -77,8 +101,9 @@ I'll answer as the world-famous <specific field> scientists with <most prestigio
 
 <Deep knowledge step-by-step answer, with CONCRETE details>
 """
-CONVERSATION_HISTORY_LIMIT = 5
-MESSAGE_EXPIRATION_DAYS = 2 # Пока не используется, но оставлено
+CONVERSATION_HISTORY_LIMIT = 30 # Максимум сообщений-кандидатов в контекст (столько же оставляет фоновая очистка)
+MESSAGE_EXPIRATION_DAYS = 2 # Сообщения старше удаляет фоновая очистка истории (HistoryRetention)
+FREE_MESSAGES_PER_DAY = 7 # Бесплатных запросов в сутки без подписки
 
 # Максимальная длина сообщения Telegram (чуть меньше лимита 4096 для безопасности)
 TELEGRAM_MAX_LENGTH = 4000
@@ -86,10 +111,91 @@ TELEGRAM_MAX_LENGTH = 4000
 # Класс настроек
 class Settings(BaseSettings):
     TELEGRAM_BOT_TOKEN: str
+    TELEGRAM_API_URL: str | None = None  # свой сервер Bot API (telegram-bot-api, нагрузочный тест); по умолчанию api.telegram.org
     XAI_API_KEY: str
     DATABASE_URL: str
     # Флаг для определения типа базы данных (определяется автоматически)
     USE_SQLITE: bool = False
+    # Количество постоянных соединений (и потоков) SQLite-бэкенда
+    SQLITE_POOL_SIZE: int = 4
+    # Настройки HTTP-клиента xAI
+    XAI_BASE_URL: str = "https://api.x.ai/v1"
+    XAI_POOL_LIMIT: int = 100            # максимум одновременных соединений к API
+    XAI_DNS_TTL: int = 300               # время жизни кэша DNS, секунды
+    XAI_KEEPALIVE_TIMEOUT: float = 60.0  # сколько держать простаивающее соединение, секунды
+    XAI_RETRY_ATTEMPTS: int = 4          # попыток на один ответ (обрыв потока продолжается с места обрыва)
+    XAI_RETRY_BASE_DELAY: float = 0.5    # базовая задержка повтора, удваивается с каждой попыткой, секунды
+    XAI_RETRY_MAX_DELAY: float = 8.0     # потолок задержки повтора, секунды
+    XAI_STREAM_IDLE_TIMEOUT: float = 30.0  # поток без данных дольше этого считается оборванным, секунды
+    XAI_BREAKER_THRESHOLD: int = 5       # неудач подряд, после которых запросы к xAI сразу отклоняются
+    XAI_BREAKER_RESET: float = 30.0      # через сколько секунд пробовать снова, секунды
+    # Планировщик генераций
+    GENERATION_MAX_CONCURRENT: int = 8      # одновременных генераций на весь бот
+    GENERATION_PRIORITY_AGING: float = 30.0 # через сколько секунд ожидания запрос поднимается на уровень приоритета
+    # Промежуточные правки сообщений при стриминге
+    EDIT_MIN_INTERVAL: float = 1.5          # минимальный интервал правок одного чата, секунды
+    EDIT_MAX_INTERVAL: float = 15.0         # потолок интервала после TelegramRetryAfter, секунды
+    EDIT_GLOBAL_RATE: float = 25.0          # правок в секунду на весь бот
+    # Общее состояние генераций: "memory" — в памяти процесса (один процесс),
+    # "database" — в общей БД, для нескольких процессов за одним webhook
+    STATE_BACKEND: str = "memory"
+    STATE_POLL_INTERVAL: float = 0.5   # как часто процесс проверяет отмены из других процессов, секунды
+    STATE_STALE_AFTER: float = 30.0    # аренда без продления дольше этого считается свободной, секунды
+    # Контекст диалога в запросе к модели (токены считаются приближённо, см. count_tokens)
+    CONTEXT_TOKEN_BUDGET: int = 4000          # токенов истории вместе с текущим вопросом
+    CONTEXT_MESSAGE_MAX_TOKENS: int = 1500    # прошлые сообщения длиннее этого сокращаются
+    CONTEXT_REANCHOR_FILL: float = 0.5        # доля бюджета, которую занимает окно после переноса начала
+    # Фоновая очистка истории диалогов
+    HISTORY_RETENTION_INTERVAL: float = 60.0  # секунды между проходами
+    HISTORY_RETENTION_BATCH: int = 500        # пользователей/строк за один DELETE
+    # Отложенная пакетная запись last_active_date
+    LAST_ACTIVE_FLUSH_INTERVAL: float = 30.0  # секунды между записями
+    # Кэш строк users в памяти процесса
+    USER_CACHE_SIZE: int = 10000            # максимум пользователей в кэше (LRU)
+    USER_CACHE_TTL: float = 60.0            # срок жизни записи, секунды (ограничивает рассинхрон между процессами)
+    # Рассылки
+    BROADCAST_RATE: float = 25.0            # сообщений в секунду на все рассылки (лимит Telegram ~30/с)
+    BROADCAST_CONCURRENCY: int = 10         # одновременных отправок
+    BROADCAST_BATCH_SIZE: int = 200         # получателей в пачке (после каждой пачки сохраняется прогресс)
+    # Режим получения обновлений: polling (по умолчанию) или webhook
+    USE_WEBHOOK: bool = False
+    WEBHOOK_BASE_URL: str | None = None      # публичный адрес сервиса, например https://bot.onrender.com
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str | None = None        # X-Telegram-Bot-Api-Secret-Token; если не задан, генерируется при запуске
+    WEBAPP_HOST: str = "0.0.0.0"
+    PORT: int = 8080                         # Render передаёт порт веб-сервиса в переменной PORT
+    WEBHOOK_DRAIN_TIMEOUT: float = 25.0      # сколько ждать обработки принятых обновлений при остановке, секунды
+    WEBHOOK_REUSE_PORT: bool = False         # SO_REUSEPORT: несколько процессов слушают один порт (нужен STATE_BACKEND=database)
+    # Кэш ответов на типовые вопросы (только для вопроса без предыдущего контекста диалога)
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_TTL: float = 604800.0       # срок жизни ответа, секунды (7 дней)
+    RESPONSE_CACHE_MAX_ENTRIES: int = 5000     # сверх этого вытесняются давно не запрошенные ответы
+    RESPONSE_CACHE_PRUNE_INTERVAL: float = 300.0  # секунды между очистками
+    # Фото для vision-модели: уменьшаются и перекодируются в отдельных процессах
+    VISION_MAX_SIDE: int = 1536             # большая сторона после уменьшения, пиксели
+    VISION_JPEG_QUALITY: int = 85
+    VISION_WORKERS: int = 2                 # процессов подготовки изображений (0 — поток в процессе бота)
+    VISION_MAX_FILE_SIZE: int = 20 * 1024 * 1024  # Bot API отдаёт файлы не больше 20 МБ
+    # Документы PDF/DOCX: текст извлекается в отдельных процессах и пересказывается по частям
+    DOCUMENT_MAX_FILE_SIZE: int = 20 * 1024 * 1024  # Bot API отдаёт файлы не больше 20 МБ
+    DOCUMENT_MAX_PAGES: int = 500           # страниц PDF сверх этого не читаются
+    DOCUMENT_WORKERS: int = 2               # процессов извлечения текста (0 — поток в процессе бота)
+    DOCUMENT_CHUNK_TOKENS: int = 6000       # токенов текста в одной части для пересказа
+    DOCUMENT_SUMMARY_CONCURRENCY: int = 4   # частей одного документа пересказывается одновременно
+    # Кэш текста и пересказов документов (повторно присланный документ не скачивается и не читается)
+    DOCUMENT_CACHE_ENABLED: bool = True
+    DOCUMENT_CACHE_MAX_ENTRIES: int = 2000
+    DOCUMENT_CACHE_MAX_BYTES: int = 500 * 1024 * 1024  # суммарный размер записей; сверх него вытесняются давно не запрошенные
+    DOCUMENT_CACHE_PRUNE_INTERVAL: float = 600.0       # секунды между очистками
+    # Генерация изображений («📸 Генерация фото»): фоновые задачи с общим лимитом и кэш file_id
+    IMAGE_GENERATION_MAX_CONCURRENT: int = 2   # одновременных генераций изображений на весь бот
+    IMAGE_GENERATION_TIMEOUT: float = 120.0    # ожидание ответа API генерации, секунды
+    IMAGE_CACHE_ENABLED: bool = True           # повторный запрос отвечается уже загруженным в Telegram фото
+    IMAGE_CACHE_MAX_ENTRIES: int = 10000
+    IMAGE_CACHE_PRUNE_INTERVAL: float = 600.0  # секунды между очистками
+    # Метрики в формате Prometheus: GET /metrics на отдельном локальном порту
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9464                   # 0 — не поднимать сервер метрик
 
     # Опциональные настройки для БД (если нужно парсить DSN вручную, обычно не требуется)
     # DB_HOST: str | None = None
@@ -115,12 +221,12 @@ settings = Settings()
 # Инициализация клиента xAI для vision-модели
 vision_client = OpenAI(
     api_key=settings.XAI_API_KEY,
-    base_url="https://api.x.ai/v1",
+    base_url=settings.XAI_BASE_URL,
 )
 # Инициализация асинхронного клиента xAI для vision-модели (стриминг)
 vision_async_client = AsyncOpenAI(
     api_key=settings.XAI_API_KEY,
-    base_url="https://api.x.ai/v1",
+    base_url=settings.XAI_BASE_URL,
 )
 
 # Проверка наличия токенов
@@ -137,12 +243,11 @@ if not settings.DATABASE_URL:
 # Инициализация бота и диспетчера
 dp = Dispatcher()
 # Используем DefaultBotProperties для установки parse_mode по умолчанию
-bot = Bot(token=settings.TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
-# --- Глобальные переменные для отслеживания прогресса и отмены ---
-progress_message_ids: dict[int, int] = {} # {user_id: message_id}
-active_requests: dict[int, asyncio.Task] = {}  # {user_id: task}
-pending_photo_prompts: set[int] = set()  # Состояние ожидания запроса для генерации фото
+bot = Bot(
+    token=settings.TELEGRAM_BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL)) if settings.TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
 
 # --- Фильтр для проверки администратора ---
 class IsAdmin(BaseFilter):
@@ -192,10 +297,663 @@ def main_menu_keyboard() -> types.ReplyKeyboardMarkup:
         input_field_placeholder="Выберите действие или введите вопрос..."
     )
 
+# --- Метрики в формате Prometheus ---
+
+# Границы корзин гистограмм задержек, секунды: от запроса к SQLite до долгой генерации
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    """Общее для метрик: имя, описание и имена меток; значения хранятся по кортежу меток."""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], typing.Any] = {}
+
+    def _key(self, labels: dict[str, typing.Any]) -> tuple[str, ...]:
+        if not labels and not self.labelnames:
+            return ()
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key in sorted(self._values):
+            lines.extend(self._render_sample(key, self._values[key]))
+        return lines
+
+    def _render_sample(self, key: tuple[str, ...], value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами: observe() — bisect и два сложения."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики корзин без накопления (последняя — +Inf), сумма, количество]
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Контекстный менеджер: наблюдает длительность блока."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def _render_sample(self, key: tuple[str, ...], state) -> list[str]:
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Реестр метрик процесса и их выдача в текстовом формате Prometheus (exposition 0.0.4).
+
+    Метрики обновляются прямо в горячем пути (без блокировок: всё в одном цикле событий),
+    значения, которые дешевле прочитать, чем отслеживать (очереди, активные генерации),
+    заполняются перед выдачей функциями из add_collector().
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[typing.Callable[[], None]] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collect: typing.Callable[[], None]):
+        """collect() вызывается перед каждой выдачей метрик."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.warning(f"Ошибка сбора метрик: {e}")
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор корутины: наблюдает время её выполнения (в том числе завершившейся ошибкой)."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+metrics = MetricsRegistry()
+db_query_seconds = metrics.histogram(
+    "bot_db_query_seconds", "Время функций работы с БД (включая кэш пользователей)", ("query",)
+)
+xai_first_token_seconds = metrics.histogram(
+    "bot_xai_first_token_seconds", "Время от запроса к xAI до первого фрагмента ответа"
+)
+xai_tokens_per_second = metrics.histogram(
+    "bot_xai_tokens_per_second", "Скорость стриминга ответа xAI после первого фрагмента, токенов в секунду",
+    buckets=TOKENS_PER_SECOND_BUCKETS
+)
+xai_stream_seconds = metrics.histogram(
+    "bot_xai_stream_seconds", "Полное время стриминга ответа xAI", ("outcome",)
+)
+telegram_edit_seconds = metrics.histogram(
+    "bot_telegram_edit_seconds", "Время вызова editMessageText при стриминге", ("outcome",)
+)
+telegram_retry_after_total = metrics.counter(
+    "bot_telegram_retry_after_total", "Ответов Telegram RetryAfter (429)", ("source",)
+)
+markdown_render_seconds = metrics.histogram(
+    "bot_markdown_render_seconds", "Время преобразования Markdown в HTML Telegram", ("mode",)
+)
+generation_queue_depth = metrics.gauge(
+    "bot_generation_queue_depth", "Запросов в очереди на генерацию", ("kind",)
+)
+generations_active = metrics.gauge(
+    "bot_generations_active", "Генераций, выполняющихся сейчас", ("kind",)
+)
+generation_cancellations_total = metrics.counter(
+    "bot_generation_cancellations_total", "Генераций, отменённых кнопкой «Отмена»"
+)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """GET /metrics: все метрики процесса в текстовом формате Prometheus."""
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner | None:
+    """
+    Поднимает сервер метрик на host:port (по умолчанию только локальный интерфейс).
+    Если порт занят (например, другой процесс бота с WEBHOOK_REUSE_PORT), бот работает без него.
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning(f"Сервер метрик не запущен ({host}:{port}): {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
 # --- Функции для работы с базой данных (SQLite и PostgreSQL) ---
-# (Оставлены без изменений, так как они работали корректно)
 
-async def init_sqlite_db(db_path):
+class SQLiteBackend:
+    """
+    Долгоживущий SQLite-бэкенд: держит постоянные соединения на выделенном пуле потоков.
+
+    Каждый поток пула один раз открывает своё соединение (с WAL и настроенными прагмами)
+    и переиспользует его для всех запросов, вместо sqlite3.connect() на каждый вызов.
+    """
+
+    def __init__(self, db_path: str, pool_size: int = 4):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="sqlite"
+        )
+        self._local = threading.local()  # соединение текущего потока пула
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # check_same_thread=False нужен только для close() из другого потока,
+        # в остальном каждое соединение используется только своим потоком
+        conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")      # читатели не блокируют писателя
+        conn.execute("PRAGMA synchronous=NORMAL")    # безопасно в режиме WAL и заметно быстрее FULL
+        conn.execute("PRAGMA busy_timeout=5000")     # ждём блокировку вместо мгновенной ошибки
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")     # ~16 МБ кэша страниц на соединение
+        return conn
+
+    def _get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, func, args):
+        conn = self._get_connection()
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке пула и фиксирует транзакцию."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def _close(self):
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    async def close(self):
+        """Дожидается текущих запросов и закрывает все соединения."""
+        await asyncio.to_thread(self._close)
+
+
+# --- Миграции схемы ---
+# Базовые таблицы создаются через CREATE TABLE IF NOT EXISTS, а изменения поверх них —
+# пронумерованными миграциями. Применённые версии хранятся в schema_migrations;
+# новые миграции добавляются только в конец списков, уже выпущенные не меняются.
+
+SQLITE_USERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id INTEGER PRIMARY KEY,      -- Telegram User ID
+        username TEXT NULL,
+        first_name TEXT NOT NULL,
+        last_name TEXT NULL,
+        registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_active_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        free_messages_today INTEGER DEFAULT 7,
+        last_free_reset_date TEXT DEFAULT (date('now')), -- Используем TEXT для даты в SQLite
+        subscription_status TEXT DEFAULT 'inactive' CHECK (subscription_status IN ('inactive', 'active')),
+        subscription_expires TIMESTAMP NULL,
+        is_admin BOOLEAN DEFAULT FALSE, -- Добавим поле для админов
+        is_blocked BOOLEAN DEFAULT FALSE -- Пользователь заблокировал бота (выясняется при рассылке)
+    )
+'''
+
+# Индексы под админ-команды и /stats: поиск по username без учёта регистра,
+# выборки по активности, дате регистрации и статусу подписки
+USERS_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username))",
+    "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active_date)",
+    "CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_date)",
+    "CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (subscription_status, subscription_expires)",
+]
+
+def _sqlite_add_is_blocked(conn: sqlite3.Connection):
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(users)")}
+    if 'is_blocked' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE")
+
+def _sqlite_fix_free_messages_default(conn: sqlite3.Connection):
+    # В старых базах free_messages_today DEFAULT 3. SQLite не умеет менять DEFAULT колонки,
+    # поэтому таблица пересоздаётся по актуальной схеме с копированием данных.
+    columns = {row['name']: row for row in conn.execute("PRAGMA table_info(users)")}
+    if columns['free_messages_today']['dflt_value'] == '7':
+        return
+    conn.execute(SQLITE_USERS_TABLE_SQL.format(table="users_new"))
+    names = ", ".join(columns)
+    conn.execute(f"INSERT INTO users_new ({names}) SELECT {names} FROM users")
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+
+def _sqlite_create_users_indexes(conn: sqlite3.Connection):
+    for statement in USERS_INDEXES_SQL:
+        conn.execute(statement)
+
+# Дневные агрегаты для /stats. Их ведут триггеры на users, поэтому они верны при любом
+# пути записи (приём запроса, пакетная запись last_active_date, выдача подписки, админ-команды):
+#   stats_registrations — пользователи по дню регистрации (subscribed — из них со статусом active);
+#   stats_last_active   — пользователи по дню последней активности;
+#   stats_sub_expiry    — активные подписки по дню окончания.
+# Счётчик дня меняется, только когда строка users переходит в другой день/статус,
+# то есть last_active_date трогает агрегаты не чаще раза в сутки на пользователя.
+STATS_NO_DATE = '1970-01-01'  # день для строк без registration_date (в total они должны учитываться)
+
+def _sqlite_stats_add(row: str) -> dict[str, str]:
+    return {
+        'registrations': f"""
+            INSERT INTO stats_registrations (day, users, subscribed)
+            VALUES (COALESCE(date({row}.registration_date), '{STATS_NO_DATE}'), 1, {row}.subscription_status = 'active')
+            ON CONFLICT(day) DO UPDATE SET users = users + 1, subscribed = subscribed + excluded.subscribed;""",
+        'last_active': f"""
+            INSERT INTO stats_last_active (day, users)
+            SELECT date({row}.last_active_date), 1 WHERE date({row}.last_active_date) IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET users = users + 1;""",
+        'sub_expiry': f"""
+            INSERT INTO stats_sub_expiry (day, subs)
+            SELECT date({row}.subscription_expires), 1
+            WHERE {row}.subscription_status = 'active' AND date({row}.subscription_expires) IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET subs = subs + 1;""",
+    }
+
+def _sqlite_stats_remove(row: str) -> dict[str, str]:
+    return {
+        'registrations': f"""
+            UPDATE stats_registrations SET users = users - 1, subscribed = subscribed - ({row}.subscription_status = 'active')
+            WHERE day = COALESCE(date({row}.registration_date), '{STATS_NO_DATE}');""",
+        'last_active': f"""
+            UPDATE stats_last_active SET users = users - 1 WHERE day = date({row}.last_active_date);""",
+        'sub_expiry': f"""
+            UPDATE stats_sub_expiry SET subs = subs - 1
+            WHERE {row}.subscription_status = 'active' AND day = date({row}.subscription_expires);""",
+    }
+
+# Условия, при которых UPDATE users меняет соответствующий агрегат
+SQLITE_STATS_UPDATE_WHEN = {
+    'registrations': (
+        "registration_date, subscription_status",
+        f"COALESCE(date(OLD.registration_date), '{STATS_NO_DATE}') IS NOT COALESCE(date(NEW.registration_date), '{STATS_NO_DATE}')"
+        " OR (OLD.subscription_status = 'active') IS NOT (NEW.subscription_status = 'active')"
+    ),
+    'last_active': (
+        "last_active_date",
+        "date(OLD.last_active_date) IS NOT date(NEW.last_active_date)"
+    ),
+    'sub_expiry': (
+        "subscription_status, subscription_expires",
+        "(OLD.subscription_status = 'active') IS NOT (NEW.subscription_status = 'active')"
+        " OR date(OLD.subscription_expires) IS NOT date(NEW.subscription_expires)"
+    ),
+}
+
+def _sqlite_create_stats_rollups(conn: sqlite3.Connection):
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_registrations (day TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0, subscribed INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_last_active (day TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_sub_expiry (day TEXT PRIMARY KEY, subs INTEGER NOT NULL DEFAULT 0)")
+    # Начальное заполнение по текущим данным
+    conn.execute(f"""
+        INSERT INTO stats_registrations (day, users, subscribed)
+        SELECT COALESCE(date(registration_date), '{STATS_NO_DATE}'), COUNT(*), SUM(subscription_status = 'active')
+        FROM users GROUP BY 1
+    """)
+    conn.execute("""
+        INSERT INTO stats_last_active (day, users)
+        SELECT date(last_active_date), COUNT(*) FROM users WHERE date(last_active_date) IS NOT NULL GROUP BY 1
+    """)
+    conn.execute("""
+        INSERT INTO stats_sub_expiry (day, subs)
+        SELECT date(subscription_expires), COUNT(*) FROM users
+        WHERE subscription_status = 'active' AND date(subscription_expires) IS NOT NULL GROUP BY 1
+    """)
+    add_new, remove_old = _sqlite_stats_add("NEW"), _sqlite_stats_remove("OLD")
+    conn.execute(f"CREATE TRIGGER users_stats_insert AFTER INSERT ON users BEGIN {''.join(add_new.values())} END")
+    conn.execute(f"CREATE TRIGGER users_stats_delete AFTER DELETE ON users BEGIN {''.join(remove_old.values())} END")
+    for name, (columns, when) in SQLITE_STATS_UPDATE_WHEN.items():
+        conn.execute(
+            f"CREATE TRIGGER users_stats_update_{name} AFTER UPDATE OF {columns} ON users WHEN {when} "
+            f"BEGIN {remove_old[name]} {add_new[name]} END"
+        )
+
+# Общее состояние для нескольких процессов (DatabaseStateBackend); время — unix-секунды
+STATE_TABLES_SQL = [
+    "CREATE TABLE IF NOT EXISTS state_leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, token TEXT NOT NULL, heartbeat_at DOUBLE PRECISION NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_state_leases_owner ON state_leases (owner)",
+    "CREATE TABLE IF NOT EXISTS pending_prompts (user_id BIGINT PRIMARY KEY, created_at DOUBLE PRECISION NOT NULL)",
+]
+
+def _sqlite_create_state_tables(conn: sqlite3.Connection):
+    for statement in STATE_TABLES_SQL:
+        conn.execute(statement)
+
+RESPONSE_CACHE_SQL = [
+    """CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        prompt_version TEXT NOT NULL,
+        question TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL,
+        last_hit_at DOUBLE PRECISION NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_response_cache_last_hit ON response_cache (last_hit_at)",
+]
+
+def _sqlite_create_response_cache(conn: sqlite3.Connection):
+    for statement in RESPONSE_CACHE_SQL:
+        conn.execute(statement)
+
+DOCUMENT_CACHE_SQL = [
+    """CREATE TABLE IF NOT EXISTS document_cache (
+        content_hash TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        file_name TEXT,
+        pages INTEGER NOT NULL,
+        total_pages INTEGER NOT NULL,
+        chunks TEXT NOT NULL,
+        summaries TEXT,
+        digest TEXT,
+        size_bytes INTEGER NOT NULL,
+        build_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+        created_at DOUBLE PRECISION NOT NULL,
+        last_hit_at DOUBLE PRECISION NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_document_cache_last_hit ON document_cache (last_hit_at)",
+    """CREATE TABLE IF NOT EXISTS document_files (
+        file_unique_id TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_document_files_hash ON document_files (content_hash)",
+]
+
+def _sqlite_create_document_cache(conn: sqlite3.Connection):
+    for statement in DOCUMENT_CACHE_SQL:
+        conn.execute(statement)
+
+IMAGE_CACHE_SQL = [
+    """CREATE TABLE IF NOT EXISTS image_cache (
+        key TEXT PRIMARY KEY,
+        prompt TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL,
+        last_hit_at DOUBLE PRECISION NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_image_cache_last_hit ON image_cache (last_hit_at)",
+]
+
+def _sqlite_create_image_cache(conn: sqlite3.Connection):
+    for statement in IMAGE_CACHE_SQL:
+        conn.execute(statement)
+
+def _sqlite_add_context_anchor(conn: sqlite3.Connection):
+    # id сообщения, с которого начинается окно контекста пользователя (см. build_context)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    if 'context_anchor' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN context_anchor INTEGER")
+
+def _sqlite_add_conversation_tokens(conn: sqlite3.Connection):
+    # Число токенов сообщения считается один раз при вставке; у старых строк NULL
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(conversations)")]
+    if 'tokens' not in columns:
+        conn.execute("ALTER TABLE conversations ADD COLUMN tokens INTEGER")
+
+POSTGRES_STATS_ROLLUPS_SQL = f"""
+    CREATE TABLE IF NOT EXISTS stats_registrations (day DATE PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0, subscribed INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS stats_last_active (day DATE PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS stats_sub_expiry (day DATE PRIMARY KEY, subs INTEGER NOT NULL DEFAULT 0);
+
+    INSERT INTO stats_registrations (day, users, subscribed)
+    SELECT COALESCE(registration_date::date, DATE '{STATS_NO_DATE}'), COUNT(*), COUNT(*) FILTER (WHERE subscription_status = 'active')
+    FROM users GROUP BY 1;
+    INSERT INTO stats_last_active (day, users)
+    SELECT last_active_date::date, COUNT(*) FROM users WHERE last_active_date IS NOT NULL GROUP BY 1;
+    INSERT INTO stats_sub_expiry (day, subs)
+    SELECT subscription_expires::date, COUNT(*) FROM users
+    WHERE subscription_status = 'active' AND subscription_expires IS NOT NULL GROUP BY 1;
+
+    CREATE OR REPLACE FUNCTION users_stats_rollup() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        reg_changed BOOLEAN := TG_OP <> 'UPDATE';
+        active_changed BOOLEAN := TG_OP <> 'UPDATE';
+        expiry_changed BOOLEAN := TG_OP <> 'UPDATE';
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            reg_changed := COALESCE(OLD.registration_date::date, DATE '{STATS_NO_DATE}') IS DISTINCT FROM COALESCE(NEW.registration_date::date, DATE '{STATS_NO_DATE}')
+                OR (OLD.subscription_status = 'active') IS DISTINCT FROM (NEW.subscription_status = 'active');
+            active_changed := OLD.last_active_date::date IS DISTINCT FROM NEW.last_active_date::date;
+            expiry_changed := (OLD.subscription_status = 'active') IS DISTINCT FROM (NEW.subscription_status = 'active')
+                OR OLD.subscription_expires::date IS DISTINCT FROM NEW.subscription_expires::date;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            IF reg_changed THEN
+                UPDATE stats_registrations SET users = users - 1, subscribed = subscribed - (OLD.subscription_status = 'active')::int
+                WHERE day = COALESCE(OLD.registration_date::date, DATE '{STATS_NO_DATE}');
+            END IF;
+            IF active_changed AND OLD.last_active_date IS NOT NULL THEN
+                UPDATE stats_last_active SET users = users - 1 WHERE day = OLD.last_active_date::date;
+            END IF;
+            IF expiry_changed AND OLD.subscription_status = 'active' AND OLD.subscription_expires IS NOT NULL THEN
+                UPDATE stats_sub_expiry SET subs = subs - 1 WHERE day = OLD.subscription_expires::date;
+            END IF;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            IF reg_changed THEN
+                INSERT INTO stats_registrations (day, users, subscribed)
+                VALUES (COALESCE(NEW.registration_date::date, DATE '{STATS_NO_DATE}'), 1, (NEW.subscription_status = 'active')::int)
+                ON CONFLICT (day) DO UPDATE SET users = stats_registrations.users + 1,
+                                                subscribed = stats_registrations.subscribed + EXCLUDED.subscribed;
+            END IF;
+            IF active_changed AND NEW.last_active_date IS NOT NULL THEN
+                INSERT INTO stats_last_active (day, users) VALUES (NEW.last_active_date::date, 1)
+                ON CONFLICT (day) DO UPDATE SET users = stats_last_active.users + 1;
+            END IF;
+            IF expiry_changed AND NEW.subscription_status = 'active' AND NEW.subscription_expires IS NOT NULL THEN
+                INSERT INTO stats_sub_expiry (day, subs) VALUES (NEW.subscription_expires::date, 1)
+                ON CONFLICT (day) DO UPDATE SET subs = stats_sub_expiry.subs + 1;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$;
+
+    DROP TRIGGER IF EXISTS users_stats ON users;
+    CREATE TRIGGER users_stats
+        AFTER INSERT OR DELETE OR UPDATE OF registration_date, last_active_date, subscription_status, subscription_expires ON users
+        FOR EACH ROW EXECUTE FUNCTION users_stats_rollup();
+"""
+
+# (версия, описание, функция применения)
+SQLITE_MIGRATIONS: list[tuple[int, str, typing.Callable[[sqlite3.Connection], None]]] = [
+    (1, "users.is_blocked", _sqlite_add_is_blocked),
+    (2, "users.free_messages_today DEFAULT 7", _sqlite_fix_free_messages_default),
+    (3, "индексы users для админ-команд и статистики", _sqlite_create_users_indexes),
+    (4, "дневные агрегаты для /stats", _sqlite_create_stats_rollups),
+    (5, "общее состояние генераций для нескольких процессов", _sqlite_create_state_tables),
+    (6, "кэш ответов на типовые вопросы", _sqlite_create_response_cache),
+    (7, "conversations.tokens", _sqlite_add_conversation_tokens),
+    (8, "users.context_anchor", _sqlite_add_context_anchor),
+    (9, "кэш текста и пересказов документов", _sqlite_create_document_cache),
+    (10, "кэш сгенерированных изображений", _sqlite_create_image_cache),
+]
+
+# (версия, описание, SQL)
+POSTGRES_MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "users.is_blocked", "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE"),
+    (2, "users.free_messages_today DEFAULT 7", "ALTER TABLE users ALTER COLUMN free_messages_today SET DEFAULT 7"),
+    (3, "индексы users для админ-команд и статистики", ";\n".join(USERS_INDEXES_SQL)),
+    (4, "дневные агрегаты для /stats", POSTGRES_STATS_ROLLUPS_SQL),
+    (5, "общее состояние генераций для нескольких процессов", ";\n".join(STATE_TABLES_SQL)),
+    (6, "кэш ответов на типовые вопросы", ";\n".join(RESPONSE_CACHE_SQL)),
+    (7, "conversations.tokens", "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tokens INTEGER"),
+    (8, "users.context_anchor", "ALTER TABLE users ADD COLUMN IF NOT EXISTS context_anchor BIGINT"),
+    (9, "кэш текста и пересказов документов", ";\n".join(DOCUMENT_CACHE_SQL)),
+    (10, "кэш сгенерированных изображений", ";\n".join(IMAGE_CACHE_SQL)),
+]
+
+# Ключ advisory-блокировки: несколько экземпляров бота не применяют миграции одновременно
+MIGRATIONS_LOCK_KEY = 7_401_001
+
+def apply_sqlite_migrations(conn: sqlite3.Connection) -> list[int]:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает применённые версии."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    applied = []
+    for version, description, migrate in SQLITE_MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")  # берём блокировку записи до проверки версии
+        try:
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                conn.rollback()
+                continue
+            migrate(conn)
+            conn.execute("INSERT INTO schema_migrations (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Ошибка миграции SQLite {version} ({description})")
+            raise
+        applied.append(version)
+    return applied
+
+async def apply_postgres_migrations(connection: asyncpg.Connection) -> list[int]:
+    """Применяет недостающие миграции в одной транзакции под advisory-блокировкой."""
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    applied = []
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_KEY)
+        done = {r['version'] for r in await connection.fetch("SELECT version FROM schema_migrations")}
+        for version, description, sql in POSTGRES_MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                await connection.execute(sql)
+            except asyncpg.PostgresError as e:
+                logger.error(f"Ошибка миграции PostgreSQL {version} ({description}): {e}")
+                raise
+            await connection.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)", version, description
+            )
+            applied.append(version)
+    return applied
+
+async def init_sqlite_db(db_path: str, pool_size: int = 4) -> SQLiteBackend:
     try:
         if db_path.startswith('sqlite:///'):
             db_path = db_path[10:]
@@ -203,9 +961,9 @@ async def init_sqlite_db(db_path):
              db_path = db_path[9:]
 
         logger.info(f"Инициализация SQLite базы данных: {db_path}")
+        backend = SQLiteBackend(db_path, pool_size=pool_size)
 
-        def _init_db():
-            conn = sqlite3.connect(db_path)
+        def _init_db(conn: sqlite3.Connection):
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS conversations (
@@ -219,29 +977,37 @@ async def init_sqlite_db(db_path):
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_user_id_timestamp ON conversations (user_id, timestamp DESC)
             ''')
+            # Для удаления устаревших сообщений фоновой очисткой
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp)
+            ''')
             # Добавляем создание таблицы users
+            cursor.execute(SQLITE_USERS_TABLE_SQL.format(table="users"))
+            logger.info("Таблица 'users' для SQLite инициализирована.") # Добавляем лог
+            # Задания рассылки: прогресс сохраняется после каждой пачки получателей
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,      -- Telegram User ID
-                    username TEXT NULL,
-                    first_name TEXT NOT NULL,
-                    last_name TEXT NULL,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_active_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    free_messages_today INTEGER DEFAULT 7,
-                    last_free_reset_date TEXT DEFAULT (date('now')), -- Используем TEXT для даты в SQLite
-                    subscription_status TEXT DEFAULT 'inactive' CHECK (subscription_status IN ('inactive', 'active')),
-                    subscription_expires TIMESTAMP NULL,
-                    is_admin BOOLEAN DEFAULT FALSE -- Добавим поле для админов
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text TEXT NOT NULL,
+                    created_by INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done', 'cancelled')),
+                    total INTEGER NOT NULL DEFAULT 0,
+                    last_user_id INTEGER NOT NULL DEFAULT 0, -- курсор: все user_id <= last_user_id обработаны
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP NULL
                 )
             ''')
-            conn.commit()
-            logger.info("Таблица 'users' для SQLite инициализирована.") # Добавляем лог
-            conn.close()
 
-        await asyncio.to_thread(_init_db)
-        logger.info("SQLite база данных успешно инициализирована")
-        return db_path
+        await backend.run(_init_db)
+        applied = await backend.run(apply_sqlite_migrations)
+        if applied:
+            logger.info(f"Применены миграции SQLite: {applied}")
+        logger.info(f"SQLite база данных успешно инициализирована (соединений в пуле: {pool_size})")
+        return backend
     except Exception as e:
         logger.exception(f"Ошибка при инициализации SQLite: {e}")
         raise
@@ -258,6 +1024,7 @@ async def init_db_postgres(pool: asyncpg.Pool):
                 timestamp TIMESTAMPTZ DEFAULT NOW()
             );
             CREATE INDEX IF NOT EXISTS idx_user_id_timestamp ON conversations (user_id, timestamp DESC);
+            CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp);
             ''')
             logger.info("Таблица conversations успешно инициализирована (PostgreSQL)")
 
@@ -275,14 +1042,35 @@ async def init_db_postgres(pool: asyncpg.Pool):
                         last_free_reset_date DATE DEFAULT CURRENT_DATE,
                         subscription_status TEXT DEFAULT 'inactive' CHECK (subscription_status IN ('inactive', 'active')),
                         subscription_expires TIMESTAMPTZ NULL,
-                        is_admin BOOLEAN DEFAULT FALSE -- Добавим поле для админов
+                        is_admin BOOLEAN DEFAULT FALSE, -- Добавим поле для админов
+                        is_blocked BOOLEAN DEFAULT FALSE -- Пользователь заблокировал бота (выясняется при рассылке)
                     );
                 ''')
                 logger.info("Таблица 'users' для PostgreSQL успешно инициализирована.")
+                await connection.execute('''
+                    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                        id SERIAL PRIMARY KEY,
+                        text TEXT NOT NULL,
+                        created_by BIGINT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done', 'cancelled')),
+                        total INTEGER NOT NULL DEFAULT 0,
+                        last_user_id BIGINT NOT NULL DEFAULT 0, -- курсор: все user_id <= last_user_id обработаны
+                        sent INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        blocked INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMPTZ DEFAULT NOW(),
+                        updated_at TIMESTAMPTZ DEFAULT NOW(),
+                        finished_at TIMESTAMPTZ NULL
+                    );
+                ''')
             except asyncpg.PostgresError as e:
                  logger.error(f"Ошибка инициализации таблицы users PostgreSQL: {e}")
                  raise # Перебрасываем исключение, чтобы остановить инициализацию, если таблица users не создалась
 
+            applied = await apply_postgres_migrations(connection)
+            if applied:
+                logger.info(f"Применены миграции PostgreSQL: {applied}")
+
         except asyncpg.PostgresError as e:
             logger.error(f"Ошибка инициализации БД PostgreSQL (таблица conversations): {e}") # Уточняем лог
             raise
@@ -290,117 +1078,427 @@ async def init_db_postgres(pool: asyncpg.Pool):
             logger.exception(f"Непредвиденная ошибка инициализации БД PostgreSQL: {e}")
             raise
 
+# --- Контекст диалога: сборка истории под бюджет (подсчёт токенов — workers.count_tokens) ---
+
+def truncate_message(content: str, tokens: int, max_tokens: int) -> str:
+    """Сокращает сообщение примерно до max_tokens: начало и конец сохраняются, середина вырезается."""
+    keep = int(len(content) * max_tokens / tokens)
+    if keep >= len(content):
+        return content
+    head = keep * 2 // 3
+    tail = keep - head
+    return f"{content[:head].rstrip()}\n[… сокращено {len(content) - keep} символов …]\n{content[len(content) - tail:].lstrip()}"
+
+def build_context(
+    rows: list[dict],
+    budget: int,
+    max_message_tokens: int,
+    anchor_id: int | None = None,
+    limit: int = CONVERSATION_HISTORY_LIMIT,
+    refill: float = 0.5
+) -> tuple[list[dict], int | None]:
+    """
+    Собирает историю для запроса в пределах budget токенов; возвращает (история, якорь).
+
+    rows — сообщения с id >= anchor_id в хронологическом порядке с числом токенов
+    ('tokens', None у старых строк); последнее — текущий вопрос. Прошлые сообщения длиннее
+    max_message_tokens сокращаются (вставленный анализ не вытесняет весь диалог), текущий
+    вопрос — только если сам не помещается в бюджет.
+
+    Окно не сдвигается на каждом ходе: оно начинается с якоря (id сообщения) и только
+    дописывается, пока всё помещается в budget и limit, поэтому начало запроса — системный
+    промпт и старые ходы — остаётся побайтно тем же и попадает в кэш промптов провайдера.
+    Когда окно переполняется, якорь переносится сразу на несколько ходов вперёд: в новое
+    окно берутся последние сообщения на refill от бюджета и лимита, остальное место
+    заполняют следующие ходы. Без якоря (первый запрос) окно заполняется на весь бюджет.
+    """
+    costs = []
+    for position, row in enumerate(reversed(rows)):
+        tokens = row.get('tokens') or count_tokens(row['content'])
+        costs.append(tokens if position == 0 else min(tokens, max_message_tokens))
+    costs.reverse()
+
+    if anchor_id is not None and len(rows) < limit and sum(costs) <= budget:
+        window = len(rows)
+    else:
+        # Переякорение: последние сообщения на долю refill бюджета (текущий вопрос — всегда);
+        # первое окно пользователя заполняется целиком
+        fill = 1.0 if anchor_id is None else refill
+        target, max_count = budget * fill, max(1, int(limit * fill))
+        window, used = 0, 0
+        for cost in reversed(costs):
+            if window and (used + cost > target or window >= max_count):
+                break
+            used += cost
+            window += 1
+        if rows:
+            anchor_id = rows[-window].get('id', anchor_id)
+
+    context: list[dict] = []
+    for position, row in enumerate(rows[len(rows) - window:], start=len(rows) - window):
+        content = row['content']
+        tokens = row.get('tokens') or count_tokens(content)
+        limit_tokens = budget if position == len(rows) - 1 else max_message_tokens
+        if tokens > limit_tokens:
+            content = truncate_message(content, tokens, limit_tokens)
+        context.append({'role': row['role'], 'content': content})
+    return context, anchor_id
+
+# Кандидаты в контекст: сообщения начиная с якоря users.context_anchor, от последнего, пока
+# их стоимость (с учётом сокращения до max_message_tokens) помещается в бюджет. Содержимое
+# старых сообщений не читается вовсе. У строк без tokens стоимость — длина в символах.
+SQLITE_CONTEXT_QUERY = """
+    SELECT id, role, content, tokens FROM (
+        SELECT role, content, tokens, timestamp, id,
+               MIN(COALESCE(tokens, LENGTH(content)), :max_tokens) AS cost,
+               SUM(MIN(COALESCE(tokens, LENGTH(content)), :max_tokens)) OVER (ORDER BY timestamp DESC, id DESC) AS running
+        FROM conversations
+        WHERE user_id = :user_id AND id >= COALESCE((SELECT context_anchor FROM users WHERE user_id = :user_id), 0)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT :limit
+    ) WHERE running - cost < :budget
+    ORDER BY timestamp, id
+"""
+
+POSTGRES_CONTEXT_QUERY = """
+    SELECT id, role, content, tokens FROM (
+        SELECT role, content, tokens, timestamp, id,
+               LEAST(COALESCE(tokens, LENGTH(content)), $3) AS cost,
+               SUM(LEAST(COALESCE(tokens, LENGTH(content)), $3)) OVER (ORDER BY timestamp DESC, id DESC) AS running
+        FROM conversations
+        WHERE user_id = $1 AND id >= COALESCE((SELECT context_anchor FROM users WHERE user_id = $1), 0)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT $4
+    ) h WHERE running - cost < $2
+    ORDER BY timestamp, id
+"""
+
+async def set_context_anchor(db, user_id: int, anchor_id: int):
+    """Запоминает, с какого сообщения начинается окно контекста пользователя (см. build_context)."""
+    if settings.USE_SQLITE:
+        await db.run(lambda conn: conn.execute("UPDATE users SET context_anchor = ? WHERE user_id = ?", (anchor_id, user_id)))
+    else:
+        async with db.acquire() as conn:
+            await conn.execute("UPDATE users SET context_anchor = $2 WHERE user_id = $1", user_id, anchor_id)
+
+def _context_settings() -> dict:
+    return {
+        'budget': settings.CONTEXT_TOKEN_BUDGET,
+        'max_message_tokens': settings.CONTEXT_MESSAGE_MAX_TOKENS,
+        'refill': settings.CONTEXT_REANCHOR_FILL,
+    }
+
 # Адаптеры для работы с разными базами данных
+@timed(db_query_seconds, query="add_message_to_db")
 async def add_message_to_db(db, user_id: int, role: str, content: str):
     if settings.USE_SQLITE:
-        return await add_message_to_sqlite(db, user_id, role, content)
+        await add_message_to_sqlite(db, user_id, role, content)
     else:
-        return await add_message_to_postgres(db, user_id, role, content)
-
-async def get_last_messages(db, user_id: int, limit: int = CONVERSATION_HISTORY_LIMIT) -> list[dict]:
+        await add_message_to_postgres(db, user_id, role, content)
+    retention: HistoryRetention | None = dp.workflow_data.get('history_retention')
+    if retention:
+        retention.mark(user_id)
+
+@timed(db_query_seconds, query="get_context_messages")
+async def get_context_messages(db, user_id: int, limit: int = CONVERSATION_HISTORY_LIMIT) -> list[dict]:
+    """История для запроса к модели в пределах CONTEXT_TOKEN_BUDGET (см. build_context)."""
     if settings.USE_SQLITE:
-        return await get_last_messages_sqlite(db, user_id, limit)
+        rows, anchor_id = await get_context_rows_sqlite(db, user_id, limit)
     else:
-        return await get_last_messages_postgres(db, user_id, limit)
+        rows, anchor_id = await get_context_rows_postgres(db, user_id, limit)
+    history, new_anchor_id = build_context(rows, anchor_id=anchor_id, limit=limit, **_context_settings())
+    if new_anchor_id is not None and new_anchor_id != anchor_id:
+        try:
+            await set_context_anchor(db, user_id, new_anchor_id)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить начало окна контекста пользователя {user_id}: {e}")
+    return history
 
 # SQLite-специфичные функции
-async def add_message_to_sqlite(db_path: str, user_id: int, role: str, content: str):
+async def add_message_to_sqlite(db: SQLiteBackend, user_id: int, role: str, content: str):
+    tokens = count_tokens(content)
     try:
-        def _add_message():
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            # Простая вставка без очистки истории (можно добавить очистку по аналогии с PG)
-            cursor.execute(
-                "INSERT INTO conversations (user_id, role, content) VALUES (?, ?, ?)",
-                (user_id, role, content)
-            )
-            # Опционально: очистка старых сообщений
-            cursor.execute("""
-                DELETE FROM conversations
-                WHERE id NOT IN (
-                    SELECT id
-                    FROM conversations
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                ) AND user_id = ?
-            """, (user_id, CONVERSATION_HISTORY_LIMIT, user_id))
-            conn.commit()
-            conn.close()
+        def _add_message(conn: sqlite3.Connection):
+            # Только вставка: старые сообщения удаляет фоновая очистка (HistoryRetention)
+            conn.execute(
+                "INSERT INTO conversations (user_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+                (user_id, role, content, tokens)
+            )
 
-        await asyncio.to_thread(_add_message)
-        logger.debug(f"SQLite: Сообщение {role} для пользователя {user_id} сохранено (оставлено <= {CONVERSATION_HISTORY_LIMIT})")
+        await db.run(_add_message)
+        logger.debug(f"SQLite: Сообщение {role} для пользователя {user_id} сохранено")
     except Exception as e:
         logger.exception(f"SQLite: Ошибка при добавлении сообщения: {e}")
         raise
 
-async def get_last_messages_sqlite(db_path: str, user_id: int, limit: int) -> list[dict]:
+async def get_context_rows_sqlite(db: SQLiteBackend, user_id: int, limit: int) -> tuple[list[dict], int | None]:
     try:
-        def _get_messages():
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row # Возвращать как dict-like
+        def _get_messages(conn: sqlite3.Connection):
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT role, content FROM conversations WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-                (user_id, limit)
-            )
+            anchor = cursor.execute("SELECT context_anchor FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            cursor.execute(SQLITE_CONTEXT_QUERY, {
+                'user_id': user_id,
+                'budget': settings.CONTEXT_TOKEN_BUDGET,
+                'max_tokens': settings.CONTEXT_MESSAGE_MAX_TOKENS,
+                'limit': limit,
+            })
             rows = cursor.fetchall()
-            conn.close()
             # Преобразуем sqlite3.Row в dict
-            return [{'role': row['role'], 'content': row['content']} for row in rows]
+            return [dict(row) for row in rows], anchor[0] if anchor else None
 
-        messages = await asyncio.to_thread(_get_messages)
+        messages, anchor_id = await db.run(_get_messages)
         logger.debug(f"SQLite: Получено {len(messages)} сообщений для пользователя {user_id}")
-        return messages[::-1] # Разворачиваем для хронологического порядка
+        return messages, anchor_id
     except Exception as e:
         logger.exception(f"SQLite: Ошибка при получении истории: {e}")
-        return []
+        return [], None
 
 # PostgreSQL-специфичные функции
 async def add_message_to_postgres(pool: asyncpg.Pool, user_id: int, role: str, content: str):
+    tokens = count_tokens(content)
     try:
         async with pool.acquire() as connection:
-            async with connection.transaction(): # Используем транзакцию
-                # Добавляем новое сообщение
-                await connection.execute(
-                    "INSERT INTO conversations (user_id, role, content) VALUES ($1, $2, $3)",
-                    user_id, role, content
-                )
-                # Очистка: удаляем старые сообщения, оставляя только последние N
-                cleanup_query = """
-                WITH ranked_messages AS (
-                    SELECT id, ROW_NUMBER() OVER(PARTITION BY user_id ORDER BY timestamp DESC) as rn
-                    FROM conversations
-                    WHERE user_id = $1
-                )
-                DELETE FROM conversations
-                WHERE id IN (SELECT id FROM ranked_messages WHERE rn > $2);
-                """
-                await connection.execute(cleanup_query, user_id, CONVERSATION_HISTORY_LIMIT)
-        logger.debug(f"PostgreSQL: Сообщение {role} для пользователя {user_id} сохранено и выполнена очистка (оставлено <= {CONVERSATION_HISTORY_LIMIT}).")
+            # Только вставка: старые сообщения удаляет фоновая очистка (HistoryRetention)
+            await connection.execute(
+                "INSERT INTO conversations (user_id, role, content, tokens) VALUES ($1, $2, $3, $4)",
+                user_id, role, content, tokens
+            )
+        logger.debug(f"PostgreSQL: Сообщение {role} для пользователя {user_id} сохранено")
     except asyncpg.PostgresError as e:
-        logger.error(f"PostgreSQL: Ошибка при добавлении сообщения или очистке истории: {e}")
+        logger.error(f"PostgreSQL: Ошибка при добавлении сообщения: {e}")
         raise
     except Exception as e:
-        logger.exception(f"PostgreSQL: Непредвиденная ошибка при добавлении сообщения или очистке истории: {e}")
+        logger.exception(f"PostgreSQL: Непредвиденная ошибка при добавлении сообщения: {e}")
         raise
 
-async def get_last_messages_postgres(pool: asyncpg.Pool, user_id: int, limit: int) -> list[dict]:
+async def get_context_rows_postgres(pool: asyncpg.Pool, user_id: int, limit: int) -> tuple[list[dict], int | None]:
     try:
         async with pool.acquire() as connection:
+            anchor_id = await connection.fetchval("SELECT context_anchor FROM users WHERE user_id = $1", user_id)
             records = await connection.fetch(
-                "SELECT role, content FROM conversations WHERE user_id = $1 ORDER BY timestamp DESC LIMIT $2",
-                user_id, limit
+                POSTGRES_CONTEXT_QUERY,
+                user_id, settings.CONTEXT_TOKEN_BUDGET, settings.CONTEXT_MESSAGE_MAX_TOKENS, limit
             )
-            messages = [{'role': record['role'], 'content': record['content']} for record in records]
+            messages = [dict(record) for record in records]
             logger.debug(f"PostgreSQL: Получено {len(messages)} сообщений для пользователя {user_id}")
-            return messages[::-1] # Разворачиваем для хронологического порядка
+            return messages, anchor_id
     except asyncpg.PostgresError as e:
         logger.error(f"PostgreSQL: Ошибка при получении истории: {e}")
-        return []
+        return [], None
     except Exception as e:
         logger.exception(f"PostgreSQL: Непредвиденная ошибка при получении истории: {e}")
-        return []
+        return [], None
+
+# --- Фоновая очистка истории ---
+async def delete_expired_messages(db, older_than: datetime.datetime, batch_size: int) -> int:
+    """Удаляет до batch_size сообщений старше older_than; возвращает число удалённых."""
+    if settings.USE_SQLITE:
+        cutoff = older_than.strftime('%Y-%m-%d %H:%M:%S')
+        def _delete(conn: sqlite3.Connection):
+            return conn.execute(
+                "DELETE FROM conversations WHERE id IN (SELECT id FROM conversations WHERE timestamp < ? LIMIT ?)",
+                (cutoff, batch_size)
+            ).rowcount
+        return await db.run(_delete)
+    else:
+        async with db.acquire() as conn:
+            result = await conn.execute(
+                "DELETE FROM conversations WHERE id IN (SELECT id FROM conversations WHERE timestamp < $1 LIMIT $2)",
+                older_than, batch_size
+            )
+            return int(result.split()[-1])
+
+async def trim_user_histories(db, user_ids: list[int], keep: int) -> int:
+    """Оставляет пользователям из user_ids только keep последних сообщений; возвращает число удалённых."""
+    if not user_ids:
+        return 0
+    if settings.USE_SQLITE:
+        placeholders = ", ".join("?" * len(user_ids))
+        def _trim(conn: sqlite3.Connection):
+            return conn.execute(f"""
+                DELETE FROM conversations WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS rn
+                        FROM conversations
+                        WHERE user_id IN ({placeholders})
+                    ) WHERE rn > ?
+                )
+            """, (*user_ids, keep)).rowcount
+        return await db.run(_trim)
+    else:
+        async with db.acquire() as conn:
+            result = await conn.execute("""
+                DELETE FROM conversations WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS rn
+                        FROM conversations
+                        WHERE user_id = ANY($1::bigint[])
+                    ) ranked WHERE rn > $2
+                )
+            """, user_ids, keep)
+            return int(result.split()[-1])
+
+async def get_users_over_history_limit(db, keep: int, after_user_id: int, limit: int) -> list[int]:
+    """Пользователи (по возрастанию user_id после after_user_id), у которых больше keep сообщений."""
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            rows = conn.execute(
+                "SELECT user_id FROM conversations WHERE user_id > ? GROUP BY user_id HAVING COUNT(*) > ? ORDER BY user_id LIMIT ?",
+                (after_user_id, keep, limit)
+            ).fetchall()
+            return [r[0] for r in rows]
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM conversations WHERE user_id > $1 GROUP BY user_id HAVING COUNT(*) > $2 ORDER BY user_id LIMIT $3",
+                after_user_id, keep, limit
+            )
+            return [r['user_id'] for r in rows]
+
+class HistoryRetention:
+    """
+    Фоновая очистка conversations вместо DELETE при каждой вставке.
+
+    Раз в interval секунд удаляет сообщения старше max_age_days и обрезает историю
+    до keep последних сообщений у пользователей, которые писали с прошлого прохода
+    (при запуске — у всех, у кого сообщений больше keep). Удаления идут пачками
+    по batch_size, чтобы не держать долгих блокировок. Чтение истории само
+    ограничивается LIMIT, поэтому временно лишние строки ответам не мешают.
+    """
+
+    def __init__(self, db, keep: int, max_age_days: float | None, interval: float = 60.0, batch_size: int = 500):
+        self.db = db
+        self.keep = keep
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._dirty: set[int] = set()
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.trimmed_total = 0
+        self.expired_total = 0
+
+    def mark(self, user_id: int):
+        """Пользователь добавил сообщение: его историю нужно проверить при следующем проходе."""
+        self._dirty.add(user_id)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        try:
+            await self.sweep_all()
+        except Exception as e:
+            logger.exception(f"Ошибка начальной очистки истории: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.exception(f"Ошибка фоновой очистки истории: {e}")
+
+    async def sweep_all(self):
+        """Полный проход по всем пользователям с лишними сообщениями (при запуске)."""
+        after_user_id = -1
+        while True:
+            user_ids = await get_users_over_history_limit(self.db, self.keep, after_user_id, self.batch_size)
+            if not user_ids:
+                break
+            self.trimmed_total += await trim_user_histories(self.db, user_ids, self.keep)
+            after_user_id = user_ids[-1]
+        await self._expire()
+
+    async def run_once(self):
+        dirty, self._dirty = sorted(self._dirty), set()
+        for i in range(0, len(dirty), self.batch_size):
+            batch = dirty[i:i + self.batch_size]
+            try:
+                self.trimmed_total += await trim_user_histories(self.db, batch, self.keep)
+            except Exception:
+                self._dirty.update(batch)  # повторим на следующем проходе
+                raise
+        await self._expire()
+
+    async def _expire(self):
+        if not self.max_age_days:
+            return
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.max_age_days)
+        while True:
+            deleted = await delete_expired_messages(self.db, cutoff, self.batch_size)
+            self.expired_total += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(0)  # даём поработать обработчикам между пачками
+
+# --- Кэш пользователей ---
+class UserCache:
+    """
+    LRU-кэш строк таблицы users с ограниченным сроком жизни записей.
+
+    Функции, меняющие users, обновляют кэш сразу после записи в БД (write-through)
+    или сбрасывают запись, если новое значение вычисляет сама БД. TTL ограничивает
+    устаревание, если ту же строку меняет другой процесс.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._rows: collections.OrderedDict[int, tuple[float, dict]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> dict | None:
+        entry = self._rows.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._rows[user_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[1])  # копия: вызывающий код может менять словарь
+
+    def put(self, user_id: int, row: dict):
+        self._rows[user_id] = (time.monotonic() + self.ttl, dict(row))
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        """Применяет записанные в БД значения к закэшированной строке (если она есть)."""
+        entry = self._rows.get(user_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, user_id: int):
+        self._rows.pop(user_id, None)
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._rows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+def _db_value(value):
+    """Значение в том виде, в каком его вернёт чтение из БД (SQLite хранит даты строками)."""
+    if settings.USE_SQLITE and isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if settings.USE_SQLITE and isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
 
 # --- Функции для работы с таблицей users ---
 
@@ -420,28 +1518,31 @@ async def get_or_create_user(db, user_id: int, username: str | None, first_name:
     else:
         return await add_user_postgres(db, user_id, username, first_name, last_name)
 
+@timed(db_query_seconds, query="get_user")
 async def get_user(db, user_id: int) -> dict | None:
-    """Получает данные пользователя по ID."""
+    """Получает данные пользователя по ID (сначала из кэша)."""
+    user_data = user_cache.get(user_id)
+    if user_data is not None:
+        return user_data
     if settings.USE_SQLITE:
-        def _get():
-            conn = sqlite3.connect(db)
-            conn.row_factory = sqlite3.Row
+        def _get(conn: sqlite3.Connection):
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
-            conn.close()
             return dict(row) if row else None
-        return await asyncio.to_thread(_get)
+        user_data = await db.run(_get)
     else: # PostgreSQL
         async with db.acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-            return dict(row) if row else None
+            user_data = dict(row) if row else None
+    if user_data:
+        user_cache.put(user_id, user_data)
+    return user_data
 
-async def add_user_sqlite(db_path: str, user_id: int, username: str | None, first_name: str, last_name: str | None):
+async def add_user_sqlite(db: SQLiteBackend, user_id: int, username: str | None, first_name: str, last_name: str | None):
     """Добавляет нового пользователя в SQLite."""
     try:
-        def _add():
-            conn = sqlite3.connect(db_path)
+        def _add(conn: sqlite3.Connection):
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -453,11 +1554,9 @@ async def add_user_sqlite(db_path: str, user_id: int, username: str | None, firs
                 """,
                 (user_id, username, first_name, last_name)
             )
-            conn.commit()
-            conn.close()
             logger.info(f"SQLite: Добавлен новый пользователь {user_id}")
-        await asyncio.to_thread(_add)
-        return await get_user(db_path, user_id) # Возвращаем созданного пользователя
+        await db.run(_add)
+        return await get_user(db, user_id) # Возвращаем созданного пользователя
     except Exception as e:
         logger.exception(f"SQLite: Ошибка добавления пользователя {user_id}: {e}")
         return None
@@ -483,29 +1582,107 @@ async def add_user_postgres(pool: asyncpg.Pool, user_id: int, username: str | No
         return None
 
 async def update_user_last_active(db, user_id: int):
-    """Обновляет время последней активности пользователя."""
+    """
+    Отмечает активность пользователя. Если запущен LastActiveWriter, отметка копится в памяти
+    и записывается пачкой; иначе UPDATE выполняется сразу.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    writer: LastActiveWriter | None = dp.workflow_data.get('last_active_writer')
+    if writer:
+        writer.touch(user_id, now)
+        user_cache.update(user_id, last_active_date=_db_value(now), is_blocked=False)
+        return
     try:
-        if settings.USE_SQLITE:
-            def _update():
-                conn = sqlite3.connect(db)
-                cursor = conn.cursor()
-                cursor.execute("UPDATE users SET last_active_date = CURRENT_TIMESTAMP WHERE user_id = ?", (user_id,))
-                conn.commit()
-                conn.close()
-            await asyncio.to_thread(_update)
-        else: # PostgreSQL
-            async with db.acquire() as conn:
-                await conn.execute("UPDATE users SET last_active_date = NOW() WHERE user_id = $1", user_id)
+        await write_last_active(db, {user_id: now})
+        user_cache.update(user_id, last_active_date=_db_value(now), is_blocked=False)
         # logger.debug(f"Обновлена last_active_date для user_id={user_id}") # Опционально для отладки
     except Exception as e:
         logger.exception(f"Ошибка обновления last_active_date для user_id={user_id}: {e}")
 
+async def write_last_active(db, touches: dict[int, datetime.datetime]):
+    """Записывает отметки активности одним запросом (PostgreSQL) или одной транзакцией (SQLite)."""
+    if not touches:
+        return
+    if settings.USE_SQLITE:
+        rows = [(_db_value(ts), user_id) for user_id, ts in touches.items()]
+        def _update(conn: sqlite3.Connection):
+            # Более свежую отметку (например, из admit_request) не перезаписываем
+            conn.executemany(
+                "UPDATE users SET last_active_date = ?1, is_blocked = FALSE "
+                "WHERE user_id = ?2 AND (last_active_date IS NULL OR last_active_date < ?1)",
+                rows
+            )
+        await db.run(_update)
+    else: # PostgreSQL
+        async with db.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE users u
+                SET last_active_date = t.ts, is_blocked = FALSE
+                FROM unnest($1::bigint[], $2::timestamptz[]) AS t(user_id, ts)
+                WHERE u.user_id = t.user_id
+                  AND (u.last_active_date IS NULL OR u.last_active_date < t.ts)
+                """,
+                list(touches.keys()), list(touches.values())
+            )
+
+class LastActiveWriter:
+    """
+    Отложенная запись last_active_date: отметки копятся в памяти (по одной на пользователя,
+    побеждает последняя) и раз в interval секунд записываются одной операцией.
+    Так каждое взаимодействие не порождает отдельный UPDATE (и мёртвую версию строки в PostgreSQL).
+    """
+
+    def __init__(self, db, interval: float = 30.0):
+        self.db = db
+        self.interval = interval
+        self._pending: dict[int, datetime.datetime] = {}
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.touches_total = 0
+        self.rows_written = 0
+        self.flushes = 0
+
+    def touch(self, user_id: int, when: datetime.datetime):
+        self._pending[user_id] = when
+        self.touches_total += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        touches, self._pending = self._pending, {}
+        try:
+            await write_last_active(self.db, touches)
+            self.rows_written += len(touches)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Не удалось записать last_active_date для {len(touches)} пользователей: {e}")
+            # Вернём отметки в очередь (новые, пришедшие за время записи, важнее)
+            for user_id, ts in touches.items():
+                self._pending.setdefault(user_id, ts)
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает накопленные отметки (вызывается в on_shutdown)."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
 # --- Вспомогательные функции для управления лимитами и подпиской ---
 async def update_user_limits(db, user_id: int, free_messages_today: int, last_free_reset_date: datetime.date | None = None):
     """Обновляет счетчик бесплатных сообщений и дату сброса."""
     if settings.USE_SQLITE:
-        def _update():
-            conn = sqlite3.connect(db)
+        def _update(conn: sqlite3.Connection):
             cursor = conn.cursor()
             if last_free_reset_date:
                 cursor.execute(
@@ -517,9 +1694,7 @@ async def update_user_limits(db, user_id: int, free_messages_today: int, last_fr
                     "UPDATE users SET free_messages_today = ? WHERE user_id = ?",
                     (free_messages_today, user_id)
                 )
-            conn.commit()
-            conn.close()
-        await asyncio.to_thread(_update)
+        await db.run(_update)
     else:
         async with db.acquire() as conn:
             if last_free_reset_date:
@@ -532,57 +1707,62 @@ async def update_user_limits(db, user_id: int, free_messages_today: int, last_fr
                     "UPDATE users SET free_messages_today = $1 WHERE user_id = $2",
                     free_messages_today, user_id
                 )
+    user_cache.update(user_id, free_messages_today=free_messages_today)
+    if last_free_reset_date:
+        user_cache.update(user_id, last_free_reset_date=_db_value(last_free_reset_date))
 
 async def deactivate_subscription(db, user_id: int):
     """Деактивирует подписку пользователя."""
     if settings.USE_SQLITE:
-        def _deact():
-            conn = sqlite3.connect(db)
-            cursor = conn.cursor()
-            cursor.execute(
+        def _deact(conn: sqlite3.Connection):
+            conn.execute(
                 "UPDATE users SET subscription_status = 'inactive', subscription_expires = NULL WHERE user_id = ?",
                 (user_id,)
             )
-            conn.commit()
-            conn.close()
-        await asyncio.to_thread(_deact)
+        await db.run(_deact)
     else:
         async with db.acquire() as conn:
             await conn.execute(
                 "UPDATE users SET subscription_status = 'inactive', subscription_expires = NULL WHERE user_id = $1",
                 user_id
             )
+    user_cache.update(user_id, subscription_status='inactive', subscription_expires=None)
 
-async def check_and_consume_limit(db, settings: Settings, user_id: int) -> bool:
-    """Проверяет подписку и ежедневный лимит, списывает запросы при необходимости."""
-    user_data = await get_user(db, user_id)
-    if not user_data:
-        logger.error(f"Не найдены данные для пользователя {user_id} при проверке лимита.")
-        return False
-    # --- НАЧАЛО ИЗМЕНЕНИЙ: ПРОВЕРКА АДМИНА ---
+def _parse_db_datetime(value) -> datetime.datetime | None:
+    """Приводит значение даты/времени из БД (datetime или строка SQLite) к aware datetime в UTC."""
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+def plan_quota(user_data: dict, now: datetime.datetime) -> tuple[bool, dict]:
+    """
+    Решает, можно ли обслужить запрос пользователя, ничего не записывая в БД.
+
+    Возвращает (разрешено, изменения полей users), которые нужно сохранить:
+    деактивацию истёкшей подписки, сброс и списание дневного лимита.
+    """
     if user_data.get('is_admin', False):
-        logger.info(f"Пользователь {user_id} является администратором. Лимит не применяется.")
-        return True
-    # --- КОНЕЦ ИЗМЕНЕНИЙ ---
-    now = datetime.datetime.now(datetime.timezone.utc)
+        return True, {}
+    updates: dict = {}
     today = now.date()
     # 1. Проверка подписки
-    is_sub = False
     if user_data.get('subscription_status') == 'active':
-        sub_exp = user_data.get('subscription_expires')
-        if isinstance(sub_exp, datetime.datetime):
-            if sub_exp.tzinfo is None:
-                sub_exp = sub_exp.replace(tzinfo=datetime.timezone.utc)
-            if sub_exp > now:
-                is_sub = True
-            else:
-                logger.info(f"Подписка пользователя {user_id} истекла {sub_exp}, деактивируем.")
-                await deactivate_subscription(db, user_id)
-                user_data['subscription_status'] = 'inactive'
+        sub_exp = _parse_db_datetime(user_data.get('subscription_expires'))
+        if sub_exp is None:
+            logger.warning(f"Некорректный формат subscription_expires для user_id={user_data.get('user_id')}")
+        elif sub_exp > now:
+            return True, {}
         else:
-            logger.warning(f"Некорректный формат subscription_expires для user_id={user_id}")
-    if is_sub:
-        return True
+            logger.info(f"Подписка пользователя {user_data.get('user_id')} истекла {sub_exp}, деактивируем.")
+            updates['subscription_status'] = 'inactive'
+            updates['subscription_expires'] = None
     # 2. Проверка и сброс дневного лимита
     raw_date = user_data.get('last_free_reset_date')
     last_date = None
@@ -593,1962 +1773,4883 @@ async def check_and_consume_limit(db, settings: Settings, user_id: int) -> bool:
             last_date = datetime.date.fromisoformat(raw_date)
         except (ValueError, TypeError):
             last_date = today - datetime.timedelta(days=1)
-    limit = user_data.get('free_messages_today', 0)
+    limit = user_data.get('free_messages_today') or 0
     if last_date is None or last_date < today:
-        limit = 7
-        await update_user_limits(db, user_id, limit, today)
+        limit = FREE_MESSAGES_PER_DAY
+        updates['last_free_reset_date'] = today
     # 3. Списание или отказ
     if limit > 0:
-        await update_user_limits(db, user_id, limit - 1)
+        updates['free_messages_today'] = limit - 1
+        return True, updates
+    return False, updates
+
+@timed(db_query_seconds, query="check_and_consume_limit")
+async def check_and_consume_limit(db, settings: Settings, user_id: int) -> bool:
+    """Проверяет подписку и ежедневный лимит, списывает запросы при необходимости."""
+    user_data = await get_user(db, user_id)
+    if not user_data:
+        logger.error(f"Не найдены данные для пользователя {user_id} при проверке лимита.")
+        return False
+    if user_data.get('is_admin', False):
+        logger.info(f"Пользователь {user_id} является администратором. Лимит не применяется.")
         return True
-    return False
+    allowed, updates = plan_quota(user_data, datetime.datetime.now(datetime.timezone.utc))
+    if 'subscription_status' in updates:
+        await deactivate_subscription(db, user_id)
+    if 'free_messages_today' in updates:
+        await update_user_limits(db, user_id, updates['free_messages_today'], updates.get('last_free_reset_date'))
+    return allowed
+
+# --- Приём запроса одним обращением к БД (горячий путь текстовых сообщений) ---
+@timed(db_query_seconds, query="admit_request")
+async def admit_request(
+    db,
+    user_id: int,
+    username: str | None,
+    first_name: str,
+    last_name: str | None,
+    content: str,
+    limit: int = CONVERSATION_HISTORY_LIMIT
+) -> dict | None:
+    """
+    Принимает текстовый запрос за одну транзакцию: создаёт/обновляет пользователя,
+    отмечает активность, атомарно сбрасывает или списывает лимит, сохраняет сообщение
+    пользователя (если лимит позволяет) и возвращает историю для запроса к модели:
+    последние (не более limit) сообщения в пределах CONTEXT_TOKEN_BUDGET (build_context).
+    Лишние старые сообщения удаляет фоновая очистка (HistoryRetention).
+
+    Результат: {'user': dict, 'allowed': bool, 'history': list[dict]} или None при ошибке.
+    """
+    tokens = count_tokens(content)
+    try:
+        if settings.USE_SQLITE:
+            admission = await admit_request_sqlite(db, user_id, username, first_name, last_name, content, tokens, limit)
+        else:
+            admission = await admit_request_postgres(db, user_id, username, first_name, last_name, content, tokens, limit)
+    except Exception as e:
+        logger.exception(f"Ошибка приёма запроса пользователя {user_id}: {e}")
+        user_cache.invalidate(user_id)
+        return None
+    if admission:
+        anchor_id = admission['user'].get('context_anchor')
+        admission['history'], new_anchor_id = build_context(admission['history'], anchor_id=anchor_id, limit=limit, **_context_settings())
+        if admission['allowed'] and new_anchor_id is not None and new_anchor_id != anchor_id:
+            # Окно контекста переехало: редкая запись, раз в несколько ходов
+            try:
+                await set_context_anchor(db, user_id, new_anchor_id)
+                admission['user']['context_anchor'] = new_anchor_id
+            except Exception as e:
+                logger.error(f"Не удалось сохранить начало окна контекста пользователя {user_id}: {e}")
+        # Строка прочитана под блокировкой в той же транзакции — это самые свежие данные
+        user_cache.put(user_id, admission['user'])
+        retention: HistoryRetention | None = dp.workflow_data.get('history_retention')
+        if retention and admission['allowed']:
+            retention.mark(user_id)
+    return admission
+
+async def admit_request_sqlite(
+    db: SQLiteBackend, user_id: int, username: str | None, first_name: str,
+    last_name: str | None, content: str, tokens: int, limit: int
+) -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def _admit(conn: sqlite3.Connection):
+        # Сразу берём блокировку на запись, чтобы параллельные запросы не списали лимит дважды
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            """
+            INSERT INTO users (
+                user_id, username, first_name, last_name,
+                last_active_date, last_free_reset_date, free_messages_today
+            ) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, date('now'), ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_active_date = CURRENT_TIMESTAMP, is_blocked = FALSE
+            """,
+            (user_id, username, first_name, last_name, FREE_MESSAGES_PER_DAY)
+        )
+        user_data = dict(conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone())
+        allowed, updates = plan_quota(user_data, now)
+        if updates:
+            columns = ", ".join(f"{column} = ?" for column in updates)
+            values = [_db_value(v) for v in updates.values()]
+            conn.execute(f"UPDATE users SET {columns} WHERE user_id = ?", (*values, user_id))
+            user_data.update(zip(updates, values))
+        if allowed:
+            conn.execute(
+                "INSERT INTO conversations (user_id, role, content, tokens) VALUES (?, 'user', ?, ?)",
+                (user_id, content, tokens)
+            )
+        rows = conn.execute(SQLITE_CONTEXT_QUERY, {
+            'user_id': user_id,
+            'budget': settings.CONTEXT_TOKEN_BUDGET,
+            'max_tokens': settings.CONTEXT_MESSAGE_MAX_TOKENS,
+            'limit': limit,
+        }).fetchall()
+        history = [dict(row) for row in rows]
+        return {'user': user_data, 'allowed': allowed, 'history': history}
+
+    return await db.run(_admit)
+
+# Один оператор: блокировка строки пользователя, решение по лимиту, обновление users,
+# вставка сообщения пользователя и чтение последних сообщений.
+# Все CTE видят один снимок данных, поэтому история читается без новой строки,
+# а новое сообщение добавляется к ней уже в Python.
+ADMIT_REQUEST_POSTGRES_QUERY = """
+WITH prev AS (
+    SELECT
+        user_id,
+        free_messages_today,
+        COALESCE(is_admin, FALSE) AS is_admin,
+        COALESCE(subscription_status = 'active' AND subscription_expires > $2, FALSE) AS is_sub,
+        COALESCE(subscription_status = 'active' AND subscription_expires <= $2, FALSE) AS sub_expired,
+        (last_free_reset_date IS NULL OR last_free_reset_date < $3) AS needs_reset,
+        context_anchor
+    FROM users
+    WHERE user_id = $1
+    FOR UPDATE
+),
+quota AS (
+    SELECT
+        prev.*,
+        (is_admin OR is_sub) AS privileged,
+        CASE WHEN needs_reset THEN $4 ELSE COALESCE(free_messages_today, 0) END AS available
+    FROM prev
+),
+updated AS (
+    UPDATE users u SET
+        last_active_date = NOW(),
+        is_blocked = FALSE,
+        subscription_status = CASE WHEN NOT q.is_admin AND q.sub_expired THEN 'inactive' ELSE u.subscription_status END,
+        subscription_expires = CASE WHEN NOT q.is_admin AND q.sub_expired THEN NULL ELSE u.subscription_expires END,
+        free_messages_today = CASE
+            WHEN q.privileged THEN u.free_messages_today
+            WHEN q.available > 0 THEN q.available - 1
+            ELSE q.available
+        END,
+        last_free_reset_date = CASE WHEN NOT q.privileged AND q.needs_reset THEN $3 ELSE u.last_free_reset_date END
+    FROM quota q
+    WHERE u.user_id = q.user_id
+    RETURNING u.*, (q.privileged OR q.available > 0) AS admitted
+),
+inserted AS (
+    INSERT INTO conversations (user_id, role, content, tokens)
+    SELECT user_id, 'user', $5::text, $7::int FROM updated WHERE admitted
+    RETURNING id
+)
+SELECT
+    updated.*,
+    (
+        SELECT COALESCE(json_agg(json_build_object('id', h.id, 'role', h.role, 'content', h.content, 'tokens', h.tokens) ORDER BY h.timestamp, h.id), '[]')
+        FROM (
+            SELECT role, content, tokens, timestamp, id,
+                   LEAST(COALESCE(tokens, LENGTH(content)), $9) AS cost,
+                   SUM(LEAST(COALESCE(tokens, LENGTH(content)), $9)) OVER (ORDER BY timestamp DESC, id DESC) AS running
+            FROM conversations
+            WHERE user_id = $1 AND id >= COALESCE((SELECT context_anchor FROM prev), 0)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT $6
+        ) h
+        WHERE h.running - h.cost < $8
+    ) AS history_json,
+    (SELECT id FROM inserted) AS inserted_id
+FROM updated
+"""
+
+async def admit_request_postgres(
+    pool: asyncpg.Pool, user_id: int, username: str | None, first_name: str,
+    last_name: str | None, content: str, tokens: int, limit: int
+) -> dict | None:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # История читается без нового сообщения, поэтому его стоимость вычитается из бюджета заранее
+    max_tokens = settings.CONTEXT_MESSAGE_MAX_TOKENS
+    budget = settings.CONTEXT_TOKEN_BUDGET - tokens
+    for _ in range(2):
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                ADMIT_REQUEST_POSTGRES_QUERY,
+                user_id, now, now.date(), FREE_MESSAGES_PER_DAY, content, limit - 1, tokens, budget, max_tokens
+            )
+        if row:
+            user_data = dict(row)
+            allowed = user_data.pop('admitted')
+            history = json.loads(user_data.pop('history_json'))
+            inserted_id = user_data.pop('inserted_id')
+            if allowed:
+                history.append({'id': inserted_id, 'role': 'user', 'content': content, 'tokens': tokens})
+            return {'user': user_data, 'allowed': allowed, 'history': history[-limit:]}
+        # Новый пользователь: редкий путь, создаём запись и повторяем запрос
+        if not await add_user_postgres(pool, user_id, username, first_name, last_name):
+            return None
+    return None
 
 # --- Добавьте другие функции обновления по мере необходимости ---
 # Например, для обновления лимитов, статуса подписки и т.д.
 # async def update_user_limits(...)
 # async def update_user_subscription(...)
 
-# --- Взаимодействие с XAI API ---
+# --- Общее состояние генераций: в памяти процесса или в БД для нескольких процессов ---
+
+def generation_key(user_id: int) -> str:
+    return f"generation:{user_id}"
+
+def broadcast_key(job_id: int) -> str:
+    return f"broadcast:{job_id}"
 
-async def stream_xai_response(api_key: str, system_prompt: str, history: list[dict]) -> typing.AsyncGenerator[str, None]:
+class LocalStateBackend:
     """
-    Асинхронный генератор для получения ответа от XAI Chat API в режиме стриминга.
+    Состояние, которое должно быть единым для всех обработчиков: активные генерации
+    (защита от дублирующего запроса и отмена), ожидание запроса для генерации фото,
+    владение рассылками. Хранится в памяти процесса — вариант по умолчанию для одного процесса.
+
+    Занятость описывается «арендой» по ключу (generation_key, broadcast_key) с задачей-владельцем.
     """
-    # Убираем системный промпт из истории, если он там уже есть
-    history_no_system = [msg for msg in history if msg.get("role") != "system"]
-    # XAI ожидает системный промпт как первое сообщение в списке
-    messages = [{"role": "system", "content": system_prompt}] + history_no_system
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "Accept": "text/event-stream" # XAI использует Server-Sent Events для стриминга
-    }
-    # URL XAI API
-    url = "https://api.x.ai/v1/chat/completions"
-    payload = {
-        "model": "grok-3-mini-beta",
-        "messages": messages,
-        "stream": True,
-        "temperature": 0.5,
-        "reasoning": {"effort": "high"},
-    }
-    # Таймаут для запроса (в секундах)
-    request_timeout = 180 # 3 минуты
-
-    # Ограничение на количество попыток подключения
-    max_retries = 3
-    retry_delay = 1 # секунда
-
-    # Используем сессию aiohttp для управления соединениями
-    connector = aiohttp.TCPConnector(family=socket.AF_INET) # Используем IPv4
-    async with aiohttp.ClientSession(connector=connector) as session:
-        for attempt in range(max_retries):
-            try:
-                # Выполняем POST-запрос с указанным таймаутом
-                async with session.post(url, headers=headers, json=payload, timeout=request_timeout) as response:
-                    response.raise_for_status()  # Вызовет исключение для статусов 4xx/5xx
-
-                    buffer = ""  # Буфер для неполных данных
-                    # Читаем ответ построчно (SSE)
-                    async for line_bytes in response.content:
-                        line = line_bytes.decode('utf-8').strip()
-                        logger.debug(f"Received line: {line!r}")
-
-                        if not line:
-                            continue
-
-                        if line.startswith("data: "):
-                            buffer = line[len("data: "):]
-                            if buffer == "[DONE]":
-                                logger.info("Стриминг завершен сигналом [DONE]")
-                                return
-                            try:
-                                chunk = json.loads(buffer)
-                                choices = chunk.get('choices') or []
-                                if choices:
-                                    delta = choices[0].get('delta') or {}
-                                    text = delta.get('content')
-                                    if text:
-                                        yield text
-                                finish_reason = choices[0].get('finish_reason')
-                                if finish_reason:
-                                    logger.info(f"Стриминг завершен с причиной: {finish_reason}")
-                            except json.JSONDecodeError:
-                                logger.error(f"Ошибка декодирования JSON из строки: {buffer!r}")
-                            except Exception as e:
-                                logger.exception(f"Неожиданная ошибка при обработке чанка JSON: {e}. Чанк: {buffer}")
-                            continue
-
-            except asyncio.TimeoutError:
-                logger.error(f"Таймаут при подключении/чтении из XAI API (попытка {attempt + 1}/{max_retries}). URL: {url}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(retry_delay * (attempt + 1)) # Экспоненциальная задержка
-                    continue
-                else:
-                    raise # Перебрасываем исключение после последней попытки
-            except aiohttp.ClientConnectionError as e:
-                 logger.error(f"Ошибка соединения с XAI API: {e}. URL: {url}. Попытка {attempt + 1}/{max_retries}.")
-                 if attempt < max_retries - 1:
-                      await asyncio.sleep(retry_delay * (attempt + 1))
-                      continue
-                 else:
-                      raise
-            except aiohttp.ClientResponseError as e:
-                # Пробрасываем авторизационные ошибки (401/403) для обработки выше
-                if e.status in (401, 403):
-                    raise
-                # Логируем и повторяем только серверные ошибки 5xx
-                if e.status >= 500 and attempt < max_retries - 1:
-                    try:
-                        error_body = await response.text()
-                    except Exception:
-                        error_body = ""
-                    logger.error(f"Ошибка HTTP запроса к XAI API: {e.status} {e.message}. URL: {url}. Попытка {attempt + 1}/{max_retries}. Тело ответа: {error_body[:500]}")
-                    await asyncio.sleep(retry_delay * (attempt + 1))
-                    continue
-                # Для остальных клиентских ошибок прекращаем ретраи
-                raise
-            else:
-                 # Если запрос успешен, выходим из цикла ретраев
-                 break
 
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task | None] = {}
+        self._pending_prompts: set[int] = set()
 
-# --- Обработка Markdown в HTML для Telegram ---
-def markdown_to_telegram_html(text: str) -> str:
-    """Преобразует Markdown-подобный текст в HTML, поддерживаемый Telegram."""
-    import re, html
+    async def acquire(self, key: str, task: asyncio.Task | None) -> bool:
+        """Занимает ключ за задачей; False, если он уже занят."""
+        if key in self._tasks:
+            return False
+        self._tasks[key] = task
+        return True
 
-    if not text:
-        return ""
+    def attach(self, key: str, task: asyncio.Task):
+        """Передаёт занятый ключ другой задаче этого процесса (например, фоновой генерации)."""
+        if key in self._tasks:
+            self._tasks[key] = task
 
-    code_blocks: dict[str, str] = {}
-    placeholder_counter = 0
+    async def release(self, key: str, task: asyncio.Task | None):
+        """Освобождает ключ, если он всё ещё принадлежит task (после отмены его мог занять новый запрос)."""
+        if key in self._tasks and self._tasks[key] is task:
+            del self._tasks[key]
 
-    def _extract_code_block(match):
-        nonlocal placeholder_counter
-        placeholder = f"@@CODEBLOCK_{placeholder_counter}@@"
-        code_blocks[placeholder] = match.group(1)
-        placeholder_counter += 1
-        return placeholder
+    async def cancel(self, key: str) -> bool:
+        """Освобождает ключ и отменяет задачу-владельца; True, если ключ был занят."""
+        if key not in self._tasks:
+            return False
+        task = self._tasks.pop(key)
+        if task:
+            task.cancel()
+        return True
 
-    def _extract_inline_code(match):
-        nonlocal placeholder_counter
-        placeholder = f"@@INLINECODE_{placeholder_counter}@@"
-        code_blocks[placeholder] = match.group(1)
-        placeholder_counter += 1
-        return placeholder
+    async def set_pending_prompt(self, user_id: int):
+        self._pending_prompts.add(user_id)
 
-    # Извлечение блоков кода
-    text = re.sub(r"```(?:\w+)?\n([\s\S]*?)```", _extract_code_block, text, flags=re.DOTALL)
-    # Извлечение inline-кода
-    text = re.sub(r"`([^`]+?)`", _extract_inline_code, text)
+    async def take_pending_prompt(self, user_id: int) -> bool:
+        """Снимает флаг ожидания запроса для генерации фото; True, если он был установлен."""
+        if user_id in self._pending_prompts:
+            self._pending_prompts.remove(user_id)
+            return True
+        return False
 
-    # Экранирование остального текста
-    text = html.escape(text, quote=False)
+    def start(self):
+        pass
 
-    # Ссылки [text](url)
-    def _replace_link(match):
-        label = match.group(1)
-        url = match.group(2)
-        safe_url = html.escape(url, quote=True)
-        return f'<a href="{safe_url}">{label}</a>'
-    text = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", _replace_link, text)
+    async def stop(self):
+        pass
 
-    # Заголовки #…##
-    text = re.sub(r"^(#{1,6})\s*(.+)$", lambda m: f"<b>{m.group(2)}</b>\n", text, flags=re.MULTILINE)
+class DatabaseStateBackend(LocalStateBackend):
+    """
+    То же состояние в общей БД (таблицы state_leases и pending_prompts): позволяет запускать
+    несколько процессов бота за одним webhook (WEBHOOK_REUSE_PORT) с общим SQLite-файлом или PostgreSQL.
 
-    # Жирный **text**
-    text = re.sub(r"\*\*([^\*]+)\*\*", r"<b>\1</b>", text)
-    # Подчёркивание __text__
-    text = re.sub(r"__([^_]+)__", r"<u>\1</u>", text)
-    # Курсив *text* и _text_
-    text = re.sub(r"(?<!\*)\*([^*]+)\*(?!\*)", r"<i>\1</i>", text)
-    text = re.sub(r"(?<!_)_([^_]+)_(?!_)", r"<i>\1</i>", text)
-    # Зачёркивание ~~text~~
-    text = re.sub(r"~~(.+?)~~", r" \1⁠ ", text)
-    # Спойлеры ||text||
-    text = re.sub(r"\|\|(.+?)\|\|", r"<tg-spoiler>\1</tg-spoiler>", text)
+    Аренда занимается атомарным upsert и продлевается процессом-владельцем раз в stale_after/3 секунд;
+    аренда умершего процесса считается свободной через stale_after секунд. Отмена из другого процесса
+    удаляет строку аренды, а владелец раз в poll_interval секунд сверяет свои аренды с таблицей
+    и отменяет задачи, чьи аренды пропали.
+    """
 
-    # Восстановление кодовых блоков
-    for placeholder, code in code_blocks.items():
-        escaped = html.escape(code, quote=False)
-        if placeholder.startswith("@@CODEBLOCK_"):
-            replacement = f"<pre>{escaped}</pre>"
+    def __init__(self, db, poll_interval: float = 0.5, stale_after: float = 30.0):
+        super().__init__()
+        self.db = db
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._tokens: dict[str, str] = {}  # ключ -> токен аренды этого процесса
+        self._token_seq = 0
+        self._last_heartbeat = 0.0
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.remote_cancels = 0
+
+    async def acquire(self, key: str, task: asyncio.Task | None) -> bool:
+        self._token_seq += 1
+        token = f"{self.owner}:{self._token_seq}"
+        now = time.time()
+        if settings.USE_SQLITE:
+            def _acquire(conn: sqlite3.Connection):
+                return conn.execute("""
+                    INSERT INTO state_leases (key, owner, token, heartbeat_at) VALUES (?1, ?2, ?3, ?4)
+                    ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, token = excluded.token, heartbeat_at = excluded.heartbeat_at
+                    WHERE state_leases.heartbeat_at < ?5
+                """, (key, self.owner, token, now, now - self.stale_after)).rowcount
+            acquired = await self.db.run(_acquire) > 0
         else:
-            replacement = f"<code>{escaped}</code>"
-        text = text.replace(placeholder, replacement)
-
-    # Нормализация пустых строк (не более двух подряд)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    # Удаляем пробелы и переносы в начале/конце
-    text = text.strip()
+            async with self.db.acquire() as conn:
+                acquired = await conn.fetchval("""
+                    INSERT INTO state_leases (key, owner, token, heartbeat_at) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (key) DO UPDATE SET owner = EXCLUDED.owner, token = EXCLUDED.token, heartbeat_at = EXCLUDED.heartbeat_at
+                    WHERE state_leases.heartbeat_at < $5
+                    RETURNING TRUE
+                """, key, self.owner, token, now, now - self.stale_after) is not None
+        if acquired:
+            self._tasks[key] = task
+            self._tokens[key] = token
+        return acquired
+
+    async def release(self, key: str, task: asyncio.Task | None):
+        if key not in self._tasks or self._tasks[key] is not task:
+            return
+        # Сначала локально, чтобы фоновая сверка не приняла освобождение за отмену
+        del self._tasks[key]
+        token = self._tokens.pop(key)
+        try:
+            await self._execute(
+                "DELETE FROM state_leases WHERE key = ? AND token = ?",
+                "DELETE FROM state_leases WHERE key = $1 AND token = $2",
+                key, token
+            )
+        except Exception as e:
+            # Строка без продления сама станет свободной через stale_after
+            logger.warning(f"Не удалось освободить аренду {key}: {e}")
+
+    async def cancel(self, key: str) -> bool:
+        deleted = await self._execute(
+            "DELETE FROM state_leases WHERE key = ?",
+            "DELETE FROM state_leases WHERE key = $1",
+            key
+        )
+        task = self._tasks.pop(key, None)
+        self._tokens.pop(key, None)
+        if task:
+            task.cancel()  # владелец в этом процессе — отменяем сразу, без ожидания сверки
+        return deleted > 0
+
+    async def set_pending_prompt(self, user_id: int):
+        await self._execute(
+            "INSERT INTO pending_prompts (user_id, created_at) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET created_at = excluded.created_at",
+            "INSERT INTO pending_prompts (user_id, created_at) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET created_at = EXCLUDED.created_at",
+            user_id, time.time()
+        )
 
-    # Удаление оставшихся маркеров Markdown (*, _, ~), чтобы избежать разрывов слов и видимых символов разметки
-    text = re.sub(r'[\*_~]', '', text)
+    async def take_pending_prompt(self, user_id: int) -> bool:
+        deleted = await self._execute(
+            "DELETE FROM pending_prompts WHERE user_id = ?",
+            "DELETE FROM pending_prompts WHERE user_id = $1",
+            user_id
+        )
+        return deleted > 0
 
-    return text
+    async def _execute(self, sqlite_sql: str, postgres_sql: str, *args) -> int:
+        """Выполняет запрос на текущем бэкенде и возвращает число изменённых строк."""
+        if settings.USE_SQLITE:
+            return await self.db.run(lambda conn: conn.execute(sqlite_sql, args).rowcount)
+        async with self.db.acquire() as conn:
+            result = await conn.execute(postgres_sql, *args)
+        return int(result.split()[-1])
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Штатная остановка: освобождаем аренды сразу, чтобы другой процесс мог продолжить рассылки
+        try:
+            await self._execute(
+                "DELETE FROM state_leases WHERE owner = ?",
+                "DELETE FROM state_leases WHERE owner = $1",
+                self.owner
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось освободить аренды процесса {self.owner}: {e}")
+        self._tasks.clear()
+        self._tokens.clear()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self._tokens:
+                continue
+            tokens = dict(self._tokens)
+            try:
+                alive = await self._refresh(list(tokens.values()))
+            except Exception as e:
+                logger.warning(f"Ошибка сверки общего состояния: {e}")
+                continue
+            for key, token in tokens.items():
+                if token in alive or self._tokens.get(key) != token:
+                    continue
+                # Аренду сняли из другого процесса (отмена) или она устарела
+                self._tokens.pop(key, None)
+                task = self._tasks.pop(key, None)
+                self.remote_cancels += 1
+                logger.info(f"Аренда {key} снята извне, задача отменяется")
+                if task:
+                    task.cancel()
+
+    async def _refresh(self, tokens: list[str]) -> set[str]:
+        """Продлевает аренды (если пора) и возвращает токены, которые ещё числятся в таблице."""
+        now = time.time()
+        heartbeat = now - self._last_heartbeat >= self.stale_after / 3
+        if settings.USE_SQLITE:
+            placeholders = ", ".join("?" * len(tokens))
+            def _refresh_sqlite(conn: sqlite3.Connection):
+                if heartbeat:
+                    conn.execute(f"UPDATE state_leases SET heartbeat_at = ? WHERE token IN ({placeholders})", (now, *tokens))
+                rows = conn.execute(f"SELECT token FROM state_leases WHERE token IN ({placeholders})", tokens).fetchall()
+                return {r[0] for r in rows}
+            alive = await self.db.run(_refresh_sqlite)
+        else:
+            async with self.db.acquire() as conn:
+                if heartbeat:
+                    rows = await conn.fetch(
+                        "UPDATE state_leases SET heartbeat_at = $2 WHERE token = ANY($1::text[]) RETURNING token", tokens, now
+                    )
+                else:
+                    rows = await conn.fetch("SELECT token FROM state_leases WHERE token = ANY($1::text[])", tokens)
+            alive = {r['token'] for r in rows}
+        if heartbeat:
+            self._last_heartbeat = now
+        return alive
 
-# --- Вспомогательная функция для разбиения текста ---
-def split_text(text: str, length: int = TELEGRAM_MAX_LENGTH) -> list[str]:
-    """Разбивает текст на части указанной длины."""
-    if len(text) <= length:
-        return [text]
+# --- Рассылки: задания в БД, потоковая выборка получателей, глобальный темп отправки ---
 
-    chunks = []
-    start = 0
-    while start < len(text):
-        # Ищем последний перенос строки или пробел в пределах длины
-        end = start + length
-        if end >= len(text):
-            chunks.append(text[start:])
-            break
+async def create_broadcast_job(db, text: str, created_by: int) -> dict:
+    """Создаёт задание рассылки; total — число получателей на момент запуска."""
+    if settings.USE_SQLITE:
+        def _create(conn: sqlite3.Connection):
+            total = conn.execute("SELECT COUNT(*) FROM users WHERE NOT COALESCE(is_blocked, FALSE)").fetchone()[0]
+            cursor = conn.execute(
+                "INSERT INTO broadcast_jobs (text, created_by, total) VALUES (?, ?, ?)",
+                (text, created_by, total)
+            )
+            return dict(conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (cursor.lastrowid,)).fetchone())
+        return await db.run(_create)
+    else:
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                INSERT INTO broadcast_jobs (text, created_by, total)
+                SELECT $1, $2, COUNT(*) FROM users WHERE NOT COALESCE(is_blocked, FALSE)
+                RETURNING *
+                """,
+                text, created_by
+            )
+            return dict(row)
 
-        split_pos = -1
-        # Ищем с конца к началу чанка
-        for i in range(end - 1, start -1, -1):
-            if text[i] == '\n':
-                split_pos = i + 1 # Включаем перенос в предыдущий чанк
-                break
-            elif text[i] == ' ':
-                split_pos = i + 1 # Разделяем по пробелу
-                break
+async def get_broadcast_job(db, job_id: int | None = None) -> dict | None:
+    """Задание по id или последнее созданное, если id не указан."""
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            if job_id is None:
+                row = conn.execute("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1").fetchone()
+            else:
+                row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+            return dict(row) if row else None
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            if job_id is None:
+                row = await conn.fetchrow("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1")
+            else:
+                row = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1", job_id)
+            return dict(row) if row else None
 
-        if split_pos != -1 and split_pos > start: # Если нашли подходящую точку разрыва
-            chunks.append(text[start:split_pos])
-            start = split_pos
-        else: # Если не нашли (например, очень длинное слово или строка без пробелов)
-            # Просто рубим по длине
-            chunks.append(text[start:end])
-            start = end
+async def get_running_broadcast_jobs(db) -> list[dict]:
+    """Задания, прерванные остановкой процесса (продолжаются при запуске)."""
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            return [dict(r) for r in conn.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")]
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            return [dict(r) for r in await conn.fetch("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")]
 
-    return chunks
+async def fetch_broadcast_recipients(db, after_user_id: int, limit: int) -> list[int]:
+    """Следующая пачка получателей по курсору user_id (keyset-пагинация по первичному ключу)."""
+    if settings.USE_SQLITE:
+        def _fetch(conn: sqlite3.Connection):
+            rows = conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND NOT COALESCE(is_blocked, FALSE) ORDER BY user_id LIMIT ?",
+                (after_user_id, limit)
+            ).fetchall()
+            return [r[0] for r in rows]
+        return await db.run(_fetch)
+    else:
+        async with db.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE user_id > $1 AND NOT COALESCE(is_blocked, FALSE) ORDER BY user_id LIMIT $2",
+                after_user_id, limit
+            )
+            return [r['user_id'] for r in rows]
 
+async def save_broadcast_checkpoint(db, job_id: int, last_user_id: int, sent: int, failed: int, blocked: int, blocked_ids: list[int]):
+    """Одной транзакцией: помечает заблокировавших бота и сохраняет курсор и счётчики задания."""
+    if settings.USE_SQLITE:
+        def _save(conn: sqlite3.Connection):
+            if blocked_ids:
+                conn.executemany("UPDATE users SET is_blocked = TRUE WHERE user_id = ?", [(uid,) for uid in blocked_ids])
+            conn.execute(
+                """
+                UPDATE broadcast_jobs
+                SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (last_user_id, sent, failed, blocked, job_id)
+            )
+        await db.run(_save)
+    else:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                if blocked_ids:
+                    await conn.execute("UPDATE users SET is_blocked = TRUE WHERE user_id = ANY($1::bigint[])", blocked_ids)
+                await conn.execute(
+                    """
+                    UPDATE broadcast_jobs
+                    SET last_user_id = $2, sent = $3, failed = $4, blocked = $5, updated_at = NOW()
+                    WHERE id = $1
+                    """,
+                    job_id, last_user_id, sent, failed, blocked
+                )
+    for uid in blocked_ids:
+        user_cache.update(uid, is_blocked=True)
 
-# --- Обработчики Telegram ---
+async def set_broadcast_status(db, job_id: int, status: str):
+    """Завершает задание: status 'done' или 'cancelled'."""
+    if settings.USE_SQLITE:
+        def _set(conn: sqlite3.Connection):
+            conn.execute(
+                "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, job_id)
+            )
+        await db.run(_set)
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(
+                "UPDATE broadcast_jobs SET status = $2, finished_at = NOW(), updated_at = NOW() WHERE id = $1",
+                job_id, status
+            )
 
-@dp.message(Command("start"))
-async def start_handler(message: types.Message):
-    user_id = message.from_user.id # Получаем user_id
-    # Получаем зависимости
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
+class BroadcastEngine:
+    """
+    Выполняет рассылки в фоне.
+
+    Получатели читаются из БД пачками по курсору user_id, внутри пачки сообщения отправляют
+    concurrency воркеров, а общий темп всех рассылок ограничен rate сообщений в секунду
+    (лимит Telegram — около 30 в секунду на бота). TelegramRetryAfter приостанавливает
+    все отправки на указанное время. После каждой пачки курсор и счётчики сохраняются
+    в broadcast_jobs, поэтому после перезапуска задание продолжается с последней пачки
+    (повторно могут получить сообщение не больше batch_size пользователей).
+    Задание выполняет только процесс, занявший его аренду в state (broadcast_key), —
+    при нескольких процессах рассылка не дублируется.
+    """
 
-    if not db or not current_settings:
-        logger.error(f"Не удалось получить БД/настройки в start_handler для user_id={user_id}")
-        await message.answer("Произошла внутренняя ошибка (код s1), попробуйте позже.")
-        return
+    MAX_RETRIES = 5
 
-    # --- Получаем или создаем пользователя ---
-    user_data = await get_or_create_user(
+    def __init__(
+        self,
+        bot_instance: Bot,
         db,
-        user_id,
-        message.from_user.username,
-        message.from_user.first_name,
-        message.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id} в start_handler")
-        await message.answer("Произошла внутренняя ошибка (код s2), попробуйте позже.")
-        return
-    logger.debug(f"Данные пользователя {user_id} (start): {user_data}")
-    # --- Конец изменений ---
+        rate: float = 25.0,
+        concurrency: int = 10,
+        batch_size: int = 200,
+        state: LocalStateBackend | None = None
+    ):
+        self.bot = bot_instance
+        self.db = db
+        self.state = state or LocalStateBackend()
+        self.rate = rate
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self._next_send_at = 0.0
+        self._paused_until = 0.0
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._live: dict[int, dict] = {}  # текущие счётчики выполняющихся заданий
+
+    async def start(self, text: str, created_by: int) -> dict:
+        job = await create_broadcast_job(self.db, text, created_by)
+        logger.info(f"Рассылка #{job['id']} запущена администратором {created_by}: получателей {job['total']}")
+        await self._spawn(job)
+        return job
+
+    async def resume(self) -> int:
+        """Продолжает задания, оставшиеся в статусе running после остановки процесса."""
+        resumed = 0
+        for job in await get_running_broadcast_jobs(self.db):
+            if not await self._spawn(job):
+                continue  # задание выполняет другой процесс
+            logger.info(f"Продолжение рассылки #{job['id']} с user_id > {job['last_user_id']}")
+            resumed += 1
+        return resumed
+
+    async def _spawn(self, job: dict) -> bool:
+        if not await self.state.acquire(broadcast_key(job['id']), None):
+            return False
+        self._live[job['id']] = {
+            'sent': job['sent'], 'failed': job['failed'], 'blocked': job['blocked'],
+            'processed_at_start': job['sent'] + job['failed'] + job['blocked'],
+            'started_at': time.monotonic(),
+        }
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job['id']] = task
+        self.state.attach(broadcast_key(job['id']), task)
+        return True
 
-    # Отправляем главное меню с кнопками ReplyKeyboardMarkup
-    keyboard = main_menu_keyboard()
-    await message.answer(
-        f"Привет, {message.from_user.first_name}! Я ваш AI ассистент.\n"
-        "Задайте ваш вопрос или используйте кнопки меню.",
-        reply_markup=keyboard
-    )
+    async def cancel(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        if not task:
+            return False
+        await set_broadcast_status(self.db, job_id, 'cancelled')
+        task.cancel()
+        return True
 
-@dp.message(
-    F.text
-    & ~F.text.startswith('/')  # исключаем команды бота
-    & ~(F.text == "🔄 Новый диалог")
-    & ~(F.text == "📊 Мои лимиты")
-    & ~(F.text == "💎 Подписка")
-    & ~(F.text == "🆘 Помощь")
-    & ~(F.text == "❓ Задать вопрос")
-    & ~(F.text == "📸 Генерация фото")
-)
-async def message_handler(message: types.Message):
-    user_id = message.from_user.id
-    if user_id in pending_photo_prompts:
-        pending_photo_prompts.remove(user_id)
-        prompt = message.text
+    async def stop(self):
+        """Остановка процесса: задания остаются running и продолжатся при следующем запуске."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def progress(self, job: dict) -> dict:
+        """Прогресс задания: счётчики (живые, если рассылка идёт в этом процессе), скорость и ETA."""
+        live = self._live.get(job['id'])
+        sent, failed, blocked = (live['sent'], live['failed'], live['blocked']) if live else (job['sent'], job['failed'], job['blocked'])
+        processed = sent + failed + blocked
+        rate = 0.0
+        if live:
+            elapsed = time.monotonic() - live['started_at']
+            if elapsed > 0:
+                rate = (processed - live['processed_at_start']) / elapsed
+        remaining = max(0, job['total'] - processed)
+        return {
+            'status': job['status'],
+            'total': job['total'],
+            'processed': processed,
+            'sent': sent,
+            'failed': failed,
+            'blocked': blocked,
+            'rate': rate,
+            'eta': remaining / rate if rate > 0 else None,
+        }
+
+    async def _wait_turn(self):
+        # Резервируем окно отправки; если во время ожидания пришёл RetryAfter — ждём его окончания
+        while True:
+            now = time.monotonic()
+            send_at = max(now, self._next_send_at, self._paused_until)
+            self._next_send_at = send_at + 1.0 / self.rate
+            if send_at > now:
+                await asyncio.sleep(send_at - now)
+            if self._paused_until <= time.monotonic():
+                return
+
+    async def _send_one(self, user_id: int, text: str) -> str:
+        """Отправляет одно сообщение; возвращает 'sent', 'blocked' или 'failed'."""
+        for _ in range(self.MAX_RETRIES):
+            await self._wait_turn()
+            try:
+                await self.bot.send_message(user_id, text)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                telegram_retry_after_total.inc(source="broadcast")
+                logger.warning(f"Рассылка: RetryAfter {e.retry_after}s, отправка приостановлена")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'  # бот заблокирован или аккаунт удалён
+            except TelegramAPIError as e:
+                logger.debug(f"Рассылка: не удалось отправить user_id={user_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _run(self, job: dict):
+        job_id = job['id']
+        live = self._live[job_id]
+        last_user_id = job['last_user_id']
         try:
-            response = await vision_async_client.images.generate(
-                model="grok-2-image-1212",
-                prompt=prompt
-            )
-            url = response.data[0].url
-            await message.reply_photo(photo=url, reply_markup=main_menu_keyboard())
+            while True:
+                batch = await fetch_broadcast_recipients(self.db, last_user_id, self.batch_size)
+                if not batch:
+                    break
+                recipients = iter(batch)
+                blocked_ids: list[int] = []
+
+                async def _worker():
+                    for uid in recipients:
+                        result = await self._send_one(uid, job['text'])
+                        live[result] += 1
+                        if result == 'blocked':
+                            blocked_ids.append(uid)
+
+                await asyncio.gather(*(_worker() for _ in range(min(self.concurrency, len(batch)))))
+                last_user_id = batch[-1]
+                await save_broadcast_checkpoint(
+                    self.db, job_id, last_user_id, live['sent'], live['failed'], live['blocked'], blocked_ids
+                )
+            await set_broadcast_status(self.db, job_id, 'done')
+            logger.info(f"Рассылка #{job_id} завершена: отправлено {live['sent']}, ошибок {live['failed']}, заблокировали бота {live['blocked']}")
+            try:
+                await self.bot.send_message(
+                    job['created_by'],
+                    f"✅ Рассылка #{job_id} завершена: отправлено {live['sent']}/{job['total']}, "
+                    f"ошибок {live['failed']}, заблокировали бота {live['blocked']}."
+                )
+            except TelegramAPIError as e:
+                logger.warning(f"Не удалось уведомить администратора о завершении рассылки #{job_id}: {e}")
+        except asyncio.CancelledError:
+            logger.info(f"Рассылка #{job_id} остановлена на user_id > {last_user_id}")
+            raise
         except Exception as e:
-            logger.exception(f"Ошибка генерации фото: {e}")
-            await message.reply("Произошла ошибка при генерации фото", reply_markup=main_menu_keyboard())
-        return
-    chat_id = message.chat.id
-    user_text = message.text
+            logger.exception(f"Ошибка рассылки #{job_id} (продолжится после перезапуска): {e}")
+        finally:
+            self._tasks.pop(job_id, None)
+            self._live.pop(job_id, None)
+            await self.state.release(broadcast_key(job_id), asyncio.current_task())
 
-    # Получаем зависимости из workflow_data
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
 
-    if not db or not current_settings:
-        logger.error("Не удалось получить соединение с БД или настройки")
-        await message.answer("Произошла внутренняя ошибка (код 1), попробуйте позже.")
-        return
+# --- Взаимодействие с XAI API ---
 
-    # --- Получаем или создаем пользователя (обновляем last_active) ---
-    user_data = await get_or_create_user(
-        db,
-        user_id,
-        message.from_user.username,
-        message.from_user.first_name,
-        message.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id}")
-        await message.answer("Произошла внутренняя ошибка (код 3), попробуйте позже.")
-        return
-    # Теперь у вас есть user_data - словарь с данными пользователя
-    logger.debug(f"Данные пользователя {user_id}: {user_data}")
-    # --- КОНЕЦ ИЗМЕНЕНИЙ ---
+# Модель текстовых ответов (входит и в ключ кэша ответов)
+XAI_CHAT_MODEL = "grok-3-mini-beta"
+XAI_VISION_MODEL = "grok-2-vision-1212"
+XAI_IMAGE_MODEL = "grok-2-image-1212"
 
-    # Проверка, не идет ли уже генерация для этого пользователя
-    if user_id in active_requests:
-        try:
-            await message.reply("Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.", reply_markup=progress_keyboard(user_id))
-        except TelegramAPIError as e:
-            logger.warning(f"Не удалось отправить сообщение о дублирующем запросе: {e}")
-        return
+class XAIUnavailableError(Exception):
+    """xAI API признан недоступным: размыкатель открыт, запрос не отправлялся."""
 
-    # Регистрируем текущую задачу генерации, чтобы ее можно было отменить
-    active_requests[user_id] = asyncio.current_task()
-    # Показываем индикатор "печатает"
-    await bot.send_chat_action(chat_id=chat_id, action="typing")
 
-    current_message_id = None # Объявляем здесь, чтобы быть доступным в finally/except
-    try:
-        # Сохраняем сообщение пользователя
-        await add_message_to_db(db, user_id, "user", user_text)
-        logger.info(f"Сообщение от пользователя {user_id} сохранено")
+class XAICircuitBreaker:
+    """
+    Размыкатель цепи для запросов к xAI.
 
-        # Получаем историю сообщений
-        history = await get_last_messages(db, user_id, limit=CONVERSATION_HISTORY_LIMIT)
-        logger.info(f"Получена история сообщений для пользователя {user_id}, записей: {len(history)}")
+    После failure_threshold неудач подряд (таймауты, обрывы соединения, 5xx) размыкается:
+    запросы сразу получают XAIUnavailableError, не тратя время на таймауты и повторы.
+    Через reset_timeout секунд пропускает один пробный запрос (half-open): успех замыкает
+    цепь, неудача снова размыкает её на reset_timeout.
+    """
 
-        # Проверка лимита и подписки
-        is_allowed = await check_and_consume_limit(db, current_settings, user_id)
-        if not is_allowed:
-            kb = InlineKeyboardBuilder()
-            kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
-            await message.reply(
-                "У вас закончились бесплатные запросы на сегодня 😔\nЧтобы продолжить без ограничений, оформите подписку.",
-                reply_markup=kb.as_markup()
-            )
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def retry_after(self) -> float:
+        """Сколько секунд осталось до пробного запроса."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def before_request(self):
+        """Пропускает запрос или бросает XAIUnavailableError. В half-open пропускается только один."""
+        state = self.state
+        if state == "closed":
             return
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            logger.info("xAI: пробный запрос после размыкания цепи")
+            return
+        raise XAIUnavailableError(f"xAI API недоступен, повтор через {self.retry_after():.0f} с")
 
-        # --- Новая логика стриминга с авто-разбиением ---
-        full_raw_response = ""
-        current_message_text = "" # Текст для текущего сообщения TG
-        placeholder_message = None
-        message_count = 0 # Счетчик отправленных сообщений (частей)
-        last_edit_time = 0
-        edit_interval = 1.5
-        formatting_failed = False
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("xAI: цепь замкнута, API снова отвечает")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
 
-        # Отправка самого первого плейсхолдера
-        try:
-            placeholder_message = await message.answer("⏳", reply_markup=progress_keyboard(user_id))  # Короткий плейсхолдер с кнопкой Отмена
-            current_message_id = placeholder_message.message_id
-            message_count = 1
-            last_edit_time = time.monotonic()
-        except TelegramAPIError as e:
-            logger.error(f"Ошибка отправки начального плейсхолдера: {e}")
-            return # Не можем продолжить
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._probing:
+                logger.error(f"xAI: цепь разомкнута после {self.failures} неудач подряд на {self.reset_timeout:.0f} с")
+            self.opened_at = time.monotonic()
+        self._probing = False
 
-        async for chunk in stream_xai_response(current_settings.XAI_API_KEY, SYSTEM_PROMPT, history):
-            if not current_message_id: # Если отправка плейсхолдера не удалась или сообщение было удалено
-                 logger.warning("Прерывание стриминга, так как нет активного message_id.")
-                 break
+    def release(self):
+        """Запрос прерван без результата (отмена): пробный слот освобождается, счётчики не меняются."""
+        self._probing = False
 
-            full_raw_response += chunk
-            now = time.monotonic()
 
-            # Проверяем, не превысит ли добавление чанка лимит ТЕКУЩЕГО сообщения
-            tentative_next_text = current_message_text + chunk
-            try:
-                # Проверяем длину с учетом HTML и "..."
-                html_to_check = markdown_to_telegram_html(tentative_next_text) + "..."
-                check_formatting_failed = False
-            except Exception as fmt_err:
-                logger.warning(f"Formatting error during length check: {fmt_err}")
-                html_to_check = tentative_next_text + "..." # Проверяем raw длину
-                check_formatting_failed = True
-                formatting_failed = True # Отмечаем глобально
-
-            if len(html_to_check) > TELEGRAM_MAX_LENGTH:
-                # Лимит превышен, финализируем текущее сообщение
-                logger.info(f"Финализация сообщения {message_count} (ID: {current_message_id}) из-за длины.")
-                try:
-                    final_part_html = markdown_to_telegram_html(current_message_text) if not formatting_failed else current_message_text
-                    if final_part_html: # Редактируем только если есть текст
-                        await bot.edit_message_text(
-                            text=final_part_html,
-                            chat_id=chat_id,
-                            message_id=current_message_id,
-                            parse_mode=None if formatting_failed else ParseMode.HTML,
-                            reply_markup=progress_keyboard(user_id)  # Сохраняем кнопку Отмена
-                        )
-                except TelegramAPIError as e:
-                    logger.error(f"Ошибка финализации сообщения {message_count}: {e}")
-                    if not formatting_failed:
-                        formatting_failed = True
-                        logger.warning("Переключение на raw из-за ошибки финализации.")
-                        try:
-                            if current_message_text:
-                                await bot.edit_message_text(text=current_message_text, chat_id=chat_id, message_id=current_message_id, parse_mode=None, reply_markup=None)
-                        except TelegramAPIError as plain_e:
-                            logger.error(f"Ошибка raw финализации сообщения {message_count}: {plain_e}")
-                            current_message_id = None # Теряем это сообщение
-                    else:
-                        logger.error(f"Ошибка raw финализации сообщения {message_count}. Сообщение потеряно.")
-                        current_message_id = None
+def _json_compact(value) -> bytes:
+    """Детерминированный компактный JSON: одинаковые данные — одинаковые байты."""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode()
 
-                # Начинаем новое сообщение при переполнении: убираем отмену из старого и отправляем новый placeholder
-                current_message_text = chunk  # Начинаем с нового чанка
-                message_count += 1
-                try:
-                    # удаляем кнопку 'Отмена' из предыдущего сообщения
-                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=current_message_id, reply_markup=None)
-                    # отправляем новый placeholder с кнопкой 'Отмена'
-                    placeholder_message = await message.answer("...", reply_markup=progress_keyboard(user_id))
-                    current_message_id = placeholder_message.message_id
-                    last_edit_time = time.monotonic()
-                    logger.info(f"Начато новое сообщение {message_count} (ID: {current_message_id})")
-                except TelegramAPIError as e:
-                    logger.error(f"Ошибка отправки плейсхолдера для сообщения {message_count}: {e}")
-                    current_message_id = None
-                    break  # Прерываем стрим, если не можем создать новое сообщение
+def serialize_chat_payload(payload: dict) -> tuple[bytes, list[bytes]]:
+    """
+    Тело запроса chat/completions и его части до конца каждого сообщения.
 
-            else:
-                # Лимит не превышен, добавляем чанк к текущему тексту
-                current_message_text += chunk
+    model и messages идут первыми, остальные параметры (в том числе seed, разный у запросов)
+    — после сообщений, поэтому общее начало диалога даёт общее начало тела запроса.
+    """
+    parts = [b'{"model":' + _json_compact(payload["model"]) + b',"messages":[']
+    for i, message in enumerate(payload["messages"]):
+        parts.append((b"," if i else b"") + _json_compact(message))
+    rest = {key: value for key, value in payload.items() if key not in ("model", "messages")}
+    tail = b"]," + _json_compact(rest)[1:] if rest else b"]}"
+    return b"".join(parts) + tail, parts
+
+class PromptPrefixStats:
+    """
+    Сколько байт в начале запроса совпадает с предыдущим запросом того же диалога —
+    оценка того, какая часть промпта может быть взята из кэша промптов провайдера.
 
-                # Редактируем текущее сообщение с троттлингом
-                if now - last_edit_time > edit_interval:
-                    try:
-                        html_to_send = markdown_to_telegram_html(current_message_text) if not formatting_failed else current_message_text
-                        text_to_show = html_to_send + "..."
-
-                        await bot.edit_message_text(
-                            text=text_to_show,
-                            chat_id=chat_id,
-                            message_id=current_message_id,
-                            parse_mode=None if formatting_failed else ParseMode.HTML,
-                            reply_markup=progress_keyboard(user_id)  # Обновляем кнопку Отмена
-                        )
-                        last_edit_time = now
-                    except TelegramRetryAfter as e:
-                        logger.warning(f"Throttled: RetryAfter {e.retry_after}s")
-                        await asyncio.sleep(e.retry_after + 0.1)
-                        last_edit_time = time.monotonic()
-                    except TelegramAPIError as e:
-                         logger.error(f"Ошибка редактирования сообщения {message_count} (mid-stream): {e}")
-                         # Проверяем, не пропало ли сообщение
-                         if any(msg in str(e).lower() for msg in ("message to edit not found", "message can't be edited", "message is not modified")):
-                             logger.warning(f"Сообщение {message_count} (ID: {current_message_id}) больше недоступно для редактирования.")
-                             current_message_id = None
-                             # Не прерываем цикл, т.к. следующий чанк может создать новое сообщение
-                         elif not formatting_failed: # Если ошибка не связана с пропажей сообщения, и мы еще не перешли на raw
-                             formatting_failed = True
-                             logger.warning("Переключение на raw из-за ошибки редактирования.")
-                         # Если уже raw или ошибка была другая, просто пропускаем это редактирование
-                    except Exception as e:
-                         logger.exception(f"Неожиданная ошибка редактирования сообщения {message_count}: {e}")
+    Для каждого диалога хранятся только хэши начала запроса на границах сообщений
+    (последние max_dialogs диалогов), совпадение считается с точностью до сообщения.
+    """
 
+    def __init__(self, max_dialogs: int = 10000):
+        self.max_dialogs = max_dialogs
+        self._last: collections.OrderedDict[int, list[tuple[int, bytes]]] = collections.OrderedDict()
+        # Метрики
+        self.requests = 0
+        self.bytes_total = 0
+        self.bytes_reused = 0
+
+    def observe(self, dialog_id: int, parts: list[bytes]) -> int:
+        """Учитывает запрос; возвращает число байт начала, совпавших с прошлым запросом диалога."""
+        boundaries = []
+        digest = hashlib.blake2b(digest_size=8)
+        offset = 0
+        for part in parts:
+            digest.update(part)
+            offset += len(part)
+            boundaries.append((offset, digest.digest()))
+        reused = 0
+        for previous, current in zip(self._last.get(dialog_id, ()), boundaries):
+            if previous != current:
+                break
+            reused = current[0]
+        self._last[dialog_id] = boundaries
+        self._last.move_to_end(dialog_id)
+        if len(self._last) > self.max_dialogs:
+            self._last.popitem(last=False)
+        self.requests += 1
+        self.bytes_total += offset
+        self.bytes_reused += reused
+        return reused
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'requests': self.requests,
+            'bytes_total': self.bytes_total,
+            'bytes_reused': self.bytes_reused,
+            'reuse_ratio': self.bytes_reused / self.bytes_total if self.bytes_total else 0.0,
+            'reused_avg': self.bytes_reused / self.requests if self.requests else 0.0,
+        }
+
+
+class XAIClient:
+    """
+    Долгоживущий HTTP-клиент xAI: одна aiohttp-сессия на всё время работы бота.
 
-        # --- Финализация ПОСЛЕДНЕГО сообщения после цикла ---
-        if current_message_id and current_message_text:
-            logger.info(f"Финализация последнего сообщения {message_count} (ID: {current_message_id})")
-            try:
-                final_html = markdown_to_telegram_html(current_message_text) if not formatting_failed else current_message_text
-                # оформляем финальный текст без кнопок в этом сообщении
-                await bot.edit_message_text(
-                    text=final_html,
-                    chat_id=chat_id,
-                    message_id=current_message_id,
-                    parse_mode=None if formatting_failed else ParseMode.HTML,
-                    reply_markup=None
-                )
-                # затем показываем ReplyKeyboardMarkup меню новым сообщением
-                await message.answer(
-                    "🫡",
-                    reply_markup=main_menu_keyboard()
-                )
-                logger.info(f"Последнее сообщение {message_count} {'RAW' if formatting_failed else 'HTML'} отправлено.")
+    Пул соединений ограничен, DNS кэшируется, соединения переиспользуются (keep-alive),
+    поэтому ответы не платят за DNS, TCP- и TLS-рукопожатие на каждый запрос.
+    Создаётся в main(), закрывается в on_shutdown, передаётся через dp.workflow_data['xai_client'].
+    """
 
-            except TelegramAPIError as e:
-                logger.error(f"Ошибка финализации последнего сообщения {message_count}: {e}")
-                # Попытка отправить raw как fallback
-                try:
-                    # Raw fallback: редактируем без кнопок
-                    await bot.edit_message_text(
-                        text=current_message_text,
-                        chat_id=chat_id,
-                        message_id=current_message_id,
-                        parse_mode=None,
-                        reply_markup=None
-                    )
-                    logger.info(f"Последнее сообщение {message_count} RAW отправлено после ошибки HTML.")
-                except TelegramAPIError as plain_e:
-                    logger.error(f"Ошибка raw финализации последнего сообщения {message_count}: {plain_e}")
-                    # Как крайняя мера, отправить новым сообщением
-                    try:
-                         await message.answer(
-                             text=current_message_text,
-                             parse_mode=None,
-                             reply_markup=main_menu_keyboard()
-                         )
-                         logger.info(f"Последняя часть {message_count} отправлена новым сообщением после ошибки редактирования.")
-                    except Exception as final_send_err:
-                         logger.error(f"Не удалось отправить последнюю часть {message_count} новым сообщением: {final_send_err}")
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.x.ai/v1",
+        pool_limit: int = 100,
+        dns_ttl: int = 300,
+        keepalive_timeout: float = 60.0,
+        retry_attempts: int = 4,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 8.0,
+        stream_idle_timeout: float = 30.0,
+        breaker: XAICircuitBreaker | None = None
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.pool_limit = pool_limit
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        # Повторы стриминга: попытки, экспоненциальная задержка с джиттером, таймаут тишины в потоке
+        self.retry_attempts = max(1, retry_attempts)
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.stream_idle_timeout = stream_idle_timeout
+        self.breaker = breaker or XAICircuitBreaker()
+        self.prefix_stats = PromptPrefixStats()
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def chat_completions_url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая её при первом обращении (внутри работающего event loop)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                family=socket.AF_INET,          # Используем IPv4
+                limit=self.pool_limit,          # Всего одновременных соединений
+                limit_per_host=self.pool_limit,
+                ttl_dns_cache=self.dns_ttl,     # Кэш DNS-ответов (секунды)
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
 
-        elif not full_raw_response and message_count == 1 and current_message_id:
-            # Если API ничего не вернуло после первого плейсхолдера
-            logger.warning(f"Не получен ответ от XAI для пользователя {user_id}")
-            try:
-                # Показ ошибки без кнопок, затем меню
-                await bot.edit_message_text(
-                    "К сожалению, не удалось получить ответ от AI.",
-                    chat_id=chat_id,
-                    message_id=current_message_id,
-                    reply_markup=None
-                )
-                await message.answer(
-                    "🫡",
-                    reply_markup=main_menu_keyboard()
-                )
-            except TelegramAPIError:
-                pass # Игнорируем, если сообщение уже удалено
+    def retry_delay(self, attempt: int) -> float:
+        """Задержка перед повтором attempt (с 0): full jitter, равномерно в [0, min(max, base * 2^attempt)]."""
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
 
-        # --- Сохранение полного ответа в БД ---
-        if full_raw_response:
-            try:
-                await add_message_to_db(db, user_id, "assistant", full_raw_response)
-                logger.info(f"Ответ ассистента (RAW) для пользователя {user_id} сохранен в БД")
-            except Exception as e:
-                logger.error(f"Ошибка сохранения ответа ассистента в БД: {e}")
-        # (Логика для случая else: logger.warning(f"Не получен или пустой ответ...) обработана выше
+    async def close(self):
+        """Закрывает сессию и все соединения пула."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
-    except Exception as e:
-        logger.exception(f"Критическая ошибка в обработчике сообщений для user_id={user_id}: {e}")
-        # очистка active_requests при ошибке
-        active_requests.pop(user_id, None)
-        try:
-            # Пытаемся отредактировать последнее известное сообщение об ошибке
-            error_message = "Произошла серьезная ошибка при обработке вашего запроса."
-            if current_message_id:
-                 await bot.edit_message_text(error_message, chat_id=chat_id, message_id=current_message_id, reply_markup=None)
-            else: # Или отправляем новое, если ID нет
-                await message.answer(error_message + " Пожалуйста, попробуйте позже или используйте команду /start для сброса.")
-        except TelegramAPIError:
-             logger.error("Не удалось даже отправить сообщение об ошибке пользователю.")
 
-# --- Обработчик отмены генерации ---
-@dp.callback_query(F.data.startswith("cancel_generation_"))
-async def cancel_generation_callback(callback: types.CallbackQuery):
-    """Обрабатывает отмену генерации: прекращает задачу, убирает клавиатуру и показывает меню."""
-    # Парсим user_id из callback_data
-    try:
-        user_id_to_cancel = int(callback.data.rsplit("_", 1)[-1])
-    except ValueError:
-        await callback.answer("Ошибка обработки отмены.", show_alert=True)
-        return
+# Разбор JSON потока ответа: orjson, если установлен (оба принимают bytes)
+_json_loads = orjson.loads if orjson else json.loads
+_json_scanstring = json.decoder.scanstring  # C-реализация разбора строкового литерала JSON
+_SSE_CONTENT_KEY = re.compile(rb'"content"\s*:\s*"')
+_SSE_CONTENT_NULL = re.compile(rb'"content"\s*:\s*null')
+_SSE_FINISH_REASON = re.compile(rb'"finish_reason"\s*:\s*"([^"\\]*)"')
 
-    # Прекращаем задачу генерации и восстанавливаем лимит, если была
-    task = active_requests.pop(user_id_to_cancel, None)
-    if task:
-        task.cancel()
-        db = dp.workflow_data.get('db')
-        settings_local = dp.workflow_data.get('settings')
-        if db and settings_local:
-            try:
-                if settings_local.USE_SQLITE:
-                    def _restore():
-                        conn = sqlite3.connect(db)
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = ?",
-                            (user_id_to_cancel,)
-                        )
-                        conn.commit()
-                        conn.close()
-                    await asyncio.to_thread(_restore)
+class SSEDeltaParser:
+    """
+    Потоковый разбор Server-Sent Events ответа chat/completions прямо на байтах.
+
+    feed() принимает куски в том виде, в каком они пришли из сети (строка события
+    и даже UTF-8 символ могут быть разрезаны), и возвращает новые фрагменты
+    choices[0].delta.content. Событие собирается из всех своих строк data: (через \n)
+    и разбирается по пустой строке, как требует спецификация SSE; комментарии
+    и поля event/id/retry пропускаются.
+
+    Весь JSON события не разбирается: если в нём единственный ключ "content"
+    (обычный чанк, это choices[0].delta.content), из байтов вырезается только его
+    строковое значение, а finish_reason ищется регулярным выражением. Чанки
+    reasoning_content у reasoning-моделей так вообще не декодируются. Полный разбор
+    (orjson, если установлен) остаётся запасным путём для нестандартных событий.
+    """
+
+    def __init__(self):
+        self._tail = b""               # неполная последняя строка
+        self._data: list[bytes] = []   # строки data: текущего события
+        self.done = False              # получен [DONE]
+        self.finish_reason: str | None = None
+        self.events = 0
+
+    def feed(self, chunk: bytes) -> list[str]:
+        if self._tail:
+            chunk = self._tail + chunk
+        lines = chunk.split(b"\n")
+        self._tail = lines.pop()
+        out: list[str] = []
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                self._dispatch(out)
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+        return out
+
+    def close(self) -> list[str]:
+        """Конец потока: разбирает последнее событие, если сервер не завершил его пустой строкой."""
+        out = self.feed(b"\n") if self._tail else []
+        self._dispatch(out)
+        return out
+
+    def _dispatch(self, out: list[str]):
+        if not self._data:
+            return
+        payload = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        self._data = []
+        self.events += 1
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        match = _SSE_FINISH_REASON.search(payload)
+        if match:
+            self.finish_reason = match.group(1).decode()
+        first = payload.find(b'"content"')
+        if first == -1:
+            return
+        if payload.find(b'"content"', first + 9) == -1:
+            match = _SSE_CONTENT_KEY.match(payload, first)
+            if match:
+                try:
+                    text, _ = _json_scanstring(payload[match.end():].decode(), 0)
+                except ValueError:
+                    pass  # разберём событие целиком
                 else:
-                    async with db.acquire() as conn:
-                        await conn.execute(
-                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = $1",
-                            user_id_to_cancel
-                        )
-            except Exception:
-                logger.exception(f"Не удалось восстановить лимит для user_id={user_id_to_cancel}")
+                    if text:
+                        out.append(text)
+                    return
+            elif _SSE_CONTENT_NULL.match(payload, first):
+                return
+        self._parse_full(payload, out)
+
+    def _parse_full(self, payload: bytes, out: list[str]):
+        try:
+            chunk = _json_loads(payload)
+        except ValueError:  # json.JSONDecodeError и orjson.JSONDecodeError
+            logger.error(f"Ошибка декодирования JSON из события: {payload[:200]!r}")
+            return
+        choices = chunk.get('choices') if isinstance(chunk, dict) else None
+        if not choices:
+            return
+        choice = choices[0]
+        delta = choice.get('delta')
+        if delta:
+            text = delta.get('content')
+            if text:
+                out.append(text)
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
 
-    # Убираем inline-клавиатуру отмены
-    try:
-        await callback.message.edit_reply_markup(reply_markup=None)
-    except TelegramAPIError:
-        pass
 
-    # Уведомляем пользователя о завершении отмены
-    await callback.answer("Генерация ответа отменена.", show_alert=False)
+# Просьба продолжить оборванный ответ (уже отданный текст передаётся как реплика ассистента)
+XAI_CONTINUE_PROMPT = "Ответ оборвался. Продолжи его ровно с места обрыва, не повторяя уже написанное."
+# Совпадение на стыке короче этого считается случайным и не отбрасывается
+RESUME_MIN_OVERLAP = 16
 
-    # Показываем главное меню
-    await callback.message.answer(
-        "🫡",
-        reply_markup=main_menu_keyboard()
-    )
 
-@dp.callback_query(F.data == "clear_history")
-async def clear_history_callback(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    # Получаем зависимости из диспетчера (можно и через bot.dispatcher)
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
+class XAIStreamInterrupted(Exception):
+    """Поток ответа закончился без [DONE] и finish_reason (соединение закрыто посреди ответа)."""
 
-    if not db or not current_settings:
-        logger.error("Не удалось получить БД/настройки при очистке истории (callback)")
-        await callback.answer("Ошибка при очистке истории", show_alert=True)
-        return
 
-    # --- Получаем или создаем пользователя (обновляем last_active) ---
-    user_data = await get_or_create_user(
-        db,
-        user_id,
-        callback.from_user.username,
-        callback.from_user.first_name,
-        callback.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_history_callback")
-        await callback.answer("Произошла внутренняя ошибка (код ch1), попробуйте позже.", show_alert=True)
-        return
-    logger.debug(f"Данные пользователя {user_id} (clear_history_callback): {user_data}")
-    # --- Конец изменений ---
+class ResumeFilter:
+    """
+    Отсекает повтор уже отданного текста в ответе, продолжающем оборванный поток.
 
-    try:
-        rows_deleted_count = 0
-        if current_settings.USE_SQLITE:
-            def _clear_history_sqlite():
-                db_path = db # db здесь это путь к файлу
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-                deleted_count = cursor.rowcount
-                conn.commit()
-                conn.close()
-                return deleted_count
-            rows_deleted_count = await asyncio.to_thread(_clear_history_sqlite)
-            logger.info(f"SQLite: Очищена история пользователя {user_id}, удалено {rows_deleted_count} записей")
-        else:
-            # PostgreSQL
-            async with db.acquire() as connection: # db здесь это пул
-                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id) # Убрал RETURNING id для простоты
-                # result это строка вида "DELETE N", парсим N
-                try:
-                    rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
-                except:
-                    rows_deleted_count = -1 # Не удалось распарсить
-                logger.info(f"PostgreSQL: Очищена история пользователя {user_id}, результат: {result}")
+    Модель может продолжить с места обрыва, начать ответ заново или повторить
+    последние слова. Пока новый текст целиком встречается в уже отданном, он
+    придерживается; как только становится ясно, где стык, отбрасывается самое
+    длинное перекрытие хвоста отданного текста с началом нового (весь отданный
+    текст, если ответ начат заново), остальное пропускается как есть.
+    """
 
-        await callback.answer(f"История очищена ({rows_deleted_count} записей удалено)", show_alert=False)
-        # Можно добавить сообщение в чат для наглядности
-        # Редактируем исходное сообщение или отвечаем новым
+    def __init__(self, delivered: str, min_overlap: int = RESUME_MIN_OVERLAP):
+        self.delivered = delivered
+        self.min_overlap = max(1, min(min_overlap, len(delivered)))
+        self.buffer = ""
+        self.resolved = False
+        self.skipped = 0  # сколько символов повтора отброшено
+
+    def feed(self, text: str) -> str:
+        if self.resolved:
+            return text
+        self.buffer += text
+        if self.buffer in self.delivered:
+            return ""  # пока может оказаться повтором — ждём
+        return self._resolve()
+
+    def flush(self) -> str:
+        """Конец потока: придержанный текст целиком повторял отданный или отдаётся сейчас."""
+        if self.resolved:
+            return ""
+        if self.delivered.startswith(self.buffer) or self.delivered.endswith(self.buffer):
+            self.resolved = True
+            self.skipped = len(self.buffer)
+            return ""
+        return self._resolve()
+
+    def _resolve(self) -> str:
+        self.resolved = True
+        text, delivered = self.buffer, self.delivered
+        # Ищем самый ранний суффикс отданного текста, с которого начинается новый
+        start = delivered.find(text[:self.min_overlap])
+        while start != -1:
+            if text.startswith(delivered[start:]):
+                self.skipped = len(delivered) - start
+                return text[self.skipped:]
+            start = delivered.find(text[:self.min_overlap], start + 1)
+        return text
+
+
+async def _stream_xai_response(
+    client: XAIClient,
+    system_prompt: str,
+    history: list[dict],
+    dialog_id: int | None = None
+) -> typing.AsyncGenerator[str, None]:
+    """Попытки запроса к xAI и разбор потока; см. stream_xai_response."""
+    # Убираем системный промпт из истории, если он там уже есть
+    history_no_system = [msg for msg in history if msg.get("role") != "system"]
+    # XAI ожидает системный промпт как первое сообщение в списке
+    messages = [{"role": "system", "content": system_prompt}] + history_no_system
+
+    headers = {
+        "Authorization": f"Bearer {client.api_key}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream" # XAI использует Server-Sent Events для стриминга
+    }
+    if dialog_id is not None:
+        # Запросы одного диалога направляются к одному кэшу промптов; сам id пользователя не передаётся
+        headers["x-grok-conv-id"] = hashlib.sha256(f"{client.api_key}:{dialog_id}".encode()).hexdigest()[:32]
+    # URL XAI API
+    url = client.chat_completions_url
+    payload = {
+        "model": XAI_CHAT_MODEL,
+        "messages": messages,
+        "stream": True,
+        "temperature": 0.5,
+        "reasoning": {"effort": "high"},
+        # Один seed на все попытки: начатый заново ответ скорее совпадёт с отданным и будет отсечён
+        "seed": secrets.randbelow(2 ** 31),
+    }
+    # Таймаут на весь запрос (3 минуты) и на тишину в потоке
+    request_timeout = aiohttp.ClientTimeout(total=180, sock_read=client.stream_idle_timeout)
+
+    breaker = client.breaker
+    max_retries = client.retry_attempts
+    delivered = ""  # текст, уже отданный вызывающему
+
+    # Общая сессия клиента: соединения переиспользуются между запросами
+    session = client.session
+    body, parts = serialize_chat_payload(payload)
+    if dialog_id is not None:
+        reused = client.prefix_stats.observe(dialog_id, parts)
+        logger.debug(f"Запрос XAI: {len(body)} байт, совпадает с прошлым запросом диалога {reused} байт")
+    for attempt in range(max_retries):
+        breaker.before_request()
+        request_body = body
+        resume = None
+        if delivered:
+            request_body, _ = serialize_chat_payload(dict(payload, messages=messages + [
+                {"role": "assistant", "content": delivered},
+                {"role": "user", "content": XAI_CONTINUE_PROMPT},
+            ]))
+            resume = ResumeFilter(delivered)
+            logger.info(f"Продолжение ответа XAI с {len(delivered)} символов (попытка {attempt + 1}/{max_retries})")
+        settled = False  # исход попытки учтён размыкателем
+        retry_after = None
         try:
-            # Пытаемся отредактировать, если это было сообщение с кнопкой
-            await callback.message.edit_text("История диалога очищена.", reply_markup=None)
-        except TelegramAPIError:
-            # Если не вышло (например, это было не сообщение бота или прошло много времени),
-            # отправляем новое сообщение
-             await callback.message.answer("История диалога очищена.")
+            # Выполняем POST-запрос с указанным таймаутом
+            async with session.post(url, headers=headers, data=request_body, timeout=request_timeout) as response:
+                if response.status == 429 or response.status >= 500:
+                    error_body = await response.text()
+                    logger.error(f"Ошибка HTTP запроса к XAI API: {response.status} {response.reason}. URL: {url}. Попытка {attempt + 1}/{max_retries}. Тело ответа: {error_body[:500]}")
+                response.raise_for_status()  # Вызовет исключение для статусов 4xx/5xx
+                breaker.record_success()
+                settled = True
+
+                # Читаем ответ кусками по мере поступления и разбираем SSE на байтах
+                parser = SSEDeltaParser()
+                async for data in response.content.iter_any():
+                    for text in parser.feed(data):
+                        if resume:
+                            text = resume.feed(text)
+                        if text:
+                            delivered += text
+                            yield text
+                    if parser.done:
+                        break
+                else:
+                    for text in parser.close():
+                        if resume:
+                            text = resume.feed(text)
+                        if text:
+                            delivered += text
+                            yield text
+                if resume:
+                    text = resume.flush()
+                    if text:
+                        delivered += text
+                        yield text
+                    if resume.skipped:
+                        logger.info(f"При продолжении ответа отброшен повтор: {resume.skipped} символов")
+                if not parser.done and not parser.finish_reason:
+                    raise XAIStreamInterrupted(f"поток закрыт без [DONE] после {parser.events} событий")
+                if parser.finish_reason:
+                    logger.info(f"Стриминг завершен с причиной: {parser.finish_reason}")
+                if parser.done:
+                    logger.info("Стриминг завершен сигналом [DONE]")
+                return
+
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, XAIStreamInterrupted) as e:
+            breaker.record_failure()
+            settled = True
+            reason = "таймаут" if isinstance(e, asyncio.TimeoutError) else f"{type(e).__name__}: {e}"
+            logger.error(f"Обрыв запроса к XAI API ({reason}). URL: {url}. Попытка {attempt + 1}/{max_retries}, уже получено {len(delivered)} символов.")
+            if attempt == max_retries - 1:
+                raise # Перебрасываем исключение после последней попытки
+            last_error = e
+        except aiohttp.ClientResponseError as e:
+            # Авторизационные (401/403) и прочие клиентские ошибки не повторяем и не считаем отказом API
+            if e.status != 429 and e.status < 500:
+                raise
+            if e.status == 429:
+                # Лимит запросов: API жив, ждём сколько попросили
+                with contextlib.suppress(TypeError, ValueError):
+                    retry_after = float(e.headers.get('Retry-After')) if e.headers else None
+            else:
+                breaker.record_failure()
+                settled = True
+            if attempt == max_retries - 1:
+                raise
+            last_error = e
+        finally:
+            if not settled:
+                breaker.release()
+
+        if breaker.state == "open":
+            raise XAIUnavailableError(f"xAI API недоступен, повтор через {breaker.retry_after():.0f} с") from last_error
+        delay = client.retry_delay(attempt)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, client.retry_max_delay))
+        await asyncio.sleep(delay)
+
+async def stream_xai_response(
+    client: XAIClient,
+    system_prompt: str,
+    history: list[dict],
+    dialog_id: int | None = None
+) -> typing.AsyncGenerator[str, None]:
+    """
+    Асинхронный генератор для получения ответа от XAI Chat API в режиме стриминга.
 
-    except Exception as e:
-        logger.exception(f"Ошибка при очистке истории (callback) для user_id={user_id}: {e}")
-        await callback.answer("Произошла ошибка при очистке", show_alert=True)
+    Таймауты, обрывы соединения, 429 и 5xx повторяются (client.retry_attempts попыток,
+    экспоненциальная задержка с джиттером). Если поток оборвался посреди ответа,
+    следующая попытка просит модель продолжить с места обрыва, а ResumeFilter
+    отсекает повтор, поэтому каждый фрагмент отдаётся вызывающему ровно один раз.
+    Пока размыкатель client.breaker открыт, сразу бросается XAIUnavailableError.
 
-# --- Обработчик команды /clear ---
-@dp.message(Command("clear"))
-async def clear_command_handler(message: types.Message):
-    user_id = message.from_user.id
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
+    Тело запроса сериализуется детерминированно (serialize_chat_payload): при неизменном
+    начале истории (см. build_context) начало запроса совпадает побайтно и попадает в кэш
+    промптов провайдера. dialog_id (id пользователя) используется для учёта совпадения
+    в client.prefix_stats и как x-grok-conv-id.
 
-    if not db or not current_settings:
-        logger.error("Не удалось получить БД/настройки при очистке истории (/clear)")
-        await message.answer("Произошла внутренняя ошибка (код 2), попробуйте позже.")
-        return
+    Время до первого фрагмента, скорость стриминга (токенов в секунду) и полное время
+    ответа учитываются в метриках bot_xai_*.
+    """
+    started = time.perf_counter()
+    first_at = None
+    pieces = []
+    outcome = "error"
+    try:
+        async with contextlib.aclosing(_stream_xai_response(client, system_prompt, history, dialog_id)) as stream:
+            async for text in stream:
+                if first_at is None:
+                    first_at = time.perf_counter()
+                    xai_first_token_seconds.observe(first_at - started)
+                pieces.append(text)
+                yield text
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        finished = time.perf_counter()
+        xai_stream_seconds.observe(finished - started, outcome=outcome)
+        if outcome == "ok" and first_at is not None and finished - first_at > 0.05:
+            xai_tokens_per_second.observe(count_tokens("".join(pieces)) / (finished - first_at))
 
-    # --- Получаем или создаем пользователя (обновляем last_active) ---
-    user_data = await get_or_create_user(
-        db,
-        user_id,
-        message.from_user.username,
-        message.from_user.first_name,
-        message.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_command_handler")
-        await message.answer("Произошла внутренняя ошибка (код cl1), попробуйте позже.")
-        return
-    logger.debug(f"Данные пользователя {user_id} (clear_command): {user_data}")
-    # --- Конец изменений ---
+# --- Фото: подготовка изображения вне цикла событий и ответ vision-модели ---
 
-    try:
-        rows_deleted_count = 0
-        if current_settings.USE_SQLITE:
-            def _clear_history_sqlite_cmd():
-                db_path = db
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-                deleted_count = cursor.rowcount
-                conn.commit()
-                conn.close()
-                return deleted_count
-            rows_deleted_count = await asyncio.to_thread(_clear_history_sqlite_cmd)
-            logger.info(f"SQLite: Очищена история пользователя {user_id} по команде /clear, удалено {rows_deleted_count} записей")
-        else:
-            # PostgreSQL
-            async with db.acquire() as connection:
-                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id)
-                try:
-                     rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
-                except:
-                    rows_deleted_count = -1
-                logger.info(f"PostgreSQL: Очищена история пользователя {user_id} по команде /clear, результат: {result}")
+# Вопрос к фото без подписи
+VISION_DEFAULT_PROMPT = (
+    "Опишите, что изображено на фото. Если это медицинский документ, результаты анализов "
+    "или снимок — кратко разберите их."
+)
 
-        await message.answer(f"История диалога очищена ({rows_deleted_count} записей удалено).")
-    except Exception as e:
-        logger.exception(f"Ошибка при очистке истории (/clear) для user_id={user_id}: {e}")
-        await message.answer("Произошла ошибка при очистке истории.")
+def worker_process_context() -> multiprocessing.context.BaseContext:
+    """
+    Способ запуска процессов пулов: forkserver, где он есть, иначе spawn.
+
+    fork из процесса бота копирует его потоки (пул SQLite, троттлер, asyncio) вместе с
+    захваченными ими блокировками, и процесс пула может зависнуть на первой же из них.
+    Новый процесс multiprocessing заново выполняет запущенный скрипт бота как __mp_main__, и
+    импорт его зависимостей (aiogram, openai, PIL) занимает несколько секунд. Поэтому сервер
+    forkserver заранее загружает main и workers.py (по имени, из рабочего каталога, как при
+    python3 main.py): процессы пулов создаются из него с готовыми модулями, но без потоков
+    бота. "__main__" в списке не помогает: Python 3.11 не передаёт серверу путь скрипта.
+    Сервер общий для обоих пулов, main() запускает его до приёма обновлений.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["main", "workers"])
+        return context
+    return multiprocessing.get_context("spawn")
 
-# --- Обработчики медиа (обновлено для vision) ---
-@dp.message(F.photo)
-async def photo_handler(message: types.Message):
-    user_id = message.from_user.id
-    caption = message.caption or ""
-    logger.info(f"Получено фото от user_id={user_id} с подписью: '{caption[:50]}...'" )
+class ImagePreprocessor:
+    """
+    Подготовка фото для vision-модели вне цикла событий.
 
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
-    if not db or not current_settings:
-        await message.reply("Произошла внутренняя ошибка (код 1p), попробуйте позже.")
-        return
+    При workers > 0 prepare_image выполняется в пуле процессов: декодирование и ресайз
+    фото с телефона занимают десятки миллисекунд CPU и не должны задерживать остальные
+    обновления. workers = 0 — выполнение в потоке этого процесса (для машин с одним ядром
+    и малой памятью). Процессы пула запускает main() до приёма обновлений (start), иначе
+    они запускаются на первом фото.
+    """
 
-    user_data = await get_or_create_user(
-        db, user_id, message.from_user.username,
-        message.from_user.first_name, message.from_user.last_name
-    )
-    if not user_data:
-        await message.reply("Произошла внутренняя ошибка (код 3p), попробуйте позже.")
-        return
+    def __init__(self, workers: int, max_side: int, quality: int):
+        self.workers = max(0, workers)
+        self.max_side = max_side
+        self.quality = quality
+        self._executor: concurrent.futures.ProcessPoolExecutor | None = None
+        self.processed = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds_total = 0.0
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor | None:
+        if self._executor is None and self.workers:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=worker_process_context()
+            )
+        return self._executor
+
+    def start(self):
+        """Запускает процессы пула заранее; ждёт загрузки модулей сервером forkserver, поэтому вызывается в потоке."""
+        executor = self._get_executor()
+        if executor is not None:
+            for _ in range(self.workers):
+                executor.submit(os.getpid)
+
+    async def prepare(self, data: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            image, size = await loop.run_in_executor(
+                self._get_executor(), prepare_image, data, self.max_side, self.quality
+            )
+        except concurrent.futures.BrokenExecutor:
+            # Процесс пула погиб (например, по памяти): следующий вызов создаст новый пул
+            self.failed += 1
+            self._executor = None
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        elapsed = time.perf_counter() - started
+        self.processed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(image)
+        self.seconds_total += elapsed
+        logger.debug(f"Фото подготовлено: {len(data)} -> {len(image)} байт, {size[0]}x{size[1]}, {elapsed * 1000:.0f} мс")
+        return image
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'saved_ratio': 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+            'avg_ms': self.seconds_total / self.processed * 1000 if self.processed else 0.0,
+        }
+
+async def download_photo(photo: types.PhotoSize, max_size: int) -> bytes:
+    """Скачивает фото потоком (кусками в буфер), не больше max_size байт."""
+    if photo.file_size and photo.file_size > max_size:
+        raise ValueError(f"Фото {photo.file_size} байт больше допустимых {max_size}")
+    buffer = await bot.download(photo, destination=io.BytesIO(), chunk_size=64 * 1024)
+    return buffer.getvalue()
+
+async def stream_vision_response(
+    client: XAIClient,
+    system_prompt: str,
+    image: bytes,
+    question: str
+) -> typing.AsyncGenerator[str, None]:
+    """
+    Ответ vision-модели на вопрос о фото (JPEG), в режиме стриминга.
 
-    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
-    if not is_allowed:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
-        await message.reply(
-            "У вас закончились бесплатные запросы на сегодня 😔\n"
-            "Лимит учитывает отправку текста, фото и документов.\n"
-            "Оформите подписку для снятия ограничений.",
-            reply_markup=kb.as_markup()
+    Запрос идёт через общий vision_async_client; повторы при обрывах выполняет сам клиент
+    OpenAI. Размыкатель client.breaker общий с текстовой моделью: при недоступном API
+    сразу бросается XAIUnavailableError.
+    """
+    breaker = client.breaker
+    breaker.before_request()
+    settled = False  # исход запроса учтён размыкателем
+    image_url = "data:image/jpeg;base64," + base64.b64encode(image).decode()
+    try:
+        stream = await vision_async_client.chat.completions.create(
+            model=XAI_VISION_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": image_url, "detail": "high"}},
+                    {"type": "text", "text": question},
+                ]},
+            ],
+            stream=True,
+            temperature=0.5,
         )
-        return
+        async with stream:
+            async for chunk in stream:
+                if not settled:
+                    breaker.record_success()
+                    settled = True
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    except APIConnectionError:
+        breaker.record_failure()
+        settled = True
+        raise
+    except APIStatusError as e:
+        if e.status_code >= 500:
+            breaker.record_failure()
+            settled = True
+        raise
+    finally:
+        if not settled:
+            breaker.release()
 
-    if caption:
-        chat_id = message.chat.id
-        user_text = caption
-        if user_id in active_requests:
-            await message.reply(
-                "Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.",
-                reply_markup=progress_keyboard(user_id)
+
+# --- Документы: извлечение текста вне цикла событий и пересказ по частям ---
+
+DOCUMENT_PAGE_BATCH = 10      # страниц PDF в одном задании пула (шаг индикатора прогресса)
+DOCUMENT_MAX_ROUNDS = 3       # уровней пересказа пересказов, дальше итог сокращается
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Вопрос к документу без подписи
+DOCUMENT_DEFAULT_PROMPT = "Кратко изложите содержание документа: главное, ключевые цифры и выводы."
+# Системный промпт для пересказа одной части документа
+DOCUMENT_SUMMARY_PROMPT = (
+    "Ты помогаешь медицинскому специалисту разобрать документ. Тебе дан фрагмент документа. "
+    "Перескажи его сжато (не больше 200 слов): ключевые факты, цифры, диагнозы, назначения "
+    "и выводы, с номерами страниц, если они указаны. Не добавляй того, чего нет в тексте."
+)
+
+def document_kind(file_name: str, mime_type: str | None) -> str | None:
+    """'pdf', 'docx' или None для неподдерживаемых документов."""
+    name = file_name.lower()
+    if mime_type == "application/pdf" or name.endswith(".pdf"):
+        return "pdf"
+    if mime_type == DOCX_MIME_TYPE or name.endswith(".docx"):
+        return "docx"
+    return None
+
+class DocumentExtractor:
+    """
+    Извлечение текста документов в пуле процессов (workers > 0) или в потоке (workers = 0).
+
+    PDF читается пачками по DOCUMENT_PAGE_BATCH страниц параллельно, после каждой пачки
+    вызывается on_progress(прочитано, всего). Процессы пула запускает main() до приёма
+    обновлений (start), иначе они запускаются на первом документе.
+    """
+
+    def __init__(self, workers: int, page_batch: int = DOCUMENT_PAGE_BATCH):
+        self.workers = max(0, workers)
+        self.page_batch = max(1, page_batch)
+        self._executor: concurrent.futures.ProcessPoolExecutor | None = None
+        self.documents = 0
+        self.failed = 0
+        self.pages = 0
+        self.seconds_total = 0.0
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor | None:
+        if self._executor is None and self.workers:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=worker_process_context()
             )
-            return
-        task = asyncio.create_task(
-            generate_response_task(message, db, current_settings, user_id, user_text, chat_id)
-        )
-        active_requests[user_id] = task
-        task.add_done_callback(lambda t: active_requests.pop(user_id, None))
-    else:
-        await message.reply(
-            "Я получил ваше фото. Вы можете задать вопрос о нем в следующем сообщении."
-        )
-    return
+        return self._executor
 
-@dp.message(F.document)
-async def document_handler(message: types.Message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    file_name = message.document.file_name or "Без имени"
-    mime_type = message.document.mime_type or "Неизвестный тип"
-    file_id = message.document.file_id
-    logger.info(f"Получен документ от user_id={user_id}: {file_name} (type: {mime_type}, file_id: {file_id})")
+    def start(self):
+        """Запускает процессы пула заранее; ждёт загрузки модулей сервером forkserver, поэтому вызывается в потоке."""
+        executor = self._get_executor()
+        if executor is not None:
+            for _ in range(self.workers):
+                executor.submit(os.getpid)
 
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
-    if not db or not current_settings:
-        await message.reply("Произошла внутренняя ошибка (код 1d), попробуйте позже.")
-        return
+    async def _run(self, fn, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        except concurrent.futures.BrokenExecutor:
+            # Процесс пула погиб (например, по памяти): следующий вызов создаст новый пул
+            self._executor = None
+            raise
 
-    user_data = await get_or_create_user(db, user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
-    if not user_data:
-        await message.reply("Произошла внутренняя ошибка (код 3d), попробуйте позже.")
-        return
+    async def extract(
+        self,
+        path: str,
+        kind: str,
+        max_pages: int,
+        on_progress: typing.Callable[[int, int], None] | None = None
+    ) -> tuple[list[str], int]:
+        """Текст по страницам (не больше max_pages) и общее число страниц документа."""
+        started = time.perf_counter()
+        try:
+            if kind == "docx":
+                pages = await self._run(extract_docx_text, path)
+                total = len(pages)
+            else:
+                total = await self._run(count_pdf_pages, path)
+                pages = await self._extract_pdf(path, min(total, max_pages), on_progress)
+        except DocumentError:
+            self.failed += 1
+            raise
+        except Exception as e:
+            self.failed += 1
+            raise DocumentError("Не удалось прочитать документ, возможно, файл повреждён.") from e
+        self.documents += 1
+        self.pages += len(pages)
+        self.seconds_total += time.perf_counter() - started
+        return pages, total
+
+    async def _extract_pdf(self, path: str, count: int, on_progress) -> list[str]:
+        pages: list[str] = [""] * count
+
+        async def _batch(start: int) -> int:
+            texts = await self._run(extract_pdf_pages, path, start, min(start + self.page_batch, count))
+            pages[start:start + len(texts)] = texts
+            return len(texts)
+
+        tasks = [asyncio.create_task(_batch(start)) for start in range(0, count, self.page_batch)]
+        done = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                done += await next_done
+                if on_progress:
+                    on_progress(done, count)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return pages
+
+    async def hash(self, path: str) -> str:
+        """SHA-256 содержимого файла (ключ кэша документов)."""
+        return await self._run(file_sha256, path)
+
+    async def chunk(self, pages: list[str], max_tokens: int) -> list[str]:
+        """chunk_document в пуле: на сотнях страниц подсчёт токенов занимает сотни миллисекунд."""
+        return await self._run(chunk_document, pages, max_tokens)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            'documents': self.documents,
+            'failed': self.failed,
+            'pages': self.pages,
+            'pages_per_sec': self.pages / self.seconds_total if self.seconds_total else 0.0,
+        }
+
+async def download_document(document: types.Document, path: str, max_size: int):
+    """Скачивает документ потоком прямо в файл path, не держа его целиком в памяти."""
+    if document.file_size and document.file_size > max_size:
+        raise DocumentError(f"Файл больше {max_size // (1024 * 1024)} МБ.")
+    await bot.download(document, destination=path, timeout=120, chunk_size=256 * 1024)
+
+async def condense_document(
+    client: XAIClient,
+    chunks: list[str],
+    title: str,
+    concurrency: int,
+    chunk_tokens: int,
+    on_progress: typing.Callable[[str], None] | None = None
+) -> tuple[list[str], str]:
+    """
+    Сжимает документ до текста не больше chunk_tokens: пересказы частей первого уровня и итог.
 
-    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
-    if not is_allowed:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
-        await message.reply(
-            "У вас закончились бесплатные запросы на сегодня 😔\n"
-            "Лимит учитывает отправку текста, фото и документов.\n"
-            "Оформите подписку для снятия ограничений.",
-            reply_markup=kb.as_markup()
-        )
-        return
+    Части пересказываются параллельно (не больше concurrency запросов сразу); если
+    пересказы вместе не помещаются в chunk_tokens, они снова делятся на части и
+    пересказываются. Документ из одной части возвращается как есть.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    first_level: list[str] = []
+    for level in range(DOCUMENT_MAX_ROUNDS):
+        if len(chunks) <= 1:
+            break
+        done = 0
+
+        async def _summarize(chunk: str) -> str:
+            nonlocal done
+            async with semaphore:
+                parts = [piece async for piece in stream_xai_response(
+                    client, DOCUMENT_SUMMARY_PROMPT, [{"role": "user", "content": chunk}]
+                )]
+            done += 1
+            if on_progress:
+                on_progress(f"🧠 Анализирую документ: часть {done} из {len(chunks)}")
+            return "".join(parts)
+
+        tasks = [asyncio.create_task(_summarize(chunk)) for chunk in chunks]
+        try:
+            summaries = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        logger.info(f"Документ «{title}»: уровень {level + 1}, {len(chunks)} частей пересказано")
+        if not first_level:
+            first_level = summaries
+        chunks = chunk_document(summaries, chunk_tokens, label="часть")
+    text = "\n\n".join(chunks)
+    tokens = count_tokens(text)
+    if tokens > chunk_tokens:
+        text = truncate_message(text, tokens, chunk_tokens)
+    return first_level, text
+
+async def summarize_document(
+    client: XAIClient,
+    chunks: list[str],
+    question: str,
+    title: str,
+    concurrency: int,
+    chunk_tokens: int,
+    on_progress: typing.Callable[[str], None] | None = None,
+    digest: str | None = None,
+    on_condensed: typing.Callable[[list[str], str, float], typing.Awaitable[None]] | None = None
+) -> typing.AsyncGenerator[str, None]:
+    """
+    Ответ на вопрос по документу: map-reduce по частям (condense_document), итог в режиме стриминга.
 
-    logger.info(f"Пользователь {user_id} допущен к обработке документа '{file_name}' (лимит OK).")
-    await message.reply(f"⏳ Начинаю обработку документа '{file_name}'...")
-    # Ваш код обработки документа здесь
+    Если digest уже известен (документ из кэша), части заново не пересказываются —
+    выполняется только итоговый запрос. Иначе после сжатия вызывается
+    on_condensed(пересказы частей, digest, секунды) для сохранения в кэш.
+    """
+    if digest is None:
+        started = time.monotonic()
+        summaries, digest = await condense_document(client, chunks, title, concurrency, chunk_tokens, on_progress)
+        if on_condensed:
+            await on_condensed(summaries, digest, time.monotonic() - started)
+    if on_progress:
+        on_progress("✍️ Формирую ответ...")
+    prompt = f"{question}\n\nДокумент «{title}»:\n\n{digest}"
+    async for piece in stream_xai_response(client, SYSTEM_PROMPT, [{"role": "user", "content": prompt}]):
+        yield piece
+
+
+# --- Кэш извлечённого текста и пересказов документов ---
+
+def document_cache_version(chunk_tokens: int, max_pages: int) -> str:
+    """Записи другой версии (модель, промпт пересказа, размер части, лимит страниц) не используются."""
+    source = f"{XAI_CHAT_MODEL}\n{DOCUMENT_SUMMARY_PROMPT}\n{chunk_tokens}\n{max_pages}"
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+_DOCUMENT_CACHE_COLUMNS = "c.content_hash, c.file_name, c.pages, c.total_pages, c.chunks, c.digest, c.build_seconds"
+
+def _document_cache_row(row) -> dict:
+    entry = dict(row)
+    entry["chunks"] = json.loads(entry["chunks"])
+    return entry
+
+async def get_cached_document(db, version: str, file_unique_id: str | None = None, content_hash: str | None = None) -> dict | None:
+    """Запись кэша по file_unique_id или по хэшу содержимого; отмечает попадание."""
+    now = time.time()
+    if file_unique_id is not None:
+        where, key = "c.content_hash = (SELECT content_hash FROM document_files WHERE file_unique_id = {})", file_unique_id
+    else:
+        where, key = "c.content_hash = {}", content_hash
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            row = conn.execute(
+                f"SELECT {_DOCUMENT_CACHE_COLUMNS} FROM document_cache c WHERE {where.format('?')} AND c.version = ?",
+                (key, version)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE document_cache SET hits = hits + 1, last_hit_at = ? WHERE content_hash = ?", (now, row["content_hash"])
+                )
+            return _document_cache_row(row) if row else None
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(
+                f"""UPDATE document_cache c SET hits = c.hits + 1, last_hit_at = $3
+                    WHERE {where.format('$1')} AND c.version = $2
+                    RETURNING {_DOCUMENT_CACHE_COLUMNS}""",
+                key, version, now
+            )
+            return _document_cache_row(row) if row else None
 
-# --- Обработчики для кнопок меню ReplyKeyboardMarkup
-@dp.message(F.text == "🔄 Новый диалог")
-async def handle_new_dialog_button(message: types.Message):
-    # Просто вызываем существующий обработчик команды /clear
-    await clear_command_handler(message)
+async def add_document_alias(db, file_unique_id: str, content_hash: str):
+    """Связывает file_unique_id с уже сохранённым содержимым (тот же файл, загруженный заново)."""
+    if settings.USE_SQLITE:
+        await db.run(lambda conn: conn.execute(
+            """INSERT INTO document_files (file_unique_id, content_hash) VALUES (?, ?)
+               ON CONFLICT(file_unique_id) DO UPDATE SET content_hash = excluded.content_hash""",
+            (file_unique_id, content_hash)
+        ))
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO document_files (file_unique_id, content_hash) VALUES ($1, $2)
+                   ON CONFLICT (file_unique_id) DO UPDATE SET content_hash = excluded.content_hash""",
+                file_unique_id, content_hash
+            )
 
-@dp.message(F.text == "📊 Мои лимиты")
-async def handle_my_limits_button(message: types.Message):
-    user_id = message.from_user.id
-    db = dp.workflow_data.get('db')
-    if not db:
-        await message.reply("Ошибка получения данных.")
-        return
-    user_data = await get_user(db, user_id)
-    if not user_data:
-        await message.reply("Не удалось найти ваши данные.")
-        return
-    limit_info = f"Осталось бесплатных сообщений сегодня: {user_data.get('free_messages_today', 'N/A')}"
-    sub_info = "Подписка: неактивна"
-    if user_data.get('subscription_status') == 'active':
-        expires_ts = user_data.get('subscription_expires')
-        if isinstance(expires_ts, datetime.datetime):
-            expires_str = expires_ts.strftime('%Y-%m-%d %H:%M')
-            sub_info = f"Подписка активна до: {expires_str}"
-        else:
-            sub_info = f"Подписка активна до: {expires_ts}"
-    await message.reply(f"Информация о ваших лимитах:\n\n{limit_info}\n{sub_info}")
+async def store_cached_document(
+    db, version: str, content_hash: str, file_unique_id: str, file_name: str,
+    pages: int, total_pages: int, chunks: list[str], build_seconds: float
+):
+    """Сохраняет текст документа, разделённый на части (пересказы добавляет store_document_digest)."""
+    now = time.time()
+    chunks_json = json.dumps(chunks, ensure_ascii=False)
+    size = len(chunks_json.encode())
+    if settings.USE_SQLITE:
+        def _store(conn: sqlite3.Connection):
+            conn.execute(
+                """INSERT INTO document_cache (content_hash, version, file_name, pages, total_pages, chunks,
+                                               summaries, digest, size_bytes, build_seconds, created_at, last_hit_at, hits)
+                   VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, ?, ?, ?, 0)
+                   ON CONFLICT(content_hash) DO UPDATE SET version = excluded.version, file_name = excluded.file_name,
+                       pages = excluded.pages, total_pages = excluded.total_pages, chunks = excluded.chunks,
+                       summaries = NULL, digest = NULL, size_bytes = excluded.size_bytes,
+                       build_seconds = excluded.build_seconds, created_at = excluded.created_at,
+                       last_hit_at = excluded.last_hit_at, hits = 0""",
+                (content_hash, version, file_name, pages, total_pages, chunks_json, size, build_seconds, now, now)
+            )
+            conn.execute(
+                """INSERT INTO document_files (file_unique_id, content_hash) VALUES (?, ?)
+                   ON CONFLICT(file_unique_id) DO UPDATE SET content_hash = excluded.content_hash""",
+                (file_unique_id, content_hash)
+            )
+        await db.run(_store)
+    else:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """INSERT INTO document_cache (content_hash, version, file_name, pages, total_pages, chunks,
+                                                   summaries, digest, size_bytes, build_seconds, created_at, last_hit_at, hits)
+                       VALUES ($1, $2, $3, $4, $5, $6, NULL, NULL, $7, $8, $9, $9, 0)
+                       ON CONFLICT (content_hash) DO UPDATE SET version = excluded.version, file_name = excluded.file_name,
+                           pages = excluded.pages, total_pages = excluded.total_pages, chunks = excluded.chunks,
+                           summaries = NULL, digest = NULL, size_bytes = excluded.size_bytes,
+                           build_seconds = excluded.build_seconds, created_at = excluded.created_at,
+                           last_hit_at = excluded.last_hit_at, hits = 0""",
+                    content_hash, version, file_name, pages, total_pages, chunks_json, size, build_seconds, now
+                )
+                await conn.execute(
+                    """INSERT INTO document_files (file_unique_id, content_hash) VALUES ($1, $2)
+                       ON CONFLICT (file_unique_id) DO UPDATE SET content_hash = excluded.content_hash""",
+                    file_unique_id, content_hash
+                )
 
-@dp.message(F.text == "💎 Подписка")
-async def handle_subscription_button(message: types.Message):
-    # Заглушка раздела подписки
-    await message.reply(
-        "Раздел 'Подписка'.\n\n"
-        "Доступные тарифы:\n- 7 дней / 100 руб.\n- 30 дней / 300 руб.\n\n"
-        "(Функционал оплаты будет добавлен позже)"
-    )
+async def store_document_digest(db, content_hash: str, summaries: list[str], digest: str, seconds: float):
+    """Добавляет к записи пересказы частей и сжатый текст для итогового ответа."""
+    summaries_json = json.dumps(summaries, ensure_ascii=False)
+    extra = len(summaries_json.encode()) + len(digest.encode())
+    if settings.USE_SQLITE:
+        await db.run(lambda conn: conn.execute(
+            """UPDATE document_cache SET summaries = ?, digest = ?, size_bytes = size_bytes + ?,
+                   build_seconds = build_seconds + ?
+               WHERE content_hash = ? AND digest IS NULL""",
+            (summaries_json, digest, extra, seconds, content_hash)
+        ))
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(
+                """UPDATE document_cache SET summaries = $1, digest = $2, size_bytes = size_bytes + $3,
+                       build_seconds = build_seconds + $4
+                   WHERE content_hash = $5 AND digest IS NULL""",
+                summaries_json, digest, extra, seconds, content_hash
+            )
 
-@dp.message(F.text == "🆘 Помощь")
-async def handle_help_button(message: types.Message):
-    help_text = (
-        "<b>Помощь по боту:</b>\n\n"
-        "🤖 Я первый \"умный\" и бесплатный AI ассистент.\n"
-        "❓ Просто напишите ваш вопрос, и я постараюсь ответить.\n"
-        "🔄 Используйте кнопку \"Новый диалог\" или команду /clear, чтобы очистить историю и начать разговор с чистого листа.\n"
-        "📊 Кнопка \"Мои лимиты\" покажет, сколько бесплатных сообщений у вас осталось сегодня или до какого числа действует подписка.\n"
-        "💎 Кнопка \"Подписка\" расскажет о платных тарифах для снятия лимитов."
-    )
-    await message.reply(help_text, reply_markup=main_menu_keyboard())
+async def prune_document_cache(db, version: str, max_entries: int, max_bytes: int) -> int:
+    """
+    Удаляет записи другой версии и давно не запрошенные сверх max_entries или max_bytes
+    (по сумме size_bytes от самых свежих); возвращает число удалённых документов.
+    """
+    if settings.USE_SQLITE:
+        def _prune(conn: sqlite3.Connection):
+            deleted = conn.execute("DELETE FROM document_cache WHERE version <> ?", (version,)).rowcount
+            deleted += conn.execute(
+                """DELETE FROM document_cache WHERE content_hash IN (
+                       SELECT content_hash FROM (
+                           SELECT content_hash,
+                                  ROW_NUMBER() OVER (ORDER BY last_hit_at DESC) AS position,
+                                  SUM(size_bytes) OVER (ORDER BY last_hit_at DESC ROWS UNBOUNDED PRECEDING) AS total
+                           FROM document_cache
+                       ) WHERE position > ? OR total > ?
+                   )""",
+                (max_entries, max_bytes)
+            ).rowcount
+            conn.execute("DELETE FROM document_files WHERE content_hash NOT IN (SELECT content_hash FROM document_cache)")
+            return deleted
+        return await db.run(_prune)
+    else:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                stale = await conn.execute("DELETE FROM document_cache WHERE version <> $1", version)
+                evicted = await conn.execute(
+                    """DELETE FROM document_cache WHERE content_hash IN (
+                           SELECT content_hash FROM (
+                               SELECT content_hash,
+                                      ROW_NUMBER() OVER (ORDER BY last_hit_at DESC) AS position,
+                                      SUM(size_bytes) OVER (ORDER BY last_hit_at DESC ROWS UNBOUNDED PRECEDING) AS total
+                               FROM document_cache
+                           ) ranked WHERE position > $1 OR total > $2
+                       )""",
+                    max_entries, max_bytes
+                )
+                await conn.execute(
+                    "DELETE FROM document_files f WHERE NOT EXISTS (SELECT 1 FROM document_cache c WHERE c.content_hash = f.content_hash)"
+                )
+            return int(stale.split()[-1]) + int(evicted.split()[-1])
 
-@dp.message(F.text == "❓ Задать вопрос")
-async def handle_ask_question_button(message: types.Message):
-    await message.reply("Просто напишите ваш вопрос в чат 👇", reply_markup=main_menu_keyboard())
+class DocumentCache:
+    """
+    Кэш документов в общей БД: текст, разделённый на части, пересказы частей и сжатый
+    текст (digest), по которому строится итоговый ответ.
+
+    Ключ — хэш содержимого; file_unique_id Telegram ссылается на него через document_files.
+    Повторно присланный файл (тот же file_unique_id) не скачивается и не читается, а при
+    готовом digest выполняется только итоговый запрос под новый вопрос. Тот же документ,
+    загруженный заново (новый file_unique_id), узнаётся по хэшу после скачивания.
+    Раз в prune_interval удаляются записи старой версии и давно не запрошенные сверх
+    max_entries / max_bytes. Считает попадания и сэкономленное время для /stats.
+    """
 
-@dp.message(F.text == "📸 Генерация фото")
-async def handle_generate_photo_button(message: types.Message):
-    user_id = message.from_user.id
-    pending_photo_prompts.add(user_id)
-    await message.reply("Напишите запрос для генерации фото (опишите, что хотите увидеть)", reply_markup=main_menu_keyboard())
+    def __init__(self, db, version: str, max_entries: int, max_bytes: int, prune_interval: float = 600.0):
+        self.db = db
+        self.version = version
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.file_hits = 0      # по file_unique_id: без скачивания и извлечения
+        self.content_hits = 0   # по хэшу содержимого: без извлечения
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.saved_seconds = 0.0
+
+    async def lookup_file(self, file_unique_id: str) -> dict | None:
+        try:
+            entry = await get_cached_document(self.db, self.version, file_unique_id=file_unique_id)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша документов: {e}")
+            return None
+        if entry:
+            self.file_hits += 1
+            self.saved_seconds += entry["build_seconds"]
+        return entry
+
+    async def lookup_content(self, content_hash: str, file_unique_id: str, spent: float) -> dict | None:
+        """Запись по хэшу содержимого; spent — время, уже потраченное на скачивание и хэш."""
+        try:
+            entry = await get_cached_document(self.db, self.version, content_hash=content_hash)
+            if entry:
+                await add_document_alias(self.db, file_unique_id, content_hash)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша документов: {e}")
+            entry = None
+        if entry:
+            self.content_hits += 1
+            self.saved_seconds += max(0.0, entry["build_seconds"] - spent)
+        else:
+            self.misses += 1
+        return entry
 
-# --- Функции запуска и остановки ---
+    async def store(self, content_hash: str, file_unique_id: str, file_name: str,
+                    pages: int, total_pages: int, chunks: list[str], build_seconds: float):
+        try:
+            await store_cached_document(
+                self.db, self.version, content_hash, file_unique_id, file_name, pages, total_pages, chunks, build_seconds
+            )
+            self.stored += 1
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш документов: {e}")
 
-# Восстанавливаем функцию on_shutdown
-async def on_shutdown(**kwargs):
-    logger.info("Завершение работы бота...")
-    # Получаем dp и из него workflow_data
-    dp_local = kwargs.get('dispatcher') # aiogram передает dispatcher
-    if not dp_local:
-        logger.error("Не удалось получить dispatcher в on_shutdown")
-        return
+    async def store_digest(self, content_hash: str, summaries: list[str], digest: str, seconds: float):
+        try:
+            await store_document_digest(self.db, content_hash, summaries, digest, seconds)
+        except Exception as e:
+            logger.error(f"Ошибка записи пересказов в кэш документов: {e}")
 
-    db = dp_local.workflow_data.get('db')
-    settings_local = dp_local.workflow_data.get('settings')
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
 
-    if db and settings_local:
-        if not settings_local.USE_SQLITE:
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
             try:
-                # db здесь это пул соединений asyncpg
-                if isinstance(db, asyncpg.Pool):
-                    await db.close()
-                    logger.info("Пул соединений PostgreSQL успешно закрыт")
-                else:
-                    logger.warning("Объект 'db' не является пулом asyncpg, закрытие не выполнено.")
+                deleted = await prune_document_cache(self.db, self.version, self.max_entries, self.max_bytes)
+                self.evicted += deleted
+                if deleted:
+                    logger.info(f"Из кэша документов удалено записей: {deleted}")
             except Exception as e:
-                logger.error(f"Ошибка при закрытии пула соединений PostgreSQL: {e}")
-        else:
-            logger.info("Используется SQLite, явное закрытие пула не требуется.")
-    else:
-         logger.warning("Не удалось получить 'db' или 'settings' из workflow_data при завершении работы.")
+                logger.exception(f"Ошибка очистки кэша документов: {e}")
+            await asyncio.sleep(self.prune_interval)
+
+    def stats(self) -> dict[str, float]:
+        hits = self.file_hits + self.content_hits
+        total = hits + self.misses
+        return {
+            'file_hits': self.file_hits,
+            'content_hits': self.content_hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'hit_rate': hits / total if total else 0.0,
+            'saved_seconds': self.saved_seconds,
+            'saved_avg': self.saved_seconds / hits if hits else 0.0,
+        }
+
+async def load_document(
+    document: types.Document,
+    current_settings: Settings,
+    extractor: DocumentExtractor,
+    document_cache: DocumentCache | None,
+    on_progress: typing.Callable[[str], None] | None = None
+) -> dict:
+    """
+    Текст документа, разделённый на части, из кэша или после скачивания и извлечения.
 
-    logger.info("Бот остановлен.")
+    Возвращает content_hash, chunks, pages, total_pages и digest (None, если документ
+    ещё не пересказан). Новый документ сохраняется в document_cache.
+    """
+    file_name = document.file_name or "Без имени"
+    started = time.monotonic()
+    if document_cache:
+        entry = await document_cache.lookup_file(document.file_unique_id)
+        if entry:
+            logger.info(f"Документ «{file_name}» из кэша по file_unique_id ({entry['pages']} стр.)")
+            return entry
+    fd, path = tempfile.mkstemp(prefix="tgdoc-", suffix=os.path.splitext(file_name)[1])
+    os.close(fd)
+    try:
+        await download_document(document, path, current_settings.DOCUMENT_MAX_FILE_SIZE)
+        content_hash = await extractor.hash(path)
+        if document_cache:
+            entry = await document_cache.lookup_content(content_hash, document.file_unique_id, time.monotonic() - started)
+            if entry:
+                logger.info(f"Документ «{file_name}» из кэша по содержимому ({entry['pages']} стр.)")
+                return entry
+        pages, total_pages = await extractor.extract(
+            path,
+            document_kind(file_name, document.mime_type),
+            current_settings.DOCUMENT_MAX_PAGES,
+            on_progress=lambda done, count: on_progress(f"📄 Читаю документ: страница {done} из {count}") if on_progress else None
+        )
+    finally:
+        os.unlink(path)
+    chunks = await extractor.chunk(pages, current_settings.DOCUMENT_CHUNK_TOKENS)
+    if not chunks:
+        raise DocumentError("В документе не найден текст (возможно, это скан без текстового слоя).")
+    if document_cache:
+        await document_cache.store(
+            content_hash, document.file_unique_id, file_name, len(pages), total_pages, chunks, time.monotonic() - started
+        )
+    return {
+        "content_hash": content_hash,
+        "file_name": file_name,
+        "pages": len(pages),
+        "total_pages": total_pages,
+        "chunks": chunks,
+        "digest": None,
+    }
 
 
-# --- Установка команд бота (если еще не сделано) ---
-async def set_bot_commands(bot_instance: Bot):
-    commands = [
-        types.BotCommand(command="/start", description="Начать диалог / Показать меню"),
-        types.BotCommand(command="/clear", description="Очистить историю диалога"),
-        # Админ-панель
-        types.BotCommand(command="/admin", description="Список команд администратора"),
-        types.BotCommand(command="/stats", description="Показать статистику бота"),
-        types.BotCommand(command="/find_user", description="Поиск пользователя по ID или username"),
-        types.BotCommand(command="/list_subs", description="Список пользователей по подписке"),
-        types.BotCommand(command="/grant_admin", description="Выдать права администратора"),
-        types.BotCommand(command="/grant_sub", description="Выдать подписку на 7 или 30 дней"),
-        types.BotCommand(command="/send_to_user", description="Отправить сообщение конкретному пользователю"),
-        types.BotCommand(command="/broadcast", description="Рассылка сообщения всем пользователям"),
-    ]
-    try:
-        await bot_instance.set_my_commands(commands)
-        logger.info("Команды бота успешно установлены.")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка при установке команд бота: {e}")
+# --- Кэш сгенерированных изображений: запрос -> file_id в Telegram ---
 
-# --- Главная функция запуска ---
-async def main():
-    logger.info(f"Запуск приложения с настройками базы данных: {settings.DATABASE_URL}")
-    db_connection = None # Переименуем, чтобы не конфликтовать с именем модуля
+async def get_cached_image(db, key: str) -> str | None:
+    """file_id ранее отправленного изображения; отмечает попадание."""
+    now = time.time()
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            row = conn.execute("SELECT file_id FROM image_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE image_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, key))
+            return row[0] if row else None
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            return await conn.fetchval(
+                "UPDATE image_cache SET hits = hits + 1, last_hit_at = $2 WHERE key = $1 RETURNING file_id", key, now
+            )
 
-    try:
-        # Выбор типа БД на основе URL из настроек
-        if settings.USE_SQLITE:
-            logger.info("Используется SQLite для хранения данных")
-            db_connection = await init_sqlite_db(settings.DATABASE_URL) # Возвращает путь
+async def store_cached_image(db, key: str, prompt: str, file_id: str):
+    now = time.time()
+    if settings.USE_SQLITE:
+        await db.run(lambda conn: conn.execute(
+            """INSERT INTO image_cache (key, prompt, file_id, created_at, last_hit_at, hits)
+               VALUES (?, ?, ?, ?, ?, 0)
+               ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id, created_at = excluded.created_at,
+                   last_hit_at = excluded.last_hit_at, hits = 0""",
+            (key, prompt, file_id, now, now)
+        ))
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO image_cache (key, prompt, file_id, created_at, last_hit_at, hits)
+                   VALUES ($1, $2, $3, $4, $4, 0)
+                   ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id, created_at = excluded.created_at,
+                       last_hit_at = excluded.last_hit_at, hits = 0""",
+                key, prompt, file_id, now
+            )
+
+async def delete_cached_image(db, key: str):
+    if settings.USE_SQLITE:
+        await db.run(lambda conn: conn.execute("DELETE FROM image_cache WHERE key = ?", (key,)))
+    else:
+        async with db.acquire() as conn:
+            await conn.execute("DELETE FROM image_cache WHERE key = $1", key)
+
+async def prune_image_cache(db, max_entries: int) -> int:
+    """Удаляет давно не запрошенные изображения сверх max_entries; возвращает число удалённых."""
+    if settings.USE_SQLITE:
+        return await db.run(lambda conn: conn.execute(
+            "DELETE FROM image_cache WHERE key IN (SELECT key FROM image_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?)",
+            (max_entries,)
+        ).rowcount)
+    else:
+        async with db.acquire() as conn:
+            result = await conn.execute(
+                "DELETE FROM image_cache WHERE key IN (SELECT key FROM image_cache ORDER BY last_hit_at DESC OFFSET $1)",
+                max_entries
+            )
+            return int(result.split()[-1])
+
+class ImageCache:
+    """
+    Кэш сгенерированных изображений в общей БД: нормализованный запрос -> file_id фото,
+    уже загруженного в Telegram.
+
+    Повторный запрос отвечается отправкой file_id — без генерации и без повторной загрузки.
+    Ключ зависит от модели (XAI_IMAGE_MODEL). Раз в prune_interval давно не запрошенные
+    записи сверх max_entries удаляются. Считает попадания и время ответа для /stats.
+    """
+
+    def __init__(self, db, max_entries: int, prune_interval: float = 600.0):
+        self.db = db
+        self.max_entries = max(1, max_entries)
+        self.prune_interval = prune_interval
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.stale = 0      # file_id больше не принимается Telegram
+        self.evicted = 0
+        self._latencies = {True: collections.deque(maxlen=1000), False: collections.deque(maxlen=1000)}
+
+    @staticmethod
+    def key_for(prompt: str) -> str | None:
+        normalized = normalize_question(prompt)
+        if not normalized:
+            return None
+        return hashlib.sha256(f"{XAI_IMAGE_MODEL}\n{normalized}".encode()).hexdigest()
+
+    async def lookup(self, key: str) -> str | None:
+        try:
+            file_id = await get_cached_image(self.db, key)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша изображений: {e}")
+            file_id = None
+        if file_id is None:
+            self.misses += 1
         else:
-            logger.info("Используется PostgreSQL для хранения данных")
-            # Попытка подключения с таймаутом и обработкой ошибок
+            self.hits += 1
+        return file_id
+
+    async def store(self, key: str, prompt: str, file_id: str):
+        try:
+            await store_cached_image(self.db, key, prompt, file_id)
+            self.stored += 1
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш изображений: {e}")
+
+    async def forget(self, key: str):
+        self.stale += 1
+        try:
+            await delete_cached_image(self.db, key)
+        except Exception as e:
+            logger.error(f"Ошибка удаления из кэша изображений: {e}")
+
+    def record_latency(self, hit: bool, seconds: float):
+        """Время от запроса до отправленного фото."""
+        self._latencies[hit].append(seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
             try:
-                logger.info(f"Подключение к PostgreSQL: {settings.DATABASE_URL}")
-                # Увеличим таймауты для create_pool
-                db_connection = await asyncio.wait_for(
-                    asyncpg.create_pool(dsn=settings.DATABASE_URL, timeout=30.0, command_timeout=60.0, min_size=1, max_size=10),
-                    timeout=45.0 # Общий таймаут на создание пула
+                deleted = await prune_image_cache(self.db, self.max_entries)
+                self.evicted += deleted
+                if deleted:
+                    logger.info(f"Из кэша изображений удалено записей: {deleted}")
+            except Exception as e:
+                logger.exception(f"Ошибка очистки кэша изображений: {e}")
+            await asyncio.sleep(self.prune_interval)
+
+    def stats(self) -> dict[str, float]:
+        def _p50(hit: bool) -> float:
+            values = sorted(self._latencies[hit])
+            return values[len(values) // 2] if values else 0.0
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'stale': self.stale,
+            'evicted': self.evicted,
+            'hit_rate': self.hits / total if total else 0.0,
+            'hit_p50': _p50(True),
+            'miss_p50': _p50(False),
+        }
+
+
+# --- Кэш ответов на типовые вопросы ---
+
+# Ключ кэша зависит от модели и системного промпта: после их изменения старые ответы не используются
+RESPONSE_CACHE_VERSION = hashlib.sha256(f"{XAI_CHAT_MODEL}\n{SYSTEM_PROMPT}".encode()).hexdigest()[:16]
+RESPONSE_CACHE_MAX_QUESTION = 500      # более длинные вопросы почти не повторяются — не кэшируем
+RESPONSE_CACHE_REPLAY_CHUNK = 256      # размер фрагмента при проигрывании ответа из кэша, символов
+# Слова, числа вида 5.5, 120/80, 7% и знаки сравнения (вопросы про "< 7%" и "> 7%" различаются)
+_QUESTION_TOKEN = re.compile(r"\w+(?:[.,/:]\w+)*%?|[<>=≤≥±+-]")
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к виду для ключа кэша: регистр, ё/е, пробелы и пунктуация не важны."""
+    text = unicodedata.normalize("NFKC", text).lower().replace("ё", "е")
+    return " ".join(_QUESTION_TOKEN.findall(text))
+
+async def get_cached_response(db, key: str, created_after: float) -> str | None:
+    """Ответ из кэша, если он не старше created_after; отмечает попадание."""
+    now = time.time()
+    if settings.USE_SQLITE:
+        def _get(conn: sqlite3.Connection):
+            row = conn.execute(
+                "SELECT response FROM response_cache WHERE key = ? AND created_at >= ?", (key, created_after)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE response_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, key))
+            return row[0] if row else None
+        return await db.run(_get)
+    else:
+        async with db.acquire() as conn:
+            return await conn.fetchval(
+                "UPDATE response_cache SET hits = hits + 1, last_hit_at = $3 WHERE key = $1 AND created_at >= $2 RETURNING response",
+                key, created_after, now
+            )
+
+async def store_cached_response(db, key: str, question: str, response: str):
+    now = time.time()
+    if settings.USE_SQLITE:
+        def _store(conn: sqlite3.Connection):
+            conn.execute(
+                """INSERT INTO response_cache (key, prompt_version, question, response, created_at, last_hit_at, hits)
+                   VALUES (?, ?, ?, ?, ?, ?, 0)
+                   ON CONFLICT(key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at,
+                       last_hit_at = excluded.last_hit_at, hits = 0""",
+                (key, RESPONSE_CACHE_VERSION, question, response, now, now)
+            )
+        await db.run(_store)
+    else:
+        async with db.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO response_cache (key, prompt_version, question, response, created_at, last_hit_at, hits)
+                   VALUES ($1, $2, $3, $4, $5, $5, 0)
+                   ON CONFLICT (key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at,
+                       last_hit_at = excluded.last_hit_at, hits = 0""",
+                key, RESPONSE_CACHE_VERSION, question, response, now
+            )
+
+async def prune_response_cache(db, created_before: float, max_entries: int) -> int:
+    """Удаляет просроченные ответы и давно не запрошенные сверх max_entries; возвращает число удалённых."""
+    if settings.USE_SQLITE:
+        def _prune(conn: sqlite3.Connection):
+            deleted = conn.execute("DELETE FROM response_cache WHERE created_at < ?", (created_before,)).rowcount
+            deleted += conn.execute(
+                "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?)",
+                (max_entries,)
+            ).rowcount
+            return deleted
+        return await db.run(_prune)
+    else:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                expired = await conn.execute("DELETE FROM response_cache WHERE created_at < $1", created_before)
+                evicted = await conn.execute(
+                    "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_hit_at DESC OFFSET $1)",
+                    max_entries
                 )
-                if not db_connection:
-                    logger.error("Не удалось создать пул соединений PostgreSQL (вернулся None)")
-                    sys.exit(1)
+            return int(expired.split()[-1]) + int(evicted.split()[-1])
 
-                logger.info("Пул соединений PostgreSQL успешно создан")
-                # Проверим соединение и инициализируем таблицу
-                await init_db_postgres(db_connection)
+async def replay_cached_response(text: str, chunk_size: int = RESPONSE_CACHE_REPLAY_CHUNK) -> typing.AsyncGenerator[str, None]:
+    """Отдаёт сохранённый ответ фрагментами, как stream_xai_response, чтобы он прошёл тот же путь вывода."""
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+        await asyncio.sleep(0)
 
-            except asyncio.TimeoutError:
-                logger.error("Превышен таймаут подключения к базе данных PostgreSQL")
-                sys.exit(1)
-            except (socket.gaierror, OSError) as e: # Ошибки сети/DNS
-                logger.error(f"Ошибка сети или DNS при подключении к PostgreSQL: {e}. Проверьте хост/порт в DATABASE_URL.")
-                sys.exit(1)
-            except asyncpg.exceptions.InvalidPasswordError:
-                 logger.error("Ошибка аутентификации PostgreSQL: неверный пароль.")
-                 sys.exit(1)
-            except asyncpg.exceptions.InvalidCatalogNameError as e: # Добавляем обработку InvalidCatalogNameError
-                 logger.error(f"Ошибка PostgreSQL: база данных, указанная в URL, не найдена. {e}")
-                 sys.exit(1)
-            except asyncpg.PostgresError as e:
-                logger.error(f"Общая ошибка PostgreSQL при подключении/инициализации: {e}")
-                sys.exit(1)
+class ResponseCache:
+    """
+    Кэш ответов на повторяющиеся вопросы (дозировки, нормы анализов) в общей БД.
 
-        # Сохраняем зависимости (путь к SQLite или пул PG) в workflow_data
-        dp.workflow_data['db'] = db_connection
-        dp.workflow_data['settings'] = settings
-        logger.info("Зависимости DB и Settings успешно сохранены в dispatcher")
+    Применяется только к вопросу без предыдущего контекста: в истории нет ничего,
+    кроме самого вопроса, иначе ответ зависел бы от диалога. Ключ — нормализованный
+    вопрос и RESPONSE_CACHE_VERSION (модель + системный промпт). Ответ живёт ttl
+    секунд; раз в prune_interval просроченные и давно не запрошенные сверх
+    max_entries удаляются. Считает попадания/промахи и время ответа для /stats.
+    """
 
-        # Регистрация обработчиков (декораторы уже сделали это)
-        logger.info("Обработчики команд и сообщений зарегистрированы")
+    def __init__(self, db, ttl: float, max_entries: int, prune_interval: float = 300.0):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.prune_interval = prune_interval
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0   # вопрос с контекстом или слишком длинный
+        self.stored = 0
+        self.evicted = 0
+        self._latencies = {True: collections.deque(maxlen=1000), False: collections.deque(maxlen=1000)}
+
+    @staticmethod
+    def key_for(question: str) -> str | None:
+        """Ключ для вопроса без контекста или None, если вопрос не кэшируется."""
+        if len(question) > RESPONSE_CACHE_MAX_QUESTION:
+            return None
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        return hashlib.sha256(f"{RESPONSE_CACHE_VERSION}\n{normalized}".encode()).hexdigest()
+
+    async def lookup(self, history: list[dict]) -> tuple[str | None, str | None]:
+        """(ключ, ответ) для текущего вопроса; ключ None — кэш к запросу не применяется."""
+        dialog = [m for m in history if m.get("role") != "system"]
+        key = None
+        if len(dialog) == 1 and dialog[0].get("role") == "user" and isinstance(dialog[0].get("content"), str):
+            key = self.key_for(dialog[0]["content"])
+        if key is None:
+            self.bypassed += 1
+            return None, None
+        try:
+            response = await get_cached_response(self.db, key, time.time() - self.ttl)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша ответов: {e}")
+            response = None
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, response
 
-        # Регистрация обработчика shutdown БЕЗ передачи аргументов
-        dp.shutdown.register(on_shutdown)
-        logger.info("Обработчик shutdown зарегистрирован")
+    async def store(self, key: str, question: str, response: str):
+        try:
+            await store_cached_response(self.db, key, normalize_question(question), response)
+            self.stored += 1
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш ответов: {e}")
 
-        # Установка команд бота - помещаем здесь, в конце блока try
-        await set_bot_commands(bot)
+    def record_latency(self, hit: bool, seconds: float):
+        """Время от получения вопроса до финального сообщения."""
+        self._latencies[hit].append(seconds)
 
-    except Exception as e:
-        logger.exception(f"Критическая ошибка при инициализации бота: {e}")
-        sys.exit(1)
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
 
-    # Запускаем бота
-    logger.info("Запуск бота (polling)...")
-    try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
-    except Exception as e:
-        logger.exception(f"Критическая ошибка во время работы бота: {e}")
-    finally:
-        # Закрытие сессии бота (важно для корректного завершения)
-        await bot.session.close()
-        logger.info("Сессия бота закрыта.")
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
 
-# Отдельная асинхронная функция для очистки задач
-async def cleanup_tasks():
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    if tasks:
-        logger.info(f"Ожидание завершения {len(tasks)} фоновых задач...")
-        [task.cancel() for task in tasks]
+    async def _loop(self):
+        while True:
+            try:
+                deleted = await prune_response_cache(self.db, time.time() - self.ttl, self.max_entries)
+                self.evicted += deleted
+                if deleted:
+                    logger.info(f"Из кэша ответов удалено записей: {deleted}")
+            except Exception as e:
+                logger.exception(f"Ошибка очистки кэша ответов: {e}")
+            await asyncio.sleep(self.prune_interval)
+
+    def stats(self) -> dict[str, float]:
+        def _p50(hit: bool) -> float:
+            values = sorted(self._latencies[hit])
+            return values[len(values) // 2] if values else 0.0
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'hit_rate': self.hits / total if total else 0.0,
+            'hit_p50': _p50(True),
+            'miss_p50': _p50(False),
+        }
+
+
+# --- Планировщик генераций: глобальный лимит и очередь с приоритетами ---
+GENERATION_PRIORITY_ADMIN = 0
+GENERATION_PRIORITY_SUBSCRIBER = 1
+GENERATION_PRIORITY_FREE = 2
+
+def generation_priority(user_data: dict | None) -> int:
+    """Приоритет генерации по данным users: админы, затем активные подписчики, затем бесплатные."""
+    if not user_data:
+        return GENERATION_PRIORITY_FREE
+    if user_data.get('is_admin'):
+        return GENERATION_PRIORITY_ADMIN
+    if user_data.get('subscription_status') == 'active':
+        expires = _parse_db_datetime(user_data.get('subscription_expires'))
+        if expires and expires > datetime.datetime.now(datetime.timezone.utc):
+            return GENERATION_PRIORITY_SUBSCRIBER
+    return GENERATION_PRIORITY_FREE
+
+class _GenerationTicket:
+    """Место в очереди одного запроса."""
+    __slots__ = ('user_id', 'priority', 'seq', 'enqueued_at', 'granted', 'wakeup')
+
+    def __init__(self, user_id: int, priority: int, seq: int):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.wakeup = asyncio.Event()  # выдача слота или изменение позиции в очереди
+
+class GenerationScheduler:
+    """
+    Ограничивает число одновременных генераций xAI и выстраивает остальные в очередь.
+
+    Порядок: приоритет тарифа (админ → подписчик → бесплатный), внутри тарифа — FIFO.
+    Чтобы бесплатные пользователи не ждали бесконечно, каждые aging_seconds ожидания
+    запрос поднимается на один уровень приоритета.
+    """
+
+    def __init__(self, max_concurrent: int, aging_seconds: float = 30.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.aging_seconds = aging_seconds
+        self._active = 0
+        self._waiting: list[_GenerationTicket] = []
+        self._seq = 0
+        # Метрики
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.max_depth = 0
+        self._waits: collections.deque[float] = collections.deque(maxlen=1000)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def depth(self) -> int:
+        """Текущая длина очереди."""
+        return len(self._waiting)
+
+    def _sort_key(self, ticket: _GenerationTicket, now: float) -> tuple[int, int]:
+        boost = int((now - ticket.enqueued_at) / self.aging_seconds) if self.aging_seconds > 0 else 0
+        return (max(GENERATION_PRIORITY_ADMIN, ticket.priority - boost), ticket.seq)
+
+    def position(self, ticket: _GenerationTicket) -> int:
+        """Позиция в очереди (1 — следующий на выполнение)."""
+        now = time.monotonic()
+        key = self._sort_key(ticket, now)
+        return 1 + sum(1 for other in self._waiting if self._sort_key(other, now) < key)
+
+    def _notify_waiting(self):
+        for ticket in self._waiting:
+            ticket.wakeup.set()
+
+    def _grant(self, waited: float):
+        self._active += 1
+        self.admitted_total += 1
+        self._waits.append(waited)
+
+    def _grant_next(self):
+        now = time.monotonic()
+        while self._waiting and self._active < self.max_concurrent:
+            ticket = min(self._waiting, key=lambda t: self._sort_key(t, now))
+            self._waiting.remove(ticket)
+            self._grant(now - ticket.enqueued_at)
+            ticket.granted = True
+            ticket.wakeup.set()
+        self._notify_waiting()
+
+    async def acquire(
+        self,
+        user_id: int,
+        priority: int = GENERATION_PRIORITY_FREE,
+        on_position: typing.Callable[[int], typing.Awaitable[None]] | None = None
+    ) -> float:
+        """Ждёт свободный слот генерации; возвращает время ожидания в секундах."""
+        if self._active < self.max_concurrent and not self._waiting:
+            self._grant(0.0)
+            return 0.0
+        self._seq += 1
+        ticket = _GenerationTicket(user_id, priority, self._seq)
+        self._waiting.append(ticket)
+        self.queued_total += 1
+        self.max_depth = max(self.max_depth, len(self._waiting))
+        self._notify_waiting()
+        last_position = None
         try:
-            await asyncio.gather(*tasks, return_exceptions=True)
-            logger.info("Фоновые задачи завершены.")
+            while not ticket.granted:
+                ticket.wakeup.clear()
+                position = self.position(ticket)
+                if on_position and position != last_position:
+                    last_position = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        logger.warning(f"Не удалось показать позицию в очереди user_id={user_id}: {e}")
+                    continue  # пока показывали позицию, слот мог освободиться
+                await ticket.wakeup.wait()
         except asyncio.CancelledError:
-             logger.info("Задачи были отменены во время завершения.")
+            if ticket.granted:
+                self.release()
+            else:
+                self._waiting.remove(ticket)
+                self._notify_waiting()
+            raise
+        waited = time.monotonic() - ticket.enqueued_at
+        logger.info(f"Генерация для user_id={user_id} начата после ожидания в очереди {waited:.1f} с")
+        return waited
+
+    def release(self):
+        """Освобождает слот и передаёт его следующему в очереди."""
+        self._active = max(0, self._active - 1)
+        self._grant_next()
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        priority: int = GENERATION_PRIORITY_FREE,
+        on_position: typing.Callable[[int], typing.Awaitable[None]] | None = None
+    ):
+        """Контекстный менеджер: слот генерации на время стриминга ответа."""
+        await self.acquire(user_id, priority, on_position)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict[str, float]:
+        """Метрики очереди: текущая/максимальная глубина и время ожидания."""
+        waits = sorted(self._waits)
+        def _pct(p: float) -> float:
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+        return {
+            'active': self._active,
+            'max_concurrent': self.max_concurrent,
+            'depth': len(self._waiting),
+            'max_depth': self.max_depth,
+            'admitted_total': self.admitted_total,
+            'queued_total': self.queued_total,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p50': _pct(0.5),
+            'wait_p95': _pct(0.95),
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+
+def _collect_generation_metrics():
+    """Очереди и активные генерации текстовых ответов и изображений — для /metrics."""
+    for kind, key in (("text", 'generation_scheduler'), ("image", 'image_scheduler')):
+        scheduler: GenerationScheduler | None = dp.workflow_data.get(key)
+        if scheduler:
+            generation_queue_depth.set(scheduler.depth, kind=kind)
+            generations_active.set(scheduler.active, kind=kind)
+
+metrics.add_collector(_collect_generation_metrics)
+
+
+# --- Троттлинг редактирования сообщений при стриминге ---
+class _ChatEditState:
+    """Адаптивный интервал редактирования для одного чата."""
+    __slots__ = ('interval', 'next_at', 'blocked_until')
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_at = 0.0        # раньше этого момента (monotonic) чат не редактируем
+        self.blocked_until = 0.0  # конец окна TelegramRetryAfter
+
+class _PendingEdit:
+    """Последний ещё не отправленный текст для одного сообщения и задача, которая его отправит."""
+    __slots__ = ('text', 'parse_mode', 'reply_markup', 'on_error', 'last_sent', 'sending', 'task')
+
+    def __init__(self):
+        self.text: str | None = None
+        self.parse_mode: str | None = None
+        self.reply_markup = None
+        self.on_error: typing.Callable[[int, TelegramAPIError], None] | None = None
+        self.last_sent: tuple[str, str | None] | None = None
+        self.sending = False
+        self.task: asyncio.Task | None = None
+
+class EditThrottler:
+    """
+    Планировщик editMessageText для стриминга ответов.
+    Сообщение учитывается с первого submit() до drop()/settle().
+
+    submit() не ждёт сети: он запоминает последний текст сообщения, а отдельная задача
+    отправляет его, когда позволяют интервалы. Если текст успел смениться несколько раз,
+    уходит только последний вариант (coalesced); текст, совпадающий с уже отправленным,
+    не отправляется (skipped). Интервал чата растёт после TelegramRetryAfter и плавно
+    возвращается к min_interval после успешных правок; общий темп правок всего бота
+    ограничен global_rate и делится между чатами, которые сейчас стримят.
+    """
 
-async def generate_response_task(
-    message: types.Message,
-    db,
-    current_settings: Settings,
-    user_id: int,
-    user_text: str,
-    chat_id: int
-):
-    """Генерация ответа в фоне со стримингом, прогрессом и сохранением в БД."""
-    progress_msg = None
-    full_raw = ""
-    try:
-        # Отправляем прогресс-сообщение
-        progress_msg = await message.reply(
-            "⏳ Генерирую ответ...",
-            reply_markup=progress_keyboard(user_id)
-        )
-        progress_message_ids[user_id] = progress_msg.message_id
-        # Сохраняем пользовательский запрос
-        await add_message_to_db(db, user_id, "user", user_text)
-        # Получаем историю
-        history = await get_last_messages(db, user_id, limit=CONVERSATION_HISTORY_LIMIT)
-        # Настройка для стриминга
-        current_text = ""
-        last_edit = time.monotonic()
-        interval = 1.5
-        formatting_failed = False
-        # Стриминг ответа
-        async for chunk in stream_xai_response(
-            current_settings.XAI_API_KEY,
-            SYSTEM_PROMPT,
-            history
-        ):
-            full_raw += chunk
-            current_text += chunk
-            now = time.monotonic()
-            if now - last_edit > interval and progress_msg:
+    def __init__(self, bot_instance: Bot, min_interval: float = 1.5, max_interval: float = 15.0, global_rate: float = 25.0):
+        self.bot = bot_instance
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_global_rate = global_rate
+        self.global_rate = global_rate
+        self._global_next_at = 0.0
+        self._chats: dict[int, _ChatEditState] = {}
+        self._edits: dict[tuple[int, int], _PendingEdit] = {}
+        # Метрики
+        self.sent_total = 0
+        self.coalesced_total = 0
+        self.skipped_total = 0
+        self.throttled_total = 0
+        self.failed_total = 0
+
+    def _chat_interval(self, chat: _ChatEditState) -> float:
+        # Чем больше чатов стримят одновременно, тем реже правим каждый
+        active_chats = len({chat_id for chat_id, _ in self._edits})
+        return max(chat.interval, active_chats / self.global_rate)
+
+    def submit(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        parse_mode: str | None = ParseMode.HTML,
+        reply_markup=None,
+        on_error: typing.Callable[[int, TelegramAPIError], None] | None = None
+    ):
+        """Ставит в очередь новый текст сообщения (заменяя ещё не отправленный). on_error(message_id, ошибка) вызывается при неудачной правке."""
+        key = (chat_id, message_id)
+        edit = self._edits.get(key)
+        if edit is None:
+            edit = self._edits[key] = _PendingEdit()
+        if edit.text is not None:
+            self.coalesced_total += 1
+        edit.text, edit.parse_mode, edit.reply_markup, edit.on_error = text, parse_mode, reply_markup, on_error
+        if edit.task is None or edit.task.done():
+            edit.task = asyncio.create_task(self._run(key, edit))
+
+    def drop(self, chat_id: int, message_id: int):
+        """
+        Завершает стриминг в сообщение: отменяет неотправленную правку и забывает сообщение
+        (правка, уже ушедшая в Telegram, завершится сама). Вызывать, когда сообщение больше не правится через submit().
+        """
+        edit = self._edits.pop((chat_id, message_id), None)
+        if edit is None:
+            return
+        edit.text = None
+        if edit.task and not edit.sending:
+            edit.task.cancel()
+        if not any(c == chat_id for c, _ in self._edits):
+            self._chats.pop(chat_id, None)
+
+    async def settle(self, chat_id: int, message_id: int):
+        """
+        Как drop(), но дожидается отправляемой правки и окончания RetryAfter чата:
+        после этого сообщение можно править напрямую (финальный текст).
+        """
+        edit = self._edits.get((chat_id, message_id))
+        task = edit.task if edit else None
+        chat = self._chats.get(chat_id)
+        self.drop(chat_id, message_id)
+        if task and not task.done():
+            await asyncio.wait({task})
+        if chat and chat.blocked_until > time.monotonic():
+            await asyncio.sleep(chat.blocked_until - time.monotonic())
+
+    async def _run(self, key: tuple[int, int], edit: _PendingEdit):
+        chat_id, message_id = key
+        chat = self._chats.setdefault(chat_id, _ChatEditState(self.min_interval))
+        try:
+            while edit.text is not None:
+                now = time.monotonic()
+                if chat.next_at > now:
+                    await asyncio.sleep(chat.next_at - now)
+                    continue  # за время ожидания текст мог смениться или правку отменили
+                if edit.last_sent == (edit.text, edit.parse_mode):
+                    edit.text = None
+                    self.skipped_total += 1
+                    continue
+                # Общий темп бота: резервируем ближайшее свободное окно
+                send_at = max(now, self._global_next_at)
+                self._global_next_at = send_at + 1.0 / self.global_rate
+                if send_at > now:
+                    await asyncio.sleep(send_at - now)
+                    if edit.text is None:
+                        break
+                text, parse_mode, reply_markup, on_error = edit.text, edit.parse_mode, edit.reply_markup, edit.on_error
+                edit.text = None
+                edit.sending = True
+                started = time.perf_counter()
                 try:
-                    preview = markdown_to_telegram_html(current_text) + '...'
-                    await bot.edit_message_text(
-                        text=preview,
+                    await self.bot.edit_message_text(
+                        text=text,
                         chat_id=chat_id,
-                        message_id=progress_msg.message_id,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=progress_keyboard(user_id)
+                        message_id=message_id,
+                        parse_mode=parse_mode,
+                        reply_markup=reply_markup
                     )
-                    last_edit = now
-                except TelegramRetryAfter as rte:
-                    await asyncio.sleep(rte.retry_after + 0.1)
-                    last_edit = time.monotonic()
-                except TelegramAPIError:
-                    formatting_failed = True
-        # Финализация
-        if progress_msg:
-            final_text = markdown_to_telegram_html(current_text) if not formatting_failed else current_text
-            await bot.edit_message_text(
-                text=final_text,
-                chat_id=chat_id,
-                message_id=progress_msg.message_id,
-                parse_mode=ParseMode.HTML,
-                reply_markup=None
-            )
-            await message.answer("🫡", reply_markup=main_menu_keyboard())
-        else:
-            # Если progress_msg исчез, отправим новый
-            parts = split_text(markdown_to_telegram_html(full_raw))
-            for i, part in enumerate(parts):
-                await message.answer(part, parse_mode=ParseMode.HTML, reply_markup=main_menu_keyboard() if i == len(parts)-1 else None)
-        # Сохраняем ответ ассистента
-        if full_raw:
-            await add_message_to_db(db, user_id, "assistant", full_raw)
-    except asyncio.CancelledError:
-        # При отмене
-        if progress_msg:
-            try:
-                await bot.edit_message_text(
-                    text="Генерация отменена.",
-                    chat_id=chat_id,
-                    message_id=progress_msg.message_id,
-                    reply_markup=None
-                )
-            except TelegramAPIError:
-                pass
-    except Exception as e:
-        logger.exception(f"Ошибка в generate_response_task для user_id={user_id}: {e}")
-        if progress_msg:
-            try:
-                await bot.edit_message_text(
-                    text="Произошла ошибка при генерировании ответа.",
-                    chat_id=chat_id,
-                    message_id=progress_msg.message_id,
-                    reply_markup=None
-                )
-            except TelegramAPIError:
-                pass
-    finally:
-        progress_message_ids.pop(user_id, None)
-        active_requests.pop(user_id, None)
+                    telegram_edit_seconds.observe(time.perf_counter() - started, outcome="ok")
+                    edit.last_sent = (text, parse_mode)
+                    self.sent_total += 1
+                    chat.interval = max(self.min_interval, chat.interval * 0.9)
+                    self.global_rate = min(self.max_global_rate, self.global_rate * 1.02)
+                except TelegramRetryAfter as e:
+                    # Правка не применена: вернём текст в очередь (если новее нет) и замедлимся
+                    telegram_edit_seconds.observe(time.perf_counter() - started, outcome="retry_after")
+                    telegram_retry_after_total.inc(source="edit")
+                    self.throttled_total += 1
+                    logger.warning(f"Throttled: RetryAfter {e.retry_after}s (chat_id={chat_id})")
+                    if edit.text is None and self._edits.get(key) is edit:
+                        edit.text, edit.parse_mode, edit.reply_markup, edit.on_error = text, parse_mode, reply_markup, on_error
+                    chat.interval = min(self.max_interval, max(chat.interval * 2, float(e.retry_after)))
+                    chat.blocked_until = chat.next_at = time.monotonic() + e.retry_after + 0.1
+                    self.global_rate = max(1.0, self.global_rate * 0.8)
+                    continue
+                except TelegramAPIError as e:
+                    telegram_edit_seconds.observe(time.perf_counter() - started, outcome="error")
+                    if "message is not modified" in str(e).lower():
+                        edit.last_sent = (text, parse_mode)
+                        self.skipped_total += 1
+                    else:
+                        self.failed_total += 1
+                        if on_error:
+                            on_error(message_id, e)
+                        else:
+                            logger.warning(f"Ошибка редактирования сообщения {message_id} в чате {chat_id}: {e}")
+                finally:
+                    edit.sending = False
+                chat.next_at = time.monotonic() + self._chat_interval(chat)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception(f"Неожиданная ошибка троттлера правок (chat_id={chat_id}): {e}")
+
+    def stats(self) -> dict[str, float]:
+        """Счётчики правок: отправлено, объединено, пропущено без изменений, ограничено Telegram, ошибок."""
+        return {
+            'sent': self.sent_total,
+            'coalesced': self.coalesced_total,
+            'skipped': self.skipped_total,
+            'throttled': self.throttled_total,
+            'failed': self.failed_total,
+            'active_messages': len(self._edits),
+            'global_rate': self.global_rate,
+        }
+
+
+async def edit_final_text(bot_instance: Bot, attempts: int = 3, **kwargs):
+    """
+    editMessageText для итогового текста ответа. Промежуточную правку при RetryAfter можно
+    пропустить, итоговую нельзя: ждём retry_after и повторяем (до attempts попыток).
+    """
+    for attempt in range(attempts):
+        try:
+            return await bot_instance.edit_message_text(**kwargs)
+        except TelegramRetryAfter as e:
+            telegram_retry_after_total.inc(source="final")
+            if attempt == attempts - 1:
+                raise
+            logger.warning(f"Итоговая правка: RetryAfter {e.retry_after}s (chat_id={kwargs.get('chat_id')})")
+            await asyncio.sleep(e.retry_after)
 
-# --- НАЧАЛО: Админ-команды с проверкой is_admin ---
 
-# Список административных команд с описаниями
-ADMIN_COMMANDS_LIST = [
-    ("/admin", "Показать это сообщение с описанием команд."),
-    ("/stats", "Показать расширенную статистику по боту."),
-    ("/find_user", "`<id_or_username>` - Найти пользователя по ID или @username."),
-    ("/list_subs", "`[active|expired]` - Показать список пользователей с подписками (по умолчанию 'active', можно указать 'expired')."),
-    ("/grant_admin", "Выдать права администратора другому пользователю."),
-    ("/grant_sub", "`<user_id> <7|30>` - Выдать подписку пользователю на указанное количество дней."),
-    ("/send_to_user", "`<user_id> <text>` - Отправить сообщение пользователю от имени бота."),
-    ("/broadcast", "`<text>` - **ОСТОРОЖНО!** Отправить сообщение всем пользователям бота (может занять время)."),
-]
+# --- Обработка Markdown в HTML для Telegram ---
+# Регулярные выражения компилируются один раз (используются и при стриминге на каждом чанке)
+_MD_CODE_BLOCK_RE = re.compile(r"```(?:\w+)?\n([\s\S]*?)```", flags=re.DOTALL)
+_MD_INLINE_CODE_RE = re.compile(r"`([^`]+?)`")
+_MD_LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
+_MD_HEADER_RE = re.compile(r"^(#{1,6})\s*(.+)$", flags=re.MULTILINE)
+_MD_BOLD_RE = re.compile(r"\*\*([^\*]+)\*\*")
+_MD_UNDERLINE_RE = re.compile(r"__([^_]+)__")
+# Одиночный маркер открывает курсив перед непробельным символом и закрывает после него:
+# "* пункт" в начале строки и "5 * 3" не курсив; "_" внутри слова (snake_case) тоже
+_MD_ITALIC_STAR_RE = re.compile(r"(?<!\*)\*(?!\s)([^*]+)(?<!\s)\*(?!\*)")
+_MD_ITALIC_UNDERSCORE_RE = re.compile(r"(?<!\w)_(?!\s)([^_]+)(?<!\s)_(?!\w)")
+_MD_STRIKE_RE = re.compile(r"~~(.+?)~~")
+_MD_SPOILER_RE = re.compile(r"\|\|(.+?)\|\|")
+_MD_EXTRA_NEWLINES_RE = re.compile(r'\n{3,}')
+_MD_LEFTOVER_MARKERS_RE = re.compile(r'[\*_~]')
+# Строка, оканчивающаяся заголовком без текста: "\s*" в _MD_HEADER_RE может забрать следующие строки
+_MD_OPEN_HEADER_RE = re.compile(r"^#{1,6}\s*\Z", flags=re.MULTILINE)
+
+def _last_marker_opens(text: str, marker: str, double: bool) -> bool:
+    """
+    Проверяет, может ли последний оставшийся маркер (* или _) открыть конструкцию, продолжающуюся дальше.
 
-@dp.message(Command("admin"), IsAdmin())
-async def admin_help_menu(message: types.Message):
-    """Отправляет отформатированный список всех админ-команд."""
-    help_lines = ["<b>Административные команды:</b>\n"]
+    Более ранние маркеры уже ни с чем не совпадут: между ними и дописанным текстом стоит
+    последний. Одиночный маркер перед пробелом ("* пункт", "5 * 3") и "_" после буквы
+    (snake_case) курсив не открывают и фиксации абзаца не мешают.
+    """
+    i = text.rfind(marker)
+    if i < 0:
+        return False
+    preceded = i > 0 and text[i - 1] == marker
+    if double or preceded:
+        return preceded and double
+    if i + 1 < len(text) and text[i + 1].isspace():
+        return False
+    return marker == '*' or i == 0 or not (text[i - 1].isalnum() or text[i - 1] == '_')
 
-    for command, description in ADMIN_COMMANDS_LIST:
-        escaped_description = html.escape(description)
-        help_lines.append(f"<code>{command}</code> - {escaped_description}")
+def _markdown_to_html_body(text: str) -> tuple[str, bool]:
+    """
+    Выполняет все проходы markdown_to_telegram_html до нормализации пустых строк.
 
-    help_text = "\n".join(help_lines)
-    await message.reply(help_text, parse_mode=ParseMode.HTML)
+    Второй элемент результата — True, если в тексте не осталось незакрытых конструкций
+    (код, ссылка, заголовок, жирный/курсив), которые могли бы совпасть с текстом,
+    дописанным после него. Такой фрагмент можно рендерить независимо от продолжения.
+    """
+    code_blocks: dict[str, str] = {}
 
-@dp.message(Command("stats"), IsAdmin())
-async def admin_stats_enhanced(message: types.Message):
-    """Расширенная статистика бота для админа."""
-    db = dp.workflow_data.get('db')
-    settings_local = dp.workflow_data.get('settings')
-    try:
-        stats = await get_extended_stats(db, settings_local)
-        report = (
-            "📊 *Расширенная Статистика* 📊\n\n"
-            "*Пользователи:*\n"
-            f"- Всего: {stats['total_users']}\n"
-            f"- Активных сегодня: {stats['active_today']}\n"
-            f"- Активных за 7 дней: {stats['active_week']}\n"
-            f"- Новых сегодня: {stats['new_today']}\n"
-            f"- Новых за 7 дней: {stats['new_week']}\n\n"
-            "*Подписки:*\n"
-            f"- Активных сейчас: {stats['active_subs']}\n"
-            f"- Новых сегодня: {stats['new_subs_today']}\n"
-            f"- Новых за 7 дней: {stats['new_subs_week']}\n"
-            f"- Истекает в ближайшие 7 дней: {stats['expiring_subs']}\n"
+    # Плейсхолдеры без символов разметки: иначе проходы курсива по "_" их ломают
+    def _extract_code_block(match):
+        placeholder = f"\x00{len(code_blocks)}\x00"
+        code_blocks[placeholder] = f"<pre>{html.escape(match.group(1), quote=False)}</pre>"
+        return placeholder
+
+    def _extract_inline_code(match):
+        placeholder = f"\x00{len(code_blocks)}\x00"
+        code_blocks[placeholder] = f"<code>{html.escape(match.group(1), quote=False)}</code>"
+        return placeholder
+
+    closed = True
+    # Извлечение блоков кода
+    text = _MD_CODE_BLOCK_RE.sub(_extract_code_block, text)
+    # Извлечение inline-кода
+    text = _MD_INLINE_CODE_RE.sub(_extract_inline_code, text)
+    closed = closed and '`' not in text
+
+    # Экранирование остального текста
+    text = html.escape(text, quote=False)
+
+    # Ссылки [text](url)
+    def _replace_link(match):
+        label = match.group(1)
+        url = match.group(2)
+        safe_url = html.escape(url, quote=True)
+        return f'<a href="{safe_url}">{label}</a>'
+    text = _MD_LINK_RE.sub(_replace_link, text)
+    last_bracket = text.rfind('[')
+    last_link_start = text.rfind('](')
+    closed = (
+        closed
+        and (last_bracket < 0 or text.find(']', last_bracket) >= 0)
+        and (last_link_start < 0 or text.find(')', last_link_start) >= 0)
+    )
+
+    # Заголовки #…## (проверка до замены: жадный "\s*" предпочтёт текст из следующих строк)
+    closed = closed and not _MD_OPEN_HEADER_RE.search(text)
+    text = _MD_HEADER_RE.sub(lambda m: f"<b>{m.group(2)}</b>\n", text)
+
+    # Жирный **text**
+    text = _MD_BOLD_RE.sub(r"<b>\1</b>", text)
+    closed = closed and not _last_marker_opens(text, '*', double=True)
+    # Подчёркивание __text__
+    text = _MD_UNDERLINE_RE.sub(r"<u>\1</u>", text)
+    closed = closed and not _last_marker_opens(text, '_', double=True)
+    # Курсив *text* и _text_
+    text = _MD_ITALIC_STAR_RE.sub(r"<i>\1</i>", text)
+    closed = closed and not _last_marker_opens(text, '*', double=False)
+    text = _MD_ITALIC_UNDERSCORE_RE.sub(r"<i>\1</i>", text)
+    closed = closed and not _last_marker_opens(text, '_', double=False)
+    # Зачёркивание ~~text~~ и спойлеры ||text|| не переходят через перенос строки
+    text = _MD_STRIKE_RE.sub(r" \1⁠ ", text)
+    text = _MD_SPOILER_RE.sub(r"<tg-spoiler>\1</tg-spoiler>", text)
+
+    # Восстановление кодовых блоков
+    for placeholder, replacement in code_blocks.items():
+        text = text.replace(placeholder, replacement)
+
+    # Нормализация пустых строк (не более двух подряд)
+    text = _MD_EXTRA_NEWLINES_RE.sub('\n\n', text)
+    return text, closed
+
+def markdown_to_telegram_html(text: str) -> str:
+    """Преобразует Markdown-подобный текст в HTML, поддерживаемый Telegram."""
+    if not text:
+        return ""
+    with markdown_render_seconds.time(mode="full"):
+        text, _ = _markdown_to_html_body(text)
+        # Удаляем пробелы и переносы в начале/конце
+        text = text.strip()
+        # Удаление оставшихся маркеров Markdown (*, _, ~), чтобы избежать разрывов слов и видимых символов разметки
+        return _MD_LEFTOVER_MARKERS_RE.sub('', text)
+
+class StreamingMarkdownRenderer:
+    """
+    Инкрементальный рендерер Markdown → Telegram-HTML для стриминга.
+
+    Текст разбивается на абзацы (граница — пустая строка перед непробельным символом).
+    Как только накопленный хвост до границы не содержит незакрытых конструкций,
+    его HTML фиксируется и больше не пересчитывается; на каждом чанке рендерится
+    только незафиксированный хвост. Результат html() совпадает с
+    markdown_to_telegram_html() для всего переданного текста.
+    """
+
+    _BOUNDARY_RE = re.compile(r"\n\n(?=\S)")
+
+    def __init__(self, text: str = ""):
+        self._committed_html = ""   # HTML зафиксированных абзацев (уже без маркеров)
+        self._tail = ""             # ещё не зафиксированный исходный текст
+        self._tail_html: str | None = None
+        if text:
+            self.feed(text)
+
+    def feed(self, chunk: str) -> None:
+        """Добавляет очередной чанк исходного текста."""
+        if not chunk:
+            return
+        scan_from = max(len(self._tail) - 2, 0)
+        self._tail += chunk
+        self._tail_html = None
+        # Проверяем только последнюю границу абзаца в новом фрагменте
+        boundary = None
+        for match in self._BOUNDARY_RE.finditer(self._tail, scan_from):
+            boundary = match.end()
+        if boundary is not None:
+            self._try_commit(boundary)
+
+    def _try_commit(self, boundary: int) -> None:
+        with markdown_render_seconds.time(mode="stream_commit"):
+            body, closed = _markdown_to_html_body(self._tail[:boundary])
+        if not closed:
+            return
+        if not self._committed_html:
+            body = body.lstrip()
+        self._committed_html += _MD_LEFTOVER_MARKERS_RE.sub('', body)
+        self._tail = self._tail[boundary:]
+
+    def html(self) -> str:
+        """HTML всего полученного текста (эквивалентно markdown_to_telegram_html)."""
+        if self._tail_html is None:
+            with markdown_render_seconds.time(mode="stream_tail"):
+                body = _markdown_to_html_body(self._tail)[0] if self._tail else ""
+                body = body.rstrip() if self._committed_html else body.strip()
+                self._tail_html = self._committed_html + _MD_LEFTOVER_MARKERS_RE.sub('', body)
+        return self._tail_html
+
+    def __len__(self) -> int:
+        return len(self.html())
+
+# --- Вспомогательная функция для разбиения текста ---
+def split_text(text: str, length: int = TELEGRAM_MAX_LENGTH) -> list[str]:
+    """Разбивает текст на части указанной длины."""
+    if len(text) <= length:
+        return [text]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        # Ищем последний перенос строки или пробел в пределах длины
+        end = start + length
+        if end >= len(text):
+            chunks.append(text[start:])
+            break
+
+        split_pos = -1
+        # Ищем с конца к началу чанка
+        for i in range(end - 1, start -1, -1):
+            if text[i] == '\n':
+                split_pos = i + 1 # Включаем перенос в предыдущий чанк
+                break
+            elif text[i] == ' ':
+                split_pos = i + 1 # Разделяем по пробелу
+                break
+
+        if split_pos != -1 and split_pos > start: # Если нашли подходящую точку разрыва
+            chunks.append(text[start:split_pos])
+            start = split_pos
+        else: # Если не нашли (например, очень длинное слово или строка без пробелов)
+            # Просто рубим по длине
+            chunks.append(text[start:end])
+            start = end
+
+    return chunks
+
+
+# --- Обработчики Telegram ---
+
+@dp.message(Command("start"))
+async def start_handler(message: types.Message):
+    user_id = message.from_user.id # Получаем user_id
+    # Получаем зависимости
+    db = dp.workflow_data.get('db')
+    current_settings = dp.workflow_data.get('settings')
+
+    if not db or not current_settings:
+        logger.error(f"Не удалось получить БД/настройки в start_handler для user_id={user_id}")
+        await message.answer("Произошла внутренняя ошибка (код s1), попробуйте позже.")
+        return
+
+    # --- Получаем или создаем пользователя ---
+    user_data = await get_or_create_user(
+        db,
+        user_id,
+        message.from_user.username,
+        message.from_user.first_name,
+        message.from_user.last_name
+    )
+    if not user_data:
+        logger.error(f"Не удалось получить или создать пользователя {user_id} в start_handler")
+        await message.answer("Произошла внутренняя ошибка (код s2), попробуйте позже.")
+        return
+    logger.debug(f"Данные пользователя {user_id} (start): {user_data}")
+    # --- Конец изменений ---
+
+    # Отправляем главное меню с кнопками ReplyKeyboardMarkup
+    keyboard = main_menu_keyboard()
+    await message.answer(
+        f"Привет, {message.from_user.first_name}! Я ваш AI ассистент.\n"
+        "Задайте ваш вопрос или используйте кнопки меню.",
+        reply_markup=keyboard
+    )
+
+@dp.message(
+    F.text
+    & ~F.text.startswith('/')  # исключаем команды бота
+    & ~(F.text == "🔄 Новый диалог")
+    & ~(F.text == "📊 Мои лимиты")
+    & ~(F.text == "💎 Подписка")
+    & ~(F.text == "🆘 Помощь")
+    & ~(F.text == "❓ Задать вопрос")
+    & ~(F.text == "📸 Генерация фото")
+)
+async def message_handler(message: types.Message):
+    user_id = message.from_user.id
+    state: LocalStateBackend = dp.workflow_data['state_backend']
+    if await state.take_pending_prompt(user_id):
+        # Запрос для генерации фото: генерация идёт фоновой задачей, обработчик сразу свободен
+        db = dp.workflow_data.get('db')
+        current_settings = dp.workflow_data.get('settings')
+        if not db or not current_settings:
+            await message.reply("Произошла внутренняя ошибка (код 1i), попробуйте позже.")
+            return
+        user_data = await get_or_create_user(
+            db, user_id, message.from_user.username,
+            message.from_user.first_name, message.from_user.last_name
         )
-        await message.reply(report, parse_mode=ParseMode.MARKDOWN)
+        if not user_data:
+            await message.reply("Произошла внутренняя ошибка (код 3i), попробуйте позже.")
+            return
+        if not await check_and_consume_limit(db, current_settings, user_id):
+            kb = InlineKeyboardBuilder()
+            kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
+            await message.reply(
+                "У вас закончились бесплатные запросы на сегодня 😔\n"
+                "Оформите подписку для снятия ограничений.",
+                reply_markup=kb.as_markup()
+            )
+            return
+        if not await state.acquire(generation_key(user_id), asyncio.current_task()):
+            await message.reply(
+                "Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.",
+                reply_markup=progress_keyboard(user_id)
+            )
+            return
+        task = asyncio.create_task(
+            generate_image_task(message, user_id, message.text, message.chat.id, generation_priority(user_data))
+        )
+        # Слот освобождает сама задача в finally
+        state.attach(generation_key(user_id), task)
+        return
+    chat_id = message.chat.id
+    user_text = message.text
+
+    # Получаем зависимости из workflow_data
+    db = dp.workflow_data.get('db')
+    current_settings = dp.workflow_data.get('settings')
+    xai_client = dp.workflow_data.get('xai_client')
+
+    if not db or not current_settings or not xai_client:
+        logger.error("Не удалось получить соединение с БД, настройки или клиент xAI")
+        await message.answer("Произошла внутренняя ошибка (код 1), попробуйте позже.")
+        return
+
+    # Регистрируем текущую задачу генерации, чтобы ее можно было отменить;
+    # если генерация для пользователя уже идёт (в любом процессе) — это дублирующий запрос
+    if not await state.acquire(generation_key(user_id), asyncio.current_task()):
+        try:
+            await message.reply("Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.", reply_markup=progress_keyboard(user_id))
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось отправить сообщение о дублирующем запросе: {e}")
+        return
+
+    current_message_id = None # Объявляем здесь, чтобы быть доступным в finally/except
+    received_at = time.monotonic()
+    try:
+        # Показываем индикатор "печатает"
+        await bot.send_chat_action(chat_id=chat_id, action="typing")
+
+        # Одной транзакцией: пользователь, last_active, лимит, сохранение сообщения и история
+        admission = await admit_request(
+            db,
+            user_id,
+            message.from_user.username,
+            message.from_user.first_name,
+            message.from_user.last_name,
+            user_text
+        )
+        if not admission:
+            logger.error(f"Не удалось принять запрос пользователя {user_id}")
+            await message.answer("Произошла внутренняя ошибка (код 3), попробуйте позже.")
+            return
+        logger.debug(f"Данные пользователя {user_id}: {admission['user']}")
+
+        # Проверка лимита и подписки
+        if not admission['allowed']:
+            kb = InlineKeyboardBuilder()
+            kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
+            await message.reply(
+                "У вас закончились бесплатные запросы на сегодня 😔\nЧтобы продолжить без ограничений, оформите подписку.",
+                reply_markup=kb.as_markup()
+            )
+            return
+
+        history = admission['history']
+        logger.info(f"Сообщение от пользователя {user_id} сохранено, записей в истории: {len(history)}")
+
+        # Типовой вопрос без контекста: ответ может быть в кэше
+        response_cache: ResponseCache | None = dp.workflow_data.get('response_cache')
+        cache_key, cached_response = await response_cache.lookup(history) if response_cache else (None, None)
+
+        # --- Новая логика стриминга с авто-разбиением ---
+        full_raw_response = ""
+        current_message_text = "" # Текст для текущего сообщения TG
+        current_message_html = "" # HTML текущего сообщения (markdown_to_telegram_html(current_message_text))
+        renderer = StreamingMarkdownRenderer() # Инкрементальный рендерер текущего сообщения
+        placeholder_message = None
+        message_count = 0 # Счетчик отправленных сообщений (частей)
+        formatting_failed = False
+        edit_throttler: EditThrottler = dp.workflow_data['edit_throttler']
+        cancel_keyboard = progress_keyboard(user_id)  # строится один раз, а не на каждый чанк
+
+        def _on_edit_error(message_id: int, e: TelegramAPIError):
+            # Вызывается троттлером, если промежуточная правка не удалась
+            nonlocal current_message_id, formatting_failed
+            logger.error(f"Ошибка редактирования сообщения {message_id} (mid-stream): {e}")
+            if message_id != current_message_id:
+                return
+            if any(msg in str(e).lower() for msg in ("message to edit not found", "message can't be edited")):
+                logger.warning(f"Сообщение {message_count} (ID: {current_message_id}) больше недоступно для редактирования.")
+                edit_throttler.drop(chat_id, current_message_id)
+                current_message_id = None
+            elif not formatting_failed:
+                formatting_failed = True
+                logger.warning("Переключение на raw из-за ошибки редактирования.")
+
+        # Отправка самого первого плейсхолдера
+        try:
+            placeholder_message = await message.answer("⏳", reply_markup=progress_keyboard(user_id))  # Короткий плейсхолдер с кнопкой Отмена
+            current_message_id = placeholder_message.message_id
+            message_count = 1
+        except TelegramAPIError as e:
+            logger.error(f"Ошибка отправки начального плейсхолдера: {e}")
+            return # Не можем продолжить
+
+        # Ожидаем слот генерации (глобальный лимит); пока ждём — показываем позицию в очереди
+        queue_shown = False
+
+        async def _show_queue_position(position: int):
+            nonlocal queue_shown
+            queue_shown = True
+            edit_throttler.submit(
+                chat_id,
+                current_message_id,
+                f"⏳ Вы #{position} в очереди на генерацию ответа...",
+                parse_mode=None,
+                reply_markup=progress_keyboard(user_id)
+            )
+
+        if cached_response is not None:
+            # Ответ из кэша не занимает слот генерации и проигрывается через тот же вывод
+            logger.info(f"Ответ для пользователя {user_id} взят из кэша")
+            generation_slot = contextlib.nullcontext()
+            response_stream = replay_cached_response(cached_response)
+        else:
+            scheduler: GenerationScheduler = dp.workflow_data['generation_scheduler']
+            generation_slot = scheduler.slot(user_id, generation_priority(admission['user']), _show_queue_position)
+            response_stream = stream_xai_response(xai_client, SYSTEM_PROMPT, history, dialog_id=user_id)
+        stream_completed = False
+        async with generation_slot:
+            if queue_shown:
+                edit_throttler.submit(chat_id, current_message_id, "⏳", parse_mode=None, reply_markup=progress_keyboard(user_id))
+            async for chunk in response_stream:
+                if not current_message_id: # Если отправка плейсхолдера не удалась или сообщение было удалено
+                     logger.warning("Прерывание стриминга, так как нет активного message_id.")
+                     break
+
+                full_raw_response += chunk
+
+                # Проверяем, не превысит ли добавление чанка лимит ТЕКУЩЕГО сообщения
+                tentative_next_text = current_message_text + chunk
+                tentative_html = tentative_next_text
+                try:
+                    # Проверяем длину с учетом HTML и "..." (рендерится только незакрытый хвост текста)
+                    renderer.feed(chunk)
+                    tentative_html = renderer.html()
+                    html_to_check = tentative_html + "..."
+                except Exception as fmt_err:
+                    logger.warning(f"Formatting error during length check: {fmt_err}")
+                    html_to_check = tentative_next_text + "..." # Проверяем raw длину
+                    formatting_failed = True # Отмечаем глобально
+
+                if len(html_to_check) > TELEGRAM_MAX_LENGTH:
+                    # Лимит превышен, финализируем текущее сообщение
+                    logger.info(f"Финализация сообщения {message_count} (ID: {current_message_id}) из-за длины.")
+                    await edit_throttler.settle(chat_id, current_message_id)
+                    try:
+                        final_part_html = current_message_html if not formatting_failed else current_message_text
+                        if final_part_html: # Редактируем только если есть текст
+                            await bot.edit_message_text(
+                                text=final_part_html,
+                                chat_id=chat_id,
+                                message_id=current_message_id,
+                                parse_mode=None if formatting_failed else ParseMode.HTML,
+                                reply_markup=progress_keyboard(user_id)  # Сохраняем кнопку Отмена
+                            )
+                    except TelegramAPIError as e:
+                        logger.error(f"Ошибка финализации сообщения {message_count}: {e}")
+                        if not formatting_failed:
+                            formatting_failed = True
+                            logger.warning("Переключение на raw из-за ошибки финализации.")
+                            try:
+                                if current_message_text:
+                                    await bot.edit_message_text(text=current_message_text, chat_id=chat_id, message_id=current_message_id, parse_mode=None, reply_markup=None)
+                            except TelegramAPIError as plain_e:
+                                logger.error(f"Ошибка raw финализации сообщения {message_count}: {plain_e}")
+                                current_message_id = None # Теряем это сообщение
+                        else:
+                            logger.error(f"Ошибка raw финализации сообщения {message_count}. Сообщение потеряно.")
+                            current_message_id = None
+
+                    # Начинаем новое сообщение при переполнении: убираем отмену из старого и отправляем новый placeholder
+                    current_message_text = chunk  # Начинаем с нового чанка
+                    renderer = StreamingMarkdownRenderer()
+                    try:
+                        renderer.feed(chunk)
+                        current_message_html = renderer.html()
+                    except Exception as fmt_err:
+                        logger.warning(f"Formatting error for new message part: {fmt_err}")
+                        formatting_failed = True
+                    message_count += 1
+                    try:
+                        # удаляем кнопку 'Отмена' из предыдущего сообщения
+                        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=current_message_id, reply_markup=None)
+                        # отправляем новый placeholder с кнопкой 'Отмена'
+                        placeholder_message = await message.answer("...", reply_markup=progress_keyboard(user_id))
+                        current_message_id = placeholder_message.message_id
+                        logger.info(f"Начато новое сообщение {message_count} (ID: {current_message_id})")
+                    except TelegramAPIError as e:
+                        logger.error(f"Ошибка отправки плейсхолдера для сообщения {message_count}: {e}")
+                        current_message_id = None
+                        break  # Прерываем стрим, если не можем создать новое сообщение
+
+                else:
+                    # Лимит не превышен, добавляем чанк к текущему тексту
+                    current_message_text += chunk
+                    current_message_html = tentative_html
+
+                    # Промежуточная правка: троттлер отправит последний текст, когда позволят интервалы
+                    html_to_send = current_message_html if not formatting_failed else current_message_text
+                    edit_throttler.submit(
+                        chat_id,
+                        current_message_id,
+                        html_to_send + "...",
+                        parse_mode=None if formatting_failed else ParseMode.HTML,
+                        reply_markup=cancel_keyboard,  # Сохраняем кнопку Отмена
+                        on_error=_on_edit_error
+                    )
+            else:
+                stream_completed = True
+
+
+        # --- Финализация ПОСЛЕДНЕГО сообщения после цикла ---
+        if current_message_id:
+            await edit_throttler.settle(chat_id, current_message_id)
+        if current_message_id and current_message_text:
+            logger.info(f"Финализация последнего сообщения {message_count} (ID: {current_message_id})")
+            try:
+                final_html = current_message_html if not formatting_failed else current_message_text
+                # оформляем финальный текст без кнопок в этом сообщении
+                await edit_final_text(
+                    bot,
+                    text=final_html,
+                    chat_id=chat_id,
+                    message_id=current_message_id,
+                    parse_mode=None if formatting_failed else ParseMode.HTML,
+                    reply_markup=None
+                )
+                # затем показываем ReplyKeyboardMarkup меню новым сообщением
+                await message.answer(
+                    "🫡",
+                    reply_markup=main_menu_keyboard()
+                )
+                logger.info(f"Последнее сообщение {message_count} {'RAW' if formatting_failed else 'HTML'} отправлено.")
+
+            except TelegramAPIError as e:
+                logger.error(f"Ошибка финализации последнего сообщения {message_count}: {e}")
+                # Попытка отправить raw как fallback
+                try:
+                    # Raw fallback: редактируем без кнопок
+                    await bot.edit_message_text(
+                        text=current_message_text,
+                        chat_id=chat_id,
+                        message_id=current_message_id,
+                        parse_mode=None,
+                        reply_markup=None
+                    )
+                    logger.info(f"Последнее сообщение {message_count} RAW отправлено после ошибки HTML.")
+                except TelegramAPIError as plain_e:
+                    logger.error(f"Ошибка raw финализации последнего сообщения {message_count}: {plain_e}")
+                    # Как крайняя мера, отправить новым сообщением
+                    try:
+                         await message.answer(
+                             text=current_message_text,
+                             parse_mode=None,
+                             reply_markup=main_menu_keyboard()
+                         )
+                         logger.info(f"Последняя часть {message_count} отправлена новым сообщением после ошибки редактирования.")
+                    except Exception as final_send_err:
+                         logger.error(f"Не удалось отправить последнюю часть {message_count} новым сообщением: {final_send_err}")
+
+        elif not full_raw_response and message_count == 1 and current_message_id:
+            # Если API ничего не вернуло после первого плейсхолдера
+            logger.warning(f"Не получен ответ от XAI для пользователя {user_id}")
+            try:
+                # Показ ошибки без кнопок, затем меню
+                await bot.edit_message_text(
+                    "К сожалению, не удалось получить ответ от AI.",
+                    chat_id=chat_id,
+                    message_id=current_message_id,
+                    reply_markup=None
+                )
+                await message.answer(
+                    "🫡",
+                    reply_markup=main_menu_keyboard()
+                )
+            except TelegramAPIError:
+                pass # Игнорируем, если сообщение уже удалено
+
+        # --- Сохранение полного ответа в БД ---
+        if full_raw_response:
+            try:
+                await add_message_to_db(db, user_id, "assistant", full_raw_response)
+                logger.info(f"Ответ ассистента (RAW) для пользователя {user_id} сохранен в БД")
+            except Exception as e:
+                logger.error(f"Ошибка сохранения ответа ассистента в БД: {e}")
+        # (Логика для случая else: logger.warning(f"Не получен или пустой ответ...) обработана выше
+
+        # --- Кэш ответов: сохраняем только полностью полученный ответ ---
+        if cache_key:
+            if cached_response is None and stream_completed and full_raw_response:
+                await response_cache.store(cache_key, user_text, full_raw_response)
+            response_cache.record_latency(cached_response is not None, time.monotonic() - received_at)
+
+    except XAIUnavailableError as e:
+        logger.warning(f"Запрос user_id={user_id} не отправлен в xAI: {e}")
+        try:
+            error_message = "Сервис AI временно недоступен. Пожалуйста, попробуйте через минуту."
+            if current_message_id:
+                dp.workflow_data['edit_throttler'].drop(chat_id, current_message_id)
+                await bot.edit_message_text(error_message, chat_id=chat_id, message_id=current_message_id, reply_markup=None)
+            else:
+                await message.answer(error_message, reply_markup=main_menu_keyboard())
+        except TelegramAPIError:
+            logger.error("Не удалось отправить сообщение о недоступности AI пользователю.")
+    except Exception as e:
+        logger.exception(f"Критическая ошибка в обработчике сообщений для user_id={user_id}: {e}")
+        try:
+            # Пытаемся отредактировать последнее известное сообщение об ошибке
+            error_message = "Произошла серьезная ошибка при обработке вашего запроса."
+            if current_message_id:
+                 dp.workflow_data['edit_throttler'].drop(chat_id, current_message_id)
+                 await bot.edit_message_text(error_message, chat_id=chat_id, message_id=current_message_id, reply_markup=None)
+            else: # Или отправляем новое, если ID нет
+                await message.answer(error_message + " Пожалуйста, попробуйте позже или используйте команду /start для сброса.")
+        except TelegramAPIError:
+             logger.error("Не удалось даже отправить сообщение об ошибке пользователю.")
+    finally:
+        # Неотправленная промежуточная правка не должна перезаписать отменённое/финальное сообщение
+        if current_message_id:
+            dp.workflow_data['edit_throttler'].drop(chat_id, current_message_id)
+        # Освобождаем слот пользователя (если его уже не занял новый запрос после отмены)
+        await state.release(generation_key(user_id), asyncio.current_task())
+
+# --- Обработчик отмены генерации ---
+@dp.callback_query(F.data.startswith("cancel_generation_"))
+async def cancel_generation_callback(callback: types.CallbackQuery):
+    """Обрабатывает отмену генерации: прекращает задачу, убирает клавиатуру и показывает меню."""
+    # Парсим user_id из callback_data
+    try:
+        user_id_to_cancel = int(callback.data.rsplit("_", 1)[-1])
+    except ValueError:
+        await callback.answer("Ошибка обработки отмены.", show_alert=True)
+        return
+
+    # Прекращаем задачу генерации (в любом процессе) и восстанавливаем лимит, если была
+    state: LocalStateBackend = dp.workflow_data['state_backend']
+    if await state.cancel(generation_key(user_id_to_cancel)):
+        generation_cancellations_total.inc()
+        db = dp.workflow_data.get('db')
+        settings_local = dp.workflow_data.get('settings')
+        if db and settings_local:
+            try:
+                if settings_local.USE_SQLITE:
+                    def _restore(conn: sqlite3.Connection):
+                        conn.execute(
+                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = ?",
+                            (user_id_to_cancel,)
+                        )
+                    await db.run(_restore)
+                else:
+                    async with db.acquire() as conn:
+                        await conn.execute(
+                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = $1",
+                            user_id_to_cancel
+                        )
+                user_cache.invalidate(user_id_to_cancel)
+            except Exception:
+                logger.exception(f"Не удалось восстановить лимит для user_id={user_id_to_cancel}")
+
+    # Убираем inline-клавиатуру отмены
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except TelegramAPIError:
+        pass
+
+    # Уведомляем пользователя о завершении отмены
+    await callback.answer("Генерация ответа отменена.", show_alert=False)
+
+    # Показываем главное меню
+    await callback.message.answer(
+        "🫡",
+        reply_markup=main_menu_keyboard()
+    )
+
+@dp.callback_query(F.data == "clear_history")
+async def clear_history_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    # Получаем зависимости из диспетчера (можно и через bot.dispatcher)
+    db = dp.workflow_data.get('db')
+    current_settings = dp.workflow_data.get('settings')
+
+    if not db or not current_settings:
+        logger.error("Не удалось получить БД/настройки при очистке истории (callback)")
+        await callback.answer("Ошибка при очистке истории", show_alert=True)
+        return
+
+    # --- Получаем или создаем пользователя (обновляем last_active) ---
+    user_data = await get_or_create_user(
+        db,
+        user_id,
+        callback.from_user.username,
+        callback.from_user.first_name,
+        callback.from_user.last_name
+    )
+    if not user_data:
+        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_history_callback")
+        await callback.answer("Произошла внутренняя ошибка (код ch1), попробуйте позже.", show_alert=True)
+        return
+    logger.debug(f"Данные пользователя {user_id} (clear_history_callback): {user_data}")
+    # --- Конец изменений ---
+
+    try:
+        rows_deleted_count = 0
+        if current_settings.USE_SQLITE:
+            def _clear_history_sqlite(conn: sqlite3.Connection):
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                return cursor.rowcount
+            rows_deleted_count = await db.run(_clear_history_sqlite) # db здесь это SQLiteBackend
+            logger.info(f"SQLite: Очищена история пользователя {user_id}, удалено {rows_deleted_count} записей")
+        else:
+            # PostgreSQL
+            async with db.acquire() as connection: # db здесь это пул
+                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id) # Убрал RETURNING id для простоты
+                # result это строка вида "DELETE N", парсим N
+                try:
+                    rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
+                except:
+                    rows_deleted_count = -1 # Не удалось распарсить
+                logger.info(f"PostgreSQL: Очищена история пользователя {user_id}, результат: {result}")
+
+        await callback.answer(f"История очищена ({rows_deleted_count} записей удалено)", show_alert=False)
+        # Можно добавить сообщение в чат для наглядности
+        # Редактируем исходное сообщение или отвечаем новым
+        try:
+            # Пытаемся отредактировать, если это было сообщение с кнопкой
+            await callback.message.edit_text("История диалога очищена.", reply_markup=None)
+        except TelegramAPIError:
+            # Если не вышло (например, это было не сообщение бота или прошло много времени),
+            # отправляем новое сообщение
+             await callback.message.answer("История диалога очищена.")
+
     except Exception as e:
-        logger.exception("Ошибка получения расширенной статистики")
-        await message.reply(f"Ошибка получения статистики: {e}")
+        logger.exception(f"Ошибка при очистке истории (callback) для user_id={user_id}: {e}")
+        await callback.answer("Произошла ошибка при очистке", show_alert=True)
 
-@dp.message(Command("grant_admin"), IsAdmin())
-async def grant_admin_handler(message: types.Message):
+# --- Обработчик команды /clear ---
+@dp.message(Command("clear"))
+async def clear_command_handler(message: types.Message):
+    user_id = message.from_user.id
     db = dp.workflow_data.get('db')
-    # Разбор аргументов
-    parts = message.text.strip().split(maxsplit=1)
-    if len(parts) != 2:
-        return await message.reply("Использование: /grant_admin <user_id>")
+    current_settings = dp.workflow_data.get('settings')
+
+    if not db or not current_settings:
+        logger.error("Не удалось получить БД/настройки при очистке истории (/clear)")
+        await message.answer("Произошла внутренняя ошибка (код 2), попробуйте позже.")
+        return
+
+    # --- Получаем или создаем пользователя (обновляем last_active) ---
+    user_data = await get_or_create_user(
+        db,
+        user_id,
+        message.from_user.username,
+        message.from_user.first_name,
+        message.from_user.last_name
+    )
+    if not user_data:
+        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_command_handler")
+        await message.answer("Произошла внутренняя ошибка (код cl1), попробуйте позже.")
+        return
+    logger.debug(f"Данные пользователя {user_id} (clear_command): {user_data}")
+    # --- Конец изменений ---
+
     try:
-        target_id = int(parts[1])
-    except ValueError:
-        return await message.reply("Неверный формат ID пользователя.")
-    # Проверка существования пользователя
-    target = await get_user(db, target_id)
-    if not target:
-        return await message.reply(f"Пользователь {target_id} не найден.")
-    # Обновляем права администратора
-    await update_user_admin(db, target_id, True)
-    await message.reply(f"✅ Пользователь {target_id} теперь администратор.")
+        rows_deleted_count = 0
+        if current_settings.USE_SQLITE:
+            def _clear_history_sqlite_cmd(conn: sqlite3.Connection):
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                return cursor.rowcount
+            rows_deleted_count = await db.run(_clear_history_sqlite_cmd)
+            logger.info(f"SQLite: Очищена история пользователя {user_id} по команде /clear, удалено {rows_deleted_count} записей")
+        else:
+            # PostgreSQL
+            async with db.acquire() as connection:
+                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id)
+                try:
+                     rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
+                except:
+                    rows_deleted_count = -1
+                logger.info(f"PostgreSQL: Очищена история пользователя {user_id} по команде /clear, результат: {result}")
+
+        await message.answer(f"История диалога очищена ({rows_deleted_count} записей удалено).")
+    except Exception as e:
+        logger.exception(f"Ошибка при очистке истории (/clear) для user_id={user_id}: {e}")
+        await message.answer("Произошла ошибка при очистке истории.")
+
+# --- Обработчики медиа (обновлено для vision) ---
+@dp.message(F.photo)
+async def photo_handler(message: types.Message):
+    user_id = message.from_user.id
+    caption = message.caption or ""
+    logger.info(f"Получено фото от user_id={user_id} с подписью: '{caption[:50]}...'" )
+
+    db = dp.workflow_data.get('db')
+    current_settings = dp.workflow_data.get('settings')
+    if not db or not current_settings:
+        await message.reply("Произошла внутренняя ошибка (код 1p), попробуйте позже.")
+        return
+
+    user_data = await get_or_create_user(
+        db, user_id, message.from_user.username,
+        message.from_user.first_name, message.from_user.last_name
+    )
+    if not user_data:
+        await message.reply("Произошла внутренняя ошибка (код 3p), попробуйте позже.")
+        return
+
+    # Самый крупный вариант фото (Telegram присылает их по возрастанию размера)
+    photo = message.photo[-1]
+    if photo.file_size and photo.file_size > current_settings.VISION_MAX_FILE_SIZE:
+        await message.reply("Фото слишком большое, отправьте изображение поменьше.")
+        return
+
+    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
+    if not is_allowed:
+        kb = InlineKeyboardBuilder()
+        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
+        await message.reply(
+            "У вас закончились бесплатные запросы на сегодня 😔\n"
+            "Лимит учитывает отправку текста, фото и документов.\n"
+            "Оформите подписку для снятия ограничений.",
+            reply_markup=kb.as_markup()
+        )
+        return
+
+    chat_id = message.chat.id
+    state: LocalStateBackend = dp.workflow_data['state_backend']
+    if not await state.acquire(generation_key(user_id), asyncio.current_task()):
+        await message.reply(
+            "Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.",
+            reply_markup=progress_keyboard(user_id)
+        )
+        return
+    task = asyncio.create_task(
+        generate_response_task(
+            message, db, current_settings, user_id, caption, chat_id,
+            priority=generation_priority(user_data),
+            photo=photo
+        )
+    )
+    # Слот освобождает сама задача в finally
+    state.attach(generation_key(user_id), task)
+
+@dp.message(F.document)
+async def document_handler(message: types.Message):
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    file_name = message.document.file_name or "Без имени"
+    mime_type = message.document.mime_type or "Неизвестный тип"
+    file_id = message.document.file_id
+    logger.info(f"Получен документ от user_id={user_id}: {file_name} (type: {mime_type}, file_id: {file_id})")
+
+    db = dp.workflow_data.get('db')
+    current_settings = dp.workflow_data.get('settings')
+    if not db or not current_settings:
+        await message.reply("Произошла внутренняя ошибка (код 1d), попробуйте позже.")
+        return
+
+    if not document_kind(file_name, message.document.mime_type):
+        await message.reply("Я умею читать документы PDF и DOCX. Отправьте файл в одном из этих форматов.")
+        return
+    if message.document.file_size and message.document.file_size > current_settings.DOCUMENT_MAX_FILE_SIZE:
+        await message.reply(f"Файл слишком большой: максимум {current_settings.DOCUMENT_MAX_FILE_SIZE // (1024 * 1024)} МБ.")
+        return
+
+    user_data = await get_or_create_user(db, user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
+    if not user_data:
+        await message.reply("Произошла внутренняя ошибка (код 3d), попробуйте позже.")
+        return
+
+    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
+    if not is_allowed:
+        kb = InlineKeyboardBuilder()
+        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
+        await message.reply(
+            "У вас закончились бесплатные запросы на сегодня 😔\n"
+            "Лимит учитывает отправку текста, фото и документов.\n"
+            "Оформите подписку для снятия ограничений.",
+            reply_markup=kb.as_markup()
+        )
+        return
+
+    logger.info(f"Пользователь {user_id} допущен к обработке документа '{file_name}' (лимит OK).")
+    state: LocalStateBackend = dp.workflow_data['state_backend']
+    if not await state.acquire(generation_key(user_id), asyncio.current_task()):
+        await message.reply(
+            "Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.",
+            reply_markup=progress_keyboard(user_id)
+        )
+        return
+    task = asyncio.create_task(
+        generate_response_task(
+            message, db, current_settings, user_id, message.caption or "", chat_id,
+            priority=generation_priority(user_data),
+            document=message.document
+        )
+    )
+    # Слот освобождает сама задача в finally
+    state.attach(generation_key(user_id), task)
+
+# --- Обработчики для кнопок меню ReplyKeyboardMarkup
+@dp.message(F.text == "🔄 Новый диалог")
+async def handle_new_dialog_button(message: types.Message):
+    # Просто вызываем существующий обработчик команды /clear
+    await clear_command_handler(message)
+
+@dp.message(F.text == "📊 Мои лимиты")
+async def handle_my_limits_button(message: types.Message):
+    user_id = message.from_user.id
+    db = dp.workflow_data.get('db')
+    if not db:
+        await message.reply("Ошибка получения данных.")
+        return
+    user_data = await get_user(db, user_id)
+    if not user_data:
+        await message.reply("Не удалось найти ваши данные.")
+        return
+    limit_info = f"Осталось бесплатных сообщений сегодня: {user_data.get('free_messages_today', 'N/A')}"
+    sub_info = "Подписка: неактивна"
+    if user_data.get('subscription_status') == 'active':
+        expires_ts = user_data.get('subscription_expires')
+        if isinstance(expires_ts, datetime.datetime):
+            expires_str = expires_ts.strftime('%Y-%m-%d %H:%M')
+            sub_info = f"Подписка активна до: {expires_str}"
+        else:
+            sub_info = f"Подписка активна до: {expires_ts}"
+    await message.reply(f"Информация о ваших лимитах:\n\n{limit_info}\n{sub_info}")
+
+@dp.message(F.text == "💎 Подписка")
+async def handle_subscription_button(message: types.Message):
+    # Заглушка раздела подписки
+    await message.reply(
+        "Раздел 'Подписка'.\n\n"
+        "Доступные тарифы:\n- 7 дней / 100 руб.\n- 30 дней / 300 руб.\n\n"
+        "(Функционал оплаты будет добавлен позже)"
+    )
 
-@dp.message(Command("grant_sub"), IsAdmin())
-async def grant_sub_handler(message: types.Message):
-    """Выдаёт подписку пользователю на 7 или 30 дней."""
-    db = dp.workflow_data.get('db')
-    parts = message.text.strip().split(maxsplit=2)
-    if len(parts) != 3:
-        return await message.reply("Использование: /grant_sub <user_id> <days>")
-    try:
-        target_id = int(parts[1])
-        days = int(parts[2])
-    except ValueError:
-        return await message.reply("Неверный формат, нужно: /grant_sub <user_id> <days>")
-    if days not in (7, 30):
-        return await message.reply("Можно выдать подписку только на 7 или 30 дней.")
-    target = await get_user(db, target_id)
-    if not target:
-        return await message.reply(f"Пользователь {target_id} не найден.")
-    await update_user_subscription(db, target_id, days)
-    new_data = await get_user(db, target_id)
-    expires = new_data.get('subscription_expires')
-    await message.reply(f"✅ Подписка выдана пользователю {target_id} на {days} дней (до {expires}).")
+@dp.message(F.text == "🆘 Помощь")
+async def handle_help_button(message: types.Message):
+    help_text = (
+        "<b>Помощь по боту:</b>\n\n"
+        "🤖 Я первый \"умный\" и бесплатный AI ассистент.\n"
+        "❓ Просто напишите ваш вопрос, и я постараюсь ответить.\n"
+        "🔄 Используйте кнопку \"Новый диалог\" или команду /clear, чтобы очистить историю и начать разговор с чистого листа.\n"
+        "📊 Кнопка \"Мои лимиты\" покажет, сколько бесплатных сообщений у вас осталось сегодня или до какого числа действует подписка.\n"
+        "💎 Кнопка \"Подписка\" расскажет о платных тарифах для снятия лимитов."
+    )
+    await message.reply(help_text, reply_markup=main_menu_keyboard())
 
-@dp.message(Command("broadcast"), IsAdmin())
-async def broadcast_handler(message: types.Message, command: CommandObject):
-    db = dp.workflow_data.get('db')
+@dp.message(F.text == "❓ Задать вопрос")
+async def handle_ask_question_button(message: types.Message):
+    await message.reply("Просто напишите ваш вопрос в чат 👇", reply_markup=main_menu_keyboard())
+
+@dp.message(F.text == "📸 Генерация фото")
+async def handle_generate_photo_button(message: types.Message):
     user_id = message.from_user.id
-    # Фильтрация IsAdmin
-    settings_local = dp.workflow_data.get('settings')
-    text = (command.args or "").strip()
-    if not text:
-        await message.reply("Использование: /broadcast <текст>")
+    await dp.workflow_data['state_backend'].set_pending_prompt(user_id)
+    await message.reply("Напишите запрос для генерации фото (опишите, что хотите увидеть)", reply_markup=main_menu_keyboard())
+
+# --- Функции запуска и остановки ---
+
+# Восстанавливаем функцию on_shutdown
+async def on_shutdown(**kwargs):
+    logger.info("Завершение работы бота...")
+    # Получаем dp и из него workflow_data
+    dp_local = kwargs.get('dispatcher') # aiogram передает dispatcher
+    if not dp_local:
+        logger.error("Не удалось получить dispatcher в on_shutdown")
         return
-    # Получаем список
-    if settings_local.USE_SQLITE:
-        def _all_ids():
-            conn = sqlite3.connect(db)
-            cur = conn.cursor()
-            cur.execute("SELECT user_id FROM users")
-            ids = [r[0] for r in cur.fetchall()]
-            conn.close()
-            return ids
-        user_ids = await asyncio.to_thread(_all_ids)
-    else:
-        async with db.acquire() as conn:
-            records = await conn.fetch("SELECT user_id FROM users")
-            user_ids = [r['user_id'] for r in records]
-    sent = 0
-    total = len(user_ids)
-    for uid in user_ids:
+
+    db = dp_local.workflow_data.get('db')
+    settings_local = dp_local.workflow_data.get('settings')
+    xai_client = dp_local.workflow_data.get('xai_client')
+    broadcast_engine = dp_local.workflow_data.get('broadcast_engine')
+
+    if broadcast_engine:
+        # До закрытия БД: прогресс рассылок уже сохранён по пачкам, задания продолжатся при запуске
+        await broadcast_engine.stop()
+
+    state_backend = dp_local.workflow_data.get('state_backend')
+    if state_backend:
+        # После остановки рассылок: аренды освобождаются, другой процесс может их продолжить
+        await state_backend.stop()
+
+    history_retention = dp_local.workflow_data.get('history_retention')
+    if history_retention:
+        await history_retention.stop()
+
+    response_cache = dp_local.workflow_data.get('response_cache')
+    if response_cache:
+        await response_cache.stop()
+
+    image_preprocessor = dp_local.workflow_data.get('image_preprocessor')
+    if image_preprocessor:
+        image_preprocessor.close()
+
+    document_cache = dp_local.workflow_data.get('document_cache')
+    if document_cache:
+        await document_cache.stop()
+
+    document_extractor = dp_local.workflow_data.get('document_extractor')
+    if document_extractor:
+        document_extractor.close()
+
+    image_cache = dp_local.workflow_data.get('image_cache')
+    if image_cache:
+        await image_cache.stop()
+
+    metrics_runner = dp_local.workflow_data.get('metrics_runner')
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+    last_active_writer = dp_local.workflow_data.get('last_active_writer')
+    if last_active_writer:
         try:
-            await bot.send_message(uid, text)
-            sent += 1
-            logger.info(f"Broadcast to {uid} succeeded")
+            await last_active_writer.stop()
+            logger.info(f"Отметки активности записаны (всего строк: {last_active_writer.rows_written})")
         except Exception as e:
-            logger.warning(f"Broadcast to {uid} failed: {e}")
-        await asyncio.sleep(0.1)
-    await message.reply(f"Рассылка завершена: отправлено {sent}/{total} пользователям.")
+            logger.error(f"Ошибка записи отметок активности при завершении: {e}")
 
-@dp.message(Command("find_user"), IsAdmin())
-async def admin_find_user(message: types.Message, command: CommandObject):
-    """Поиск пользователя по ID или username для админа."""
-    db = dp.workflow_data.get('db')
-    settings_local = dp.workflow_data.get('settings')
-    if not db:
-        return await message.reply("Ошибка БД")
-    if not command.args:
-        return await message.reply("Укажите ID или username: /find_user <query>")
-    query = command.args.strip()
-    user_data = None
-    # Попытка поиска по ID
-    try:
-        user_id_to_find = int(query)
-        user_data = await get_user(db, user_id_to_find)
-    except ValueError:
-        # Поиск по username
-        query_lower = query.lower().lstrip('@')
-        if settings_local.USE_SQLITE:
-            def _find_by_username():
-                conn = sqlite3.connect(db)
-                conn.row_factory = sqlite3.Row
-                cur = conn.cursor()
-                cur.execute(
-                    "SELECT * FROM users WHERE lower(username) = ?", (query_lower,)
-                )
-                row = cur.fetchone()
-                conn.close()
-                return dict(row) if row else None
-            user_data = await asyncio.to_thread(_find_by_username)
+    if xai_client:
+        try:
+            await xai_client.close()
+            logger.info("HTTP-сессия клиента xAI закрыта")
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии HTTP-сессии xAI: {e}")
+
+    if db and settings_local:
+        if not settings_local.USE_SQLITE:
+            try:
+                # db здесь это пул соединений asyncpg
+                if isinstance(db, asyncpg.Pool):
+                    await db.close()
+                    logger.info("Пул соединений PostgreSQL успешно закрыт")
+                else:
+                    logger.warning("Объект 'db' не является пулом asyncpg, закрытие не выполнено.")
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии пула соединений PostgreSQL: {e}")
         else:
-            async with db.acquire() as conn:
-                row = await conn.fetchrow(
-                    "SELECT * FROM users WHERE lower(username) = $1", query_lower
-                )
-                user_data = dict(row) if row else None
-    if not user_data:
-        return await message.reply(f"Пользователь по запросу '{query}' не найден.")
-    # Форматирование информации о пользователе
-    info_lines = [f"Найден пользователь по запросу '{query}':"]
-    info_lines.append(f"ID: {user_data.get('user_id')}")
-    info_lines.append(f"Username: {user_data.get('username')}")
-    info_lines.append(
-        f"Имя: {user_data.get('first_name')} {user_data.get('last_name')}"
-    )
-    info_lines.append(f"Регистрация: {user_data.get('registration_date')}")
-    info_lines.append(
-        f"Последняя активность: {user_data.get('last_active_date')}"
-    )
-    info_lines.append(
-        f"Бесплатных сегодня: {user_data.get('free_messages_today')}"
+            try:
+                if isinstance(db, SQLiteBackend):
+                    await db.close()
+                    logger.info("Соединения SQLite успешно закрыты")
+                else:
+                    logger.warning("Объект 'db' не является SQLiteBackend, закрытие не выполнено.")
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии соединений SQLite: {e}")
+    else:
+         logger.warning("Не удалось получить 'db' или 'settings' из workflow_data при завершении работы.")
+
+    logger.info("Бот остановлен.")
+
+
+# --- Режим webhook ---
+class InFlightUpdates:
+    """
+    Outer-middleware диспетчера: учитывает обновления, которые сейчас обрабатываются.
+    Нужен для корректной остановки webhook-сервера (дождаться принятых обновлений) и для /healthz.
+    """
+
+    def __init__(self):
+        self._tasks: set[asyncio.Task] = set()
+        self.processed_total = 0
+
+    async def __call__(self, handler, event, data):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+            self.processed_total += 1
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: float) -> int:
+        """Ждёт завершения обрабатываемых обновлений; возвращает число не успевших завершиться."""
+        pending = {t for t in self._tasks if not t.done()}
+        if not pending:
+            return 0
+        logger.info(f"Ожидание обработки {len(pending)} принятых обновлений (до {timeout:.0f} с)...")
+        _, still_pending = await asyncio.wait(pending, timeout=timeout)
+        return len(still_pending)
+
+async def health_handler(request: web.Request) -> web.Response:
+    """GET /healthz: процесс жив и принимает обновления."""
+    in_flight: InFlightUpdates = request.app['in_flight']
+    scheduler: GenerationScheduler | None = dp.workflow_data.get('generation_scheduler')
+    return web.json_response({
+        'status': 'draining' if request.app['draining'] else 'ok',
+        'mode': 'webhook',
+        'in_flight_updates': len(in_flight),
+        'processed_updates': in_flight.processed_total,
+        'active_generations': scheduler.active if scheduler else 0,
+        'queued_generations': scheduler.depth if scheduler else 0,
+    })
+
+def create_webhook_app(dispatcher: Dispatcher, bot_instance: Bot, secret_token: str, in_flight: InFlightUpdates, path: str, drain_timeout: float) -> web.Application:
+    """
+    aiohttp-приложение для режима webhook: POST path — обновления от Telegram
+    (проверка X-Telegram-Bot-Api-Secret-Token), GET /healthz — проверка состояния.
+    """
+    app = web.Application()
+    app['in_flight'] = in_flight
+    app['draining'] = False
+
+    async def _drain(app_local: web.Application):
+        # Выполняется первым при остановке: новые обновления Telegram повторит позже,
+        # уже принятые дорабатываются до закрытия БД и HTTP-сессий
+        app_local['draining'] = True
+        left = await in_flight.drain(drain_timeout)
+        if left:
+            logger.warning(f"Не дождались завершения {left} обновлений при остановке")
+
+    app.on_shutdown.append(_drain)
+    app.router.add_get('/healthz', health_handler)
+    # Запускает dp.startup/dp.shutdown (в том числе on_shutdown) вместе с приложением
+    setup_application(app, dispatcher, bot=bot_instance)
+    # handle_in_background: Telegram сразу получает 200, обработка идёт в отдельной задаче
+    SimpleRequestHandler(dispatcher=dispatcher, bot=bot_instance, secret_token=secret_token).register(app, path=path)
+    return app
+
+async def run_webhook(dispatcher: Dispatcher, bot_instance: Bot, current_settings: Settings, in_flight: InFlightUpdates):
+    """Регистрирует webhook в Telegram и обслуживает его до SIGTERM/SIGINT."""
+    if not current_settings.WEBHOOK_BASE_URL:
+        logger.error("USE_WEBHOOK включён, но WEBHOOK_BASE_URL не задан")
+        sys.exit(1)
+    secret_token = current_settings.WEBHOOK_SECRET
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, используется случайный токен до перезапуска")
+
+    app = create_webhook_app(
+        dispatcher, bot_instance, secret_token, in_flight,
+        path=current_settings.WEBHOOK_PATH,
+        drain_timeout=current_settings.WEBHOOK_DRAIN_TIMEOUT
     )
-    info_lines.append(
-        f"Подписка: {user_data.get('subscription_status')}"
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(
+        runner, current_settings.WEBAPP_HOST, current_settings.PORT,
+        reuse_port=current_settings.WEBHOOK_REUSE_PORT or None
     )
-    info_lines.append(
-        f"Конец подписки: {user_data.get('subscription_expires')}"
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {current_settings.WEBAPP_HOST}:{current_settings.PORT}")
+
+    webhook_url = current_settings.WEBHOOK_BASE_URL.rstrip('/') + current_settings.WEBHOOK_PATH
+    await bot_instance.set_webhook(
+        webhook_url,
+        secret_token=secret_token,
+        allowed_updates=dispatcher.resolve_used_update_types()
     )
-    info_lines.append(f"Админ: {user_data.get('is_admin')}" )
-    await message.reply("\n".join(info_lines))
-
-@dp.message(Command("list_subs"), IsAdmin())
-async def list_subs_handler(message: types.Message, command: CommandObject):
-    db = dp.workflow_data.get('db')
-    settings_local = dp.workflow_data.get('settings')
-    mode = (command.args or "active").strip().lower()
-    logger.info(f"Admin {message.from_user.id} вызвал /list_subs mode={mode}")
-    if settings_local.USE_SQLITE:
-        def _list():
-            conn = sqlite3.connect(db)
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            if mode == "active":
-                cur.execute("SELECT user_id, username FROM users WHERE subscription_status='active'")
-            else:
-                cur.execute(
-                    "SELECT user_id, username FROM users WHERE subscription_status='inactive' AND DATE(subscription_expires) BETWEEN DATE('now','-7 days') AND DATE('now')"
-                )
-            rows = cur.fetchall()
-            conn.close()
-            return rows
-        rows = await asyncio.to_thread(_list)
-        subs = [dict(r) for r in rows]
-    else:
-        async with db.acquire() as conn:
-            if mode == "active":
-                records = await conn.fetch("SELECT user_id, username FROM users WHERE subscription_status='active'")
-            else:
-                records = await conn.fetch(
-                    "SELECT user_id, username FROM users WHERE subscription_status='inactive' AND subscription_expires BETWEEN (NOW() - INTERVAL '7 days') AND NOW()"
-                )
-            subs = [dict(r) for r in records]
-    if not subs:
-        await message.reply("Нет пользователей для данного режима.")
-        return
-    lines = [f"{s['user_id']} (@{s.get('username','')})" for s in subs]
-    text = f"Список подписок ({mode}):\n" + "\n".join(lines)
-    await message.reply(text)
+    logger.info(f"Webhook установлен: {webhook_url}")
 
-@dp.message(Command("send_to_user"), IsAdmin())
-async def send_to_user_handler(message: types.Message, command: CommandObject):
-    db = dp.workflow_data.get('db')
-    settings_local = dp.workflow_data.get('settings')
-    # Либо фильтр IsAdmin
-    parts = (command.args or "").split(None, 1)
-    if len(parts) < 2:
-        await message.reply("Использование: /send_to_user <user_id> <текст>")
-        return
-    try:
-        target = int(parts[0])
-    except ValueError:
-        await message.reply("Неверный user_id.")
-        return
-    text = parts[1]
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
     try:
-        await bot.send_message(target, text)
-        logger.info(f"Admin {message.from_user.id} отправил сообщение пользователю {target}")
-        await message.reply(f"Сообщение пользователю {target} отправлено.")
-    except Exception as e:
-        logger.warning(f"Ошибка при отправке {target}: {e}")
-        await message.reply(f"Не удалось отправить сообщение пользователю {target}.")
-
-# --- КОНЕЦ: Админ-команды ---
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook-сервера...")
+        # Webhook не удаляем: при перезапуске на Render новый экземпляр переустановит его сам
+        await runner.cleanup()
 
-# --- Admin helper functions: сбор статистики бота ---
-async def get_extended_stats(db, settings: Settings) -> dict[str, int]:
-    """Собирает расширенную статистику пользователей и подписок."""
-    # SQLite
-    if settings.USE_SQLITE:
-        def _ext():
-            conn = sqlite3.connect(db)
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM users")
-            total = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE last_active_date>=DATE('now')")
-            active_today = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE last_active_date>=DATE('now','-7 days')")
-            active_week = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE registration_date>=DATE('now')")
-            new_today = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE registration_date>=DATE('now','-7 days')")
-            new_week = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE subscription_status='active' AND subscription_expires>DATE('now')")
-            active_subs = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE subscription_status='active' AND registration_date>=DATE('now')")
-            new_subs_today = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM users WHERE subscription_status='active' AND registration_date>=DATE('now','-7 days')")
-            new_subs_week = cur.fetchone()[0]
-            cur.execute(
-                "SELECT COUNT(*) FROM users WHERE subscription_status='active' AND subscription_expires BETWEEN DATE('now') AND DATE('now','+7 days')"
-            )
-            expiring = cur.fetchone()[0]
-            conn.close()
-            return {
-                'total_users': total,
-                'active_today': active_today,
-                'active_week': active_week,
-                'new_today': new_today,
-                'new_week': new_week,
-                'active_subs': active_subs,
-                'new_subs_today': new_subs_today,
-                'new_subs_week': new_subs_week,
-                'expiring_subs': expiring
-            }
-        return await asyncio.to_thread(_ext)
-    # PostgreSQL
-    async with db.acquire() as conn:
-        rec = await conn.fetchrow(
-            """
-            SELECT
-             (SELECT COUNT(*) FROM users) AS total,
-             (SELECT COUNT(*) FROM users WHERE last_active_date>=CURRENT_DATE) AS active_today,
-             (SELECT COUNT(*) FROM users WHERE last_active_date>=(CURRENT_DATE - INTERVAL '7 days')) AS active_week,
-             (SELECT COUNT(*) FROM users WHERE registration_date>=CURRENT_DATE) AS new_today,
-             (SELECT COUNT(*) FROM users WHERE registration_date>=(CURRENT_DATE - INTERVAL '7 days')) AS new_week,
-             (SELECT COUNT(*) FROM users WHERE subscription_status='active' AND subscription_expires>NOW()) AS active_subs,
-             (SELECT COUNT(*) FROM users WHERE subscription_status='active' AND registration_date>=CURRENT_DATE) AS new_subs_today,
-             (SELECT COUNT(*) FROM users WHERE subscription_status='active' AND registration_date>=(CURRENT_DATE - INTERVAL '7 days')) AS new_subs_week,
-             (SELECT COUNT(*) FROM users WHERE subscription_status='active' AND subscription_expires BETWEEN NOW() AND (NOW() + INTERVAL '7 days')) AS expiring_subs
-            """
-        )
-    return {
-        'total_users': rec['total'],
-        'active_today': rec['active_today'],
-        'active_week': rec['active_week'],
-        'new_today': rec['new_today'],
-        'new_week': rec['new_week'],
-        'active_subs': rec['active_subs'],
-        'new_subs_today': rec['new_subs_today'],
-        'new_subs_week': rec['new_subs_week'],
-        'expiring_subs': rec['expiring_subs']
-    }
 
-# --- Обработчик отмены генерации ---
-@dp.callback_query(F.data.startswith("cancel_generation_"))
-async def cancel_generation_callback(callback: types.CallbackQuery):
-    """Обрабатывает отмену генерации: прекращает задачу, убирает клавиатуру и показывает меню."""
-    # Парсим user_id из callback_data
+# --- Установка команд бота (если еще не сделано) ---
+async def set_bot_commands(bot_instance: Bot):
+    commands = [
+        types.BotCommand(command="/start", description="Начать диалог / Показать меню"),
+        types.BotCommand(command="/clear", description="Очистить историю диалога"),
+        # Админ-панель
+        types.BotCommand(command="/admin", description="Список команд администратора"),
+        types.BotCommand(command="/stats", description="Показать статистику бота"),
+        types.BotCommand(command="/find_user", description="Поиск пользователя по ID или username"),
+        types.BotCommand(command="/list_subs", description="Список пользователей по подписке"),
+        types.BotCommand(command="/grant_admin", description="Выдать права администратора"),
+        types.BotCommand(command="/grant_sub", description="Выдать подписку на 7 или 30 дней"),
+        types.BotCommand(command="/send_to_user", description="Отправить сообщение конкретному пользователю"),
+        types.BotCommand(command="/broadcast", description="Рассылка сообщения всем пользователям"),
+        types.BotCommand(command="/broadcast_status", description="Прогресс рассылки"),
+        types.BotCommand(command="/broadcast_cancel", description="Отменить рассылку"),
+    ]
     try:
-        user_id_to_cancel = int(callback.data.rsplit("_", 1)[-1])
-    except ValueError:
-        await callback.answer("Ошибка обработки отмены.", show_alert=True)
-        return
+        await bot_instance.set_my_commands(commands)
+        logger.info("Команды бота успешно установлены.")
+    except TelegramAPIError as e:
+        logger.error(f"Ошибка при установке команд бота: {e}")
+
+# --- Главная функция запуска ---
+async def main():
+    logger.info(f"Запуск приложения с настройками базы данных: {settings.DATABASE_URL}")
+    db_connection = None # Переименуем, чтобы не конфликтовать с именем модуля
 
-    # Прекращаем задачу генерации и восстанавливаем лимит, если была
-    task = active_requests.pop(user_id_to_cancel, None)
-    if task:
-        task.cancel()
-        db = dp.workflow_data.get('db')
-        settings_local = dp.workflow_data.get('settings')
-        if db and settings_local:
+    try:
+        # Выбор типа БД на основе URL из настроек
+        if settings.USE_SQLITE:
+            logger.info("Используется SQLite для хранения данных")
+            db_connection = await init_sqlite_db(settings.DATABASE_URL, settings.SQLITE_POOL_SIZE) # Возвращает SQLiteBackend
+        else:
+            logger.info("Используется PostgreSQL для хранения данных")
+            # Попытка подключения с таймаутом и обработкой ошибок
             try:
-                if settings_local.USE_SQLITE:
-                    def _restore():
-                        conn = sqlite3.connect(db)
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = ?",
-                            (user_id_to_cancel,)
-                        )
-                        conn.commit()
-                        conn.close()
-                    await asyncio.to_thread(_restore)
-                else:
-                    async with db.acquire() as conn:
-                        await conn.execute(
-                            "UPDATE users SET free_messages_today = free_messages_today + 1 WHERE user_id = $1",
-                            user_id_to_cancel
-                        )
-            except Exception:
-                logger.exception(f"Не удалось восстановить лимит для user_id={user_id_to_cancel}")
+                logger.info(f"Подключение к PostgreSQL: {settings.DATABASE_URL}")
+                # Увеличим таймауты для create_pool
+                db_connection = await asyncio.wait_for(
+                    asyncpg.create_pool(dsn=settings.DATABASE_URL, timeout=30.0, command_timeout=60.0, min_size=1, max_size=10),
+                    timeout=45.0 # Общий таймаут на создание пула
+                )
+                if not db_connection:
+                    logger.error("Не удалось создать пул соединений PostgreSQL (вернулся None)")
+                    sys.exit(1)
 
-    # Убираем inline-клавиатуру отмены
-    try:
-        await callback.message.edit_reply_markup(reply_markup=None)
-    except TelegramAPIError:
-        pass
+                logger.info("Пул соединений PostgreSQL успешно создан")
+                # Проверим соединение и инициализируем таблицу
+                await init_db_postgres(db_connection)
 
-    # Уведомляем пользователя о завершении отмены
-    await callback.answer("Генерация ответа отменена.", show_alert=False)
+            except asyncio.TimeoutError:
+                logger.error("Превышен таймаут подключения к базе данных PostgreSQL")
+                sys.exit(1)
+            except (socket.gaierror, OSError) as e: # Ошибки сети/DNS
+                logger.error(f"Ошибка сети или DNS при подключении к PostgreSQL: {e}. Проверьте хост/порт в DATABASE_URL.")
+                sys.exit(1)
+            except asyncpg.exceptions.InvalidPasswordError:
+                 logger.error("Ошибка аутентификации PostgreSQL: неверный пароль.")
+                 sys.exit(1)
+            except asyncpg.exceptions.InvalidCatalogNameError as e: # Добавляем обработку InvalidCatalogNameError
+                 logger.error(f"Ошибка PostgreSQL: база данных, указанная в URL, не найдена. {e}")
+                 sys.exit(1)
+            except asyncpg.PostgresError as e:
+                logger.error(f"Общая ошибка PostgreSQL при подключении/инициализации: {e}")
+                sys.exit(1)
 
-    # Показываем главное меню
-    await callback.message.answer(
-        "🫡",
-        reply_markup=main_menu_keyboard()
-    )
+        # Сохраняем зависимости (SQLiteBackend или пул PG) в workflow_data
+        dp.workflow_data['db'] = db_connection
+        dp.workflow_data['settings'] = settings
+        # Глобальный лимит одновременных генераций с очередью по приоритетам
+        dp.workflow_data['generation_scheduler'] = GenerationScheduler(
+            settings.GENERATION_MAX_CONCURRENT,
+            aging_seconds=settings.GENERATION_PRIORITY_AGING
+        )
+        # Отдельный лимит для генерации изображений: долгие запросы не занимают слоты текстовых ответов
+        dp.workflow_data['image_scheduler'] = GenerationScheduler(
+            settings.IMAGE_GENERATION_MAX_CONCURRENT,
+            aging_seconds=settings.GENERATION_PRIORITY_AGING
+        )
+        # Троттлинг промежуточных правок при стриминге (общий для всех чатов)
+        dp.workflow_data['edit_throttler'] = EditThrottler(
+            bot,
+            min_interval=settings.EDIT_MIN_INTERVAL,
+            max_interval=settings.EDIT_MAX_INTERVAL,
+            global_rate=settings.EDIT_GLOBAL_RATE
+        )
+        # Общее состояние генераций (активные запросы, отмена, ожидание запроса фото, владение рассылками)
+        if settings.STATE_BACKEND == "database":
+            state_backend = DatabaseStateBackend(
+                db_connection,
+                poll_interval=settings.STATE_POLL_INTERVAL,
+                stale_after=settings.STATE_STALE_AFTER
+            )
+            logger.info(f"Общее состояние генераций хранится в БД (процесс {state_backend.owner})")
+        else:
+            state_backend = LocalStateBackend()
+            if settings.WEBHOOK_REUSE_PORT:
+                logger.warning("WEBHOOK_REUSE_PORT без STATE_BACKEND=database: отмена и защита от дублей работают только внутри процесса")
+        state_backend.start()
+        dp.workflow_data['state_backend'] = state_backend
+        # Фоновая очистка истории: лимит CONVERSATION_HISTORY_LIMIT и срок MESSAGE_EXPIRATION_DAYS
+        history_retention = HistoryRetention(
+            db_connection,
+            keep=CONVERSATION_HISTORY_LIMIT,
+            max_age_days=MESSAGE_EXPIRATION_DAYS,
+            interval=settings.HISTORY_RETENTION_INTERVAL,
+            batch_size=settings.HISTORY_RETENTION_BATCH
+        )
+        history_retention.start()
+        dp.workflow_data['history_retention'] = history_retention
+        # Кэш ответов на типовые вопросы (включается RESPONSE_CACHE_ENABLED)
+        if settings.RESPONSE_CACHE_ENABLED:
+            response_cache = ResponseCache(
+                db_connection,
+                ttl=settings.RESPONSE_CACHE_TTL,
+                max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+                prune_interval=settings.RESPONSE_CACHE_PRUNE_INTERVAL
+            )
+            response_cache.start()
+            dp.workflow_data['response_cache'] = response_cache
+            logger.info(f"Кэш ответов включён (версия промпта {RESPONSE_CACHE_VERSION})")
+        # Подготовка фото для vision-модели в отдельных процессах (закрывается в on_shutdown)
+        image_preprocessor = ImagePreprocessor(
+            settings.VISION_WORKERS,
+            max_side=settings.VISION_MAX_SIDE,
+            quality=settings.VISION_JPEG_QUALITY
+        )
+        dp.workflow_data['image_preprocessor'] = image_preprocessor
+        # Извлечение текста документов в отдельных процессах (закрывается в on_shutdown)
+        document_extractor = DocumentExtractor(settings.DOCUMENT_WORKERS)
+        dp.workflow_data['document_extractor'] = document_extractor
+        # Процессы пулов запускаются до приёма обновлений: иначе первое фото или документ
+        # ждали бы, пока сервер forkserver загрузит модули бота
+        pools_started = time.perf_counter()
+        await asyncio.to_thread(image_preprocessor.start)
+        await asyncio.to_thread(document_extractor.start)
+        logger.info(f"Пулы процессов запущены за {time.perf_counter() - pools_started:.1f} с")
+        # Кэш текста и пересказов документов
+        if settings.DOCUMENT_CACHE_ENABLED:
+            document_cache = DocumentCache(
+                db_connection,
+                version=document_cache_version(settings.DOCUMENT_CHUNK_TOKENS, settings.DOCUMENT_MAX_PAGES),
+                max_entries=settings.DOCUMENT_CACHE_MAX_ENTRIES,
+                max_bytes=settings.DOCUMENT_CACHE_MAX_BYTES,
+                prune_interval=settings.DOCUMENT_CACHE_PRUNE_INTERVAL
+            )
+            document_cache.start()
+            dp.workflow_data['document_cache'] = document_cache
+        # Кэш сгенерированных изображений: запрос -> file_id
+        if settings.IMAGE_CACHE_ENABLED:
+            image_cache = ImageCache(
+                db_connection,
+                max_entries=settings.IMAGE_CACHE_MAX_ENTRIES,
+                prune_interval=settings.IMAGE_CACHE_PRUNE_INTERVAL
+            )
+            image_cache.start()
+            dp.workflow_data['image_cache'] = image_cache
+        # Пакетная запись last_active_date (сбрасывается в on_shutdown)
+        last_active_writer = LastActiveWriter(db_connection, settings.LAST_ACTIVE_FLUSH_INTERVAL)
+        last_active_writer.start()
+        dp.workflow_data['last_active_writer'] = last_active_writer
+        # Фоновые рассылки; незавершённые до перезапуска продолжаются
+        broadcast_engine = BroadcastEngine(
+            bot,
+            db_connection,
+            rate=settings.BROADCAST_RATE,
+            concurrency=settings.BROADCAST_CONCURRENCY,
+            batch_size=settings.BROADCAST_BATCH_SIZE,
+            state=state_backend
+        )
+        dp.workflow_data['broadcast_engine'] = broadcast_engine
+        resumed = await broadcast_engine.resume()
+        if resumed:
+            logger.info(f"Продолжено незавершённых рассылок: {resumed}")
+        # Общий HTTP-клиент xAI с пулом соединений (закрывается в on_shutdown)
+        dp.workflow_data['xai_client'] = XAIClient(
+            settings.XAI_API_KEY,
+            base_url=settings.XAI_BASE_URL,
+            pool_limit=settings.XAI_POOL_LIMIT,
+            dns_ttl=settings.XAI_DNS_TTL,
+            keepalive_timeout=settings.XAI_KEEPALIVE_TIMEOUT,
+            retry_attempts=settings.XAI_RETRY_ATTEMPTS,
+            retry_base_delay=settings.XAI_RETRY_BASE_DELAY,
+            retry_max_delay=settings.XAI_RETRY_MAX_DELAY,
+            stream_idle_timeout=settings.XAI_STREAM_IDLE_TIMEOUT,
+            breaker=XAICircuitBreaker(settings.XAI_BREAKER_THRESHOLD, settings.XAI_BREAKER_RESET)
+        )
+        logger.info("Зависимости DB, Settings и клиент xAI успешно сохранены в dispatcher")
 
-@dp.callback_query(F.data == "clear_history")
-async def clear_history_callback(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    # Получаем зависимости из диспетчера (можно и через bot.dispatcher)
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
+        # Регистрация обработчиков (декораторы уже сделали это)
+        logger.info("Обработчики команд и сообщений зарегистрированы")
 
-    if not db or not current_settings:
-        logger.error("Не удалось получить БД/настройки при очистке истории (callback)")
-        await callback.answer("Ошибка при очистке истории", show_alert=True)
-        return
+        # Регистрация обработчика shutdown БЕЗ передачи аргументов
+        dp.shutdown.register(on_shutdown)
+        logger.info("Обработчик shutdown зарегистрирован")
 
-    # --- Получаем или создаем пользователя (обновляем last_active) ---
-    user_data = await get_or_create_user(
-        db,
-        user_id,
-        callback.from_user.username,
-        callback.from_user.first_name,
-        callback.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_history_callback")
-        await callback.answer("Произошла внутренняя ошибка (код ch1), попробуйте позже.", show_alert=True)
-        return
-    logger.debug(f"Данные пользователя {user_id} (clear_history_callback): {user_data}")
-    # --- Конец изменений ---
+        # Учёт обрабатываемых обновлений (для остановки webhook-сервера и /healthz)
+        in_flight = InFlightUpdates()
+        dp.update.outer_middleware(in_flight)
 
-    try:
-        rows_deleted_count = 0
-        if current_settings.USE_SQLITE:
-            def _clear_history_sqlite():
-                db_path = db # db здесь это путь к файлу
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-                deleted_count = cursor.rowcount
-                conn.commit()
-                conn.close()
-                return deleted_count
-            rows_deleted_count = await asyncio.to_thread(_clear_history_sqlite)
-            logger.info(f"SQLite: Очищена история пользователя {user_id}, удалено {rows_deleted_count} записей")
-        else:
-            # PostgreSQL
-            async with db.acquire() as connection: # db здесь это пул
-                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id) # Убрал RETURNING id для простоты
-                # result это строка вида "DELETE N", парсим N
-                try:
-                    rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
-                except:
-                    rows_deleted_count = -1 # Не удалось распарсить
-                logger.info(f"PostgreSQL: Очищена история пользователя {user_id}, результат: {result}")
+        # Локальный сервер метрик Prometheus (останавливается в on_shutdown)
+        if settings.METRICS_PORT:
+            dp.workflow_data['metrics_runner'] = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
 
-        await callback.answer(f"История очищена ({rows_deleted_count} записей удалено)", show_alert=False)
-        # Можно добавить сообщение в чат для наглядности
-        # Редактируем исходное сообщение или отвечаем новым
-        try:
-            # Пытаемся отредактировать, если это было сообщение с кнопкой
-            await callback.message.edit_text("История диалога очищена.", reply_markup=None)
-        except TelegramAPIError:
-            # Если не вышло (например, это было не сообщение бота или прошло много времени),
-            # отправляем новое сообщение
-             await callback.message.answer("История диалога очищена.")
+        # Установка команд бота - помещаем здесь, в конце блока try
+        await set_bot_commands(bot)
 
     except Exception as e:
-        logger.exception(f"Ошибка при очистке истории (callback) для user_id={user_id}: {e}")
-        await callback.answer("Произошла ошибка при очистке", show_alert=True)
+        logger.exception(f"Критическая ошибка при инициализации бота: {e}")
+        sys.exit(1)
 
-# --- Обработчик команды /clear ---
-@dp.message(Command("clear"))
-async def clear_command_handler(message: types.Message):
-    user_id = message.from_user.id
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
+    # Запускаем бота
+    try:
+        if settings.USE_WEBHOOK:
+            logger.info("Запуск бота (webhook)...")
+            await run_webhook(dp, bot, settings, in_flight)
+        else:
+            logger.info("Запуск бота (polling)...")
+            # Если раньше работал webhook, polling без его удаления получит ошибку конфликта
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    except Exception as e:
+        logger.exception(f"Критическая ошибка во время работы бота: {e}")
+    finally:
+        # Закрытие сессии бота (важно для корректного завершения)
+        await bot.session.close()
+        logger.info("Сессия бота закрыта.")
 
-    if not db or not current_settings:
-        logger.error("Не удалось получить БД/настройки при очистке истории (/clear)")
-        await message.answer("Произошла внутренняя ошибка (код 2), попробуйте позже.")
-        return
+# Отдельная асинхронная функция для очистки задач
+async def cleanup_tasks():
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    if tasks:
+        logger.info(f"Ожидание завершения {len(tasks)} фоновых задач...")
+        [task.cancel() for task in tasks]
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info("Фоновые задачи завершены.")
+        except asyncio.CancelledError:
+             logger.info("Задачи были отменены во время завершения.")
 
-    # --- Получаем или создаем пользователя (обновляем last_active) ---
-    user_data = await get_or_create_user(
-        db,
-        user_id,
-        message.from_user.username,
-        message.from_user.first_name,
-        message.from_user.last_name
-    )
-    if not user_data:
-        logger.error(f"Не удалось получить или создать пользователя {user_id} в clear_command_handler")
-        await message.answer("Произошла внутренняя ошибка (код cl1), попробуйте позже.")
-        return
-    logger.debug(f"Данные пользователя {user_id} (clear_command): {user_data}")
-    # --- Конец изменений ---
+async def generate_response_task(
+    message: types.Message,
+    db,
+    current_settings: Settings,
+    user_id: int,
+    user_text: str,
+    chat_id: int,
+    priority: int = GENERATION_PRIORITY_FREE,
+    photo: types.PhotoSize | None = None,
+    document: types.Document | None = None
+):
+    """
+    Генерация ответа в фоне со стримингом, прогрессом и сохранением в БД.
 
+    Если передано photo, оно скачивается, подготавливается (ImagePreprocessor) и вместе
+    с user_text (подписью) отправляется vision-модели; в историю записывается подпись
+    с пометкой [Фото], чтобы следующие вопросы учитывали ответ о фото.
+    Документ (document) берётся из кэша или скачивается во временный файл и читается
+    постранично (load_document), затем пересказывается по частям (summarize_document).
+    """
+    progress_msg = None
+    full_raw = ""
     try:
-        rows_deleted_count = 0
-        if current_settings.USE_SQLITE:
-            def _clear_history_sqlite_cmd():
-                db_path = db
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-                deleted_count = cursor.rowcount
-                conn.commit()
-                conn.close()
-                return deleted_count
-            rows_deleted_count = await asyncio.to_thread(_clear_history_sqlite_cmd)
-            logger.info(f"SQLite: Очищена история пользователя {user_id} по команде /clear, удалено {rows_deleted_count} записей")
+        # Отправляем прогресс-сообщение
+        progress_msg = await message.reply(
+            "⏳ Обрабатываю фото..." if photo else "⏳ Загружаю документ..." if document else "⏳ Генерирую ответ...",
+            reply_markup=progress_keyboard(user_id)
+        )
+        edit_throttler: EditThrottler = dp.workflow_data['edit_throttler']
+        cancel_keyboard = progress_keyboard(user_id)
+
+        def _show_progress(text: str):
+            edit_throttler.submit(chat_id, progress_msg.message_id, text, reply_markup=cancel_keyboard)
+
+        if document:
+            file_name = document.file_name or "Без имени"
+            document_cache: DocumentCache | None = dp.workflow_data.get('document_cache')
+            loaded = await load_document(
+                document, current_settings, dp.workflow_data['document_extractor'], document_cache,
+                on_progress=_show_progress
+            )
+            if loaded["total_pages"] > loaded["pages"]:
+                await message.reply(f"Документ длинный: прочитаны первые {loaded['pages']} из {loaded['total_pages']} страниц.")
+            logger.info(f"Документ «{file_name}» user_id={user_id}: {loaded['pages']} стр., {len(loaded['chunks'])} частей")
+            await add_message_to_db(db, user_id, "user", f"[Документ: {file_name}] {user_text}".rstrip())
+
+            async def _store_digest(summaries: list[str], digest: str, seconds: float):
+                if document_cache:
+                    await document_cache.store_digest(loaded["content_hash"], summaries, digest, seconds)
+
+            response_stream = summarize_document(
+                dp.workflow_data['xai_client'],
+                loaded["chunks"],
+                user_text or DOCUMENT_DEFAULT_PROMPT,
+                file_name,
+                concurrency=current_settings.DOCUMENT_SUMMARY_CONCURRENCY,
+                chunk_tokens=current_settings.DOCUMENT_CHUNK_TOKENS,
+                on_progress=_show_progress,
+                digest=loaded["digest"],
+                on_condensed=_store_digest
+            )
+        elif photo:
+            image = await download_photo(photo, current_settings.VISION_MAX_FILE_SIZE)
+            preprocessor: ImagePreprocessor = dp.workflow_data['image_preprocessor']
+            image = await preprocessor.prepare(image)
+            await add_message_to_db(db, user_id, "user", f"[Фото] {user_text}".rstrip())
+            response_stream = stream_vision_response(
+                dp.workflow_data['xai_client'],
+                SYSTEM_PROMPT,
+                image,
+                user_text or VISION_DEFAULT_PROMPT
+            )
         else:
-            # PostgreSQL
-            async with db.acquire() as connection:
-                result = await connection.execute("DELETE FROM conversations WHERE user_id = $1", user_id)
-                try:
-                     rows_deleted_count = int(result.split()[-1]) if result.startswith("DELETE") else 0
-                except:
-                    rows_deleted_count = -1
-                logger.info(f"PostgreSQL: Очищена история пользователя {user_id} по команде /clear, результат: {result}")
-
-        await message.answer(f"История диалога очищена ({rows_deleted_count} записей удалено).")
-    except Exception as e:
-        logger.exception(f"Ошибка при очистке истории (/clear) для user_id={user_id}: {e}")
-        await message.answer("Произошла ошибка при очистке истории.")
-
-# --- Обработчики медиа (обновлено для vision) ---
-@dp.message(F.photo)
-async def photo_handler(message: types.Message):
-    user_id = message.from_user.id
-    caption = message.caption or ""
-    logger.info(f"Получено фото от user_id={user_id} с подписью: '{caption[:50]}...'" )
+            # Сохраняем пользовательский запрос
+            await add_message_to_db(db, user_id, "user", user_text)
+            # Получаем историю
+            history = await get_context_messages(db, user_id)
+            response_stream = stream_xai_response(
+                dp.workflow_data['xai_client'],
+                SYSTEM_PROMPT,
+                history,
+                dialog_id=user_id
+            )
+        # Настройка для стриминга
+        current_text = ""
+        renderer = StreamingMarkdownRenderer()
+        formatting_failed = False
 
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
-    if not db or not current_settings:
-        await message.reply("Произошла внутренняя ошибка (код 1p), попробуйте позже.")
-        return
+        def _on_edit_error(message_id: int, e: TelegramAPIError):
+            nonlocal formatting_failed
+            logger.warning(f"Ошибка промежуточного редактирования сообщения {message_id}: {e}")
+            formatting_failed = True
+        # Ждём слот генерации (глобальный лимит), показывая позицию в очереди
+        async def _show_queue_position(position: int):
+            edit_throttler.submit(
+                chat_id,
+                progress_msg.message_id,
+                f"⏳ Вы #{position} в очереди на генерацию ответа...",
+                parse_mode=None,
+                reply_markup=cancel_keyboard
+            )
 
-    user_data = await get_or_create_user(
-        db, user_id, message.from_user.username,
-        message.from_user.first_name, message.from_user.last_name
-    )
-    if not user_data:
-        await message.reply("Произошла внутренняя ошибка (код 3p), попробуйте позже.")
-        return
+        scheduler: GenerationScheduler = dp.workflow_data['generation_scheduler']
+        async with scheduler.slot(user_id, priority, _show_queue_position):
+            # Стриминг ответа
+            async for chunk in response_stream:
+                full_raw += chunk
+                if progress_msg:
+                    previous_html = renderer.html()
+                    renderer.feed(chunk)
+                    if len(renderer.html() + '...') > TELEGRAM_MAX_LENGTH and current_text:
+                        # Лимит сообщения превышен: финализируем текущее и продолжаем в новом (как в message_handler)
+                        await edit_throttler.settle(chat_id, progress_msg.message_id)
+                        try:
+                            await edit_final_text(
+                                bot,
+                                text=previous_html if not formatting_failed else current_text,
+                                chat_id=chat_id,
+                                message_id=progress_msg.message_id,
+                                parse_mode=None if formatting_failed else ParseMode.HTML,
+                                reply_markup=None
+                            )
+                        except TelegramAPIError as e:
+                            logger.error(f"Ошибка финализации части ответа (ID: {progress_msg.message_id}): {e}")
+                        current_text = ""
+                        renderer = StreamingMarkdownRenderer()
+                        renderer.feed(chunk)
+                        try:
+                            progress_msg = await message.answer("...", reply_markup=progress_keyboard(user_id))
+                        except TelegramAPIError as e:
+                            logger.error(f"Ошибка отправки плейсхолдера для продолжения ответа: {e}")
+                            progress_msg = None
+                current_text += chunk
+                if progress_msg and not formatting_failed:
+                    edit_throttler.submit(
+                        chat_id,
+                        progress_msg.message_id,
+                        renderer.html() + '...',
+                        reply_markup=cancel_keyboard,
+                        on_error=_on_edit_error
+                    )
+        # Сохраняем ответ ассистента до доставки, чтобы ошибка правки не теряла его
+        if full_raw:
+            await add_message_to_db(db, user_id, "assistant", full_raw)
+        # Финализация
+        if progress_msg:
+            await edit_throttler.settle(chat_id, progress_msg.message_id)
+            final_text = renderer.html() if not formatting_failed else current_text
+            await edit_final_text(
+                bot,
+                text=final_text,
+                chat_id=chat_id,
+                message_id=progress_msg.message_id,
+                parse_mode=None if formatting_failed else ParseMode.HTML,
+                reply_markup=None
+            )
+            await message.answer("🫡", reply_markup=main_menu_keyboard())
+        else:
+            # Если progress_msg исчез, отправим новый
+            parts = split_text(markdown_to_telegram_html(current_text or full_raw))
+            for i, part in enumerate(parts):
+                await message.answer(part, parse_mode=ParseMode.HTML, reply_markup=main_menu_keyboard() if i == len(parts)-1 else None)
 
-    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
-    if not is_allowed:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
-        await message.reply(
-            "У вас закончились бесплатные запросы на сегодня 😔\n"
-            "Лимит учитывает отправку текста, фото и документов.\n"
-            "Оформите подписку для снятия ограничений.",
-            reply_markup=kb.as_markup()
-        )
-        return
+    except asyncio.CancelledError:
+        # При отмене
+        if progress_msg:
+            dp.workflow_data['edit_throttler'].drop(chat_id, progress_msg.message_id)
+            try:
+                await bot.edit_message_text(
+                    text="Генерация отменена.",
+                    chat_id=chat_id,
+                    message_id=progress_msg.message_id,
+                    reply_markup=None
+                )
+            except TelegramAPIError:
+                pass
+    except Exception as e:
+        unavailable = isinstance(e, XAIUnavailableError)
+        if unavailable:
+            logger.warning(f"Запрос user_id={user_id} не отправлен в xAI: {e}")
+        elif isinstance(e, DocumentError):
+            logger.warning(f"Документ user_id={user_id} не обработан: {e} ({e.__cause__!r})")
+        else:
+            logger.exception(f"Ошибка в generate_response_task для user_id={user_id}: {e}")
+        if progress_msg:
+            dp.workflow_data['edit_throttler'].drop(chat_id, progress_msg.message_id)
+            try:
+                await bot.edit_message_text(
+                    text="Сервис AI временно недоступен. Пожалуйста, попробуйте через минуту." if unavailable
+                    else str(e) if isinstance(e, DocumentError)
+                    else "Произошла ошибка при генерировании ответа.",
+                    chat_id=chat_id,
+                    message_id=progress_msg.message_id,
+                    reply_markup=None
+                )
+            except TelegramAPIError:
+                pass
+    finally:
+        if progress_msg:
+            dp.workflow_data['edit_throttler'].drop(chat_id, progress_msg.message_id)
+        await dp.workflow_data['state_backend'].release(generation_key(user_id), asyncio.current_task())
 
-    if caption:
-        chat_id = message.chat.id
-        user_text = caption
-        if user_id in active_requests:
-            await message.reply(
-                "Пожалуйста, дождитесь завершения предыдущего запроса или отмените его.",
+async def generate_image_task(
+    message: types.Message,
+    user_id: int,
+    prompt: str,
+    chat_id: int,
+    priority: int = GENERATION_PRIORITY_FREE
+):
+    """
+    Генерация изображения в фоне: сообщение-заглушка с кнопкой отмены, очередь
+    image_scheduler (отдельный лимит IMAGE_GENERATION_MAX_CONCURRENT), отправка фото.
+
+    Повторный запрос (ImageCache) отправляется по file_id уже загруженного в Telegram фото
+    без обращения к API. Если Telegram больше не принимает file_id, изображение генерируется заново.
+    """
+    current_settings: Settings = dp.workflow_data['settings']
+    image_cache: ImageCache | None = dp.workflow_data.get('image_cache')
+    edit_throttler: EditThrottler = dp.workflow_data['edit_throttler']
+    cache_key = image_cache.key_for(prompt) if image_cache else None
+    progress_msg = None
+    received_at = time.monotonic()
+    try:
+        progress_msg = await message.reply("🎨 Генерирую изображение...", reply_markup=progress_keyboard(user_id))
+        if cache_key:
+            file_id = await image_cache.lookup(cache_key)
+            if file_id:
+                try:
+                    await message.reply_photo(photo=file_id, reply_markup=main_menu_keyboard())
+                    image_cache.record_latency(True, time.monotonic() - received_at)
+                    return
+                except TelegramBadRequest as e:
+                    logger.warning(f"file_id из кэша изображений не принят Telegram: {e}")
+                    await image_cache.forget(cache_key)
+
+        queued = False
+
+        async def _show_queue_position(position: int):
+            nonlocal queued
+            queued = True
+            edit_throttler.submit(
+                chat_id,
+                progress_msg.message_id,
+                f"⏳ Вы #{position} в очереди на генерацию изображения...",
+                parse_mode=None,
                 reply_markup=progress_keyboard(user_id)
             )
-            return
-        task = asyncio.create_task(
-            generate_response_task(message, db, current_settings, user_id, user_text, chat_id)
-        )
-        active_requests[user_id] = task
-        task.add_done_callback(lambda t: active_requests.pop(user_id, None))
-    else:
-        await message.reply(
-            "Я получил ваше фото. Вы можете задать вопрос о нем в следующем сообщении."
-        )
-    return
 
-@dp.message(F.document)
-async def document_handler(message: types.Message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    file_name = message.document.file_name or "Без имени"
-    mime_type = message.document.mime_type or "Неизвестный тип"
-    file_id = message.document.file_id
-    logger.info(f"Получен документ от user_id={user_id}: {file_name} (type: {mime_type}, file_id: {file_id})")
+        scheduler: GenerationScheduler = dp.workflow_data['image_scheduler']
+        async with scheduler.slot(user_id, priority, _show_queue_position):
+            if queued:
+                # Вместо позиции в очереди снова показываем, что генерация идёт
+                edit_throttler.submit(
+                    chat_id,
+                    progress_msg.message_id,
+                    "🎨 Генерирую изображение...",
+                    parse_mode=None,
+                    reply_markup=progress_keyboard(user_id)
+                )
+            response = await asyncio.wait_for(
+                vision_async_client.images.generate(model=XAI_IMAGE_MODEL, prompt=prompt),
+                timeout=current_settings.IMAGE_GENERATION_TIMEOUT
+            )
+        sent = await message.reply_photo(photo=response.data[0].url, reply_markup=main_menu_keyboard())
+        if image_cache:
+            image_cache.record_latency(False, time.monotonic() - received_at)
+            if cache_key and sent.photo:
+                await image_cache.store(cache_key, prompt, sent.photo[-1].file_id)
+    except asyncio.CancelledError:
+        if progress_msg:
+            edit_throttler.drop(chat_id, progress_msg.message_id)
+            try:
+                await bot.edit_message_text(
+                    text="Генерация отменена.",
+                    chat_id=chat_id,
+                    message_id=progress_msg.message_id,
+                    reply_markup=None
+                )
+            except TelegramAPIError:
+                pass
+            progress_msg = None
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            logger.warning(f"Генерация изображения для user_id={user_id} не уложилась в {current_settings.IMAGE_GENERATION_TIMEOUT:.0f} с")
+        else:
+            logger.exception(f"Ошибка генерации фото для user_id={user_id}: {e}")
+        if progress_msg:
+            edit_throttler.drop(chat_id, progress_msg.message_id)
+            try:
+                await bot.edit_message_text(
+                    text="Произошла ошибка при генерации фото",
+                    chat_id=chat_id,
+                    message_id=progress_msg.message_id,
+                    reply_markup=None
+                )
+            except TelegramAPIError:
+                pass
+            progress_msg = None
+    finally:
+        # Заглушка больше не нужна: фото отправлено отдельным сообщением
+        if progress_msg:
+            edit_throttler.drop(chat_id, progress_msg.message_id)
+            with contextlib.suppress(TelegramAPIError):
+                await bot.delete_message(chat_id, progress_msg.message_id)
+        await dp.workflow_data['state_backend'].release(generation_key(user_id), asyncio.current_task())
 
-    db = dp.workflow_data.get('db')
-    current_settings = dp.workflow_data.get('settings')
-    if not db or not current_settings:
-        await message.reply("Произошла внутренняя ошибка (код 1d), попробуйте позже.")
-        return
+# --- НАЧАЛО: Админ-команды с проверкой is_admin ---
 
-    user_data = await get_or_create_user(db, user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
-    if not user_data:
-        await message.reply("Произошла внутренняя ошибка (код 3d), попробуйте позже.")
-        return
+# Список административных команд с описаниями
+ADMIN_COMMANDS_LIST = [
+    ("/admin", "Показать это сообщение с описанием команд."),
+    ("/stats", "Показать расширенную статистику по боту."),
+    ("/find_user", "`<id_or_username>` - Найти пользователя по ID или @username."),
+    ("/list_subs", "`[active|expired]` - Показать список пользователей с подписками (по умолчанию 'active', можно указать 'expired')."),
+    ("/grant_admin", "Выдать права администратора другому пользователю."),
+    ("/grant_sub", "`<user_id> <7|30>` - Выдать подписку пользователю на указанное количество дней."),
+    ("/send_to_user", "`<user_id> <text>` - Отправить сообщение пользователю от имени бота."),
+    ("/broadcast", "`<text>` - **ОСТОРОЖНО!** Отправить сообщение всем пользователям бота (выполняется в фоне)."),
+    ("/broadcast_status", "`[id]` - Прогресс рассылки и оценка времени до завершения."),
+    ("/broadcast_cancel", "`<id>` - Отменить рассылку."),
+]
 
-    is_allowed = await check_and_consume_limit(db, current_settings, user_id)
-    if not is_allowed:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="💎 Оформить подписку", callback_data="subscribe_info")
-        await message.reply(
-            "У вас закончились бесплатные запросы на сегодня 😔\n"
-            "Лимит учитывает отправку текста, фото и документов.\n"
-            "Оформите подписку для снятия ограничений.",
-            reply_markup=kb.as_markup()
-        )
-        return
+@dp.message(Command("admin"), IsAdmin())
+async def admin_help_menu(message: types.Message):
+    """Отправляет отформатированный список всех админ-команд."""
+    help_lines = ["<b>Административные команды:</b>\n"]
 
-    logger.info(f"Пользователь {user_id} допущен к обработке документа '{file_name}' (лимит OK).")
-    await message.reply(f"⏳ Начинаю обработку документа '{file_name}'...")
-    # Ваш код обработки документа здесь
+    for command, description in ADMIN_COMMANDS_LIST:
+        escaped_description = html.escape(description)
+        help_lines.append(f"<code>{command}</code> - {escaped_description}")
 
-# --- Обработчики для кнопок меню ReplyKeyboardMarkup
-@dp.message(F.text == "🔄 Новый диалог")
-async def handle_new_dialog_button(message: types.Message):
-    # Просто вызываем существующий обработчик команды /clear
-    await clear_command_handler(message)
+    help_text = "\n".join(help_lines)
+    await message.reply(help_text, parse_mode=ParseMode.HTML)
 
-@dp.message(F.text == "📊 Мои лимиты")
-async def handle_my_limits_button(message: types.Message):
-    user_id = message.from_user.id
+@dp.message(Command("stats"), IsAdmin())
+async def admin_stats_enhanced(message: types.Message):
+    """Расширенная статистика бота для админа."""
     db = dp.workflow_data.get('db')
-    if not db:
-        await message.reply("Ошибка получения данных.")
-        return
-    user_data = await get_user(db, user_id)
-    if not user_data:
-        await message.reply("Не удалось найти ваши данные.")
-        return
-    limit_info = f"Осталось бесплатных сообщений сегодня: {user_data.get('free_messages_today', 'N/A')}"
-    sub_info = "Подписка: неактивна"
-    if user_data.get('subscription_status') == 'active':
-        expires_ts = user_data.get('subscription_expires')
-        if isinstance(expires_ts, datetime.datetime):
-            expires_str = expires_ts.strftime('%Y-%m-%d %H:%M')
-            sub_info = f"Подписка активна до: {expires_str}"
-        else:
-            sub_info = f"Подписка активна до: {expires_ts}"
-    await message.reply(f"Информация о ваших лимитах:\n\n{limit_info}\n{sub_info}")
-
-@dp.message(F.text == "💎 Подписка")
-async def handle_subscription_button(message: types.Message):
-    # Заглушка раздела подписки
-    await message.reply(
-        "Раздел 'Подписка'.\n\n"
-        "Доступные тарифы:\n- 7 дней / 100 руб.\n- 30 дней / 300 руб.\n\n"
-        "(Функционал оплаты будет добавлен позже)"
-    )
-
-@dp.message(F.text == "🆘 Помощь")
-async def handle_help_button(message: types.Message):
-    help_text = (
-        "<b>Помощь по боту:</b>\n\n"
-        "🤖 Я первый \"умный\" и бесплатный AI ассистент.\n"
-        "❓ Просто напишите ваш вопрос, и я постараюсь ответить.\n"
-        "🔄 Используйте кнопку \"Новый диалог\" или команду /clear, чтобы очистить историю и начать разговор с чистого листа.\n"
-        "📊 Кнопка \"Мои лимиты\" покажет, сколько бесплатных сообщений у вас осталось сегодня или до какого числа действует подписка.\n"
-        "💎 Кнопка \"Подписка\" расскажет о платных тарифах для снятия лимитов."
-    )
-    await message.reply(help_text, reply_markup=main_menu_keyboard())
-
-@dp.message(F.text == "❓ Задать вопрос")
-async def handle_ask_question_button(message: types.Message):
-    await message.reply("Просто напишите ваш вопрос в чат 👇", reply_markup=main_menu_keyboard())
+    settings_local = dp.workflow_data.get('settings')
+    try:
+        stats = await get_extended_stats(db, settings_local)
+        report = (
+            "📊 *Расширенная Статистика* 📊\n\n"
+            "*Пользователи:*\n"
+            f"- Всего: {stats['total_users']}\n"
+            f"- Активных сегодня: {stats['active_today']}\n"
+            f"- Активных за 7 дней: {stats['active_week']}\n"
+            f"- Новых сегодня: {stats['new_today']}\n"
+            f"- Новых за 7 дней: {stats['new_week']}\n\n"
+            "*Подписки:*\n"
+            f"- Активных сейчас: {stats['active_subs']}\n"
+            f"- Новых сегодня: {stats['new_subs_today']}\n"
+            f"- Новых за 7 дней: {stats['new_subs_week']}\n"
+            f"- Истекает в ближайшие 7 дней: {stats['expiring_subs']}\n"
+        )
+        scheduler = dp.workflow_data.get('generation_scheduler')
+        if scheduler:
+            queue = scheduler.stats()
+            report += (
+                "\n*Очередь генераций:*\n"
+                f"- Выполняется: {queue['active']}/{queue['max_concurrent']}\n"
+                f"- В очереди: {queue['depth']} (максимум {queue['max_depth']})\n"
+                f"- Ожидание: среднее {queue['wait_avg']:.1f} с, p95 {queue['wait_p95']:.1f} с, макс. {queue['wait_max']:.1f} с\n"
+            )
+        image_scheduler = dp.workflow_data.get('image_scheduler')
+        if image_scheduler:
+            queue = image_scheduler.stats()
+            report += (
+                "\n*Генерация изображений:*\n"
+                f"- Выполняется: {queue['active']}/{queue['max_concurrent']}, в очереди: {queue['depth']} (максимум {queue['max_depth']})\n"
+                f"- Ожидание: среднее {queue['wait_avg']:.1f} с, p95 {queue['wait_p95']:.1f} с\n"
+            )
+            image_cache = dp.workflow_data.get('image_cache')
+            if image_cache:
+                images = image_cache.stats()
+                report += (
+                    f"- Кэш: попаданий {images['hits']}, промахов {images['misses']} ({images['hit_rate']:.0%} попаданий), "
+                    f"устаревших ссылок на фото {images['stale']}, вытеснено {images['evicted']}\n"
+                    f"- Время до фото p50: из кэша {images['hit_p50']:.2f} с, генерация {images['miss_p50']:.1f} с\n"
+                )
+        cache = user_cache.stats()
+        report += (
+            "\n*Кэш пользователей:*\n"
+            f"- Записей: {cache['size']}, попаданий: {cache['hits']}, промахов: {cache['misses']} ({cache['hit_rate']:.0%} попаданий)\n"
+        )
+        xai_client = dp.workflow_data.get('xai_client')
+        if xai_client:
+            prefix = xai_client.prefix_stats.stats()
+            report += (
+                "\n*Кэш промптов xAI:*\n"
+                f"- Начало запроса совпадает с прошлым запросом диалога: {prefix['reuse_ratio']:.0%} байт "
+                f"(в среднем {prefix['reused_avg'] / 1024:.1f} КиБ, запросов: {prefix['requests']})\n"
+            )
+        image_preprocessor = dp.workflow_data.get('image_preprocessor')
+        if image_preprocessor:
+            images = image_preprocessor.stats()
+            report += (
+                "\n*Фото (vision):*\n"
+                f"- Обработано: {images['processed']}, ошибок: {images['failed']}, в среднем {images['avg_ms']:.0f} мс\n"
+                f"- Объём: {images['bytes_in'] / 1048576:.1f} МиБ -> {images['bytes_out'] / 1048576:.1f} МиБ ({images['saved_ratio']:.0%} сэкономлено)\n"
+            )
+        document_extractor = dp.workflow_data.get('document_extractor')
+        if document_extractor:
+            documents = document_extractor.stats()
+            report += (
+                "\n*Документы:*\n"
+                f"- Обработано: {documents['documents']}, ошибок: {documents['failed']}\n"
+                f"- Страниц: {documents['pages']}, скорость извлечения {documents['pages_per_sec']:.0f} стр./с\n"
+            )
+        document_cache = dp.workflow_data.get('document_cache')
+        if document_cache:
+            cached_docs = document_cache.stats()
+            report += (
+                f"- Кэш: по идентификатору файла {cached_docs['file_hits']}, по содержимому {cached_docs['content_hits']}, "
+                f"промахов {cached_docs['misses']} ({cached_docs['hit_rate']:.0%} попаданий)\n"
+                f"- Сэкономлено времени: {cached_docs['saved_seconds']:.0f} с (в среднем {cached_docs['saved_avg']:.1f} с на попадание), "
+                f"вытеснено {cached_docs['evicted']}\n"
+            )
+        response_cache = dp.workflow_data.get('response_cache')
+        if response_cache:
+            answers = response_cache.stats()
+            report += (
+                "\n*Кэш ответов:*\n"
+                f"- Попаданий: {answers['hits']}, промахов: {answers['misses']} ({answers['hit_rate']:.0%} попаданий), с контекстом: {answers['bypassed']}\n"
+                f"- Сохранено: {answers['stored']}, вытеснено: {answers['evicted']}\n"
+                f"- Время ответа p50: из кэша {answers['hit_p50']:.2f} с, генерация {answers['miss_p50']:.2f} с\n"
+            )
+        edit_throttler = dp.workflow_data.get('edit_throttler')
+        if edit_throttler:
+            edits = edit_throttler.stats()
+            report += (
+                "\n*Правки при стриминге:*\n"
+                f"- Отправлено: {edits['sent']}, объединено: {edits['coalesced']}, без изменений: {edits['skipped']}\n"
+                f"- RetryAfter: {edits['throttled']}, ошибок: {edits['failed']}, темп: {edits['global_rate']:.1f}/с\n"
+            )
+        await message.reply(report, parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logger.exception("Ошибка получения расширенной статистики")
+        await message.reply(f"Ошибка получения статистики: {e}")
 
-@dp.message(F.text == "📸 Генерация фото")
-async def handle_generate_photo_button(message: types.Message):
-    user_id = message.from_user.id
-    pending_photo_prompts.add(user_id)
-    await message.reply("Напишите запрос для генерации фото (опишите, что хотите увидеть)", reply_markup=main_menu_keyboard())
+@dp.message(Command("grant_admin"), IsAdmin())
+async def grant_admin_handler(message: types.Message):
+    db = dp.workflow_data.get('db')
+    # Разбор аргументов
+    parts = message.text.strip().split(maxsplit=1)
+    if len(parts) != 2:
+        return await message.reply("Использование: /grant_admin <user_id>")
+    try:
+        target_id = int(parts[1])
+    except ValueError:
+        return await message.reply("Неверный формат ID пользователя.")
+    # Проверка существования пользователя
+    target = await get_user(db, target_id)
+    if not target:
+        return await message.reply(f"Пользователь {target_id} не найден.")
+    # Обновляем права администратора
+    await update_user_admin(db, target_id, True)
+    await message.reply(f"✅ Пользователь {target_id} теперь администратор.")
 
-# --- Функции запуска и остановки ---
+@dp.message(Command("grant_sub"), IsAdmin())
+async def grant_sub_handler(message: types.Message):
+    """Выдаёт подписку пользователю на 7 или 30 дней."""
+    db = dp.workflow_data.get('db')
+    parts = message.text.strip().split(maxsplit=2)
+    if len(parts) != 3:
+        return await message.reply("Использование: /grant_sub <user_id> <days>")
+    try:
+        target_id = int(parts[1])
+        days = int(parts[2])
+    except ValueError:
+        return await message.reply("Неверный формат, нужно: /grant_sub <user_id> <days>")
+    if days not in (7, 30):
+        return await message.reply("Можно выдать подписку только на 7 или 30 дней.")
+    target = await get_user(db, target_id)
+    if not target:
+        return await message.reply(f"Пользователь {target_id} не найден.")
+    await update_user_subscription(db, target_id, days)
+    new_data = await get_user(db, target_id)
+    expires = new_data.get('subscription_expires')
+    await message.reply(f"✅ Подписка выдана пользователю {target_id} на {days} дней (до {expires}).")
 
-# Восстанавливаем функцию on_shutdown
-async def on_shutdown(**kwargs):
-    logger.info("Завершение работы бота...")
-    # Получаем dp и из него workflow_data
-    dp_local = kwargs.get('dispatcher') # aiogram передает dispatcher
-    if not dp_local:
-        logger.error("Не удалось получить dispatcher в on_shutdown")
+@dp.message(Command("broadcast"), IsAdmin())
+async def broadcast_handler(message: types.Message, command: CommandObject):
+    text = (command.args or "").strip()
+    if not text:
+        await message.reply("Использование: /broadcast <текст>")
         return
+    engine: BroadcastEngine = dp.workflow_data['broadcast_engine']
+    job = await engine.start(text, message.from_user.id)
+    await message.reply(
+        f"Рассылка #{job['id']} запущена: получателей {job['total']}.\n"
+        f"Прогресс: /broadcast_status {job['id']}, отмена: /broadcast_cancel {job['id']}"
+    )
 
-    db = dp_local.workflow_data.get('db')
-    settings_local = dp_local.workflow_data.get('settings')
-
-    if db and settings_local:
-        if not settings_local.USE_SQLITE:
-            try:
-                # db здесь это пул соединений asyncpg
-                if isinstance(db, asyncpg.Pool):
-                    await db.close()
-                    logger.info("Пул соединений PostgreSQL успешно закрыт")
-                else:
-                    logger.warning("Объект 'db' не является пулом asyncpg, закрытие не выполнено.")
-            except Exception as e:
-                logger.error(f"Ошибка при закрытии пула соединений PostgreSQL: {e}")
-        else:
-            logger.info("Используется SQLite, явное закрытие пула не требуется.")
-    else:
-         logger.warning("Не удалось получить 'db' или 'settings' из workflow_data при завершении работы.")
-
-    logger.info("Бот остановлен.")
-
+def _format_duration(seconds: float) -> str:
+    minutes, sec = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин {sec} с"
 
-# --- Установка команд бота (если еще не сделано) ---
-async def set_bot_commands(bot_instance: Bot):
-    commands = [
-        types.BotCommand(command="/start", description="Начать диалог / Показать меню"),
-        types.BotCommand(command="/clear", description="Очистить историю диалога"),
-        # Админ-панель
-        types.BotCommand(command="/admin", description="Список команд администратора"),
-        types.BotCommand(command="/stats", description="Показать статистику бота"),
-        types.BotCommand(command="/find_user", description="Поиск пользователя по ID или username"),
-        types.BotCommand(command="/list_subs", description="Список пользователей по подписке"),
-        types.BotCommand(command="/grant_admin", description="Выдать права администратора"),
-        types.BotCommand(command="/grant_sub", description="Выдать подписку на 7 или 30 дней"),
-        types.BotCommand(command="/send_to_user", description="Отправить сообщение конкретному пользователю"),
-        types.BotCommand(command="/broadcast", description="Рассылка сообщения всем пользователям"),
+@dp.message(Command("broadcast_status"), IsAdmin())
+async def broadcast_status_handler(message: types.Message, command: CommandObject):
+    """Прогресс рассылки (последней, если id не указан) со скоростью и оценкой времени до конца."""
+    db = dp.workflow_data.get('db')
+    engine: BroadcastEngine = dp.workflow_data['broadcast_engine']
+    arg = (command.args or "").strip()
+    if arg and not arg.isdigit():
+        return await message.reply("Использование: /broadcast_status [id]")
+    job = await get_broadcast_job(db, int(arg) if arg else None)
+    if not job:
+        return await message.reply("Рассылок пока не было." if not arg else f"Рассылка #{arg} не найдена.")
+    progress = engine.progress(job)
+    percent = progress['processed'] / progress['total'] * 100 if progress['total'] else 100.0
+    lines = [
+        f"Рассылка #{job['id']} ({progress['status']})",
+        f"Обработано: {progress['processed']}/{progress['total']} ({percent:.1f}%)",
+        f"Отправлено: {progress['sent']}, ошибок: {progress['failed']}, заблокировали бота: {progress['blocked']}",
     ]
-    try:
-        await bot_instance.set_my_commands(commands)
-        logger.info("Команды бота успешно установлены.")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка при установке команд бота: {e}")
-
-# --- Главная функция запуска ---
-async def main():
-    logger.info(f"Запуск приложения с настройками базы данных: {settings.DATABASE_URL}")
-    db_connection = None # Переименуем, чтобы не конфликтовать с именем модуля
+    if progress['rate'] > 0:
+        lines.append(f"Скорость: {progress['rate']:.1f} сообщ./с")
+    if progress['status'] == 'running' and progress['eta'] is not None:
+        lines.append(f"Осталось примерно: {_format_duration(progress['eta'])}")
+    await message.reply("\n".join(lines))
+
+@dp.message(Command("broadcast_cancel"), IsAdmin())
+async def broadcast_cancel_handler(message: types.Message, command: CommandObject):
+    engine: BroadcastEngine = dp.workflow_data['broadcast_engine']
+    arg = (command.args or "").strip()
+    if not arg.isdigit():
+        return await message.reply("Использование: /broadcast_cancel <id>")
+    if await engine.cancel(int(arg)):
+        await message.reply(f"Рассылка #{arg} отменена.")
+    else:
+        await message.reply(f"Рассылка #{arg} не выполняется.")
 
+@dp.message(Command("find_user"), IsAdmin())
+async def admin_find_user(message: types.Message, command: CommandObject):
+    """Поиск пользователя по ID или username для админа."""
+    db = dp.workflow_data.get('db')
+    settings_local = dp.workflow_data.get('settings')
+    if not db:
+        return await message.reply("Ошибка БД")
+    if not command.args:
+        return await message.reply("Укажите ID или username: /find_user <query>")
+    query = command.args.strip()
+    user_data = None
+    # Попытка поиска по ID
     try:
-        # Выбор типа БД на основе URL из настроек
-        if settings.USE_SQLITE:
-            logger.info("Используется SQLite для хранения данных")
-            db_connection = await init_sqlite_db(settings.DATABASE_URL) # Возвращает путь
+        user_id_to_find = int(query)
+        user_data = await get_user(db, user_id_to_find)
+    except ValueError:
+        # Поиск по username
+        query_lower = query.lower().lstrip('@')
+        if settings_local.USE_SQLITE:
+            def _find_by_username(conn: sqlite3.Connection):
+                cur = conn.cursor()
+                cur.execute(
+                    "SELECT * FROM users WHERE lower(username) = ?", (query_lower,)
+                )
+                row = cur.fetchone()
+                return dict(row) if row else None
+            user_data = await db.run(_find_by_username)
         else:
-            logger.info("Используется PostgreSQL для хранения данных")
-            # Попытка подключения с таймаутом и обработкой ошибок
-            try:
-                logger.info(f"Подключение к PostgreSQL: {settings.DATABASE_URL}")
-                # Увеличим таймауты для create_pool
-                db_connection = await asyncio.wait_for(
-                    asyncpg.create_pool(dsn=settings.DATABASE_URL, timeout=30.0, command_timeout=60.0, min_size=1, max_size=10),
-                    timeout=45.0 # Общий таймаут на создание пула
+            async with db.acquire() as conn:
+                row = await conn.fetchrow(
+                    "SELECT * FROM users WHERE lower(username) = $1", query_lower
                 )
-                if not db_connection:
-                    logger.error("Не удалось создать пул соединений PostgreSQL (вернулся None)")
-                    sys.exit(1)
-
-                logger.info("Пул соединений PostgreSQL успешно создан")
-                # Проверим соединение и инициализируем таблицу
-                await init_db_postgres(db_connection)
-
-            except asyncio.TimeoutError:
-                logger.error("Превышен таймаут подключения к базе данных PostgreSQL")
-                sys.exit(1)
-            except (socket.gaierror, OSError) as e: # Ошибки сети/DNS
-                logger.error(f"Ошибка сети или DNS при подключении к PostgreSQL: {e}. Проверьте хост/порт в DATABASE_URL.")
-                sys.exit(1)
-            except asyncpg.exceptions.InvalidPasswordError:
-                 logger.error("Ошибка аутентификации PostgreSQL: неверный пароль.")
-                 sys.exit(1)
-            except asyncpg.exceptions.InvalidCatalogNameError as e: # Добавляем обработку InvalidCatalogNameError
-                 logger.error(f"Ошибка PostgreSQL: база данных, указанная в URL, не найдена. {e}")
-                 sys.exit(1)
-            except asyncpg.PostgresError as e:
-                logger.error(f"Общая ошибка PostgreSQL при подключении/инициализации: {e}")
-                sys.exit(1)
-
-        # Сохраняем зависимости (путь к SQLite или пул PG) в workflow_data
-        dp.workflow_data['db'] = db_connection
-        dp.workflow_data['settings'] = settings
-        logger.info("Зависимости DB и Settings успешно сохранены в dispatcher")
-
-        # Регистрация обработчиков (декораторы уже сделали это)
-        logger.info("Обработчики команд и сообщений зарегистрированы")
-
-        # Регистрация обработчика shutdown БЕЗ передачи аргументов
-        dp.shutdown.register(on_shutdown)
-        logger.info("Обработчик shutdown зарегистрирован")
-
-        # Установка команд бота - помещаем здесь, в конце блока try
-        await set_bot_commands(bot)
+                user_data = dict(row) if row else None
+    if not user_data:
+        return await message.reply(f"Пользователь по запросу '{query}' не найден.")
+    # Форматирование информации о пользователе
+    info_lines = [f"Найден пользователь по запросу '{query}':"]
+    info_lines.append(f"ID: {user_data.get('user_id')}")
+    info_lines.append(f"Username: {user_data.get('username')}")
+    info_lines.append(
+        f"Имя: {user_data.get('first_name')} {user_data.get('last_name')}"
+    )
+    info_lines.append(f"Регистрация: {user_data.get('registration_date')}")
+    info_lines.append(
+        f"Последняя активность: {user_data.get('last_active_date')}"
+    )
+    info_lines.append(
+        f"Бесплатных сегодня: {user_data.get('free_messages_today')}"
+    )
+    info_lines.append(
+        f"Подписка: {user_data.get('subscription_status')}"
+    )
+    info_lines.append(
+        f"Конец подписки: {user_data.get('subscription_expires')}"
+    )
+    info_lines.append(f"Админ: {user_data.get('is_admin')}" )
+    await message.reply("\n".join(info_lines))
 
-    except Exception as e:
-        logger.exception(f"Критическая ошибка при инициализации бота: {e}")
-        sys.exit(1)
+@dp.message(Command("list_subs"), IsAdmin())
+async def list_subs_handler(message: types.Message, command: CommandObject):
+    db = dp.workflow_data.get('db')
+    settings_local = dp.workflow_data.get('settings')
+    mode = (command.args or "active").strip().lower()
+    logger.info(f"Admin {message.from_user.id} вызвал /list_subs mode={mode}")
+    if settings_local.USE_SQLITE:
+        def _list(conn: sqlite3.Connection):
+            cur = conn.cursor()
+            if mode == "active":
+                cur.execute("SELECT user_id, username FROM users WHERE subscription_status='active'")
+            else:
+                cur.execute(
+                    "SELECT user_id, username FROM users WHERE subscription_status='inactive' AND DATE(subscription_expires) BETWEEN DATE('now','-7 days') AND DATE('now')"
+                )
+            return [dict(r) for r in cur.fetchall()]
+        subs = await db.run(_list)
+    else:
+        async with db.acquire() as conn:
+            if mode == "active":
+                records = await conn.fetch("SELECT user_id, username FROM users WHERE subscription_status='active'")
+            else:
+                records = await conn.fetch(
+                    "SELECT user_id, username FROM users WHERE subscription_status='inactive' AND subscription_expires BETWEEN (NOW() - INTERVAL '7 days') AND NOW()"
+                )
+            subs = [dict(r) for r in records]
+    if not subs:
+        await message.reply("Нет пользователей для данного режима.")
+        return
+    lines = [f"{s['user_id']} (@{s.get('username','')})" for s in subs]
+    text = f"Список подписок ({mode}):\n" + "\n".join(lines)
+    await message.reply(text)
 
-    # Запускаем бота
-    logger.info("Запуск бота (polling)...")
+@dp.message(Command("send_to_user"), IsAdmin())
+async def send_to_user_handler(message: types.Message, command: CommandObject):
+    db = dp.workflow_data.get('db')
+    settings_local = dp.workflow_data.get('settings')
+    # Либо фильтр IsAdmin
+    parts = (command.args or "").split(None, 1)
+    if len(parts) < 2:
+        await message.reply("Использование: /send_to_user <user_id> <текст>")
+        return
+    try:
+        target = int(parts[0])
+    except ValueError:
+        await message.reply("Неверный user_id.")
+        return
+    text = parts[1]
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        await bot.send_message(target, text)
+        logger.info(f"Admin {message.from_user.id} отправил сообщение пользователю {target}")
+        await message.reply(f"Сообщение пользователю {target} отправлено.")
     except Exception as e:
-        logger.exception(f"Критическая ошибка во время работы бота: {e}")
-    finally:
-        # Закрытие сессии бота (важно для корректного завершения)
-        await bot.session.close()
-        logger.info("Сессия бота закрыта.")
+        logger.warning(f"Ошибка при отправке {target}: {e}")
+        await message.reply(f"Не удалось отправить сообщение пользователю {target}.")
 
-# Отдельная асинхронная функция для очистки задач
-async def cleanup_tasks():
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    if tasks:
-        logger.info(f"Ожидание завершения {len(tasks)} фоновых задач...")
-        [task.cancel() for task in tasks]
-        try:
-            await asyncio.gather(*tasks, return_exceptions=True)
-            logger.info("Фоновые задачи завершены.")
-        except asyncio.CancelledError:
-             logger.info("Задачи были отменены во время завершения.")
+# --- КОНЕЦ: Админ-команды ---
+
+# --- Admin helper functions: сбор статистики бота ---
+async def get_extended_stats(db, settings: Settings) -> dict[str, int]:
+    """
+    Собирает расширенную статистику пользователей и подписок.
+
+    Читает дневные агрегаты (stats_*), которые ведут триггеры на users, — O(дней), а не O(пользователей).
+    Подписки, заканчивающиеся в граничные дни окна, досчитываются по индексу idx_users_subscription,
+    чтобы результат совпадал с исходными условиями с точностью до времени.
+    """
+    # SQLite
+    if settings.USE_SQLITE:
+        def _ext(conn: sqlite3.Connection):
+            row = conn.execute(
+                """
+                SELECT
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations) AS total,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_last_active WHERE day >= DATE('now')) AS active_today,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_last_active WHERE day >= DATE('now','-7 days')) AS active_week,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations WHERE day >= DATE('now')) AS new_today,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations WHERE day >= DATE('now','-7 days')) AS new_week,
+                 (SELECT COALESCE(SUM(subs), 0) FROM stats_sub_expiry WHERE day > DATE('now'))
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires > DATE('now') AND subscription_expires < DATE('now','+1 day')) AS active_subs,
+                 (SELECT COALESCE(SUM(subscribed), 0) FROM stats_registrations WHERE day >= DATE('now')) AS new_subs_today,
+                 (SELECT COALESCE(SUM(subscribed), 0) FROM stats_registrations WHERE day >= DATE('now','-7 days')) AS new_subs_week,
+                 (SELECT COALESCE(SUM(subs), 0) FROM stats_sub_expiry WHERE day > DATE('now') AND day < DATE('now','+7 days'))
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires >= DATE('now') AND subscription_expires < DATE('now','+1 day'))
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires >= DATE('now','+7 days') AND subscription_expires <= DATE('now','+7 days')) AS expiring_subs
+                """
+            ).fetchone()
+            return dict(row)
+        rec = await db.run(_ext)
+    # PostgreSQL
+    else:
+        async with db.acquire() as conn:
+            rec = await conn.fetchrow(
+                """
+                SELECT
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations) AS total,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_last_active WHERE day >= CURRENT_DATE) AS active_today,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_last_active WHERE day >= CURRENT_DATE - 7) AS active_week,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations WHERE day >= CURRENT_DATE) AS new_today,
+                 (SELECT COALESCE(SUM(users), 0) FROM stats_registrations WHERE day >= CURRENT_DATE - 7) AS new_week,
+                 (SELECT COALESCE(SUM(subs), 0) FROM stats_sub_expiry WHERE day > CURRENT_DATE)
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires > NOW() AND subscription_expires < CURRENT_DATE + 1) AS active_subs,
+                 (SELECT COALESCE(SUM(subscribed), 0) FROM stats_registrations WHERE day >= CURRENT_DATE) AS new_subs_today,
+                 (SELECT COALESCE(SUM(subscribed), 0) FROM stats_registrations WHERE day >= CURRENT_DATE - 7) AS new_subs_week,
+                 (SELECT COALESCE(SUM(subs), 0) FROM stats_sub_expiry WHERE day > CURRENT_DATE AND day < CURRENT_DATE + 7)
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires >= NOW() AND subscription_expires < CURRENT_DATE + 1)
+                  + (SELECT COUNT(*) FROM users WHERE subscription_status='active'
+                       AND subscription_expires >= CURRENT_DATE + 7 AND subscription_expires <= NOW() + INTERVAL '7 days') AS expiring_subs
+                """
+            )
+    return {
+        'total_users': int(rec['total']),
+        'active_today': int(rec['active_today']),
+        'active_week': int(rec['active_week']),
+        'new_today': int(rec['new_today']),
+        'new_week': int(rec['new_week']),
+        'active_subs': int(rec['active_subs']),
+        'new_subs_today': int(rec['new_subs_today']),
+        'new_subs_week': int(rec['new_subs_week']),
+        'expiring_subs': int(rec['expiring_subs'])
+    }
 
 # --- Функция для обновления прав администратора пользователя ---
 async def update_user_admin(db, target_user_id: int, make_admin: bool):
     """Обновляет флаг is_admin для пользователя target_user_id"""
     if settings.USE_SQLITE:
-        def _upd():
-            conn = sqlite3.connect(db)
-            cur = conn.cursor()
-            cur.execute(
+        def _upd(conn: sqlite3.Connection):
+            conn.execute(
                 "UPDATE users SET is_admin = ? WHERE user_id = ?",
                 (1 if make_admin else 0, target_user_id)
             )
-            conn.commit()
-            conn.close()
-        await asyncio.to_thread(_upd)
+        await db.run(_upd)
     else:
         async with db.acquire() as conn:
             await conn.execute(
                 "UPDATE users SET is_admin = $1 WHERE user_id = $2",
                 make_admin, target_user_id
             )
+    user_cache.update(target_user_id, is_admin=(1 if make_admin else 0) if settings.USE_SQLITE else make_admin)
 
 # --- Функция для выдачи подписки пользователю на указанное количество дней ---
 async def update_user_subscription(db, target_user_id: int, days: int):
     """Активирует подписку пользователя на days дней."""
     if settings.USE_SQLITE:
-        def _upd():
-            conn = sqlite3.connect(db)
-            cur = conn.cursor()
-            cur.execute(
+        def _upd(conn: sqlite3.Connection):
+            conn.execute(
                 "UPDATE users SET subscription_status='active', subscription_expires=date('now', '+' || ? || ' days') WHERE user_id = ?",
                 (days, target_user_id)
             )
-            conn.commit()
-            conn.close()
-        await asyncio.to_thread(_upd)
+        await db.run(_upd)
     else:
         async with db.acquire() as conn:
             await conn.execute(
                 "UPDATE users SET subscription_status='active', subscription_expires = NOW() + $1 * INTERVAL '1 day' WHERE user_id = $2",
                 days, target_user_id
             )
+    # Дату окончания вычисляет БД: перечитаем строку при следующем обращении
+    user_cache.invalidate(target_user_id)
 
 # Запускаем бота
 if __name__ == "__main__":
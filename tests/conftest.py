@@ -0,0 +1,25 @@
+"""
+Общая настройка тестов: main.py читает настройки при импорте, поэтому обязательные
+переменные окружения задаются до него. База по умолчанию — SQLite во временном каталоге;
+тесты, которым нужна своя база, создают её через init_sqlite_db в tmp_path.
+
+Запуск:
+    pip install -r requirements.txt -r requirements-dev.txt
+    python -m pytest -q
+"""
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("XAI_API_KEY", "test-key")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bot-tests-'), 'bot.db')}")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import main  # noqa: E402,F401
+
+logging.disable(logging.INFO)
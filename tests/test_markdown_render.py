@@ -0,0 +1,43 @@
+"""StreamingMarkdownRenderer: при любой нарезке потока html() совпадает с markdown_to_telegram_html."""
+import pytest
+from hypothesis import HealthCheck, given, settings, strategies as st
+
+import main
+
+# Фрагменты разметки, которые чаще всего оказываются разрезаны между чанками
+TOKENS = [
+    "**", "*", "__", "_", "`", "```", "```py\n", "~~", "||", "[", "]", "(", ")", "](", "#", "## ",
+    "\n", "\n\n", "\n\n\n", " ", "a", "bc", "word", "<", "&", "x_y", "http://a.b/c_d", "- ", "1. ", "\t",
+    "* ", "\n* ", " * ", "snake_case.py", "_a_", "*b*",
+]
+markdown_text = st.lists(st.sampled_from(TOKENS), max_size=200).map("".join)
+
+
+@settings(max_examples=1000, deadline=None, suppress_health_check=[HealthCheck.too_slow])
+@given(markdown_text, st.lists(st.integers(0, 400), max_size=15))
+def test_streamed_html_matches_full_render(text, cuts):
+    renderer = main.StreamingMarkdownRenderer()
+    position = 0
+    for cut in sorted(min(cut, len(text)) for cut in cuts) + [len(text)]:
+        renderer.feed(text[position:cut])
+        position = cut
+        assert renderer.html() == main.markdown_to_telegram_html(text[:cut])
+
+
+def test_two_code_spans_keep_placeholders_intact():
+    text = "Сравните `len(a)` и `sum(b)`, затем _проверьте_ ответ."
+    expected = "Сравните <code>len(a)</code> и <code>sum(b)</code>, затем <i>проверьте</i> ответ."
+    assert main.markdown_to_telegram_html(text) == expected
+    assert main.StreamingMarkdownRenderer(text).html() == expected
+
+
+@pytest.mark.parametrize("first", ["* пункт один", "файл snake_case.py", "5 * 3 = 15"])
+def test_unpaired_marker_does_not_block_later_commits(first):
+    paragraphs = [first] + [f"Абзац {i} с **жирным** и _курсивом_." for i in range(20)]
+    text = "\n\n".join(paragraphs)
+    renderer = main.StreamingMarkdownRenderer()
+    for i in range(0, len(text), 20):
+        renderer.feed(text[i:i + 20])
+        assert renderer.html() == main.markdown_to_telegram_html(text[:i + 20])
+    # Зафиксировано всё, кроме последнего абзаца
+    assert renderer._tail == paragraphs[-1]
@@ -0,0 +1,133 @@
+"""
+/metrics после одного сообщения через message_handler: заглушки Bot API и xAI на свободных
+портах, база — временный SQLite-файл, сервер метрик — start_metrics_server на порту 0.
+"""
+import asyncio
+import json
+import re
+import time
+
+import aiohttp
+import pytest
+from aiogram import types
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import main
+
+USER_ID = 700_000_001
+ANSWER = ["Нормальная глюкоза натощак — ", "**3.3–5.5 ммоль/л**", ".\n\nПовторите анализ ", "через *месяц*."]
+
+
+async def start_app(routes: list[tuple[str, str, object]]) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+async def bot_api(request: web.Request) -> web.Response:
+    method = request.match_info["method"]
+    data = await request.post()
+    if method in ("sendMessage", "editMessageText"):
+        chat_id = int(data.get("chat_id") or 0)
+        message_id = int(data.get("message_id") or 0) or 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+        }})
+    return web.json_response({"ok": True, "result": True})
+
+
+async def xai_api(request: web.Request) -> web.StreamResponse:
+    await request.read()
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for piece in ANSWER:
+        chunk = {"choices": [{"delta": {"content": piece}}]}
+        await response.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+        await asyncio.sleep(0.05)  # стриминг идёт дольше интервала правок: будут промежуточные правки
+    await response.write(b'data: {"choices":[{"delta":{},"finish_reason":"stop"}]}\n\ndata: [DONE]\n\n')
+    return response
+
+
+def make_update(text: str) -> types.Update:
+    return types.Update(**{"update_id": 1, "message": {
+        "message_id": 1, "date": int(time.time()),
+        "chat": {"id": USER_ID, "type": "private"},
+        "from": {"id": USER_ID, "is_bot": False, "first_name": "metrics"},
+        "text": text,
+    }})
+
+
+def histogram_count(text: str, name: str, labels: str = "") -> int:
+    match = re.search(rf"^{name}_count{re.escape(labels)} (\d+)$", text, flags=re.MULTILINE)
+    return int(match.group(1)) if match else 0
+
+
+@pytest.fixture
+def workflow_data(monkeypatch):
+    monkeypatch.setattr(main.settings, "USE_SQLITE", True)
+    monkeypatch.setattr(main.dp, "workflow_data", dict(main.dp.workflow_data))
+    monkeypatch.setattr(main.bot.session, "api", main.bot.session.api)
+    return main.dp.workflow_data
+
+
+def test_metrics_endpoint_after_one_message(tmp_path, workflow_data):
+    async def scenario():
+        telegram, telegram_url = await start_app([("POST", "/bot{token}/{method}", bot_api)])
+        xai, xai_url = await start_app([("POST", "/v1/chat/completions", xai_api)])
+        main.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+        db = await main.init_sqlite_db(f"sqlite:///{tmp_path / 'metrics.db'}")
+        xai_client = main.XAIClient("test-key", base_url=f"{xai_url}/v1")
+        workflow_data.update(
+            db=db,
+            settings=main.settings,
+            generation_scheduler=main.GenerationScheduler(2),
+            edit_throttler=main.EditThrottler(main.bot, min_interval=0.01, max_interval=0.05),
+            state_backend=main.LocalStateBackend(),
+            xai_client=xai_client,
+        )
+        metrics_runner = await main.start_metrics_server("127.0.0.1", 0)
+        assert metrics_runner is not None
+        try:
+            await main.dp.feed_update(main.bot, make_update("Какая норма глюкозы натощак?"))
+            port = metrics_runner.addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    assert response.status == 200
+                    assert response.content_type == "text/plain"
+                    return await response.text()
+        finally:
+            await metrics_runner.cleanup()
+            await xai_client.close()
+            await main.bot.session.close()
+            await db.close()
+            await xai.cleanup()
+            await telegram.cleanup()
+
+    text = asyncio.run(scenario())
+    for name, kind in (
+        ("bot_db_query_seconds", "histogram"),
+        ("bot_xai_first_token_seconds", "histogram"),
+        ("bot_xai_tokens_per_second", "histogram"),
+        ("bot_xai_stream_seconds", "histogram"),
+        ("bot_telegram_edit_seconds", "histogram"),
+        ("bot_markdown_render_seconds", "histogram"),
+        ("bot_telegram_retry_after_total", "counter"),
+        ("bot_generation_cancellations_total", "counter"),
+        ("bot_generation_queue_depth", "gauge"),
+        ("bot_generations_active", "gauge"),
+    ):
+        assert f"# TYPE {name} {kind}" in text
+    # Сообщение прошло горячий путь: БД, стриминг xAI, правки, рендер
+    assert histogram_count(text, "bot_db_query_seconds", '{query="add_message_to_db"}') >= 1
+    assert histogram_count(text, "bot_xai_first_token_seconds") >= 1
+    assert histogram_count(text, "bot_xai_stream_seconds", '{outcome="ok"}') >= 1
+    assert histogram_count(text, "bot_telegram_edit_seconds", '{outcome="ok"}') >= 1
+    assert 'bot_xai_first_token_seconds_bucket{le="+Inf"}' in text
+    assert 'bot_generations_active{kind="text"} 0' in text
@@ -0,0 +1,109 @@
+"""DatabaseStateBackend на временном SQLite-файле: два экземпляра изображают два процесса бота."""
+import asyncio
+
+import pytest
+
+import main
+
+KEY = main.generation_key(42)
+
+
+@pytest.fixture(autouse=True)
+def _sqlite(monkeypatch):
+    monkeypatch.setattr(main.settings, "USE_SQLITE", True)
+
+
+def run_with_backends(tmp_path, scenario, **kwargs):
+    """Запускает scenario(a, b) с двумя бэкендами над одним файлом базы и закрывает их."""
+    async def _run():
+        db = await main.init_sqlite_db(f"sqlite:///{tmp_path / 'state.db'}")
+        a = main.DatabaseStateBackend(db, **kwargs)
+        b = main.DatabaseStateBackend(db, **kwargs)
+        try:
+            await scenario(a, b)
+        finally:
+            await a.stop()
+            await b.stop()
+            await db.close()
+    asyncio.run(_run())
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "условие не выполнилось за отведённое время"
+        await asyncio.sleep(0.01)
+
+
+def test_acquire_rejects_duplicate_until_release(tmp_path):
+    async def scenario(a, b):
+        assert await a.acquire(KEY, None)
+        assert not await a.acquire(KEY, None)
+        assert not await b.acquire(KEY, None)
+        # Чужая задача не освобождает аренду
+        await a.release(KEY, asyncio.current_task())
+        assert not await b.acquire(KEY, None)
+        await a.release(KEY, None)
+        assert await b.acquire(KEY, None)
+    run_with_backends(tmp_path, scenario)
+
+
+def test_cancel_from_other_owner_cancels_task(tmp_path):
+    async def scenario(a, b):
+        a.start()
+        task = asyncio.create_task(asyncio.sleep(60))
+        assert await a.acquire(KEY, task)
+        assert await b.cancel(KEY)
+        await wait_for(task.done)
+        assert task.cancelled()
+        assert a.remote_cancels == 1
+        assert not await b.cancel(KEY)
+        # Ключ свободен для нового запроса
+        assert await b.acquire(KEY, None)
+    run_with_backends(tmp_path, scenario, poll_interval=0.02)
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    async def scenario(a, b):
+        a.start()
+        task = asyncio.create_task(asyncio.sleep(60))
+        assert await a.acquire(KEY, task)
+        # Владелец продлевает аренду: спустя несколько stale_after она всё ещё занята
+        await asyncio.sleep(0.8)
+        assert not await b.acquire(KEY, None)
+        assert not task.done()
+        task.cancel()
+    run_with_backends(tmp_path, scenario, poll_interval=0.02, stale_after=0.2)
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    async def scenario(a, b):
+        # Сверка не запущена (процесс «завис»): аренда не продлевается
+        assert await a.acquire(KEY, None)
+        assert not await b.acquire(KEY, None)
+        await asyncio.sleep(0.3)
+        assert await b.acquire(KEY, None)
+    run_with_backends(tmp_path, scenario, poll_interval=0.02, stale_after=0.2)
+
+
+def test_owner_cancels_task_when_lease_is_taken_over(tmp_path):
+    async def scenario(a, b):
+        task = asyncio.create_task(asyncio.sleep(60))
+        assert await a.acquire(KEY, task)
+        await asyncio.sleep(0.3)  # без сверки аренда не продлевается и устаревает
+        assert await b.acquire(KEY, None)
+        a.start()
+        await wait_for(task.done)
+        assert a.remote_cancels == 1
+    run_with_backends(tmp_path, scenario, poll_interval=0.02, stale_after=0.2)
+
+
+def test_pending_prompt_is_taken_once(tmp_path):
+    async def scenario(a, b):
+        assert not await b.take_pending_prompt(7)
+        await a.set_pending_prompt(7)
+        await a.set_pending_prompt(7)
+        assert await b.take_pending_prompt(7)
+        assert not await a.take_pending_prompt(7)
+        assert not await b.take_pending_prompt(8)
+    run_with_backends(tmp_path, scenario)
@@ -0,0 +1,171 @@
+"""
+_stream_xai_response против локальной SSE-заглушки chat/completions: обрыв соединения
+посреди ответа, 5xx и 429, тишина в потоке дольше stream_idle_timeout, размыкатель цепи.
+Отдельно — SSEDeltaParser на потоке, оборванном посреди CRLF.
+"""
+import asyncio
+import json
+import time
+
+import pytest
+from aiohttp import web
+
+import main
+
+ANSWER = (
+    "Нормальное артериальное давление у взрослого — ниже 120/80 мм рт. ст. "
+    "Показатели 130–139/85–89 считаются высоким нормальным давлением. "
+    "Давление от 140/90 при повторных измерениях — признак артериальной гипертензии."
+)
+PIECES = [ANSWER[i:i + 12] for i in range(0, len(ANSWER), 12)]
+
+
+def sse(text: str) -> bytes:
+    return b"data: " + json.dumps({"choices": [{"delta": {"content": text}}]}).encode() + b"\n\n"
+
+
+SSE_END = b'data: {"choices":[{"delta":{},"finish_reason":"stop"}]}\n\ndata: [DONE]\n\n'
+
+
+class StubXAI:
+    """Отвечает на запросы по сценарию: каждый запрос забирает следующий шаг из steps (последний повторяется)."""
+
+    def __init__(self, steps: list[str]):
+        self.steps = steps
+        self.requests: list[dict] = []
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests.append(payload)
+        step = self.steps[min(len(self.requests), len(self.steps)) - 1]
+        if step == "503":
+            return web.Response(status=503, text="upstream unavailable")
+        if step == "429":
+            return web.Response(status=429, text="rate limited", headers={"Retry-After": "0.3"})
+        messages = payload["messages"]
+        delivered = messages[-2]["content"] if messages[-1]["content"] == main.XAI_CONTINUE_PROMPT else ""
+        if step == "restart":
+            pieces = PIECES  # модель начала ответ заново
+        elif step == "overlap":
+            # модель повторила последние слова и продолжила
+            tail = ANSWER[max(0, len(delivered) - 20):]
+            pieces = [tail[i:i + 12] for i in range(0, len(tail), 12)]
+        else:
+            pieces = PIECES[:5]
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for piece in pieces:
+            await response.write(sse(piece))
+        if step == "drop":
+            await asyncio.sleep(0.05)
+            request.transport.close()  # соединение оборвалось посреди ответа
+            return response
+        if step == "stall":
+            await asyncio.sleep(0.6)  # тишина дольше stream_idle_timeout
+            return response
+        await response.write(SSE_END)
+        return response
+
+
+class RecordingClient(main.XAIClient):
+    """XAIClient, запоминающий номера попыток, перед которыми выдерживалась задержка."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backoffs: list[int] = []
+
+    def retry_delay(self, attempt: int) -> float:
+        self.backoffs.append(attempt)
+        return super().retry_delay(attempt)
+
+
+def run_stub(steps: list[str], scenario, **client_kwargs):
+    async def _run():
+        stub = StubXAI(steps)
+        await stub.start()
+        client_kwargs.setdefault("retry_base_delay", 0.01)
+        client_kwargs.setdefault("retry_max_delay", 1.0)
+        client_kwargs.setdefault("stream_idle_timeout", 0.2)
+        client = RecordingClient("test-key", base_url=stub.url, **client_kwargs)
+        try:
+            await scenario(stub, client)
+        finally:
+            await client.close()
+            await stub.stop()
+    asyncio.run(_run())
+
+
+async def collect(client: main.XAIClient) -> list[str]:
+    history = [{"role": "user", "content": "Какое давление считается нормальным?"}]
+    return [text async for text in main._stream_xai_response(client, "system", history, dialog_id=1)]
+
+
+def test_dropped_connection_resumes_without_duplicated_text():
+    async def scenario(stub, client):
+        chunks = await collect(client)
+        assert "".join(chunks) == ANSWER
+        assert len(stub.requests) == 2
+        continuation = stub.requests[1]["messages"]
+        assert continuation[-1]["content"] == main.XAI_CONTINUE_PROMPT
+        assert continuation[-2] == {"role": "assistant", "content": "".join(PIECES[:5])}
+        assert client.backoffs == [0]
+    run_stub(["drop", "restart"], scenario)
+
+
+def test_idle_stream_times_out_and_resumes_after_repeated_words():
+    async def scenario(stub, client):
+        chunks = await collect(client)
+        assert "".join(chunks) == ANSWER
+        assert len(stub.requests) == 2
+        assert client.breaker.state == "closed"
+    run_stub(["stall", "overlap"], scenario)
+
+
+def test_5xx_and_429_are_retried_with_backoff():
+    async def scenario(stub, client):
+        started = time.monotonic()
+        chunks = await collect(client)
+        assert "".join(chunks) == ANSWER
+        assert len(stub.requests) == 3
+        assert client.backoffs == [0, 1]
+        # Retry-After из ответа 429 выдерживается, даже если джиттер дал меньшую задержку
+        assert time.monotonic() - started >= 0.3
+        # Успешный ответ сбрасывает счётчик неудач размыкателя
+        assert client.breaker.failures == 0
+    run_stub(["503", "429", "restart"], scenario)
+
+
+def test_breaker_opens_after_failures_and_fails_fast():
+    async def scenario(stub, client):
+        with pytest.raises(main.XAIUnavailableError):
+            await collect(client)
+        assert len(stub.requests) == 2
+        assert client.breaker.state == "open"
+        # Пока цепь разомкнута, запрос не отправляется
+        started = time.monotonic()
+        with pytest.raises(main.XAIUnavailableError):
+            await collect(client)
+        assert time.monotonic() - started < 0.1
+        assert len(stub.requests) == 2
+    run_stub(["503"], scenario, retry_attempts=4, breaker=main.XAICircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+
+def test_parser_close_keeps_last_event_of_crlf_stream_cut_after_cr():
+    parser = main.SSEDeltaParser()
+    assert parser.feed(b'data: {"choices":[{"delta":{"content":"hi"}}]}\r\n\r') == []
+    assert parser.close() == ["hi"]
@@ -0,0 +1,157 @@
+"""
+Функции, которые бот выполняет в пулах процессов (ImagePreprocessor, DocumentExtractor).
+
+Модуль не импортирует бота: процессы пула получают функции отсюда по имени. Сам бот в них
+всё же загружен — multiprocessing выполняет запущенный скрипт в каждом новом процессе как
+__mp_main__. При forkserver модули main и workers заранее загружает сервер (см.
+worker_process_context), и процессы пула создаются из него без потоков бота, которые
+достались бы им при fork. При spawn загрузка повторяется в каждом процессе пула.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+
+from PIL import Image, ImageOps  # для конвертации любых форматов изображений
+from PyPDF2 import PdfReader  # текст PDF-документов
+import docx  # текст DOCX-документов (python-docx)
+
+# --- Подсчёт токенов ---
+
+CONTEXT_MESSAGE_OVERHEAD = 4   # служебные токены роли и разметки сообщения
+_TOKEN_PIECE = re.compile(r"[^\W\d_]+|\d+|\S")  # слово, число или отдельный знак
+
+def count_tokens(text: str) -> int:
+    """
+    Приближённое число токенов сообщения для BPE-токенизатора модели (без внешних зависимостей).
+    Латинское слово — около 4 символов на токен, кириллица — около 3, числа — по 3 цифры,
+    остальные знаки — по токену. Оценка с запасом: бюджет лучше недобрать, чем превысить.
+    """
+    tokens = CONTEXT_MESSAGE_OVERHEAD
+    for piece in _TOKEN_PIECE.findall(text):
+        if len(piece) == 1:
+            tokens += 1
+        elif piece.isascii() and not piece.isdigit():
+            tokens += (len(piece) + 3) // 4
+        else:
+            tokens += (len(piece) + 2) // 3
+    return tokens
+
+# --- Фото ---
+
+def prepare_image(data: bytes, max_side: int, quality: int) -> tuple[bytes, tuple[int, int]]:
+    """
+    Уменьшает изображение до max_side по большей стороне и перекодирует в JPEG без метаданных.
+
+    Выполняется в пуле процессов (ImagePreprocessor), поэтому должна оставаться функцией
+    уровня модуля. Ориентация из EXIF применяется к пикселям, сам EXIF (в том числе
+    геометка) и ICC-профиль в результат не попадают.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        scale = max_side / max(img.size)
+        if scale < 1:
+            # JPEG декодируется сразу в масштабе 1/2..1/8, не меньше целевого — в разы быстрее полного
+            img.draft("RGB", (int(img.width * scale) + 1, int(img.height * scale) + 1))
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=None)
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue(), img.size
+
+# --- Документы ---
+
+class DocumentError(Exception):
+    """Документ нельзя обработать; текст исключения показывается пользователю."""
+
+# Последний открытый PDF в процессе (потоке) пула: следующие пачки страниц того же файла
+# не разбирают его заново — повторное открытие большого PDF дороже извлечения пачки
+_pdf_reader_cache = threading.local()
+
+def _open_pdf(path: str) -> PdfReader:
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cached = getattr(_pdf_reader_cache, "entry", None)
+    if cached and cached[0] == key:
+        return cached[1]
+    reader = PdfReader(path)
+    if reader.is_encrypted and not reader.decrypt(""):
+        raise DocumentError("PDF защищён паролем.")
+    _pdf_reader_cache.entry = (key, reader)
+    return reader
+
+def count_pdf_pages(path: str) -> int:
+    return len(_open_pdf(path).pages)
+
+def extract_pdf_pages(path: str, start: int, end: int) -> list[str]:
+    """Текст страниц [start, end). Выполняется в процессе пула (DocumentExtractor)."""
+    reader = _open_pdf(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+def extract_docx_text(path: str) -> list[str]:
+    """Текст абзацев и таблиц DOCX одной «страницей» (в DOCX нет разбиения на страницы)."""
+    document = docx.Document(path)
+    lines = [paragraph.text for paragraph in document.paragraphs]
+    for table in document.tables:
+        for row in table.rows:
+            lines.append(" | ".join(cell.text.strip() for cell in row.cells))
+    return ["\n".join(lines)]
+
+def chunk_document(pages: list[str], max_tokens: int, label: str = "стр.") -> list[str]:
+    """
+    Делит текст на части не больше max_tokens (по count_tokens) по границам строк.
+
+    Перед текстом каждой страницы ставится метка «[стр. N]», чтобы пересказ мог ссылаться
+    на страницы. Строка длиннее max_tokens режется по пробелам.
+    """
+    chunks: list[str] = []
+    lines: list[str] = []
+    used = 0
+
+    def _add(line: str, tokens: int):
+        nonlocal used
+        if used + tokens > max_tokens and lines:
+            chunks.append("\n".join(lines))
+            lines.clear()
+            used = 0
+        lines.append(line)
+        used += tokens
+
+    for number, text in enumerate(pages, 1):
+        if not text.strip():
+            continue
+        if len(pages) > 1:
+            _add(f"[{label} {number}]", 4)
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            tokens = count_tokens(line) - CONTEXT_MESSAGE_OVERHEAD
+            while tokens > max_tokens:
+                # Длинная строка без переносов (так бывает в PDF): режем по пробелу около границы
+                cut = max(1, int(len(line) * max_tokens / tokens))
+                space = line.rfind(" ", 0, cut)
+                if space > 0:
+                    cut = space
+                _add(line[:cut], max_tokens)
+                line = line[cut:].lstrip()
+                tokens = count_tokens(line) - CONTEXT_MESSAGE_OVERHEAD
+            if line:
+                _add(line, tokens)
+    if lines:
+        chunks.append("\n".join(lines))
+    return chunks